@@ -0,0 +1,327 @@
+import os
+import time
+from multiprocessing import Pool, cpu_count
+
+from calibration import get_registry
+from workspace import get_default_workspace
+from speciation import prepare_speciation_in_moles_per_total_mass
+from instrumentation import (
+	metrics,
+	timed
+	)
+from manifest import (
+	get_file_record,
+	hash_json_data,
+	load_manifest,
+	save_manifest
+	)
+
+# calibration factors shared with each worker process once, by the pool initializer
+_worker_state = None
+
+def discover_condition_samples(gc_measurement_path=None, workspace=None):
+	"""
+	This method scans `data/measurement/*/gc_speciation` (or the measurement
+	folder of `workspace`) and outputs
+	a dictionary named `condition_samples_dict` with
+	key: `condition` and value: sorted list of `samples`.
+
+	Only samples having both a GC speciation file and a GC inner
+	standard file are collected, since speciation needs both.
+	"""
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
+	condition_samples_dict = {}
+	for condition in sorted(os.listdir(gc_measurement_path)):
+		gc_speciation_path = os.path.join(gc_measurement_path, condition, 'gc_speciation')
+		gc_inner_standard_path = os.path.join(gc_measurement_path, condition, 'gc_inner_standard')
+		if not os.path.isdir(gc_speciation_path):
+			continue
+
+		samples = []
+		for f in os.listdir(gc_speciation_path):
+			if not f.endswith('.txt'):
+				continue
+			sample = f.split('.txt')[0]
+			if os.path.isfile(os.path.join(gc_inner_standard_path, sample+'.csv')):
+				samples.append(sample)
+
+		if samples:
+			condition_samples_dict[condition] = sorted(samples)
+
+	return condition_samples_dict
+
+def get_calibration_key(calibration_factor_function_dict, registry=None, calibration_history=None,
+						response_lookup_tables=None, peak_shape=None, spectral_library=None, workspace=None):
+	"""
+	This method hashes everything a speciation result depends on besides
+	its own GC files: the calibration factors (and calibration history,
+	response lookup tables, deconvolution peak shape or spectral library,
+	if any) and the species constants.
+	"""
+
+	if registry is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		registry = workspace.registry
+
+	calibration_species_constants_file = os.path.join(registry.calibration_path,
+											'calibration_species_constants.csv')
+
+	calibration_data = [calibration_factor_function_dict,
+						get_file_record(calibration_species_constants_file)['sha1']]
+	if calibration_history is not None:
+		calibration_data.append(calibration_history.histories)
+	if response_lookup_tables is not None:
+		calibration_data.append(dict((species, response_lookup_table.to_dict())
+								for species, response_lookup_table in response_lookup_tables.items()))
+	if peak_shape is not None:
+		calibration_data.append(peak_shape.to_dict())
+	if spectral_library is not None:
+		calibration_data.append(spectral_library.get_signature())
+
+	return hash_json_data(calibration_data)
+
+def select_outdated_samples(condition_samples_dict, calibration_key, gc_measurement_path=None, workspace=None):
+	"""
+	This method compares every sample's GC speciation file, GC inner standard
+	file and `calibration_key` with the condition's `speciation_manifest.json`
+	and outputs a tuple `(outdated_condition_samples_dict, manifest_dict)` where
+	`manifest_dict` has key: `condition` and value: the manifest updated with
+	the current input records of the outdated samples.
+	"""
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
+	from result_store import load_condition_results
+
+	outdated_condition_samples_dict = {}
+	manifest_dict = {}
+	for condition, samples in condition_samples_dict.items():
+		manifest = load_manifest(os.path.join(gc_measurement_path, condition, 'speciation_manifest.json'))
+		columns = load_condition_results(condition, gc_measurement_path)
+		stored_samples = set(columns[0]) if columns is not None else set()
+
+		outdated_samples = []
+		for sample in samples:
+			previous_record = manifest.get(sample, {})
+			record = {'calibration': calibration_key}
+			record['gc_speciation'] = get_file_record(
+										os.path.join(gc_measurement_path, condition,
+													'gc_speciation', sample+'.txt'),
+										previous_record.get('gc_speciation'))
+			record['gc_inner_standard'] = get_file_record(
+										os.path.join(gc_measurement_path, condition,
+													'gc_inner_standard', sample+'.csv'),
+										previous_record.get('gc_inner_standard'))
+
+			if not previous_record \
+				or previous_record['calibration'] != record['calibration'] \
+				or previous_record['gc_speciation']['sha1'] != record['gc_speciation']['sha1'] \
+				or previous_record['gc_inner_standard']['sha1'] != record['gc_inner_standard']['sha1'] \
+				or sample not in stored_samples:
+				outdated_samples.append(sample)
+			manifest[sample] = record
+
+		if outdated_samples:
+			outdated_condition_samples_dict[condition] = outdated_samples
+		manifest_dict[condition] = manifest
+
+	return outdated_condition_samples_dict, manifest_dict
+
+def _get_worker_state(calibration_factor_function_dict, gc_measurement_path, export_json, calibration_path,
+					collect_metrics=False, calibration_history=None, response_lookup_tables=None,
+					peak_shape=None, spectral_library=None):
+
+	return {'calibration_factor_function_dict': calibration_factor_function_dict,
+			'gc_measurement_path': gc_measurement_path,
+			'export_json': export_json,
+			'registry': get_registry(calibration_path),
+			'collect_metrics': collect_metrics,
+			'calibration_history': calibration_history,
+			'response_lookup_tables': response_lookup_tables,
+			'peak_shape': peak_shape,
+			'spectral_library': spectral_library}
+
+def _init_worker(*args):
+
+	global _worker_state
+	_worker_state = _get_worker_state(*args)
+	if _worker_state['collect_metrics']:
+		metrics.enable()
+
+def _speciate_sample(condition_sample, worker_state=None):
+	"""
+	This method speciates one sample with `worker_state`, by default the
+	one set by the pool initializer. Runs in the current process pass their
+	own, so that several of them may run side by side in threads.
+	"""
+
+	if worker_state is None:
+		worker_state = _worker_state
+
+	condition, sample = condition_sample
+	speciation_dict_in_moles_per_total_mass = prepare_speciation_in_moles_per_total_mass(
+												condition,
+												sample,
+												worker_state['calibration_factor_function_dict'],
+												worker_state['gc_measurement_path'],
+												worker_state['registry'],
+												save_results=False,
+												export_json=worker_state['export_json'],
+												calibration_history=worker_state['calibration_history'],
+												response_lookup_tables=worker_state['response_lookup_tables'],
+												peak_shape=worker_state['peak_shape'],
+												spectral_library=worker_state['spectral_library']
+												)
+
+	# worker processes send their metrics back with every sample
+	metrics_report = None
+	if worker_state['collect_metrics']:
+		metrics_report = metrics.get_report()
+		metrics.reset()
+
+	return condition, sample, speciation_dict_in_moles_per_total_mass, metrics_report
+
+@timed('batch_speciation')
+def run_batch_speciation(
+					condition_samples_dict=None,
+					calibration_factor_function_dict=None,
+					gc_measurement_path=None,
+					processes=None,
+					chunksize=None,
+					incremental=False,
+					export_json=False,
+					registry=None,
+					calibration_history=None,
+					response_lookup_tables=None,
+					workspace=None,
+					peak_shape=None,
+					spectral_library=None
+					):
+	"""
+	This method runs `prepare_speciation_in_moles_per_total_mass` for every
+	condition and sample over a process pool, and outputs a tuple
+	`(batch_speciation_dict, samples_per_second)` where `batch_speciation_dict`
+	has key: `condition` and value: {`sample`: speciation in moles/g}.
+
+	Calibration factors are loaded once here from `registry` (default: the
+	calibration folder of `workspace`, itself `data` by default) and handed to each worker by the pool initializer
+	instead of being reloaded per sample.
+	With `processes=1` everything runs in the current process.
+	With a `calibration_history`, each sample uses the calibration factors
+	valid on its acquisition date, and species in `response_lookup_tables`
+	are converted by their nonlinear detector response. With a `peak_shape`
+	(see `peak_deconvolution`), co-eluting peaks are deconvolved first, and
+	with a `spectral_library` uncalibrated peaks are named by their spectra.
+
+	Results are written per condition in one go into the result store
+	`speciation_results.npz`; with `export_json=True` workers also write
+	`speciation_results/<sample>.json`.
+
+	With `incremental=True` only samples whose inputs or calibration changed
+	since the last run are speciated (see `select_outdated_samples`), and
+	only those are in `batch_speciation_dict`.
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	if condition_samples_dict is None:
+		condition_samples_dict = discover_condition_samples(gc_measurement_path)
+
+	if registry is None:
+		registry = workspace.registry
+
+	if calibration_factor_function_dict is None and calibration_history is None:
+		calibration_factor_function_dict = registry.get_fitted_calibration_factor_functions()
+
+	if incremental:
+		calibration_key = get_calibration_key(calibration_factor_function_dict, registry, calibration_history,
+											response_lookup_tables, peak_shape, spectral_library)
+		condition_samples_dict, manifest_dict = select_outdated_samples(condition_samples_dict,
+																		calibration_key,
+																		gc_measurement_path)
+
+	condition_samples = []
+	for condition in sorted(condition_samples_dict):
+		# create result folders up front so workers don't race on them
+		save_results_path = os.path.join(gc_measurement_path, condition, 'speciation_results')
+		if export_json and not os.path.exists(save_results_path):
+			os.mkdir(save_results_path)
+
+		for sample in condition_samples_dict[condition]:
+			condition_samples.append((condition, sample))
+
+	batch_speciation_dict = {}
+	for condition in condition_samples_dict:
+		batch_speciation_dict[condition] = {}
+
+	start_time = time.time()
+	if processes == 1 or not condition_samples:
+		worker_state = _get_worker_state(calibration_factor_function_dict, gc_measurement_path, export_json,
+										registry.calibration_path, calibration_history=calibration_history,
+										response_lookup_tables=response_lookup_tables, peak_shape=peak_shape,
+										spectral_library=spectral_library)
+		results = [_speciate_sample(condition_sample, worker_state) for condition_sample in condition_samples]
+	else:
+		if processes is None:
+			processes = cpu_count()
+		if chunksize is None:
+			chunksize = max(1, len(condition_samples)//(4*processes))
+
+		pool = Pool(processes,
+					initializer=_init_worker,
+					initargs=(calibration_factor_function_dict, gc_measurement_path, export_json,
+								registry.calibration_path, metrics.enabled, calibration_history,
+								response_lookup_tables, peak_shape, spectral_library)
+					)
+		try:
+			results = list(pool.imap_unordered(_speciate_sample, condition_samples, chunksize))
+		finally:
+			pool.close()
+			pool.join()
+
+	for condition, sample, speciation_dict_in_moles_per_total_mass, metrics_report in results:
+		batch_speciation_dict[condition][sample] = speciation_dict_in_moles_per_total_mass
+		if metrics_report is not None:
+			metrics.merge(metrics_report)
+
+	# NumPy is only needed for writing the result store
+	from result_store import save_condition_results
+	for condition, speciation_dict_by_sample in batch_speciation_dict.items():
+		save_condition_results(condition, speciation_dict_by_sample, gc_measurement_path, workspace=workspace)
+	elapsed_time = time.time() - start_time
+
+	if incremental:
+		for condition, manifest in manifest_dict.items():
+			save_manifest(manifest, os.path.join(gc_measurement_path, condition,
+												'speciation_manifest.json'))
+
+	if elapsed_time > 0:
+		samples_per_second = len(condition_samples)/elapsed_time
+	else:
+		samples_per_second = float('inf')
+
+	return batch_speciation_dict, samples_per_second
+
+if __name__ == '__main__':
+
+	batch_speciation_dict, samples_per_second = run_batch_speciation()
+
+	sample_count = sum(len(samples) for samples in batch_speciation_dict.values())
+	print('speciated {0} samples in {1} conditions: {2:.1f} samples/s'.format(
+										sample_count,
+										len(batch_speciation_dict),
+										samples_per_second
+										))
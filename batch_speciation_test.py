@@ -0,0 +1,114 @@
+import unittest
+import os
+import shutil
+import tempfile
+from batch_speciation import (
+	discover_condition_samples,
+	run_batch_speciation
+	)
+from speciation import (
+	read_gc_speciation_file,
+	read_gc_inner_standard_file,
+	calculate_speciation_in_moles_per_total_mass
+	)
+from calibration import (
+	load_fitted_calibration_factor_functions,
+	)
+from result_store import (
+	load_condition_speciation_dicts,
+	save_condition_results
+	)
+
+class test_batch_speciation(unittest.TestCase):
+
+	def setUp(self):
+
+		# copy test_condition into a scratch measurement folder with a few samples
+		self.gc_measurement_path = tempfile.mkdtemp()
+		test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+		for condition in ['condition_a', 'condition_b']:
+			for folder, extension in [('gc_speciation', '.txt'), ('gc_inner_standard', '.csv')]:
+				os.makedirs(os.path.join(self.gc_measurement_path, condition, folder))
+				for sample in ['sample0', 'sample1', 'sample2']:
+					shutil.copy(os.path.join(test_condition_path, folder, 'sample0'+extension),
+								os.path.join(self.gc_measurement_path, condition, folder, sample+extension))
+
+		# a speciation file without inner standard file is not a sample
+		shutil.copy(os.path.join(test_condition_path, 'gc_speciation', 'sample0.txt'),
+					os.path.join(self.gc_measurement_path, 'condition_b', 'gc_speciation', 'orphan.txt'))
+
+	def tearDown(self):
+
+		shutil.rmtree(self.gc_measurement_path)
+
+	def test_discover_condition_samples(self):
+
+		condition_samples_dict = discover_condition_samples(self.gc_measurement_path)
+
+		self.assertEqual(sorted(condition_samples_dict), ['condition_a', 'condition_b'])
+		self.assertEqual(condition_samples_dict['condition_b'], ['sample0', 'sample1', 'sample2'])
+
+	def test_run_batch_speciation(self):
+
+		calibration_factor_function_dict = load_fitted_calibration_factor_functions()
+
+		gc_speciation_data_dict = read_gc_speciation_file(os.path.join(
+									'data', 'measurement', 'test_condition',
+									'gc_speciation', 'sample0.txt'))
+		gc_inner_standard_data_dict = read_gc_inner_standard_file(os.path.join(
+									'data', 'measurement', 'test_condition',
+									'gc_inner_standard', 'sample0.csv'))
+		expected_speciation_dict = calculate_speciation_in_moles_per_total_mass(
+													gc_speciation_data_dict,
+													gc_inner_standard_data_dict,
+													calibration_factor_function_dict
+													)
+
+		for processes in [1, 2]:
+			batch_speciation_dict, samples_per_second = run_batch_speciation(
+												gc_measurement_path=self.gc_measurement_path,
+												processes=processes
+												)
+
+			self.assertEqual(len(batch_speciation_dict), 2)
+			self.assertEqual(len(batch_speciation_dict['condition_a']), 3)
+			self.assertEqual(batch_speciation_dict['condition_b']['sample2'], expected_speciation_dict)
+			self.assertGreater(samples_per_second, 0)
+			self.assertEqual(load_condition_speciation_dicts('condition_a', self.gc_measurement_path)['sample1'],
+							expected_speciation_dict)
+
+		run_batch_speciation(gc_measurement_path=self.gc_measurement_path, processes=2, export_json=True)
+		self.assertTrue(os.path.isfile(os.path.join(self.gc_measurement_path,
+								'condition_a', 'speciation_results', 'sample1.json')))
+
+	def test_run_batch_speciation_incremental(self):
+
+		batch_speciation_dict, _ = run_batch_speciation(gc_measurement_path=self.gc_measurement_path,
+													processes=1, incremental=True)
+		self.assertEqual(sum(len(samples) for samples in batch_speciation_dict.values()), 6)
+
+		batch_speciation_dict, _ = run_batch_speciation(gc_measurement_path=self.gc_measurement_path,
+													processes=1, incremental=True)
+		self.assertEqual(sum(len(samples) for samples in batch_speciation_dict.values()), 0)
+
+		# a changed inner standard file and a removed result are rebuilt
+		with open(os.path.join(self.gc_measurement_path, 'condition_a',
+								'gc_inner_standard', 'sample1.csv'), 'w') as write_out:
+			write_out.write('total_liquid_mass(g), inner_standard, inner_standard_mass(g)\n0.2, chlorothiophene, 0.03')
+		speciation_dict_by_sample = load_condition_speciation_dicts('condition_b', self.gc_measurement_path)
+		del speciation_dict_by_sample['sample2']
+		save_condition_results('condition_b', speciation_dict_by_sample, self.gc_measurement_path, merge=False)
+
+		batch_speciation_dict, _ = run_batch_speciation(gc_measurement_path=self.gc_measurement_path,
+													processes=1, incremental=True)
+		self.assertEqual(list(batch_speciation_dict['condition_a']), ['sample1'])
+		self.assertEqual(list(batch_speciation_dict['condition_b']), ['sample2'])
+
+		# new calibration factors invalidate every sample
+		calibration_factor_function_dict = dict(load_fitted_calibration_factor_functions())
+		calibration_factor_function_dict['PDD'] = [3e14]
+		batch_speciation_dict, _ = run_batch_speciation(
+												calibration_factor_function_dict=calibration_factor_function_dict,
+												gc_measurement_path=self.gc_measurement_path,
+												processes=1, incremental=True)
+		self.assertEqual(sum(len(samples) for samples in batch_speciation_dict.values()), 6)
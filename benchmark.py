@@ -0,0 +1,219 @@
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+
+from calibration import (
+	get_registry,
+	list_calibration_species,
+	prepare_calibration_factor_functions,
+	read_calibration_file
+	)
+from speciation import (
+	read_gc_inner_standard_file,
+	read_gc_speciation_file
+	)
+from batch_speciation import (
+	discover_condition_samples,
+	run_batch_speciation
+	)
+from exptl_data_integration import save_exptl_data_to_chemkin_simulation_format
+from synthetic_campaign import generate_campaign
+
+STAGES = ['parse', 'calibration_fit', 'speciation', 'integration']
+
+def time_stage(stage_function, repeat=1):
+	"""
+	This method runs `stage_function` `repeat` times and outputs the best
+	wall time in seconds and the item count it returned.
+	"""
+
+	best_seconds = None
+	for _ in range(repeat):
+		start_time = time.perf_counter()
+		item_count = stage_function()
+		seconds = time.perf_counter() - start_time
+		if best_seconds is None or seconds < best_seconds:
+			best_seconds = seconds
+
+	return best_seconds, item_count
+
+def parse_campaign(data_path):
+	"""
+	This method parses every calibration file, GC speciation report and GC
+	inner standard file of a campaign and outputs the number of files read.
+	"""
+
+	calibration_path = os.path.join(data_path, 'calibration')
+	gc_measurement_path = os.path.join(data_path, 'measurement')
+
+	file_count = 0
+	for species in list_calibration_species(calibration_path):
+		read_calibration_file(os.path.join(calibration_path, species+'.txt'))
+		file_count += 1
+
+	for condition, samples in discover_condition_samples(gc_measurement_path).items():
+		for sample in samples:
+			read_gc_speciation_file(os.path.join(gc_measurement_path, condition,
+												'gc_speciation', sample+'.txt'))
+			read_gc_inner_standard_file(os.path.join(gc_measurement_path, condition,
+												'gc_inner_standard', sample+'.csv'))
+			file_count += 2
+
+	return file_count
+
+def run_benchmarks(data_path, processes=None, repeat=1):
+	"""
+	This method times the pipeline stage by stage on the campaign in
+	`data_path`: parsing, calibration fitting, batch speciation and
+	`save_exptl_data_to_chemkin_simulation_format` for every condition
+	after `before_pyrolysis`.
+
+	output: dictionary with key: `stage` and value: dictionary of
+	`seconds`, `items` and `items_per_second`
+	"""
+
+	calibration_path = os.path.join(data_path, 'calibration')
+	gc_measurement_path = os.path.join(data_path, 'measurement')
+	registry = get_registry(calibration_path)
+	condition_samples_dict = discover_condition_samples(gc_measurement_path)
+	conditions_after = [condition for condition in condition_samples_dict
+						if condition != 'before_pyrolysis']
+
+	def fit():
+		prepare_calibration_factor_functions(calibration_path=calibration_path, registry=registry)
+		return len(list_calibration_species(calibration_path))
+
+	def speciate():
+		batch_speciation_dict, _ = run_batch_speciation(condition_samples_dict,
+											gc_measurement_path=gc_measurement_path,
+											processes=processes,
+											registry=registry)
+		return sum(len(samples) for samples in batch_speciation_dict.values())
+
+	def integrate():
+		for condition_after in conditions_after:
+			save_exptl_data_to_chemkin_simulation_format('before_pyrolysis', condition_after,
+														registry, gc_measurement_path)
+		return len(conditions_after)
+
+	stage_functions = {'parse': lambda: parse_campaign(data_path),
+						'calibration_fit': fit,
+						'speciation': speciate,
+						'integration': integrate}
+
+	stage_results = {}
+	for stage in STAGES:
+		seconds, item_count = time_stage(stage_functions[stage], repeat)
+		stage_results[stage] = {'seconds': seconds,
+								'items': item_count,
+								'items_per_second': item_count/seconds if seconds > 0 else None}
+
+	return stage_results
+
+def load_benchmark_results(benchmark_results_file):
+
+	if not os.path.exists(benchmark_results_file):
+		return []
+
+	with open(benchmark_results_file, 'r') as read_in:
+		return json.load(read_in)
+
+def save_benchmark_results(run, benchmark_results_file):
+	"""
+	This method appends one benchmark run to `benchmark_results_file`,
+	a json list of runs, oldest first.
+	"""
+
+	runs = load_benchmark_results(benchmark_results_file)
+	runs.append(run)
+	with open(benchmark_results_file, 'w') as write_out:
+		json.dump(runs, write_out, indent=2)
+
+	return runs
+
+def compare_benchmark_results(baseline_run, current_run, tolerance=0.2):
+	"""
+	This method compares the stage timings of two benchmark runs and outputs
+	the regressions, stages at least `tolerance` (fraction) slower in
+	`current_run`, as a list of `(stage, baseline seconds, current seconds)`.
+	Runs of campaigns of different scale should not be compared.
+	"""
+
+	regressions = []
+	for stage in STAGES:
+		if stage not in baseline_run['stages'] or stage not in current_run['stages']:
+			continue
+		baseline_seconds = baseline_run['stages'][stage]['seconds']
+		current_seconds = current_run['stages'][stage]['seconds']
+		if current_seconds > baseline_seconds*(1 + tolerance):
+			regressions.append((stage, baseline_seconds, current_seconds))
+
+	return regressions
+
+def benchmark_campaign(
+				condition_count=3,
+				samples_per_condition=10,
+				species_count=20,
+				seed=0,
+				processes=None,
+				repeat=1,
+				data_path=None
+				):
+	"""
+	This method generates a synthetic campaign (in a temporary folder unless
+	`data_path` is given), benchmarks it and outputs the run, a dictionary
+	with the campaign scale, the time of the run and the stage results.
+	"""
+
+	remove_data_path = data_path is None
+	if data_path is None:
+		data_path = tempfile.mkdtemp(prefix='smartgc_benchmark_')
+
+	try:
+		generate_campaign(data_path, condition_count, samples_per_condition, species_count, seed)
+		stage_results = run_benchmarks(data_path, processes, repeat)
+	finally:
+		if remove_data_path:
+			shutil.rmtree(data_path)
+
+	return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'campaign': {'condition_count': condition_count,
+						'samples_per_condition': samples_per_condition,
+						'species_count': species_count,
+						'seed': seed,
+						'processes': processes},
+			'stages': stage_results}
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmark the smartGC pipeline on a synthetic campaign.')
+	parser.add_argument('--conditions', type=int, default=3)
+	parser.add_argument('--samples', type=int, default=100, help='samples per condition')
+	parser.add_argument('--species', type=int, default=50)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--processes', type=int, default=None)
+	parser.add_argument('--repeat', type=int, default=1)
+	parser.add_argument('--results-file', default='benchmark_results.json')
+	parser.add_argument('--tolerance', type=float, default=0.2)
+	args = parser.parse_args()
+
+	runs = load_benchmark_results(args.results_file)
+	run = benchmark_campaign(args.conditions, args.samples, args.species, args.seed,
+							args.processes, args.repeat)
+
+	for stage in STAGES:
+		print('{0:16s} {1:10.3f} s {2:12.1f} items/s'.format(stage,
+											run['stages'][stage]['seconds'],
+											run['stages'][stage]['items_per_second'] or 0))
+
+	# compare against the last run of the same campaign
+	baseline_runs = [previous_run for previous_run in runs if previous_run['campaign'] == run['campaign']]
+	if baseline_runs:
+		for stage, baseline_seconds, current_seconds in compare_benchmark_results(
+											baseline_runs[-1], run, args.tolerance):
+			print('REGRESSION {0}: {1:.3f} s -> {2:.3f} s'.format(stage, baseline_seconds, current_seconds))
+
+	save_benchmark_results(run, args.results_file)
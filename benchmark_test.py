@@ -0,0 +1,51 @@
+import unittest
+import os
+import shutil
+import tempfile
+from benchmark import (
+	STAGES,
+	benchmark_campaign,
+	compare_benchmark_results,
+	load_benchmark_results,
+	save_benchmark_results
+	)
+
+class test_benchmark(unittest.TestCase):
+
+	def test_benchmark_campaign(self):
+
+		run = benchmark_campaign(condition_count=2, samples_per_condition=3, species_count=5, processes=1)
+
+		self.assertEqual(sorted(run['stages']), sorted(STAGES))
+		self.assertEqual(run['stages']['parse']['items'], 5 + 2*2*3)
+		self.assertEqual(run['stages']['calibration_fit']['items'], 5)
+		self.assertEqual(run['stages']['speciation']['items'], 6)
+		self.assertEqual(run['stages']['integration']['items'], 1)
+
+	def test_benchmark_campaign_in_data_path(self):
+
+		data_path = tempfile.mkdtemp()
+		try:
+			benchmark_campaign(2, 2, 4, processes=1, data_path=data_path)
+			exptl_data_path = os.path.join(data_path, 'measurement', 'pyrolysis_350C', 'exptl_data_for_simulation')
+			self.assertEqual(sorted(os.listdir(exptl_data_path)), ['sample0_350C.json', 'sample1_350C.json'])
+		finally:
+			shutil.rmtree(data_path)
+
+	def test_save_and_compare_benchmark_results(self):
+
+		baseline_run = {'stages': {'parse': {'seconds': 1.0}, 'speciation': {'seconds': 2.0}}}
+		current_run = {'stages': {'parse': {'seconds': 1.1}, 'speciation': {'seconds': 3.0}}}
+
+		self.assertEqual(compare_benchmark_results(baseline_run, current_run, tolerance=0.2),
+						[('speciation', 2.0, 3.0)])
+		self.assertEqual(compare_benchmark_results(baseline_run, current_run, tolerance=0.6), [])
+
+		results_path = tempfile.mkdtemp()
+		try:
+			benchmark_results_file = os.path.join(results_path, 'benchmark_results.json')
+			save_benchmark_results(baseline_run, benchmark_results_file)
+			save_benchmark_results(current_run, benchmark_results_file)
+			self.assertEqual(load_benchmark_results(benchmark_results_file), [baseline_run, current_run])
+		finally:
+			shutil.rmtree(results_path)
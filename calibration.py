@@ -1,74 +1,100 @@
 import os
-import statsmodels.api as sm
 import json
-
+import hashlib
+import threading
+from report_parser import (
+	is_peak_table,
+	iter_report_rows
+	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
+
+@timed('parse')
 def read_calibration_file(calibration_file):
+	"""
+	This method reads the injection volumes (uL) and peak areas of a
+	calibration report, given as a file or as a `PeakTable` of it.
+	"""
+
+	if is_peak_table(calibration_file):
+		return ([float(injection_volume) for injection_volume in calibration_file.peaks],
+				calibration_file.areas.tolist())
 
 	injection_volumes = []
 	peak_areas = []
-	with open(calibration_file, 'r') as read_in:
-		start_read = False
-		
-		for line in read_in:
-			if start_read and line.strip() != '':
-				fields = line.split('\t')
-				injection_volume = float(fields[0].strip())
-				peak_area = float(fields[4].strip())
-				injection_volumes.append(injection_volume)
-				peak_areas.append(peak_area)
-
-			if line.startswith('volume'):
-				start_read = True
+	for fields in iter_report_rows(calibration_file, 'volume'):
+		injection_volume = float(fields[0])
+		peak_area = float(fields[4])
+		injection_volumes.append(injection_volume)
+		peak_areas.append(peak_area)
 
 	return injection_volumes, peak_areas
 
-def read_calibration_species_constants():
+@timed('parse')
+def read_calibration_species_constants(calibration_species_constants_file=None, workspace=None):
 
-	calibration_species_constants_file = os.path.join(
-												'data', 
-												'calibration', 
-												'calibration_species_constants.csv'
-												)
+	if calibration_species_constants_file is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		calibration_species_constants_file = workspace.get_calibration_file('calibration_species_constants.csv')
 
 	calibration_species_constants_dict = {}
-	with open(calibration_species_constants_file, 'r') as read_in:
-		start_read = False
-		
-		for line in read_in:
-			if start_read and line.strip() != '':
-				fields = line.split(',')
-				species = fields[0].strip()
-				density = float(fields[1].strip())
-				MW = float(fields[2].strip())
-
-				calibration_species_constants_dict[species] = {}
-				calibration_species_constants_dict[species]['density'] = density
-				calibration_species_constants_dict[species]['MW'] = MW
-
-			if line.startswith('species'):
-				start_read = True
+	for fields in iter_report_rows(calibration_species_constants_file, 'species', ','):
+		species = fields[0]
+		density = float(fields[1])
+		MW = float(fields[2])
+
+		calibration_species_constants_dict[species] = {}
+		calibration_species_constants_dict[species]['density'] = density
+		calibration_species_constants_dict[species]['MW'] = MW
 
 	return calibration_species_constants_dict
 
-def read_calibration_data(calibration_species_list=None, calibration_path=None):
+def list_calibration_species(calibration_path):
+
+	calibration_species_list = []
+
+	for f in os.listdir(calibration_path):
+		if os.path.isfile(os.path.join(calibration_path, f)) and f.endswith('.txt'):
+			calibration_species_list.append(f.split('.txt')[0])
+
+	return calibration_species_list
+
+def get_calibration_line(params):
+	"""
+	This method outputs the tuple `(slope, intercept)` of the fitted params
+	of a species, [a] or [b, a] for `peak_area = a*injection_moles + b`.
+	"""
+
+	if len(params) == 2:
+		return params[1], params[0]
+
+	return params[0], 0.0
+
+@timed('calibration_read')
+def read_calibration_data(calibration_species_list=None, calibration_path=None, registry=None, workspace=None):
 	"""
 	This method reads GC calibration files and output 
 	a dictionary named `calibration_data_dict` with 
 	key: `species` and value: tuple `(injection_moles, peak_areas)`
 	"""
 
+	if workspace is None:
+		workspace = get_default_workspace()
+
 	if calibration_path is None:
-		calibration_path = os.path.join('data', 'calibration')
+		calibration_path = workspace.calibration_path
 
 	if calibration_species_list is None:
-		calibration_species_list = []
-
-		for f in os.listdir(calibration_path):
-			if os.path.isfile(os.path.join(calibration_path, f)) and f.endswith('.txt'):
-				calibration_species_list.append(f.split('.txt')[0])
+		calibration_species_list = list_calibration_species(calibration_path)
 
 	# load calibration species constants such as density, MW
-	calibration_species_constants_dict = read_calibration_species_constants()
+	if registry is None:
+		registry = workspace.registry
+	calibration_species_constants_dict = registry.get_calibration_species_constants()
 
 	calibration_data_dict = {}
 	for species in calibration_species_list:
@@ -85,70 +111,331 @@ def read_calibration_data(calibration_species_list=None, calibration_path=None):
 
 	return calibration_data_dict
 
-def get_calibration_factor_function_dict_by_linear_regression(calibration_data_dict, zero_intercept=True):
+@timed('calibration_fit')
+def get_calibration_factor_function_dict_by_linear_regression(
+											calibration_data_dict,
+											zero_intercept=True,
+											weighting=None,
+											point_range=None
+											):
 	"""
 	This method fits the calibration experimental data into the form 
 	`peak_area = a*injection_moles` or `peak_area = a*injection_moles + b`
 	with the choice of `zero_intercept`, which is True by default.
 	
-	Here I chose to only use the first 3 data points is due to the fact that
-	these 3 points covers the concentration range of species in experiment. But 
-	user can play with it with his own situation.
-
+	All points are used by default, but since only the low-concentration
+	points cover the concentration range of species in experiment, user can
+	pick e.g. the first 3 of them with `point_range=(0, 3)` and play with it
+	in his own situation, or let `get_calibration_factor_function_dict_by_cross_validation`
+	choose. `weighting` can be None, '1/x' or '1/x^2'.
+
+	All species are fitted together by `fit_calibration_factors`; the
+	input lists are not modified.
 	"""
 
-	calibration_factor_function_dict = {}
-	for species in calibration_data_dict:
-		injection_moles, peak_areas = calibration_data_dict[species]
-		injection_moles.insert(0, 0.0)
-		peak_areas.insert(0, 0.0)
+	# NumPy is only needed for fitting, keep it out of speciation imports
+	from calibration_fitting import fit_calibration_factors
 
-		y_to_fit = peak_areas[:]
-		x_to_fit = injection_moles[:]
+	calibration_fit = fit_calibration_factors(calibration_data_dict,
+											zero_intercept=zero_intercept,
+											weighting=weighting,
+											point_range=point_range)
 
-		if not zero_intercept:
-			x_to_fit = sm.add_constant(x_to_fit)
-		
-		model = sm.OLS(y_to_fit, x_to_fit)
-		calibration_factor_function_dict[species] = list(model.fit().params)
+	calibration_factor_function_dict = {}
+	for species, params in zip(calibration_fit.species_list, calibration_fit.params):
+		calibration_factor_function_dict[species] = [float(param) for param in params]
+	if metrics.enabled:
+		metrics.increment('species_calibrated', len(calibration_factor_function_dict))
 
 	return calibration_factor_function_dict
 
+@timed('calibration_fit')
+def get_calibration_factor_function_dict_by_cross_validation(
+											calibration_data_dict,
+											folds=None,
+											evaluation_range=None
+											):
+	"""
+	This method chooses the intercept, weighting and point range of each
+	species' linear fit by cross-validation instead of leaving the choice
+	to the user, see `calibration_selection.select_calibration_models`:
+	leave-one-out by default, or k-fold with `folds=k`.
+
+	output: tuple `(calibration_factor_function_dict, selected_model_dict)`,
+	where the latter describes the chosen model of each species.
+	"""
+
+	from calibration_selection import (
+		get_selected_model_dict,
+		select_calibration_models
+		)
+
+	calibration_model_selection = select_calibration_models(calibration_data_dict,
+															folds=folds,
+															evaluation_range=evaluation_range)
+
+	calibration_factor_function_dict = dict(zip(calibration_model_selection.species_list,
+												calibration_model_selection.params))
+	if metrics.enabled:
+		metrics.increment('species_calibrated', len(calibration_factor_function_dict))
+
+	return calibration_factor_function_dict, get_selected_model_dict(calibration_model_selection)
+
+@timed('calibration')
+def prepare_calibration_factor_functions(
+									calibration_species_list=None,
+									calibration_path=None,
+									incremental=False,
+									registry=None,
+									workspace=None,
+									select_model=False,
+									folds=None
+									):
+	"""
+	This method fits and saves calibration factor functions. Species 
+	constants are read from, and the fit is saved to, the folder of 
+	`registry` (default: the calibration folder of `workspace`). With `incremental=True` the fit
+	is skipped and the saved functions are returned when neither the 
+	calibration files, the species constants, the saved file nor the
+	fit settings changed since the last fit, according to `calibration_manifest.json`.
+
+	With `select_model=True` each species gets the model chosen by
+	cross-validation (see `get_calibration_factor_function_dict_by_cross_validation`),
+	and the choices are saved to `calibration_model_selection.json`.
+	"""
+
+	from manifest import (
+		get_file_record,
+		load_manifest,
+		save_manifest
+		)
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if calibration_path is None:
+		calibration_path = workspace.calibration_path
 
-def prepare_calibration_factor_functions(calibration_species_list=None, calibration_path=None):
+	if calibration_species_list is None:
+		calibration_species_list = list_calibration_species(calibration_path)
+
+	if registry is None:
+		registry = workspace.registry
+
+	calibration_factor_function_save_file = os.path.join(
+												registry.calibration_path,
+												'fitted_calibration_factor_functions.json')
+	calibration_manifest_file = os.path.join(
+												registry.calibration_path,
+												'calibration_manifest.json')
+	calibration_model_selection_file = os.path.join(
+												registry.calibration_path,
+												'calibration_model_selection.json')
+	fit_settings = {'select_model': select_model, 'folds': folds}
+
+	# hash calibration inputs
+	calibration_manifest = load_manifest(calibration_manifest_file)
+	previous_input_records = calibration_manifest.get('inputs', {})
+	input_files = [os.path.join(calibration_path, species+'.txt') for species in calibration_species_list]
+	input_files.append(os.path.join(registry.calibration_path, 'calibration_species_constants.csv'))
+
+	input_records = {}
+	for input_file in input_files:
+		input_records[input_file] = get_file_record(input_file, previous_input_records.get(input_file))
+
+	if incremental and 'output' in calibration_manifest \
+		and os.path.exists(calibration_factor_function_save_file):
+		output_record = get_file_record(calibration_factor_function_save_file,
+										calibration_manifest.get('output'))
+		input_hashes = dict((f, record['sha1']) for f, record in input_records.items())
+		previous_input_hashes = dict((f, record['sha1']) for f, record in previous_input_records.items())
+		if output_record['sha1'] == calibration_manifest['output']['sha1'] \
+			and input_hashes == previous_input_hashes \
+			and calibration_manifest.get('settings', {'select_model': False, 'folds': None}) == fit_settings:
+			return load_fitted_calibration_factor_functions(calibration_factor_function_save_file)
 
 	# read calibration data
-	calibration_data_dict = read_calibration_data(calibration_species_list, calibration_path)
+	calibration_data_dict = read_calibration_data(calibration_species_list, calibration_path, registry)
 
 	# linear regression
-	calibration_factor_function_dict = get_calibration_factor_function_dict_by_linear_regression(
+	if select_model:
+		calibration_factor_function_dict, selected_model_dict = \
+			get_calibration_factor_function_dict_by_cross_validation(calibration_data_dict, folds)
+		with open(calibration_model_selection_file, 'w') as write_out:
+			json.dump(selected_model_dict, write_out, indent=2)
+	else:
+		calibration_factor_function_dict = get_calibration_factor_function_dict_by_linear_regression(
 											calibration_data_dict)	
+		# the choices of an earlier fit no longer describe the factors
+		if os.path.exists(calibration_model_selection_file):
+			os.remove(calibration_model_selection_file)
 
 	# save calibration factor functions
-	calibration_factor_function_save_file = os.path.join(
-												'data', 
-												'calibration', 
-												'fitted_calibration_factor_functions.json')
+	with metrics.stage_timer('json_write'):
+		with open(calibration_factor_function_save_file, 'w') as write_out:
+			json.dump(calibration_factor_function_dict, write_out, indent=2)
 
-	with open(calibration_factor_function_save_file, 'w') as write_out:
-		json.dump(calibration_factor_function_dict, write_out, indent=2)
+	calibration_manifest = {'inputs': input_records,
+							'output': get_file_record(calibration_factor_function_save_file),
+							'settings': fit_settings}
+	save_manifest(calibration_manifest, calibration_manifest_file)
 
 	# return calibration factor function dict
 	return calibration_factor_function_dict
 
-def load_fitted_calibration_factor_functions():
+def load_fitted_calibration_factor_functions(fitted_calibration_factor_functions_path=None, workspace=None):
 
 	calibration_factor_function_dict = {}
 
-	fitted_calibration_factor_functions_path = os.path.join(
-												'data', 
-												'calibration', 
+	if fitted_calibration_factor_functions_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		fitted_calibration_factor_functions_path = workspace.get_calibration_file(
 												'fitted_calibration_factor_functions.json')
 	with open(fitted_calibration_factor_functions_path, 'r') as read_in:
 		calibration_factor_function_dict = json.load(read_in)
 
 	return calibration_factor_function_dict
 
+def load_calibration_model_selection(calibration_model_selection_path):
+
+	with open(calibration_model_selection_path, 'r') as read_in:
+		return json.load(read_in)
+
+class CalibrationRegistry(object):
+	"""
+	This class keeps calibration species constants and fitted calibration
+	factor functions of one calibration folder in memory, so that a batch of
+	samples parses `calibration_species_constants.csv` and
+	`fitted_calibration_factor_functions.json` once instead of once per sample.
+
+	A cached file is re-parsed as soon as its modification time or size 
+	changes, or with `check_content=True` as soon as its sha1 changes.
+	Returned dictionaries are shared between callers and must not be mutated.
+	The calibration folder defaults to that of `workspace` (default: `data`).
+	"""
+
+	def __init__(self, calibration_path=None, check_content=False, workspace=None):
+
+		if calibration_path is None:
+			if workspace is None:
+				workspace = get_default_workspace()
+			calibration_path = workspace.calibration_path
+
+		self.calibration_path = calibration_path
+		self.check_content = check_content
+		self.hits = 0
+		self.misses = 0
+		self._cache = {} # key: absolute file path, value: (file signature, parsed data)
+		self._lock = threading.Lock()
+
+	def _get_file_signature(self, file_path):
+
+		if self.check_content:
+			with open(file_path, 'rb') as read_in:
+				return hashlib.sha1(read_in.read()).hexdigest()
+
+		file_stat = os.stat(file_path)
+		return (file_stat.st_mtime_ns, file_stat.st_size)
+
+	def _load(self, file_path, read_file):
+
+		key = os.path.abspath(file_path)
+		signature = self._get_file_signature(file_path)
+		with self._lock:
+			if key in self._cache and self._cache[key][0] == signature:
+				self.hits += 1
+				if metrics.enabled:
+					metrics.increment('calibration_cache_hits')
+				return self._cache[key][1]
+
+		data = read_file(file_path)
+		with self._lock:
+			self.misses += 1
+			self._cache[key] = (signature, data)
+		if metrics.enabled:
+			metrics.increment('calibration_cache_misses')
+
+		return data
+
+	def get_calibration_species_constants(self):
+
+		calibration_species_constants_file = os.path.join(
+												self.calibration_path,
+												'calibration_species_constants.csv'
+												)
+
+		return self._load(calibration_species_constants_file,
+						read_calibration_species_constants)
+
+	def get_fitted_calibration_factor_functions(self):
+
+		fitted_calibration_factor_functions_path = os.path.join(
+												self.calibration_path,
+												'fitted_calibration_factor_functions.json'
+												)
+
+		return self._load(fitted_calibration_factor_functions_path,
+						load_fitted_calibration_factor_functions)
+
+	def get_calibration_model_selection(self):
+		"""
+		This method outputs the models chosen for the fitted factors, saved to
+		`calibration_model_selection.json` by `prepare_calibration_factor_functions`
+		with `select_model=True`, or an empty dictionary without one.
+		"""
+
+		calibration_model_selection_file = os.path.join(self.calibration_path,
+														'calibration_model_selection.json')
+		if not os.path.exists(calibration_model_selection_file):
+			return {}
+
+		return self._load(calibration_model_selection_file, load_calibration_model_selection)
+
+	def get_response_lookup_tables(self):
+		"""
+		This method outputs the lookup tables of `fitted_response_models.json`,
+		see `response_models.prepare_response_models`.
+		"""
+
+		# NumPy is only needed for nonlinear responses
+		from response_models import load_response_lookup_tables
+
+		response_models_file = os.path.join(self.calibration_path, 'fitted_response_models.json')
+
+		return self._load(response_models_file, load_response_lookup_tables)
+
+	def invalidate(self):
+
+		with self._lock:
+			self._cache.clear()
+
+_registries = {} # key: normalized calibration path, value: CalibrationRegistry
+_registries_lock = threading.Lock()
+
+def get_registry(calibration_path=None, workspace=None):
+	"""
+	This method returns the process-wide `CalibrationRegistry` of a
+	calibration folder (default: the calibration folder of `workspace`,
+	`data/calibration`), creating it on first use.
+	"""
+
+	if calibration_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		calibration_path = workspace.calibration_path
+
+	key = os.path.normpath(calibration_path)
+	with _registries_lock:
+		if key not in _registries:
+			_registries[key] = CalibrationRegistry(calibration_path)
+
+		return _registries[key]
+
+def get_default_registry():
+
+	return get_registry()
+
 if __name__ == '__main__':
 	prepare_calibration_factor_functions()
 
@@ -0,0 +1,144 @@
+from collections import namedtuple
+import numpy as np
+
+# params has one row per species: [a] for `peak_area = a*injection_moles` or,
+# as with statsmodels' add_constant, [b, a] for `peak_area = a*injection_moles + b`
+CalibrationFit = namedtuple('CalibrationFit', ['species_list', 'params', 'standard_errors', 'r_squared'])
+
+def stack_calibration_data(calibration_data_dict, species_list=None, point_range=None, include_origin=True):
+	"""
+	This method packs the `(injection_moles, peak_areas)` tuples of
+	`read_calibration_data` into padded arrays `x`, `y` and a 0/1 `mask`,
+	all of shape (species, points). The input lists are left untouched.
+
+	`point_range=(start, stop)` selects measured points by position, e.g.
+	`(0, 3)` keeps the 3 lowest-concentration injections. With
+	`include_origin=True` a (0, 0) point is put in front, like the
+	original statsmodels fit did.
+
+	output: tuple `(species_list, x, y, mask)`
+	"""
+
+	if species_list is None:
+		species_list = list(calibration_data_dict)
+
+	selected_data = []
+	for species in species_list:
+		injection_moles, peak_areas = calibration_data_dict[species]
+		if point_range is not None:
+			injection_moles = injection_moles[point_range[0]:point_range[1]]
+			peak_areas = peak_areas[point_range[0]:point_range[1]]
+		if include_origin:
+			injection_moles = [0.0] + list(injection_moles)
+			peak_areas = [0.0] + list(peak_areas)
+		selected_data.append((injection_moles, peak_areas))
+
+	point_count = max([len(injection_moles) for injection_moles, _ in selected_data] + [0])
+	x = np.zeros((len(species_list), point_count))
+	y = np.zeros((len(species_list), point_count))
+	mask = np.zeros((len(species_list), point_count))
+	for i, (injection_moles, peak_areas) in enumerate(selected_data):
+		x[i, :len(injection_moles)] = injection_moles
+		y[i, :len(peak_areas)] = peak_areas
+		mask[i, :len(injection_moles)] = 1.0
+
+	return species_list, x, y, mask
+
+def get_weights(x, mask, weighting=None):
+	"""
+	This method turns a `weighting` choice into per-point weights:
+	None (ordinary least squares), `'1/x'` or `'1/x^2'`. Origin points
+	(x = 0) get the weight of the smallest injection, so that they don't
+	dominate the fit.
+	"""
+
+	if weighting is None:
+		return mask.copy()
+
+	if weighting == '1/x':
+		power = 1
+	elif weighting == '1/x^2':
+		power = 2
+	else:
+		raise ValueError('Unknown weighting: {0}'.format(weighting))
+
+	positive = (x > 0) & (mask > 0)
+	smallest_x = np.where(positive, x, np.inf).min(axis=-1, keepdims=True)
+	smallest_x = np.where(np.isfinite(smallest_x), smallest_x, 1.0)
+	x_for_weights = np.where(positive, x, smallest_x)
+
+	return mask/x_for_weights**power
+
+def solve_weighted_least_squares(x, y, weights, zero_intercept=True):
+	"""
+	This method fits `y = a*x` or `y = a*x + b` for every row of the
+	arrays `x`, `y`, `weights` (any number of leading batch dimensions,
+	points along the last axis) with closed-form weighted normal equations.
+	Points with zero weight are ignored.
+
+	output: tuple `(params, standard_errors, r_squared)` where `params` and
+	`standard_errors` have a last axis of [a] or [b, a].
+	R^2 is uncentered for zero-intercept fits, as in statsmodels.
+	"""
+
+	point_counts = (weights > 0).sum(axis=-1)
+	sum_w = weights.sum(axis=-1)
+	sum_wx = (weights*x).sum(axis=-1)
+	sum_wy = (weights*y).sum(axis=-1)
+	sum_wxx = (weights*x*x).sum(axis=-1)
+	sum_wxy = (weights*x*y).sum(axis=-1)
+	sum_wyy = (weights*y*y).sum(axis=-1)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		if zero_intercept:
+			slopes = sum_wxy/sum_wxx
+			intercepts = np.zeros_like(slopes)
+			param_count = 1
+		else:
+			determinants = sum_w*sum_wxx - sum_wx*sum_wx
+			slopes = (sum_w*sum_wxy - sum_wx*sum_wy)/determinants
+			intercepts = (sum_wxx*sum_wy - sum_wx*sum_wxy)/determinants
+			param_count = 2
+
+		residuals = y - slopes[..., None]*x - intercepts[..., None]
+		sum_of_squared_residuals = (weights*residuals*residuals).sum(axis=-1)
+		residual_variances = sum_of_squared_residuals/(point_counts - param_count)
+
+		if zero_intercept:
+			total_sum_of_squares = sum_wyy
+			params = slopes[..., None]
+			standard_errors = np.sqrt(residual_variances/sum_wxx)[..., None]
+		else:
+			total_sum_of_squares = sum_wyy - sum_wy*sum_wy/sum_w
+			params = np.stack([intercepts, slopes], axis=-1)
+			standard_errors = np.stack([np.sqrt(residual_variances*sum_wxx/determinants),
+										np.sqrt(residual_variances*sum_w/determinants)], axis=-1)
+
+		r_squared = 1.0 - sum_of_squared_residuals/total_sum_of_squares
+
+	return params, standard_errors, r_squared
+
+def fit_calibration_factors(
+					calibration_data_dict,
+					zero_intercept=True,
+					weighting=None,
+					point_range=None,
+					include_origin=True,
+					species_list=None
+					):
+	"""
+	This method fits the calibration data of all species in one vectorized
+	least-squares pass and outputs a `CalibrationFit` of arrays aligned with
+	its `species_list`. See `stack_calibration_data` for `point_range` and
+	`include_origin` and `get_weights` for `weighting`.
+	"""
+
+	species_list, x, y, mask = stack_calibration_data(calibration_data_dict,
+													species_list,
+													point_range,
+													include_origin)
+	weights = get_weights(x, mask, weighting)
+
+	params, standard_errors, r_squared = solve_weighted_least_squares(x, y, weights, zero_intercept)
+
+	return CalibrationFit(species_list, params, standard_errors, r_squared)
@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+from calibration_fitting import (
+	stack_calibration_data,
+	get_weights,
+	fit_calibration_factors
+	)
+from calibration import read_calibration_data
+
+class test_calibration_fitting(unittest.TestCase):
+
+	def setUp(self):
+
+		self.calibration_data_dict = read_calibration_data(['PDD', 'undecane', 'toluene', 'chlorothiophene'])
+
+	def lstsq_fit(self, x, y, weights, zero_intercept):
+
+		if zero_intercept:
+			design_matrix = x[:, None]
+		else:
+			design_matrix = np.column_stack([np.ones_like(x), x])
+		sqrt_weights = np.sqrt(weights)
+		params = np.linalg.lstsq(design_matrix*sqrt_weights[:, None], y*sqrt_weights, rcond=None)[0]
+
+		return params
+
+	def test_stack_calibration_data(self):
+
+		species_list, x, y, mask = stack_calibration_data(self.calibration_data_dict,
+														['PDD', 'toluene'],
+														point_range=(0, 3))
+
+		self.assertEqual(species_list, ['PDD', 'toluene'])
+		self.assertEqual(x.shape, (2, 4))
+		self.assertEqual(y[0, 0], 0.0)
+		self.assertEqual(y[0, 1], 131261886)
+		self.assertEqual(len(self.calibration_data_dict['PDD'][0]), 4)
+
+	def test_fit_calibration_factors(self):
+
+		for zero_intercept in [True, False]:
+			for weighting in [None, '1/x', '1/x^2']:
+				for point_range in [None, (0, 3)]:
+					calibration_fit = fit_calibration_factors(self.calibration_data_dict,
+															zero_intercept=zero_intercept,
+															weighting=weighting,
+															point_range=point_range)
+
+					_, x, y, mask = stack_calibration_data(self.calibration_data_dict,
+															calibration_fit.species_list,
+															point_range)
+					weights = get_weights(x, mask, weighting)
+					for i in range(len(calibration_fit.species_list)):
+						params = self.lstsq_fit(x[i], y[i], weights[i], zero_intercept)
+						np.testing.assert_allclose(calibration_fit.params[i], params, rtol=1e-9)
+
+	def test_fit_calibration_factors_statistics(self):
+
+		calibration_fit = fit_calibration_factors(self.calibration_data_dict)
+		PDD_index = calibration_fit.species_list.index('PDD')
+
+		# reference values of statsmodels OLS on PDD
+		self.assertAlmostEqual(calibration_fit.standard_errors[PDD_index][0]/6.29529979e+12, 1.0, 8)
+		self.assertAlmostEqual(calibration_fit.params[PDD_index][0]/317927834692571.88, 1.0, 12)
+		self.assertAlmostEqual(calibration_fit.r_squared[PDD_index], 0.99843, 5)
+		self.assertTrue(np.all(calibration_fit.standard_errors > 0))
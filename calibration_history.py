@@ -0,0 +1,312 @@
+import os
+import json
+import bisect
+import datetime
+import tempfile
+import threading
+from calibration import (
+	list_calibration_species,
+	read_calibration_file
+	)
+from report_parser import read_report_date
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
+
+def update_calibration_factor(calibration_factor, covariance, injection_moles, peak_area):
+	"""
+	This method is one recursive least-squares step of the zero-intercept
+	fit `peak_area = a*injection_moles`: it outputs the updated tuple
+	`(calibration_factor, covariance)`. A `covariance` of None means no
+	point was seen yet, in which case the first non-zero injection sets
+	the factor exactly.
+	"""
+
+	if injection_moles == 0:
+		return calibration_factor, covariance
+
+	if covariance is None:
+		return peak_area/injection_moles, 1.0/injection_moles**2
+
+	gain = covariance*injection_moles/(1.0 + injection_moles*covariance*injection_moles)
+	calibration_factor += gain*(peak_area - injection_moles*calibration_factor)
+	covariance -= gain*injection_moles*covariance
+
+	return calibration_factor, covariance
+
+class CalibrationHistory(object):
+	"""
+	This class keeps, for every species, the time-indexed history of its
+	calibration factor, updated by recursive least squares each time a
+	calibration session (one dated calibration report) arrives. An update
+	only touches the latest state of the species, so its cost does not
+	grow with the length of the history.
+
+	Before each session the covariance is divided by `forgetting_factor`,
+	so older sessions weigh `forgetting_factor` less per session and the
+	factor follows instrument drift; with `forgetting_factor=1` every
+	point ever injected counts equally, as in the global fit of
+	`prepare_calibration_factor_functions`.
+
+	Each history entry is a dictionary with keys `date` (ISO format),
+	`source` (calibration report), `calibration_factor`, `covariance` and
+	`points`, the number of injections in the session.
+	"""
+
+	def __init__(self, history_file=None, forgetting_factor=0.8, workspace=None):
+
+		if history_file is None:
+			if workspace is None:
+				workspace = get_default_workspace()
+			history_file = workspace.get_calibration_file('calibration_history.json')
+
+		if not 0 < forgetting_factor <= 1:
+			raise ValueError('forgetting_factor must be in (0, 1]: {0}'.format(forgetting_factor))
+
+		self.history_file = history_file
+		self.forgetting_factor = forgetting_factor
+		self.histories = {} # key: species, value: list of history entries in date order
+		self._dates = {} # key: species, value: list of entry dates, for bisection
+		self._sources = {} # key: species, value: set of sources already applied
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+
+		# the lock can't be pickled for worker processes
+		state = self.__dict__.copy()
+		del state['_lock']
+		return state
+
+	def __setstate__(self, state):
+
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	@classmethod
+	def load(cls, history_file=None, forgetting_factor=None):
+		"""
+		This method loads a saved history, or outputs an empty one if
+		`history_file` doesn't exist yet. The saved forgetting factor is
+		kept unless `forgetting_factor` is given.
+		"""
+
+		calibration_history = cls(history_file)
+		if os.path.exists(calibration_history.history_file):
+			with open(calibration_history.history_file, 'r') as read_in:
+				saved_history = json.load(read_in)
+			calibration_history.forgetting_factor = saved_history['forgetting_factor']
+			for species, history in saved_history['species'].items():
+				calibration_history.histories[species] = history
+				calibration_history._dates[species] = [entry['date'] for entry in history]
+				calibration_history._sources[species] = set(entry['source'] for entry in history)
+
+		if forgetting_factor is not None:
+			calibration_history.forgetting_factor = forgetting_factor
+
+		return calibration_history
+
+	def save(self):
+
+		with self._lock:
+			saved_history = {'forgetting_factor': self.forgetting_factor,
+							'species': self.histories}
+			with metrics.stage_timer('json_write'):
+				# a temporary file of its own, so that processes saving at once never mix their writes
+				descriptor, temporary_file = tempfile.mkstemp(prefix='calibration_history.', suffix='.tmp',
+															dir=os.path.dirname(self.history_file))
+				try:
+					with os.fdopen(descriptor, 'w') as write_out:
+						json.dump(saved_history, write_out, indent=2, sort_keys=True)
+					os.replace(temporary_file, self.history_file)
+				except BaseException:
+					os.remove(temporary_file)
+					raise
+
+	def has_source(self, species, source):
+
+		return source in self._sources.get(species, ())
+
+	def update(self, species, calibration_date, injection_moles, peak_areas, source=None):
+		"""
+		This method adds one calibration session of `species` measured on
+		`calibration_date` and outputs its history entry, or None if
+		`source` was already applied. Sessions must arrive in date order;
+		an older session raises ValueError since it would need a refit,
+		see `update_calibration_history(..., rebuild=True)`.
+		"""
+
+		calibration_date = calibration_date.isoformat()
+		with self._lock:
+			if source is not None and source in self._sources.get(species, ()):
+				return None
+
+			history = self.histories.setdefault(species, [])
+			dates = self._dates.setdefault(species, [])
+			if dates and calibration_date < dates[-1]:
+				raise ValueError('Calibration of {0} on {1} is older than the latest one on {2}'.format(
+									species, calibration_date, dates[-1]))
+
+			if history:
+				calibration_factor = history[-1]['calibration_factor']
+				covariance = history[-1]['covariance']/self.forgetting_factor
+			else:
+				calibration_factor, covariance = 0.0, None
+
+			for moles, peak_area in zip(injection_moles, peak_areas):
+				calibration_factor, covariance = update_calibration_factor(
+													calibration_factor, covariance,
+													moles, peak_area)
+			if covariance is None:
+				raise ValueError('Calibration of {0} on {1} has no non-zero injection'.format(
+									species, calibration_date))
+
+			entry = {'date': calibration_date,
+					'source': source,
+					'calibration_factor': calibration_factor,
+					'covariance': covariance,
+					'points': len(injection_moles)}
+			history.append(entry)
+			dates.append(calibration_date)
+			self._sources.setdefault(species, set()).add(source)
+
+		return entry
+
+	def get_entry(self, species, sample_date=None):
+		"""
+		This method outputs the history entry of `species` valid on
+		`sample_date`: the latest session on or before that date, or the
+		first session for samples measured before any calibration.
+		Without `sample_date` the latest entry is returned.
+		"""
+
+		history = self.histories.get(species)
+		if not history:
+			raise KeyError(species)
+
+		if sample_date is None:
+			return history[-1]
+
+		index = bisect.bisect_right(self._dates[species], sample_date.isoformat())
+
+		return history[max(index - 1, 0)]
+
+	def get_calibration_factor(self, species, sample_date=None):
+
+		return self.get_entry(species, sample_date)['calibration_factor']
+
+	def get_calibration_factor_function_dict(self, sample_date=None):
+		"""
+		This method outputs the calibration factors valid on `sample_date`
+		in the format of `fitted_calibration_factor_functions.json`:
+		key: `species` and value: [`calibration_factor`].
+		"""
+
+		calibration_factor_function_dict = {}
+		for species in self.histories:
+			calibration_factor_function_dict[species] = [self.get_calibration_factor(species, sample_date)]
+
+		return calibration_factor_function_dict
+
+	def get_factor_history(self, species):
+		"""
+		This method outputs the drift of `species` as a list of
+		`(date, calibration_factor)` tuples.
+		"""
+
+		return [(datetime.date(*[int(part) for part in entry['date'].split('-')]), entry['calibration_factor'])
+				for entry in self.histories.get(species, [])]
+
+def list_calibration_files(calibration_path=None, workspace=None):
+	"""
+	This method outputs a dictionary with key: `species` and value: list of
+	its calibration reports: `<species>.txt` and, for re-injected standards,
+	every `<species>/*.txt` report.
+	"""
+
+	if calibration_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		calibration_path = workspace.calibration_path
+
+	calibration_files_dict = {}
+	for species in list_calibration_species(calibration_path):
+		calibration_files_dict[species] = [os.path.join(calibration_path, species+'.txt')]
+	for f in sorted(os.listdir(calibration_path)):
+		species_path = os.path.join(calibration_path, f)
+		if not os.path.isdir(species_path):
+			continue
+		for calibration_file in sorted(os.listdir(species_path)):
+			if calibration_file.endswith('.txt'):
+				calibration_files_dict.setdefault(f, []).append(os.path.join(species_path, calibration_file))
+
+	return calibration_files_dict
+
+@timed('calibration_history')
+def update_calibration_history(
+							calibration_files_dict=None,
+							calibration_path=None,
+							registry=None,
+							forgetting_factor=None,
+							rebuild=False,
+							save_history=True,
+							workspace=None
+							):
+	"""
+	This method adds every calibration report not yet in the history of
+	the `registry` folder (`calibration_history.json`) and outputs the
+	updated `CalibrationHistory`. Reports are dated by their `Signal:`
+	line and applied in date order; already applied reports are skipped,
+	so re-running after new injections only costs the new sessions.
+	With `rebuild=True` the history is recomputed from all reports.
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if calibration_path is None:
+		calibration_path = workspace.calibration_path
+
+	if calibration_files_dict is None:
+		calibration_files_dict = list_calibration_files(calibration_path)
+
+	if registry is None:
+		registry = workspace.registry
+	calibration_species_constants_dict = registry.get_calibration_species_constants()
+
+	history_file = os.path.join(registry.calibration_path, 'calibration_history.json')
+	if rebuild:
+		calibration_history = CalibrationHistory(history_file)
+		if forgetting_factor is not None:
+			calibration_history.forgetting_factor = forgetting_factor
+	else:
+		calibration_history = CalibrationHistory.load(history_file, forgetting_factor)
+
+	sessions = []
+	for species, calibration_files in calibration_files_dict.items():
+		for calibration_file in calibration_files:
+			source = os.path.basename(calibration_file)
+			if calibration_history.has_source(species, source):
+				continue
+			calibration_date = read_report_date(calibration_file, 'volume')
+			if calibration_date is None:
+				raise ValueError('No date found in calibration file {0}'.format(calibration_file))
+			sessions.append((calibration_date, species, source, calibration_file))
+
+	for calibration_date, species, source, calibration_file in sorted(sessions):
+		injection_volumes, peak_areas = read_calibration_file(calibration_file)
+
+		# convert volume/uL to moles
+		density = calibration_species_constants_dict[species]['density'] # unit: g/cm3
+		MW = calibration_species_constants_dict[species]['MW'] # unit: g/mol
+		injection_moles = [volume*1e-3*density/MW for volume in injection_volumes]
+
+		calibration_history.update(species, calibration_date, injection_moles, peak_areas, source)
+	if metrics.enabled:
+		metrics.increment('calibration_sessions', len(sessions))
+
+	if save_history:
+		calibration_history.save()
+
+	return calibration_history
@@ -0,0 +1,129 @@
+import unittest
+import os
+import json
+import pickle
+import shutil
+import datetime
+import tempfile
+from calibration import (
+	get_calibration_factor_function_dict_by_linear_regression,
+	get_registry,
+	read_calibration_data
+	)
+from calibration_history import (
+	CalibrationHistory,
+	list_calibration_files,
+	update_calibration_history
+	)
+from speciation import prepare_speciation_in_moles_per_total_mass
+
+class test_calibration_history(unittest.TestCase):
+
+	def setUp(self):
+
+		self.calibration_path = tempfile.mkdtemp()
+		for f in ['calibration_species_constants.csv', 'PDD.txt', 'undecane.txt']:
+			shutil.copy(os.path.join('data', 'calibration', f), self.calibration_path)
+
+	def tearDown(self):
+
+		shutil.rmtree(self.calibration_path)
+
+	def write_calibration_file(self, species, report_name, scale):
+
+		# a re-injection of the standard with peak areas scaled by `scale`
+		with open(os.path.join(self.calibration_path, species+'.txt'), 'r') as read_in:
+			lines = read_in.readlines()
+		lines[0] = 'Signal: {0}.D\\FID1B.ch\n'.format(report_name)
+		lines[1] = report_name + '\n'
+		for i, line in enumerate(lines):
+			fields = line.split('\t')
+			if len(fields) > 4 and fields[0] != 'volume/uL':
+				fields[4] = str(float(fields[4])*scale)
+				lines[i] = '\t'.join(fields)
+
+		species_path = os.path.join(self.calibration_path, species)
+		if not os.path.exists(species_path):
+			os.mkdir(species_path)
+		with open(os.path.join(species_path, report_name+'.txt'), 'w') as write_out:
+			write_out.writelines(lines)
+
+	def test_update_matches_linear_regression(self):
+
+		calibration_history = CalibrationHistory(forgetting_factor=1.0)
+		calibration_data_dict = read_calibration_data(['PDD'], self.calibration_path,
+													get_registry(self.calibration_path))
+		injection_moles, peak_areas = calibration_data_dict['PDD']
+		calibration_history.update('PDD', datetime.date(2016, 10, 6), injection_moles, peak_areas)
+
+		calibration_factor_function_dict = get_calibration_factor_function_dict_by_linear_regression(
+											calibration_data_dict)
+		self.assertAlmostEqual(calibration_history.get_calibration_factor('PDD')
+								/calibration_factor_function_dict['PDD'][0], 1.0, 12)
+
+		# sessions must arrive in date order
+		self.assertRaises(ValueError, calibration_history.update, 'PDD', datetime.date(2016, 10, 1),
+						injection_moles, peak_areas)
+
+	def test_update_calibration_history(self):
+
+		self.write_calibration_file('PDD', '20161013_10_PDD_01ul', 0.9)
+		self.write_calibration_file('PDD', '20161020_10_PDD_01ul', 0.8)
+		self.assertEqual([os.path.basename(f) for f in list_calibration_files(self.calibration_path)['PDD']],
+						['PDD.txt', '20161013_10_PDD_01ul.txt', '20161020_10_PDD_01ul.txt'])
+
+		registry = get_registry(self.calibration_path)
+		calibration_history = update_calibration_history(calibration_path=self.calibration_path,
+														registry=registry, forgetting_factor=0.5)
+		factor_history = calibration_history.get_factor_history('PDD')
+		self.assertEqual([calibration_date for calibration_date, _ in factor_history],
+						[datetime.date(2016, 10, 6), datetime.date(2016, 10, 13), datetime.date(2016, 10, 20)])
+
+		# the factor follows the drift, but older sessions still count
+		first_factor = factor_history[0][1]
+		self.assertLess(factor_history[2][1], factor_history[1][1])
+		self.assertGreater(factor_history[2][1], 0.8*first_factor)
+		self.assertEqual(calibration_history.get_calibration_factor('PDD', datetime.date(2016, 10, 15)),
+						factor_history[1][1])
+		self.assertEqual(calibration_history.get_calibration_factor('PDD', datetime.date(2016, 7, 22)),
+						first_factor)
+
+		# only new reports are applied on the next update
+		self.write_calibration_file('PDD', '20161027_10_PDD_01ul', 0.8)
+		calibration_history = update_calibration_history(calibration_path=self.calibration_path,
+														registry=registry)
+		self.assertEqual(calibration_history.forgetting_factor, 0.5)
+		self.assertEqual(len(calibration_history.histories['PDD']), 4)
+		self.assertEqual(len(calibration_history.histories['undecane']), 1)
+		self.assertEqual(pickle.loads(pickle.dumps(calibration_history)).histories,
+						calibration_history.histories)
+
+		with open(os.path.join(self.calibration_path, 'calibration_history.json'), 'r') as read_in:
+			self.assertEqual(json.load(read_in)['species'], calibration_history.histories)
+		self.assertEqual([f for f in os.listdir(self.calibration_path) if f.endswith('.tmp')], [])
+
+		# an older report needs a rebuild
+		self.write_calibration_file('PDD', '20161010_10_PDD_01ul', 0.85)
+		self.assertRaises(ValueError, update_calibration_history,
+						calibration_path=self.calibration_path, registry=registry)
+		calibration_history = update_calibration_history(calibration_path=self.calibration_path,
+														registry=registry, rebuild=True)
+		self.assertEqual(len(calibration_history.histories['PDD']), 5)
+
+	def test_speciation_with_calibration_history(self):
+
+		calibration_factor_function_dict = get_registry().get_fitted_calibration_factor_functions()
+		calibration_history = CalibrationHistory(forgetting_factor=1.0)
+		for calibration_date, scale in [(datetime.date(2016, 7, 1), 1.0), (datetime.date(2016, 8, 1), 2.0)]:
+			calibration_history.update('PDD', calibration_date, [1.0], [scale*calibration_factor_function_dict['PDD'][0]])
+
+		# sample0 is measured on 2016-07-22, before the second calibration
+		speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+																save_results=False)
+		dated_speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+																calibration_factor_function_dict,
+																save_results=False,
+																calibration_history=calibration_history)
+		self.assertEqual(sorted(dated_speciation_dict), sorted(speciation_dict))
+		for species in speciation_dict:
+			self.assertAlmostEqual(dated_speciation_dict[species]/speciation_dict[species], 1.0, 12)
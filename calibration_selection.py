@@ -0,0 +1,180 @@
+from collections import namedtuple
+import numpy as np
+from calibration_fitting import (
+	get_weights,
+	solve_weighted_least_squares,
+	stack_calibration_data
+	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+
+WEIGHTINGS = [None, '1/x', '1/x^2']
+
+# cross-validated relative errors closer than this are ties, won by the simpler model
+TIE_TOLERANCE = 1e-9
+
+# a candidate calibration model, see `fit_calibration_factors` for its fields
+CalibrationModel = namedtuple('CalibrationModel', ['zero_intercept', 'weighting', 'point_range'])
+
+# `cv_errors` has shape (models, species); `selected_models` holds an index
+# into `models` and `params` the params fitted on all points per species
+CalibrationModelSelection = namedtuple('CalibrationModelSelection',
+									['species_list', 'models', 'cv_errors', 'selected_models', 'params'])
+
+def get_candidate_models(point_count, min_points=2):
+	"""
+	This method outputs the `CalibrationModel`s to choose from for species
+	with up to `point_count` measured points: each intercept choice and
+	weighting, on all points and on the lowest `point_count - 1` down to
+	`min_points` points. The simplest models come first (zero intercept, no
+	weighting, all points) so that they win ties.
+	"""
+
+	point_ranges = [None] + [(0, stop) for stop in range(point_count - 1, min_points - 1, -1)]
+
+	return [CalibrationModel(zero_intercept, weighting, point_range)
+			for zero_intercept in [True, False]
+			for weighting in WEIGHTINGS
+			for point_range in point_ranges]
+
+def get_fold_masks(point_count, folds=None):
+	"""
+	This method outputs a 0/1 matrix of shape (folds, points) of the
+	points held out by each cross-validation fold: one point per fold for
+	leave-one-out (`folds=None`), else every `folds`-th point so that each
+	fold spans the concentration range.
+	"""
+
+	if folds is None or folds >= point_count:
+		return np.eye(point_count)
+
+	if folds < 2:
+		raise ValueError('Cross-validation needs at least 2 folds, got {0}'.format(folds))
+
+	return (np.arange(point_count) % folds == np.arange(folds)[:, None]).astype(float)
+
+def get_range_masks(point_counts, point_ranges):
+	"""
+	This method outputs a 0/1 array of shape (ranges, species, points) of
+	the measured points each `point_range` selects for species with
+	`point_counts` points, with the slicing of `stack_calibration_data`.
+	"""
+
+	max_point_count = max(list(point_counts) + [0])
+	range_masks = np.zeros((len(point_ranges), len(point_counts), max_point_count))
+	for i, point_range in enumerate(point_ranges):
+		start, stop = point_range if point_range is not None else (None, None)
+		for j, point_count in enumerate(point_counts):
+			range_masks[i, j, :point_count][start:stop] = 1.0
+
+	return range_masks
+
+@timed('calibration_selection')
+def select_calibration_models(
+						calibration_data_dict,
+						models=None,
+						folds=None,
+						evaluation_range=None,
+						include_origin=True,
+						species_list=None
+						):
+	"""
+	This method picks the calibration model of every species in
+	`calibration_data_dict` (from `read_calibration_data`) by cross-validation:
+	leave-one-out by default, or k-fold with `folds=k` (see `get_fold_masks`).
+	Each fold refits every candidate of `models` (default:
+	`get_candidate_models`) without its held-out points, which are then
+	back-calculated to injection moles as in speciation. The model with the
+	lowest root-mean-square relative error of these moles wins.
+
+	Every candidate is scored on the same held-out points, those within
+	`evaluation_range` (default: all; e.g. `(0, 3)` to judge models on the
+	low-concentration range of experiments), so that models fitted on fewer
+	points are charged for extrapolating. Point ranges are applied as
+	weight masks, so all (model, fold, species) fits are one batch of
+	`solve_weighted_least_squares`.
+
+	output: a `CalibrationModelSelection`
+	"""
+
+	species_list, x, y, mask = stack_calibration_data(calibration_data_dict,
+													species_list,
+													include_origin=include_origin)
+	origin_count = 1 if include_origin else 0
+	point_counts = (mask.sum(axis=1) - origin_count).astype(int)
+	measured_count = x.shape[1] - origin_count
+	if models is None:
+		models = get_candidate_models(measured_count)
+
+	def pad_origin(measured_masks, value):
+
+		padding = np.full(measured_masks.shape[:-1] + (origin_count,), value)
+
+		return np.concatenate([padding, measured_masks], axis=-1)
+
+	# (models, species, points) training masks of the models, with origins
+	range_masks = pad_origin(get_range_masks(point_counts, [model.point_range for model in models]), 1.0)*mask
+
+	# (folds + 1, points) training masks, the first fold keeps all points
+	held_out_masks = pad_origin(get_fold_masks(measured_count, folds), 0.0)
+	training_masks = 1.0 - np.concatenate([np.zeros((1, x.shape[1])), held_out_masks])
+
+	weights = np.stack([get_weights(x, range_mask*training_masks[:, None, :], model.weighting)
+						for model, range_mask in zip(models, range_masks)])
+
+	# slopes and intercepts of shape (models, folds + 1, species)
+	slopes = np.zeros(weights.shape[:-1])
+	intercepts = np.zeros(weights.shape[:-1])
+	for zero_intercept in [True, False]:
+		model_indices = [i for i, model in enumerate(models) if model.zero_intercept == zero_intercept]
+		if model_indices:
+			params, _, _ = solve_weighted_least_squares(x, y, weights[model_indices], zero_intercept)
+			slopes[model_indices] = params[..., -1]
+			if not zero_intercept:
+				intercepts[model_indices] = params[..., 0]
+
+	# relative errors of the held-out moles, (models, folds, species, points)
+	evaluation_masks = pad_origin(get_range_masks(point_counts, [evaluation_range])[0], 0.0)*mask
+	scored_masks = held_out_masks[:, None, :]*evaluation_masks
+	with np.errstate(divide='ignore', invalid='ignore'):
+		predicted_x = (y - intercepts[:, 1:, :, None])/slopes[:, 1:, :, None]
+		relative_errors = np.where(scored_masks > 0, predicted_x/x - 1.0, 0.0)
+		scored_counts = scored_masks.sum(axis=(0, 2))
+		cv_errors = np.sqrt((relative_errors*relative_errors).sum(axis=(1, 3))/scored_counts)
+
+	# a fold without a usable fit disqualifies the model
+	unusable = np.any((scored_masks.sum(axis=-1) > 0) & ~(slopes[:, 1:] > 0), axis=1)
+	cv_errors = np.where(unusable | ~np.isfinite(cv_errors), np.inf, cv_errors)
+	selected_models = np.argmax(cv_errors <= cv_errors.min(axis=0) + TIE_TOLERANCE, axis=0)
+
+	params = []
+	for j, i in enumerate(selected_models):
+		if models[i].zero_intercept:
+			params.append([float(slopes[i, 0, j])])
+		else:
+			params.append([float(intercepts[i, 0, j]), float(slopes[i, 0, j])])
+	if metrics.enabled:
+		metrics.increment('calibration_models_evaluated', int(np.prod(weights.shape[:-1])))
+
+	return CalibrationModelSelection(species_list, models, cv_errors, selected_models, params)
+
+def get_selected_model_dict(calibration_model_selection):
+	"""
+	This method outputs a json-ready dictionary with key: `species` and
+	value: its selected model, params and cross-validated relative error.
+	"""
+
+	selected_model_dict = {}
+	for j, species in enumerate(calibration_model_selection.species_list):
+		i = calibration_model_selection.selected_models[j]
+		model = calibration_model_selection.models[i]
+		cv_error = float(calibration_model_selection.cv_errors[i, j])
+		selected_model_dict[species] = {'zero_intercept': model.zero_intercept,
+										'weighting': model.weighting,
+										'point_range': list(model.point_range) if model.point_range else None,
+										'params': calibration_model_selection.params[j],
+										'cv_error': cv_error if np.isfinite(cv_error) else None}
+
+	return selected_model_dict
@@ -0,0 +1,113 @@
+import unittest
+import numpy as np
+from calibration_selection import (
+	CalibrationModel,
+	get_candidate_models,
+	get_fold_masks,
+	get_selected_model_dict,
+	select_calibration_models
+	)
+from calibration_fitting import fit_calibration_factors
+from calibration import (
+	get_calibration_factor_function_dict_by_cross_validation,
+	read_calibration_data
+	)
+
+class test_calibration_selection(unittest.TestCase):
+
+	def setUp(self):
+
+		self.calibration_data_dict = read_calibration_data(['PDD', 'undecane', 'toluene', 'chlorothiophene'])
+
+		# a proportional detector, one with an offset and one that saturates
+		injection_moles = [1e-7, 2e-7, 5e-7, 1e-6, 2e-6, 5e-6]
+		random_state = np.random.RandomState(0)
+		noise = random_state.uniform(0.99, 1.01, len(injection_moles))
+		self.synthetic_data_dict = {
+			'proportional': (injection_moles, [3e14*x for x in injection_moles]),
+			'offset': (injection_moles, [(3e14*x + 5e7)*n for x, n in zip(injection_moles, noise)]),
+			'saturating': (injection_moles, [3e14*x/(1 + 2e5*x)*n for x, n in zip(injection_moles, noise)])
+			}
+
+	def test_get_fold_masks(self):
+
+		np.testing.assert_array_equal(get_fold_masks(4), np.eye(4))
+		self.assertEqual(get_fold_masks(5, 2).tolist(), [[1, 0, 1, 0, 1], [0, 1, 0, 1, 0]])
+		np.testing.assert_array_equal(get_fold_masks(5, 2).sum(axis=0), np.ones(5))
+
+		with self.assertRaises(ValueError):
+			get_fold_masks(5, 1)
+
+	def test_cv_errors(self):
+
+		models = get_candidate_models(4)
+		self.assertEqual(len(models), 18)
+		self.assertEqual(models[0], CalibrationModel(True, None, None))
+
+		calibration_model_selection = select_calibration_models(self.calibration_data_dict, models)
+		self.assertEqual(calibration_model_selection.cv_errors.shape, (18, 4))
+
+		# leave-one-out errors of a few models, one fit at a time
+		for i in [0, 5, 10, 17]:
+			model = models[i]
+			for j, species in enumerate(calibration_model_selection.species_list):
+				injection_moles, peak_areas = self.calibration_data_dict[species]
+				squared_errors = []
+				for k in range(len(injection_moles)):
+					training_data_dict = {species: (injection_moles[:k] + injection_moles[k + 1:],
+													peak_areas[:k] + peak_areas[k + 1:])}
+					point_range = model.point_range
+					if point_range is not None and k < point_range[1]:
+						point_range = (point_range[0], point_range[1] - 1)
+					params = fit_calibration_factors(training_data_dict, model.zero_intercept,
+													model.weighting, point_range).params[0]
+					intercept = params[0] if len(params) == 2 else 0.0
+					squared_errors.append(((peak_areas[k] - intercept)/params[-1]/injection_moles[k] - 1)**2)
+				self.assertAlmostEqual(calibration_model_selection.cv_errors[i, j],
+										np.sqrt(np.mean(squared_errors)), places=10)
+
+	def test_select_calibration_models(self):
+
+		calibration_model_selection = select_calibration_models(self.calibration_data_dict)
+
+		# the params are the full fit of the selected model
+		for j, species in enumerate(calibration_model_selection.species_list):
+			model = calibration_model_selection.models[calibration_model_selection.selected_models[j]]
+			calibration_fit = fit_calibration_factors(self.calibration_data_dict, model.zero_intercept,
+													model.weighting, model.point_range, species_list=[species])
+			np.testing.assert_allclose(calibration_model_selection.params[j], calibration_fit.params[0], rtol=1e-9)
+			self.assertAlmostEqual(calibration_model_selection.cv_errors[:, j].min(),
+							calibration_model_selection.cv_errors[calibration_model_selection.selected_models[j], j], 8)
+
+	def test_select_synthetic_models(self):
+
+		selected_model_dict = get_selected_model_dict(select_calibration_models(self.synthetic_data_dict))
+
+		# exact data keeps the simplest model
+		self.assertEqual(selected_model_dict['proportional']['zero_intercept'], True)
+		self.assertEqual(selected_model_dict['proportional']['weighting'], None)
+		self.assertEqual(selected_model_dict['proportional']['point_range'], None)
+		self.assertAlmostEqual(selected_model_dict['proportional']['params'][0]/3e14, 1.0, 10)
+		self.assertAlmostEqual(selected_model_dict['proportional']['cv_error'], 0.0, 10)
+
+		self.assertEqual(selected_model_dict['offset']['zero_intercept'], False)
+		# the fitted origin point pulls the intercept down a little
+		self.assertAlmostEqual(selected_model_dict['offset']['params'][0]/5e7, 1.0, delta=0.3)
+
+		# judged on low concentrations, the saturating detector drops high points
+		selected_model_dict = get_selected_model_dict(select_calibration_models(self.synthetic_data_dict,
+																				folds=3,
+																				evaluation_range=(0, 3)))
+		self.assertIsNotNone(selected_model_dict['saturating']['point_range'])
+		self.assertLess(selected_model_dict['saturating']['cv_error'], 0.05)
+
+	def test_get_calibration_factor_function_dict_by_cross_validation(self):
+
+		calibration_factor_function_dict, selected_model_dict = \
+			get_calibration_factor_function_dict_by_cross_validation(self.synthetic_data_dict)
+
+		self.assertEqual(sorted(calibration_factor_function_dict), ['offset', 'proportional', 'saturating'])
+		self.assertEqual(len(calibration_factor_function_dict['proportional']), 1)
+		self.assertEqual(len(calibration_factor_function_dict['offset']), 2)
+		for species, params in calibration_factor_function_dict.items():
+			self.assertEqual(params, selected_model_dict[species]['params'])
@@ -2,10 +2,15 @@ from calibration import (
 					read_calibration_data, 
 					read_calibration_file,
 					read_calibration_species_constants,
-					get_calibration_factor_function_dict_by_linear_regression
+					get_calibration_factor_function_dict_by_linear_regression,
+					prepare_calibration_factor_functions,
+					CalibrationRegistry
 					)
+from manifest import hash_file
 import unittest
 import os
+import shutil
+import tempfile
 
 class test_calibration(unittest.TestCase):
 
@@ -49,3 +54,80 @@ class test_calibration(unittest.TestCase):
 
 		self.assertEqual(len(calibration_factor_function_dict), 1)
 		self.assertAlmostEqual(calibration_factor_function_dict['PDD'][0]/1e15, 0.32, 1)
+
+		# fitting again must not add another origin point to the data
+		self.assertEqual(len(calibration_data_dict['PDD'][0]), 4)
+		calibration_factor_function_dict_again = get_calibration_factor_function_dict_by_linear_regression(
+											calibration_data_dict)
+		self.assertEqual(calibration_factor_function_dict_again, calibration_factor_function_dict)
+
+		calibration_factor_function_dict = get_calibration_factor_function_dict_by_linear_regression(
+											calibration_data_dict, zero_intercept=False)
+		self.assertEqual(len(calibration_factor_function_dict['PDD']), 2)
+
+	def test_calibration_registry(self):
+
+		calibration_path = tempfile.mkdtemp()
+		try:
+			for f in ['calibration_species_constants.csv', 'fitted_calibration_factor_functions.json']:
+				shutil.copy(os.path.join('data', 'calibration', f), calibration_path)
+			registry = CalibrationRegistry(calibration_path)
+
+			calibration_species_constants_dict = registry.get_calibration_species_constants()
+			self.assertEqual(calibration_species_constants_dict['PDD']['MW'], 246.43)
+			self.assertIs(registry.get_calibration_species_constants(), calibration_species_constants_dict)
+			self.assertIn('PDD', registry.get_fitted_calibration_factor_functions())
+			self.assertEqual((registry.hits, registry.misses), (1, 2))
+
+			# a changed file is parsed again
+			with open(os.path.join(calibration_path, 'calibration_species_constants.csv'), 'a') as write_out:
+				write_out.write('\nxylene, 0.86, 106.16')
+			calibration_species_constants_dict = registry.get_calibration_species_constants()
+			self.assertEqual(calibration_species_constants_dict['xylene']['MW'], 106.16)
+			self.assertEqual(registry.misses, 3)
+		finally:
+			shutil.rmtree(calibration_path)
+
+	def test_prepare_calibration_factor_functions_incremental(self):
+
+		calibration_path = tempfile.mkdtemp()
+		try:
+			for f in os.listdir(os.path.join('data', 'calibration')):
+				shutil.copy(os.path.join('data', 'calibration', f), calibration_path)
+			registry = CalibrationRegistry(calibration_path)
+			fitted_calibration_factor_functions_path = os.path.join(calibration_path,
+												'fitted_calibration_factor_functions.json')
+			calibration_model_selection_path = os.path.join(calibration_path, 'calibration_model_selection.json')
+
+			calibration_factor_function_dict = prepare_calibration_factor_functions(
+												calibration_path=calibration_path, registry=registry)
+			fitted_hash = hash_file(fitted_calibration_factor_functions_path)
+
+			# an unchanged calibration is loaded instead of refitted
+			os.utime(fitted_calibration_factor_functions_path, (1, 1))
+			self.assertEqual(prepare_calibration_factor_functions(calibration_path=calibration_path,
+																	incremental=True, registry=registry),
+							calibration_factor_function_dict)
+			self.assertEqual(os.stat(fitted_calibration_factor_functions_path).st_mtime, 1)
+
+			# a modified output is refitted
+			with open(fitted_calibration_factor_functions_path, 'a') as write_out:
+				write_out.write(' ')
+			prepare_calibration_factor_functions(calibration_path=calibration_path, incremental=True,
+												registry=registry)
+			self.assertEqual(hash_file(fitted_calibration_factor_functions_path), fitted_hash)
+
+			# a change of fit settings is refitted too
+			selected_calibration_factor_function_dict = prepare_calibration_factor_functions(
+															calibration_path=calibration_path,
+															incremental=True,
+															registry=registry,
+															select_model=True)
+			self.assertNotEqual(selected_calibration_factor_function_dict, calibration_factor_function_dict)
+			self.assertTrue(os.path.exists(calibration_model_selection_path))
+			self.assertEqual(prepare_calibration_factor_functions(calibration_path=calibration_path,
+																	incremental=True, registry=registry),
+							calibration_factor_function_dict)
+			self.assertFalse(os.path.exists(calibration_model_selection_path))
+		finally:
+			shutil.rmtree(calibration_path)
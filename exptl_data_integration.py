@@ -1,14 +1,28 @@
 import os
-from calibration import read_calibration_species_constants
+import tempfile
+from report_parser import iter_report_rows
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
 import json
 
-def save_exptl_data_to_chemkin_simulation_format(condition_before, condition_after):
+@timed('integration')
+def save_exptl_data_to_chemkin_simulation_format(
+											condition_before,
+											condition_after,
+											registry=None,
+											gc_measurement_path=None,
+											workspace=None,
+											catalog_file=None
+											):
 	"""
 	This method tries to gether speciation results before and after experiment
 	to generate files for downstream chemkin simulation:
 	
-	input: files containing mol/g data for all samples under both 
-	condition_before and condition_after.
+	input: mol/g data for all samples under both condition_before and 
+	condition_after, from their result stores (or legacy json files).
 	
 	output: exptl_data files containing mol/g data before and after with time. Each file is 
 	for one single sample. Format would be 
@@ -18,53 +32,52 @@ def save_exptl_data_to_chemkin_simulation_format(condition_before, condition_aft
 		...
 		}
 
+	The same data is added to the results catalog `catalog_file`, or to the
+	catalog of `workspace` if that one was built (see `results_catalog`).
 	"""
 
-	# get all the files needed
-	speciation_results_condition_before_path = os.path.join('data', 
-														'measurement', 
-														condition_before,
-														'speciation_results'
-														)
-
-	speciation_results_condition_after_path = os.path.join('data', 
-														'measurement', 
-														condition_after,
-														'speciation_results'
-														)
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	if registry is None:
+		registry = workspace.registry
+
+	# load speciation results of both conditions
+	# NumPy is only needed for reading the result store
+	from result_store import load_condition_speciation_dicts
+
+	speciation_dict_by_sample_before = load_condition_speciation_dicts(condition_before, gc_measurement_path)
+	speciation_dict_by_sample_after = load_condition_speciation_dicts(condition_after, gc_measurement_path)
+
 	speciation_before_dict = {} # key: sample, value: [speciation1, speciation2]
-	for f in os.listdir(speciation_results_condition_before_path):
-		if os.path.isfile(os.path.join(speciation_results_condition_before_path, f)) \
-			and f.endswith('.json'):
-			sample = f.split('_bf')[0]
-			with open(os.path.join(speciation_results_condition_before_path, f), 'r') as read_in:
-				speciation = json.load(read_in)
-				if sample not in speciation_before_dict:
-					speciation_before_dict[sample] = [speciation]
-				else:
-					speciation_before_dict[sample].append(speciation)
+	for sample_name, speciation in sorted(speciation_dict_by_sample_before.items()):
+		sample = sample_name.split('_bf')[0]
+		if sample not in speciation_before_dict:
+			speciation_before_dict[sample] = [speciation]
+		else:
+			speciation_before_dict[sample].append(speciation)
 
 	speciation_after_dict = {} # key: sample, value: [speciation1, speciation2]
-	for f in os.listdir(speciation_results_condition_after_path):
-		if os.path.isfile(os.path.join(speciation_results_condition_after_path, f)) \
-			and f.endswith('.json') and ('_aft' in f):
-			sample = f.split('_aft')[0]
-			with open(os.path.join(speciation_results_condition_after_path, f), 'r') as read_in:
-				speciation = json.load(read_in)
-				if sample not in speciation_after_dict:
-					speciation_after_dict[sample] = [speciation]
-				else:
-					speciation_after_dict[sample].append(speciation)
+	for sample_name, speciation in sorted(speciation_dict_by_sample_after.items()):
+		if '_aft' in sample_name:
+			sample = sample_name.split('_aft')[0]
+			if sample not in speciation_after_dict:
+				speciation_after_dict[sample] = [speciation]
+			else:
+				speciation_after_dict[sample].append(speciation)
 
 	# get the detailed condition specification of the experiment
-	end_time, temperature, pressure = read_condition_details(condition_after)
+	end_time, temperature, pressure = read_condition_details(condition_after, gc_measurement_path)
 
 	# construct exptl_data dictionary
 	exptl_data_dict = {} # key: sample, value: { "Time": [..,..], "PDD": [..,..],...}
-	for sample, speciations_after in speciation_after_dict.iteritems():
+	for sample, speciations_after in speciation_after_dict.items():
 		exptl_data = {}
 		for speciation in speciations_after:
-			for species, moles_per_total_mass in speciation.iteritems():
+			for species, moles_per_total_mass in speciation.items():
 				if species not in exptl_data:
 					exptl_data[species] = [moles_per_total_mass]
 				else:
@@ -75,74 +88,287 @@ def save_exptl_data_to_chemkin_simulation_format(condition_before, condition_aft
 
 		exptl_data_dict[sample] = exptl_data
 
-	for sample, exptl_data in exptl_data_dict.iteritems():
+	for sample, exptl_data in exptl_data_dict.items():
 		speciations_before = speciation_before_dict[sample]
 
 		for species in exptl_data:
-			moles_per_total_mass_list = []
-			for speciation in speciations_before:
-				try:
-					moles_per_total_mass_list.append(speciation[species])
-				except:
-					moles_per_total_mass_list.append(0)
+			# species not found in a repeat count as 0
+			moles_per_total_mass_list = [speciation.get(species, 0) for speciation in speciations_before]
 
 			exptl_data[species] = [sum(moles_per_total_mass_list)/len(moles_per_total_mass_list),
 									exptl_data[species]
 									]
 		# normalize initial mol/g
-		exptl_data = normalize_initial_moles_per_total_mass(exptl_data)
+		exptl_data = normalize_initial_moles_per_total_mass(exptl_data, registry)
 
 
 		#
 		exptl_data['Time'] = [0, end_time] # unit: hour
 
 	# save into json file, one per each sample
-	save_dir = os.path.join('data', 'measurement', condition_after, 'exptl_data_for_simulation')
+	save_dir = os.path.join(gc_measurement_path, condition_after, 'exptl_data_for_simulation')
 	if not os.path.exists(save_dir):
 		os.mkdir(save_dir)
-	for sample, exptl_data in exptl_data_dict.iteritems():
-		save_filename = '{0}_{1}.json'.format(sample, condition_after.split('_')[1])
-		with open(os.path.join(save_dir, save_filename), 'w') as write_out:
-			json.dump(exptl_data, write_out, indent=2)
+	with metrics.stage_timer('json_write'):
+		for sample, exptl_data in exptl_data_dict.items():
+			save_filename = '{0}_{1}.json'.format(sample, condition_after.split('_')[1])
+			with open(os.path.join(save_dir, save_filename), 'w') as write_out:
+				json.dump(exptl_data, write_out, indent=2)
+	if metrics.enabled:
+		metrics.increment('exptl_data_files_written', len(exptl_data_dict))
+
+	from results_catalog import get_built_catalog
+	results_catalog = get_built_catalog(catalog_file, workspace)
+	if results_catalog is not None:
+		results_catalog.add_trajectories(condition_after, [(sample, temperature, pressure, exptl_data)
+															for sample, exptl_data in sorted(exptl_data_dict.items())],
+										gc_measurement_path)
+
+def load_condition_data(conditions, gc_measurement_path=None, max_workers=None, workspace=None):
+	"""
+	This method loads the speciation results and, when the condition has a
+	`condition.csv`, the condition details of many conditions concurrently
+	and outputs a dictionary with key: `condition` and value: tuple
+	`(speciation_dict_by_sample, (end_time, temperature, pressure) or None)`.
+	"""
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
+	from concurrent.futures import ThreadPoolExecutor
+	from result_store import load_condition_speciation_dicts
+
+	def load_condition(condition):
+		condition_details = None
+		if os.path.exists(os.path.join(gc_measurement_path, condition, 'condition.csv')):
+			condition_details = read_condition_details(condition, gc_measurement_path)
+		return condition, load_condition_speciation_dicts(condition, gc_measurement_path), condition_details
+
+	condition_data_dict = {}
+	with ThreadPoolExecutor(max_workers) as executor:
+		for condition, speciation_dict_by_sample, condition_details in executor.map(load_condition, conditions):
+			condition_data_dict[condition] = (speciation_dict_by_sample, condition_details)
+
+	return condition_data_dict
+
+def list_conditions_after(gc_measurement_path=None, workspace=None):
+	"""
+	This method lists the conditions having a `condition.csv` and speciation
+	results, in a result store or as json files.
+	"""
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
+	conditions_after = []
+	for condition in sorted(os.listdir(gc_measurement_path)):
+		condition_path = os.path.join(gc_measurement_path, condition)
+		if os.path.isfile(os.path.join(condition_path, 'condition.csv')) \
+			and (os.path.isfile(os.path.join(condition_path, 'speciation_results.npz'))
+				or os.path.isdir(os.path.join(condition_path, 'speciation_results'))):
+			conditions_after.append(condition)
+
+	return conditions_after
+
+@timed('integration')
+def assemble_exptl_trajectories(
+							condition_before,
+							conditions_after=None,
+							registry=None,
+							gc_measurement_path=None,
+							max_workers=None,
+							workspace=None
+							):
+	"""
+	This method gathers the speciation results of one condition before and
+	any number of conditions after experiment (default: every condition
+	with a `condition.csv` and results) into per-sample trajectories.
+
+	Conditions after with the same temperature and pressure make one
+	trajectory, ordered by time. Repeats are averaged as in
+	`save_exptl_data_to_chemkin_simulation_format`, and the initial mol/g
+	is normalized over the species of each trajectory. Species a sample
+	has at some times of a trajectory but not at others count as 0 there.
+
+	output: dictionary with key: `sample` and value: list of trajectories
+		{ "Temperature": 450, # unit: C
+		"Pressure": 1, # unit: atm
+		"conditions": ["pyrolysis_450C_24h", "pyrolysis_450C"],
+		"Time": [0, 24, 72], # unit: hour
+		"PDD": [..,..,..],
+		...
+		}
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	if registry is None:
+		registry = workspace.registry
+
+	if conditions_after is None:
+		conditions_after = [condition for condition in list_conditions_after(gc_measurement_path)
+							if condition != condition_before]
+
+	condition_data_dict = load_condition_data([condition_before] + list(conditions_after),
+												gc_measurement_path, max_workers)
+
+	# one grouped pass over all results:
+	# key: (sample, condition), value: {species: [sum of mol/g, count]}
+	moles_per_total_mass_sums = {}
+	repeat_counts = {} # key: (sample, condition), value: number of repeats
+	for condition in [condition_before] + list(conditions_after):
+		separator = '_bf' if condition == condition_before else '_aft'
+		for sample_name, speciation in condition_data_dict[condition][0].items():
+			if separator not in sample_name:
+				continue
+			key = (sample_name.split(separator)[0], condition)
+			species_sums = moles_per_total_mass_sums.setdefault(key, {})
+			repeat_counts[key] = repeat_counts.get(key, 0) + 1
+			for species, moles_per_total_mass in speciation.items():
+				if species not in species_sums:
+					species_sums[species] = [moles_per_total_mass, 1]
+				else:
+					species_sums[species][0] += moles_per_total_mass
+					species_sums[species][1] += 1
+
+	# conditions with the same temperature and pressure, ordered by time
+	condition_groups = {} # key: (temperature, pressure), value: [(end_time, condition)]
+	for condition in conditions_after:
+		if condition_data_dict[condition][1] is None:
+			raise ValueError('No condition details for {0}: {1} is missing'.format(condition,
+								os.path.join(gc_measurement_path, condition, 'condition.csv')))
+		end_time, temperature, pressure = condition_data_dict[condition][1]
+		condition_groups.setdefault((temperature, pressure), []).append((end_time, condition))
+
+	samples = sorted(set(sample for sample, condition in moles_per_total_mass_sums
+						if condition != condition_before))
+
+	exptl_trajectory_dict = {}
+	for sample in samples:
+		if (sample, condition_before) not in moles_per_total_mass_sums:
+			raise ValueError('No {0} results for sample {1}'.format(condition_before, sample))
+		initial_sums = moles_per_total_mass_sums[(sample, condition_before)]
+		initial_repeat_count = repeat_counts[(sample, condition_before)]
+
+		exptl_trajectories = []
+		for (temperature, pressure), time_conditions in sorted(condition_groups.items()):
+			time_conditions = [(end_time, condition) for end_time, condition in sorted(time_conditions)
+								if (sample, condition) in moles_per_total_mass_sums]
+			if not time_conditions:
+				continue
+
+			# repeats after experiment are averaged over the repeats having the species
+			species_averages = []
+			for _, condition in time_conditions:
+				species_averages.append(dict((species, total/count) for species, (total, count)
+									in moles_per_total_mass_sums[(sample, condition)].items()))
+
+			exptl_data = {}
+			for species in sorted(set().union(*species_averages)):
+				# species missing from a repeat before experiment count as 0
+				initial = initial_sums.get(species, [0, 0])[0]/initial_repeat_count
+				exptl_data[species] = [initial] + [averages.get(species, 0) for averages in species_averages]
 
-def normalize_initial_moles_per_total_mass(exptl_data):
+			# normalize initial mol/g
+			exptl_data = normalize_initial_moles_per_total_mass(exptl_data, registry)
+
+			exptl_data['Temperature'] = temperature # unit: C
+			exptl_data['Pressure'] = pressure # unit: atm
+			exptl_data['conditions'] = [condition for _, condition in time_conditions]
+			exptl_data['Time'] = [0] + [end_time for end_time, _ in time_conditions] # unit: hour
+			exptl_trajectories.append(exptl_data)
+
+		exptl_trajectory_dict[sample] = exptl_trajectories
+
+	return exptl_trajectory_dict
+
+def save_exptl_trajectories(exptl_trajectory_dict, gc_measurement_path=None, workspace=None, catalog_file=None):
+	"""
+	This method writes all trajectories at once into
+	`data/measurement/exptl_trajectories_for_simulation.json` (or the
+	measurement folder of `workspace`), replaced atomically so readers never
+	see a partial file. They are added to the results catalog as in
+	`save_exptl_data_to_chemkin_simulation_format`.
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	exptl_trajectories_file = os.path.join(gc_measurement_path, 'exptl_trajectories_for_simulation.json')
+	with metrics.stage_timer('json_write'):
+		# a temporary file of its own, so that processes saving at once never mix their writes
+		descriptor, temporary_file = tempfile.mkstemp(prefix='exptl_trajectories_for_simulation.', suffix='.tmp',
+													dir=gc_measurement_path)
+		try:
+			with os.fdopen(descriptor, 'w') as write_out:
+				json.dump(exptl_trajectory_dict, write_out, indent=2, sort_keys=True)
+			os.replace(temporary_file, exptl_trajectories_file)
+		except BaseException:
+			os.remove(temporary_file)
+			raise
+
+	from results_catalog import (
+		EXPTL_TRAJECTORIES_SOURCE,
+		get_built_catalog,
+		get_trajectory_list
+		)
+	results_catalog = get_built_catalog(catalog_file, workspace)
+	if results_catalog is not None:
+		results_catalog.add_trajectories(EXPTL_TRAJECTORIES_SOURCE, get_trajectory_list(exptl_trajectory_dict),
+										gc_measurement_path)
+
+	return exptl_trajectories_file
+
+def normalize_initial_moles_per_total_mass(exptl_data, registry=None, workspace=None):
+
+	if registry is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		registry = workspace.registry
 
 	mass = 0
-	calibration_species_constants_dict = read_calibration_species_constants()
-	for species, moles_per_total_masses in exptl_data.iteritems():
+	calibration_species_constants_dict = registry.get_calibration_species_constants()
+	for species, moles_per_total_masses in exptl_data.items():
 		initial_moles_per_total_mass = moles_per_total_masses[0]
 		if initial_moles_per_total_mass > 0:
 			species_MW = calibration_species_constants_dict[species]['MW']
 			mass += species_MW * initial_moles_per_total_mass
 
-	for species, moles_per_total_masses in exptl_data.iteritems():
+	for species, moles_per_total_masses in exptl_data.items():
 		moles_per_total_masses[0] = moles_per_total_masses[0]/mass
 
 	return exptl_data
 
-def read_condition_details(condition):
+@timed('parse')
+def read_condition_details(condition, gc_measurement_path=None, workspace=None):
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
 
 	# get condition.csv file
-	condition_file = os.path.join('data', 
-								'measurement', 
+	condition_file = os.path.join(gc_measurement_path, 
 								condition,
 								'condition.csv'
 								)
 
 	# parse condition.csv file
-	with open(condition_file, 'r') as read_in:
-		start_read = False
-		
-		for line in read_in:
-			if start_read and line.strip() != '':
-				fields = line.split(',')
-				end_time = float(fields[0].strip())
-				temperature = float(fields[1].strip())
-				pressure = float(fields[2].strip())
-				break
-
-			if line.startswith('Time'):
-				start_read = True
+	fields = next(iter_report_rows(condition_file, 'Time', ','))
+	end_time = float(fields[0])
+	temperature = float(fields[1])
+	pressure = float(fields[2])
 
 	return end_time, temperature, pressure
 
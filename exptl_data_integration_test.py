@@ -0,0 +1,145 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from exptl_data_integration import (
+	assemble_exptl_trajectories,
+	list_conditions_after,
+	normalize_initial_moles_per_total_mass,
+	save_exptl_data_to_chemkin_simulation_format,
+	save_exptl_trajectories
+	)
+from calibration import CalibrationRegistry
+from result_store import save_condition_results
+
+class test_exptl_data_integration(unittest.TestCase):
+
+	def test_normalize_initial_moles_per_total_mass(self):
+
+		exptl_data = {'PDD': [0.002, 0.001], 
+					'toluene': [0.0, 0.0005],
+					'unknown_product': [0.0, 0.0001]}
+
+		exptl_data = normalize_initial_moles_per_total_mass(exptl_data, CalibrationRegistry())
+
+		# only PDD is present initially, so its normalized initial mol/g is 1/MW
+		self.assertAlmostEqual(exptl_data['PDD'][0]*246.43, 1.0, 10)
+		self.assertEqual(exptl_data['toluene'][0], 0.0)
+		self.assertEqual(exptl_data['PDD'][1], 0.001)
+
+	def test_save_exptl_data_to_chemkin_simulation_format(self):
+
+		gc_measurement_path = tempfile.mkdtemp()
+		try:
+			for condition in ['before_pyrolysis', 'pyrolysis_450C']:
+				os.mkdir(os.path.join(gc_measurement_path, condition))
+			with open(os.path.join(gc_measurement_path, 'pyrolysis_450C', 'condition.csv'), 'w') as write_out:
+				write_out.write('Time(h), Temperature(C), Pressure(atm)\n72, 450, 1\n')
+
+			save_condition_results('before_pyrolysis', {'sample1_bf_instd': {'PDD': 4e-3},
+														'sample1_bf_instd_repeat': {'PDD': 2e-3}},
+									gc_measurement_path)
+			save_condition_results('pyrolysis_450C', {'sample1_aft_instd': {'PDD': 1e-3, 'toluene': 2e-4},
+													'sample1_aft_instd_repeat': {'PDD': 3e-3, 'toluene': 4e-4}},
+									gc_measurement_path)
+
+			save_exptl_data_to_chemkin_simulation_format('before_pyrolysis', 'pyrolysis_450C',
+														gc_measurement_path=gc_measurement_path)
+
+			with open(os.path.join(gc_measurement_path, 'pyrolysis_450C',
+									'exptl_data_for_simulation', 'sample1_450C.json'), 'r') as read_in:
+				exptl_data = json.load(read_in)
+			self.assertEqual(exptl_data['Time'], [0, 72])
+			self.assertAlmostEqual(exptl_data['PDD'][0]*246.43, 1.0, 10)
+			self.assertAlmostEqual(exptl_data['PDD'][1], 2e-3, 15)
+			self.assertEqual(exptl_data['toluene'][0], 0.0)
+		finally:
+			shutil.rmtree(gc_measurement_path)
+
+	def write_conditions(self, gc_measurement_path):
+
+		os.mkdir(os.path.join(gc_measurement_path, 'before_pyrolysis'))
+		save_condition_results('before_pyrolysis', {'sample1_bf_instd': {'PDD': 4e-3, 'toluene': 1e-4},
+													'sample1_bf_instd_repeat': {'PDD': 2e-3},
+													'sample2_bf_instd': {'PDD': 3e-3}},
+								gc_measurement_path)
+
+		for condition, condition_details, speciation_dict_by_sample in [
+				('pyrolysis_400C', '72, 400, 1', {'sample1_aft_instd': {'PDD': 3e-3, 'toluene': 1e-4},
+												'sample2_aft_instd': {'PDD': 2.5e-3}}),
+				('pyrolysis_450C', '72, 450, 1', {'sample1_aft_instd': {'PDD': 1e-3, 'toluene': 2e-4},
+												'sample1_aft_instd_repeat': {'PDD': 3e-3}}),
+				('pyrolysis_450C_24h', '24, 450, 1', {'sample1_aft_instd': {'PDD': 3e-3, 'octane': 5e-5}})]:
+			os.mkdir(os.path.join(gc_measurement_path, condition))
+			with open(os.path.join(gc_measurement_path, condition, 'condition.csv'), 'w') as write_out:
+				write_out.write('Time(h), Temperature(C), Pressure(atm)\n{0}\n'.format(condition_details))
+			save_condition_results(condition, speciation_dict_by_sample, gc_measurement_path)
+
+	def test_assemble_exptl_trajectories(self):
+
+		gc_measurement_path = tempfile.mkdtemp()
+		try:
+			self.write_conditions(gc_measurement_path)
+			self.assertEqual(list_conditions_after(gc_measurement_path),
+							['pyrolysis_400C', 'pyrolysis_450C', 'pyrolysis_450C_24h'])
+
+			exptl_trajectory_dict = assemble_exptl_trajectories('before_pyrolysis',
+													gc_measurement_path=gc_measurement_path)
+			self.assertEqual(sorted(exptl_trajectory_dict), ['sample1', 'sample2'])
+			self.assertEqual([exptl_data['Temperature'] for exptl_data in exptl_trajectory_dict['sample2']], [400])
+
+			trajectory_400C, trajectory_450C = exptl_trajectory_dict['sample1']
+			self.assertEqual(trajectory_450C['conditions'], ['pyrolysis_450C_24h', 'pyrolysis_450C'])
+			self.assertEqual(trajectory_450C['Time'], [0, 24, 72])
+			self.assertEqual(trajectory_450C['Pressure'], 1)
+			self.assertEqual(trajectory_450C['PDD'][1:], [3e-3, 2e-3])
+			self.assertEqual(trajectory_450C['toluene'][1:], [0, 2e-4])
+			self.assertEqual(trajectory_450C['octane'], [0.0, 5e-5, 0])
+
+			# a one-condition trajectory is what the pairwise export writes
+			save_exptl_data_to_chemkin_simulation_format('before_pyrolysis', 'pyrolysis_400C',
+														gc_measurement_path=gc_measurement_path)
+			with open(os.path.join(gc_measurement_path, 'pyrolysis_400C',
+									'exptl_data_for_simulation', 'sample1_400C.json'), 'r') as read_in:
+				exptl_data = json.load(read_in)
+			self.assertEqual(sorted(exptl_data), sorted(set(trajectory_400C)
+								- set(['Temperature', 'Pressure', 'conditions'])))
+			for species in ['PDD', 'toluene']:
+				for expected, value in zip(exptl_data[species], trajectory_400C[species]):
+					self.assertAlmostEqual(value, expected, 15)
+
+			exptl_trajectories_file = save_exptl_trajectories(exptl_trajectory_dict, gc_measurement_path)
+			with open(exptl_trajectories_file, 'r') as read_in:
+				self.assertEqual(json.load(read_in), exptl_trajectory_dict)
+			self.assertEqual([f for f in os.listdir(gc_measurement_path) if f.endswith('.tmp')], [])
+		finally:
+			shutil.rmtree(gc_measurement_path)
+
+	def test_assemble_exptl_trajectories_without_initial_data(self):
+
+		gc_measurement_path = tempfile.mkdtemp()
+		try:
+			self.write_conditions(gc_measurement_path)
+			save_condition_results('pyrolysis_400C', {'sample3_aft_instd': {'PDD': 1e-3}}, gc_measurement_path)
+
+			self.assertRaises(ValueError, assemble_exptl_trajectories, 'before_pyrolysis',
+							['pyrolysis_400C'], gc_measurement_path=gc_measurement_path)
+		finally:
+			shutil.rmtree(gc_measurement_path)
+
+	def test_assemble_exptl_trajectories_without_condition_details(self):
+
+		gc_measurement_path = tempfile.mkdtemp()
+		try:
+			self.write_conditions(gc_measurement_path)
+			os.remove(os.path.join(gc_measurement_path, 'pyrolysis_400C', 'condition.csv'))
+
+			with self.assertRaisesRegex(ValueError, 'pyrolysis_400C.*condition.csv'):
+				assemble_exptl_trajectories('before_pyrolysis', ['pyrolysis_400C', 'pyrolysis_450C'],
+											gc_measurement_path=gc_measurement_path)
+			# conditions found by default are those with details
+			self.assertEqual(sorted(assemble_exptl_trajectories('before_pyrolysis',
+												gc_measurement_path=gc_measurement_path)), ['sample1'])
+		finally:
+			shutil.rmtree(gc_measurement_path)
@@ -0,0 +1,207 @@
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+class Metrics(object):
+	"""
+	This class collects stage timers and counters of one process.
+
+	Nothing is recorded until `enable` is called: `timed` functions then
+	cost one attribute check per call and `increment` callers are expected
+	to check `metrics.enabled` themselves before computing what they count.
+	Timers are inclusive, so `speciation` also contains the `parse` time of
+	the files it reads. Worker processes of `run_batch_speciation` send
+	their metrics back with each sample, except for cProfile statistics.
+	"""
+
+	def __init__(self):
+
+		self.enabled = False
+		self.timers = {} # key: stage, value: [calls, total seconds, max seconds]
+		self.counters = {} # key: counter, value: count
+		self.profile_stage = None
+		self._profiler = None
+		self._profile_depth = 0
+		self._lock = threading.Lock()
+
+	def enable(self, profile_stage=None):
+		"""
+		This method starts recording. With `profile_stage`, every run of that
+		stage is also profiled with cProfile, see `save_profile_stats`.
+		"""
+
+		self.enabled = True
+		self.profile_stage = profile_stage
+		if profile_stage is not None and self._profiler is None:
+			import cProfile
+			self._profiler = cProfile.Profile()
+
+	def disable(self):
+
+		self.enabled = False
+
+	def reset(self):
+
+		with self._lock:
+			self.timers = {}
+			self.counters = {}
+			self._profiler = None
+			self._profile_depth = 0
+		if self.enabled and self.profile_stage is not None:
+			self.enable(self.profile_stage)
+
+	def increment(self, counter, value=1):
+
+		with self._lock:
+			self.counters[counter] = self.counters.get(counter, 0) + value
+
+	def add_time(self, stage, seconds):
+
+		with self._lock:
+			timer = self.timers.get(stage)
+			if timer is None:
+				self.timers[stage] = [1, seconds, seconds]
+			else:
+				timer[0] += 1
+				timer[1] += seconds
+				timer[2] = max(timer[2], seconds)
+
+	def merge(self, report):
+		"""
+		This method adds the timers and counters of a report from
+		`get_report`, e.g. one sent back by a worker process.
+		"""
+
+		with self._lock:
+			for counter, count in report['counters'].items():
+				self.counters[counter] = self.counters.get(counter, 0) + count
+			for stage, timer in report['timers'].items():
+				if stage not in self.timers:
+					self.timers[stage] = [timer['calls'], timer['total_seconds'], timer['max_seconds']]
+				else:
+					self.timers[stage][0] += timer['calls']
+					self.timers[stage][1] += timer['total_seconds']
+					self.timers[stage][2] = max(self.timers[stage][2], timer['max_seconds'])
+
+	@contextmanager
+	def stage_timer(self, stage):
+		"""
+		This method times the enclosed block as one run of `stage`.
+		"""
+
+		if not self.enabled:
+			yield
+			return
+
+		profile = stage == self.profile_stage and self._profiler is not None
+		if profile:
+			# nested runs of the profiled stage share the outer profiling run
+			self._profile_depth += 1
+			if self._profile_depth == 1:
+				self._profiler.enable()
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add_time(stage, time.perf_counter() - start_time)
+			if profile:
+				self._profile_depth -= 1
+				if self._profile_depth == 0:
+					self._profiler.disable()
+
+	def get_report(self):
+		"""
+		This method outputs the recorded metrics as a dictionary:
+		{ "timers": { stage: { "calls", "total_seconds", "mean_seconds", "max_seconds" } },
+		  "counters": { counter: count } }
+		"""
+
+		with self._lock:
+			timers = dict((stage, list(timer)) for stage, timer in self.timers.items())
+			counters = dict(self.counters)
+
+		report = {'timers': {}, 'counters': counters}
+		for stage, (calls, total_seconds, max_seconds) in sorted(timers.items()):
+			report['timers'][stage] = {'calls': calls,
+										'total_seconds': total_seconds,
+										'mean_seconds': total_seconds/calls,
+										'max_seconds': max_seconds}
+
+		return report
+
+# metrics of this process
+metrics = Metrics()
+
+def timed(stage):
+	"""
+	This method decorates a function so that each call is timed as one run
+	of `stage` while metrics are enabled.
+	"""
+
+	def decorator(function):
+
+		@wraps(function)
+		def timed_function(*args, **kwargs):
+			if not metrics.enabled:
+				return function(*args, **kwargs)
+			with metrics.stage_timer(stage):
+				return function(*args, **kwargs)
+
+		return timed_function
+
+	return decorator
+
+def format_prometheus_metrics(report, prefix='smartgc'):
+	"""
+	This method formats a metrics report in the Prometheus text exposition
+	format, e.g. for the node exporter textfile collector.
+	"""
+
+	lines = ['# TYPE {0}_stage_seconds_total counter'.format(prefix)]
+	for stage, timer in sorted(report['timers'].items()):
+		lines.append('{0}_stage_seconds_total{{stage="{1}"}} {2!r}'.format(prefix, stage, timer['total_seconds']))
+	lines.append('# TYPE {0}_stage_calls_total counter'.format(prefix))
+	for stage, timer in sorted(report['timers'].items()):
+		lines.append('{0}_stage_calls_total{{stage="{1}"}} {2}'.format(prefix, stage, timer['calls']))
+	lines.append('# TYPE {0}_stage_max_seconds gauge'.format(prefix))
+	for stage, timer in sorted(report['timers'].items()):
+		lines.append('{0}_stage_max_seconds{{stage="{1}"}} {2!r}'.format(prefix, stage, timer['max_seconds']))
+	for counter, count in sorted(report['counters'].items()):
+		lines.append('# TYPE {0}_{1}_total counter'.format(prefix, counter))
+		lines.append('{0}_{1}_total {2}'.format(prefix, counter, count))
+
+	return '\n'.join(lines) + '\n'
+
+def save_metrics(metrics_file, report=None):
+	"""
+	This method writes a metrics report (default: the current one) to
+	`metrics_file`, in the Prometheus text format if it ends with `.prom`
+	and as json otherwise.
+	"""
+
+	if report is None:
+		report = metrics.get_report()
+
+	with open(metrics_file, 'w') as write_out:
+		if metrics_file.endswith('.prom'):
+			write_out.write(format_prometheus_metrics(report))
+		else:
+			json.dump(report, write_out, indent=2, sort_keys=True)
+
+def save_profile_stats(profile_file, sort='cumulative', print_top=0):
+	"""
+	This method saves the cProfile statistics of the profiled stage to
+	`profile_file` (readable with `pstats`) and optionally prints the
+	`print_top` most expensive functions.
+	"""
+
+	if metrics._profiler is None:
+		raise ValueError('No stage is profiled, enable metrics with a profile_stage first')
+
+	import pstats
+	stats = pstats.Stats(metrics._profiler)
+	stats.dump_stats(profile_file)
+	if print_top:
+		stats.sort_stats(sort).print_stats(print_top)
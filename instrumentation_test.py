@@ -0,0 +1,146 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from instrumentation import (
+	format_prometheus_metrics,
+	metrics,
+	save_metrics,
+	save_profile_stats,
+	timed
+	)
+from speciation import (
+	prepare_speciation_in_moles_per_total_mass,
+	read_gc_speciation_file
+	)
+from batch_speciation import run_batch_speciation
+from calibration import CalibrationRegistry
+
+class test_instrumentation(unittest.TestCase):
+
+	def setUp(self):
+
+		metrics.disable()
+		metrics.profile_stage = None
+		metrics.reset()
+		self.scratch_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		metrics.disable()
+		metrics.profile_stage = None
+		metrics.reset()
+		shutil.rmtree(self.scratch_path)
+
+	def test_disabled_metrics_record_nothing(self):
+
+		gc_speciation_file = os.path.join('data', 'measurement', 'test_condition', 'gc_speciation', 'sample0.txt')
+		read_gc_speciation_file(gc_speciation_file)
+
+		self.assertEqual(metrics.get_report(), {'timers': {}, 'counters': {}})
+
+	def test_parse_metrics(self):
+
+		gc_speciation_file = os.path.join('data', 'measurement', 'test_condition', 'gc_speciation', 'sample0.txt')
+		metrics.enable()
+		read_gc_speciation_file(gc_speciation_file)
+		read_gc_speciation_file(gc_speciation_file)
+
+		report = metrics.get_report()
+		self.assertEqual(report['timers']['parse']['calls'], 2)
+		self.assertEqual(report['counters']['files_read'], 2)
+		self.assertEqual(report['counters']['bytes_parsed'], 2*os.path.getsize(gc_speciation_file))
+
+	def test_speciation_metrics(self):
+
+		metrics.enable()
+		registry = CalibrationRegistry()
+		for _ in range(3):
+			speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+													registry=registry, save_results=False)
+
+		report = metrics.get_report()
+		self.assertEqual(report['timers']['speciation']['calls'], 3)
+		self.assertEqual(report['timers']['speciation_compute']['calls'], 3)
+		self.assertEqual(report['counters']['samples_speciated'], 3)
+		self.assertEqual(report['counters']['species_computed'], 3*len(speciation_dict))
+		# fitted factors loaded once per sample call, constants once per species computation
+		self.assertEqual(report['counters']['calibration_cache_misses'], 2)
+		self.assertEqual(report['counters']['calibration_cache_hits'], registry.hits)
+		self.assertTrue(report['timers']['speciation']['total_seconds']
+						>= report['timers']['speciation_compute']['total_seconds'])
+
+	def test_worker_metrics_are_merged(self):
+
+		gc_measurement_path = os.path.join(self.scratch_path, 'measurement')
+		shutil.copytree(os.path.join('data', 'measurement', 'test_condition'),
+						os.path.join(gc_measurement_path, 'test_condition'))
+		for sample in ['sample1', 'sample2', 'sample3']:
+			for folder, extension in [('gc_speciation', '.txt'), ('gc_inner_standard', '.csv')]:
+				shutil.copy(os.path.join(gc_measurement_path, 'test_condition', folder, 'sample0'+extension),
+							os.path.join(gc_measurement_path, 'test_condition', folder, sample+extension))
+
+		metrics.enable()
+		run_batch_speciation(gc_measurement_path=gc_measurement_path, processes=2)
+
+		report = metrics.get_report()
+		self.assertEqual(report['counters']['samples_speciated'], 4)
+		self.assertEqual(report['timers']['speciation']['calls'], 4)
+		self.assertEqual(report['timers']['batch_speciation']['calls'], 1)
+		self.assertEqual(report['timers']['result_write']['calls'], 1)
+
+	def test_merge(self):
+
+		metrics.enable()
+		metrics.increment('files_read', 2)
+		metrics.add_time('parse', 1.0)
+		metrics.merge({'timers': {'parse': {'calls': 3, 'total_seconds': 2.0, 'max_seconds': 1.5}},
+						'counters': {'files_read': 5}})
+
+		report = metrics.get_report()
+		self.assertEqual(report['counters']['files_read'], 7)
+		self.assertEqual(report['timers']['parse'], {'calls': 4, 'total_seconds': 3.0,
+													'mean_seconds': 0.75, 'max_seconds': 1.5})
+
+	def test_save_metrics(self):
+
+		report = {'timers': {'parse': {'calls': 2, 'total_seconds': 0.5,
+										'mean_seconds': 0.25, 'max_seconds': 0.3}},
+				'counters': {'files_read': 2}}
+
+		prometheus_text = format_prometheus_metrics(report)
+		self.assertIn('smartgc_stage_seconds_total{stage="parse"} 0.5\n', prometheus_text)
+		self.assertIn('smartgc_stage_calls_total{stage="parse"} 2\n', prometheus_text)
+		self.assertIn('smartgc_files_read_total 2\n', prometheus_text)
+
+		json_file = os.path.join(self.scratch_path, 'metrics.json')
+		save_metrics(json_file, report)
+		with open(json_file) as read_in:
+			self.assertEqual(json.load(read_in), report)
+
+		prometheus_file = os.path.join(self.scratch_path, 'metrics.prom')
+		save_metrics(prometheus_file, report)
+		with open(prometheus_file) as read_in:
+			self.assertEqual(read_in.read(), prometheus_text)
+
+	def test_profile_stage(self):
+
+		@timed('profiled')
+		def profiled_stage():
+			return sum(range(1000))
+
+		@timed('not_profiled')
+		def other_stage():
+			return profiled_stage()
+
+		metrics.enable(profile_stage='profiled')
+		other_stage()
+
+		profile_file = os.path.join(self.scratch_path, 'profiled.prof')
+		save_profile_stats(profile_file)
+
+		import pstats
+		profiled_functions = [function[2] for function in pstats.Stats(profile_file).stats]
+		self.assertIn('profiled_stage', profiled_functions)
+		self.assertNotIn('other_stage', profiled_functions)
@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import tempfile
+
+def hash_file(file_path, block_size=1 << 20):
+
+	sha1 = hashlib.sha1()
+	with open(file_path, 'rb') as read_in:
+		for block in iter(lambda: read_in.read(block_size), b''):
+			sha1.update(block)
+
+	return sha1.hexdigest()
+
+def hash_json_data(data):
+	"""
+	This method hashes json-serializable data independent of key order.
+	"""
+
+	return hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_file_record(file_path, previous_record=None):
+	"""
+	This method outputs a manifest record `{'mtime_ns', 'size', 'sha1'}`
+	of a file. The sha1 of `previous_record` is reused without reading
+	the file when modification time and size are unchanged.
+	"""
+
+	file_stat = os.stat(file_path)
+	if previous_record is not None \
+		and previous_record.get('mtime_ns') == file_stat.st_mtime_ns \
+		and previous_record.get('size') == file_stat.st_size:
+		return previous_record
+
+	return {'mtime_ns': file_stat.st_mtime_ns,
+			'size': file_stat.st_size,
+			'sha1': hash_file(file_path)}
+
+def load_manifest(manifest_file):
+
+	if not os.path.exists(manifest_file):
+		return {}
+
+	with open(manifest_file, 'r') as read_in:
+		return json.load(read_in)
+
+def save_manifest(manifest, manifest_file):
+
+	# write next to the target and rename, so an interrupted run never
+	# leaves a half-written manifest behind, through a temporary file of
+	# its own so that runs saving at once never mix their writes
+	descriptor, temporary_file = tempfile.mkstemp(prefix=os.path.basename(manifest_file)+'.', suffix='.tmp',
+												dir=os.path.dirname(manifest_file))
+	try:
+		with os.fdopen(descriptor, 'w') as write_out:
+			json.dump(manifest, write_out, indent=2, sort_keys=True)
+		os.replace(temporary_file, manifest_file)
+	except BaseException:
+		os.remove(temporary_file)
+		raise
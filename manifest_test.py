@@ -0,0 +1,44 @@
+import unittest
+import os
+import shutil
+import tempfile
+from manifest import (
+	get_file_record,
+	hash_json_data,
+	load_manifest,
+	save_manifest
+	)
+
+class test_manifest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.manifest_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.manifest_path)
+
+	def test_get_file_record(self):
+
+		file_path = os.path.join(self.manifest_path, 'sample0.txt')
+		with open(file_path, 'w') as write_out:
+			write_out.write('toluene')
+		record = get_file_record(file_path)
+
+		# an unchanged file keeps its record, a rewritten one is hashed again
+		self.assertIs(get_file_record(file_path, record), record)
+		with open(file_path, 'w') as write_out:
+			write_out.write('octane')
+		os.utime(file_path, (1, 1))
+		self.assertNotEqual(get_file_record(file_path, record)['sha1'], record['sha1'])
+
+	def test_save_manifest(self):
+
+		manifest_file = os.path.join(self.manifest_path, 'speciation_manifest.json')
+		self.assertEqual(load_manifest(manifest_file), {})
+
+		save_manifest({'sample0': {'calibration': hash_json_data({'PDD': [1.0]})}}, manifest_file)
+		self.assertEqual(load_manifest(manifest_file)['sample0']['calibration'],
+						hash_json_data({'PDD': [1.0]}))
+		self.assertEqual(os.listdir(self.manifest_path), ['speciation_manifest.json'])
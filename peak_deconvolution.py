@@ -0,0 +1,346 @@
+import functools
+import numpy as np
+from peak_table import PeakTable
+from signal_integration import (
+	AREA_SCALE,
+	estimate_baseline,
+	get_window_points
+	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+
+PEAK_SHAPES = ['gaussian', 'emg']
+
+# weight of the cluster total against the reported areas in `deconvolve_reported_areas`
+CLUSTER_TOTAL_WEIGHT = 1e3
+
+class PeakShape(object):
+	"""
+	This class is a unit-area peak shape in units of its gaussian standard
+	deviation `sigma`: a gaussian, or an exponentially modified gaussian
+	(EMG) whose exponential tail has time constant `tau_ratio*sigma`.
+
+	The shape is tabulated once, on a grid of `step` sigma, as its density
+	and cumulative integral, so that evaluating it on any array is one
+	`np.interp`. `mode` and `half_height_width` (in sigma) place a peak of
+	the shape on the apex and half-height width of a report row.
+	"""
+
+	def __init__(self, shape='gaussian', tau_ratio=1.0, step=0.005):
+
+		if shape not in PEAK_SHAPES:
+			raise ValueError('Unknown peak shape: {0}'.format(shape))
+		if shape == 'emg' and not tau_ratio > 0:
+			raise ValueError('EMG peak shapes need a positive tau_ratio')
+
+		self.shape = shape
+		self.tau_ratio = float(tau_ratio) if shape == 'emg' else 0.0
+
+		u = np.arange(-1600, 1601)*step
+		pdf_values = np.exp(-0.5*u**2)/np.sqrt(2*np.pi)
+		if shape == 'emg':
+			exponential_u = np.arange(int(30*self.tau_ratio/step) + 1)*step
+			exponential_pdf = np.exp(-exponential_u/self.tau_ratio)/self.tau_ratio
+			# trapezoidal weight of the jump at 0
+			exponential_pdf[0] *= 0.5
+			pdf_values = np.convolve(pdf_values, exponential_pdf)*step
+			u = u[0] + np.arange(pdf_values.shape[0])*step
+
+		cdf_values = np.concatenate([[0.0], np.cumsum(0.5*(pdf_values[1:] + pdf_values[:-1]))*step])
+		self.u = u
+		self.pdf_values = pdf_values/cdf_values[-1]
+		self.cdf_values = cdf_values/cdf_values[-1]
+
+		apex = int(np.argmax(self.pdf_values))
+		half_height = 0.5*self.pdf_values[apex]
+		above = np.flatnonzero(self.pdf_values >= half_height)
+		first, last = above[0], above[-1]
+		left = np.interp(half_height, self.pdf_values[first - 1:first + 1], u[first - 1:first + 1])
+		right = np.interp(half_height, self.pdf_values[last:last + 2][::-1], u[last:last + 2][::-1])
+		self.mode = float(u[apex])
+		self.half_height_width = float(right - left)
+
+	def get_positions(self, ret_times, widths):
+		"""
+		This method outputs the arrays `(centers, sigmas)` of peaks with
+		apex at `ret_times` and half-height width `widths`.
+		"""
+
+		sigmas = np.asarray(widths, dtype=float)/self.half_height_width
+
+		return np.asarray(ret_times, dtype=float) - self.mode*sigmas, sigmas
+
+	def pdf(self, u):
+
+		return np.interp(u, self.u, self.pdf_values, left=0.0, right=0.0)
+
+	def cdf(self, u):
+
+		return np.interp(u, self.u, self.cdf_values)
+
+	def to_dict(self):
+
+		return {'shape': self.shape, 'tau_ratio': self.tau_ratio}
+
+@functools.lru_cache(maxsize=None)
+def get_peak_shape(shape='gaussian', tau_ratio=1.0):
+
+	return PeakShape(shape, tau_ratio)
+
+def get_peak_clusters(start_times, end_times, group_ids=None, tolerance=0.002):
+	"""
+	This method groups peaks, in report order, into clusters of co-eluting
+	peaks: a peak belongs to the cluster of the previous one when it starts
+	after it but no later than its end (plus `tolerance` minutes), as with
+	valley-drop integration. Clusters never span two `group_ids` (samples).
+
+	It outputs an int matrix of shape (clusters, largest cluster) with the
+	peak indices of every cluster of more than one peak, padded with -1.
+	"""
+
+	start_times = np.asarray(start_times, dtype=float)
+	end_times = np.asarray(end_times, dtype=float)
+	if start_times.shape[0] < 2:
+		return np.zeros((0, 0), dtype=np.intp)
+
+	continues = (start_times[1:] > start_times[:-1]) & (start_times[1:] <= end_times[:-1] + tolerance)
+	if group_ids is not None:
+		group_ids = np.asarray(group_ids)
+		continues &= group_ids[1:] == group_ids[:-1]
+
+	cluster_ids = np.concatenate([[0], np.cumsum(~continues)])
+	cluster_sizes = np.bincount(cluster_ids)
+	cluster_firsts = np.concatenate([[0], np.cumsum(cluster_sizes)[:-1]])
+	co_eluting = cluster_sizes > 1
+	if not co_eluting.any():
+		return np.zeros((0, 0), dtype=np.intp)
+
+	selected = np.flatnonzero(co_eluting[cluster_ids])
+	cluster_rows = np.cumsum(co_eluting) - 1
+	cluster_matrix = np.full((int(co_eluting.sum()), int(cluster_sizes.max())), -1, dtype=np.intp)
+	cluster_matrix[cluster_rows[cluster_ids[selected]], selected - cluster_firsts[cluster_ids[selected]]] = selected
+
+	return cluster_matrix
+
+def solve_cluster_systems(grams, projections, valid, max_iterations=None):
+	"""
+	This method solves a batch of small non-negative least-squares problems
+	`min |M a - r|` subject to `a >= 0`, given by their normal equations
+	`grams = M^T M` and `projections = M^T r`, padded peaks being held at
+	zero. It runs the active-set method of Lawson and Hanson on all clusters
+	in lockstep: every step frees the bound peak of each unfinished cluster
+	that most reduces its residual, and the systems of the free peaks of
+	all clusters are solved at once. A cluster whose exact solution is
+	non-negative gets it unchanged.
+
+	It outputs a tuple `(solutions, resolved)` where `resolved` flags the
+	clusters with a finite, converged solution.
+	"""
+
+	grams = np.where(valid[:, :, None] & valid[:, None, :], grams, 0.0)
+	projections = np.where(valid, projections, 0.0)
+	peak_count = valid.shape[1]
+	if max_iterations is None:
+		max_iterations = 3*peak_count
+	tolerances = 1e-10*np.abs(projections).max(axis=1, initial=0.0)
+
+	def solve_free_peaks(free):
+
+		matrices = np.where(free[:, :, None] & free[:, None, :], grams, 0.0)
+		bound = ~free
+		matrices[bound, np.nonzero(bound)[1]] = 1.0
+		# the pseudo-inverse keeps one degenerate cluster from failing the batch
+		solutions = np.matmul(np.linalg.pinv(matrices), np.where(free, projections, 0.0)[:, :, None])[:, :, 0]
+
+		return np.where(free, solutions, 0.0)
+
+	solutions = np.zeros(projections.shape)
+	free = np.zeros(valid.shape, dtype=bool)
+	finite = np.all(np.isfinite(grams), axis=(1, 2)) & np.all(np.isfinite(projections), axis=1)
+	unfinished = finite.copy()
+	for _ in range(max_iterations):
+		gradients = projections - np.matmul(grams, solutions[:, :, None])[:, :, 0]
+		candidates = valid & ~free & (gradients > tolerances[:, None])
+		unfinished &= candidates.any(axis=1)
+		if not unfinished.any():
+			break
+		freed = np.argmax(np.where(candidates, gradients, -np.inf), axis=1)
+		free[unfinished, freed[unfinished]] = True
+
+		# step back towards the feasible solutions until the free peaks stay positive
+		stepping = unfinished.copy()
+		for _ in range(peak_count):
+			free_solutions = solve_free_peaks(free)
+			infeasible = stepping[:, None] & free & (free_solutions <= 0)
+			feasible = stepping & ~infeasible.any(axis=1)
+			solutions[feasible] = free_solutions[feasible]
+			stepping &= ~feasible
+			if not stepping.any():
+				break
+			with np.errstate(divide='ignore', invalid='ignore'):
+				ratios = np.where(infeasible, solutions/(solutions - free_solutions), np.inf)
+			steps = np.clip(ratios.min(axis=1), 0.0, 1.0)
+			blocking = infeasible & (ratios <= steps[:, None])
+			solutions[stepping] += steps[stepping, None]*(free_solutions[stepping] - solutions[stepping])
+			free &= ~(stepping[:, None] & (blocking | (solutions <= 0)))
+			solutions = np.where(free, solutions, 0.0)
+
+	resolved = finite & np.all(np.isfinite(solutions), axis=1) & ~unfinished
+
+	return solutions, resolved
+
+def deconvolve_reported_areas(peak_table, cluster_matrix, peak_shape):
+	"""
+	This method re-apportions the reported (valley-drop) areas of every
+	cluster among its peaks. Each peak is modelled as `peak_shape` placed
+	on its retention time and width; the reported area of a peak is then
+	the sum over the cluster's peaks of their true area times the fraction
+	of their shape between its start and end time. The true areas of all
+	clusters are fitted at once by non-negative least squares (see
+	`solve_cluster_systems`), which is exact when the reported areas allow
+	it; otherwise, as when a reported width spills more area past a valley
+	than the next peak has, the closest non-negative areas are taken.
+	Fractions are taken relative to the whole cluster window and the fit is
+	constrained to the reported total, so each cluster keeps its total.
+
+	It outputs a tuple `(areas, resolved)`, `areas` of shape
+	`cluster_matrix.shape` and `resolved` flagging clusters the fit could
+	solve; the others are left to the caller.
+	"""
+
+	valid = cluster_matrix >= 0
+	peak_indices = np.where(valid, cluster_matrix, 0)
+	centers, sigmas = peak_shape.get_positions(peak_table.ret_times[peak_indices],
+												peak_table.widths[peak_indices])
+	sigmas = np.where(sigmas > 0, sigmas, np.nan)
+
+	# fractions[c, i, j]: share of peak j of cluster c inside the boundaries of peak i
+	start_times = peak_table.start_times[peak_indices][:, :, None]
+	end_times = peak_table.end_times[peak_indices][:, :, None]
+	fractions = peak_shape.cdf((end_times - centers[:, None, :])/sigmas[:, None, :]) \
+				- peak_shape.cdf((start_times - centers[:, None, :])/sigmas[:, None, :])
+	fractions = np.where(valid[:, :, None] & valid[:, None, :], fractions, 0.0)
+	totals = fractions.sum(axis=1, keepdims=True)
+	fractions = np.nan_to_num(fractions/np.where(totals > 0, totals, np.nan))
+
+	# least squares on the reported areas plus a heavily weighted row for their total
+	reported_areas = np.where(valid, peak_table.areas[peak_indices], 0.0)
+	total_weights = CLUSTER_TOTAL_WEIGHT**2*(valid[:, :, None] & valid[:, None, :])
+	grams = np.einsum('cij,cik->cjk', fractions, fractions) + total_weights
+	projections = np.einsum('cij,ci->cj', fractions, reported_areas) \
+					+ CLUSTER_TOTAL_WEIGHT**2*reported_areas.sum(axis=1, keepdims=True)
+	areas, resolved = solve_cluster_systems(grams, projections, valid)
+
+	return areas, resolved & np.all(~valid | (np.isfinite(sigmas) & (totals[:, 0, :] > 0)), axis=1)
+
+def fit_cluster_areas(peak_table, cluster_matrix, peak_shape, times, corrected_signal):
+	"""
+	This method fits every cluster of a baseline-corrected trace as a sum
+	of `peak_shape` peaks placed on their retention times and widths, by
+	linear least squares on the trace points between the cluster's first
+	start and last end time, with non-negative areas; all clusters are
+	padded to the same number of points and solved together through their
+	normal equations.
+
+	It outputs a tuple `(areas, resolved)` like `deconvolve_reported_areas`,
+	areas in the units of the report.
+	"""
+
+	times = np.asarray(times, dtype=float)
+	corrected_signal = np.asarray(corrected_signal, dtype=float)
+
+	valid = cluster_matrix >= 0
+	peak_indices = np.where(valid, cluster_matrix, 0)
+	centers, sigmas = peak_shape.get_positions(peak_table.ret_times[peak_indices],
+												peak_table.widths[peak_indices])
+	sigmas = np.where(sigmas > 0, sigmas, np.nan)
+
+	first_indices = np.searchsorted(times, peak_table.start_times[peak_indices[:, 0]])
+	last_indices = np.searchsorted(times, np.max(np.where(valid, peak_table.end_times[peak_indices], -np.inf),
+												axis=1), side='right')
+	point_counts = np.maximum(last_indices - first_indices, 0)
+	point_offsets = np.arange(max(1, int(point_counts.max())))
+	point_valid = point_offsets[None, :] < point_counts[:, None]
+	point_indices = np.minimum(first_indices[:, None] + point_offsets[None, :], times.shape[0] - 1)
+
+	# design[c, p, j]: unit-area peak j of cluster c at trace point p, per minute
+	design = peak_shape.pdf((times[point_indices][:, :, None] - centers[:, None, :])/sigmas[:, None, :]) \
+			/sigmas[:, None, :]
+	design = np.nan_to_num(np.where(point_valid[:, :, None] & valid[:, None, :], design, 0.0))
+	signal_values = np.where(point_valid, corrected_signal[point_indices], 0.0)
+
+	grams = np.einsum('cpj,cpk->cjk', design, design)
+	areas, resolved = solve_cluster_systems(grams, np.einsum('cpj,cp->cj', design, signal_values), valid)
+
+	return areas*AREA_SCALE, resolved & np.all(~valid | np.isfinite(sigmas), axis=1)
+
+@timed('deconvolution')
+def deconvolve_peak_table(
+					peak_table,
+					peak_shape=None,
+					times=None,
+					signal=None,
+					baseline_window=1.0,
+					group_ids=None,
+					tolerance=0.002
+					):
+	"""
+	This method outputs a copy of `peak_table` in which the areas of
+	co-eluting peaks (see `get_peak_clusters`) are replaced by those of a
+	`peak_shape` fit (default: gaussian). With the raw trace `(times, signal)`
+	(see `signal_integration.load_signal`) every cluster is fitted to the
+	trace, corrected by a block-minimum baseline over `baseline_window`
+	minutes (None to skip); without it, the reported valley-drop areas are
+	re-apportioned with `deconvolve_reported_areas`. Clusters the fit
+	cannot solve keep their reported areas; single peaks are untouched.
+
+	The peaks of many samples are deconvolved in one batch by concatenating
+	their tables with `group_ids` telling the samples apart, as
+	`deconvolve_peak_tables` does.
+	"""
+
+	if peak_shape is None:
+		peak_shape = get_peak_shape()
+
+	cluster_matrix = get_peak_clusters(peak_table.start_times, peak_table.end_times, group_ids, tolerance)
+	if cluster_matrix.shape[0] == 0:
+		return peak_table
+
+	if times is None:
+		cluster_areas, resolved = deconvolve_reported_areas(peak_table, cluster_matrix, peak_shape)
+	else:
+		corrected_signal = np.asarray(signal, dtype=float)
+		if baseline_window:
+			corrected_signal = corrected_signal - estimate_baseline(corrected_signal,
+														get_window_points(np.asarray(times), baseline_window))
+		cluster_areas, resolved = fit_cluster_areas(peak_table, cluster_matrix, peak_shape, times,
+													corrected_signal)
+
+	replaced = (cluster_matrix >= 0) & resolved[:, None]
+	areas = peak_table.areas.copy()
+	areas[cluster_matrix[replaced]] = cluster_areas[replaced]
+	if metrics.enabled:
+		metrics.increment('peak_clusters_deconvolved', int(resolved.sum()))
+		metrics.increment('peak_clusters_unresolved', int((~resolved).sum()))
+
+	return peak_table.replace(areas=areas)
+
+def deconvolve_peak_tables(peak_tables, peak_shape=None, tolerance=0.002):
+	"""
+	This method deconvolves the reported areas of the peak tables of many
+	samples in one batch and outputs the list of deconvolved tables.
+	"""
+
+	if not peak_tables:
+		return []
+
+	lengths = [len(peak_table) for peak_table in peak_tables]
+	group_ids = np.repeat(np.arange(len(peak_tables)), lengths)
+	deconvolved_table = deconvolve_peak_table(PeakTable.concatenate(peak_tables), peak_shape,
+											group_ids=group_ids, tolerance=tolerance)
+
+	split_indices = np.cumsum(lengths)[:-1]
+	return [deconvolved_table[begin:end] for begin, end in zip(np.concatenate([[0], split_indices]),
+																np.concatenate([split_indices, [sum(lengths)]]))]
@@ -0,0 +1,128 @@
+import unittest
+import os
+import numpy as np
+from peak_table import PeakTable
+from peak_deconvolution import (
+	PeakShape,
+	deconvolve_peak_table,
+	deconvolve_peak_tables,
+	get_peak_clusters,
+	get_peak_shape
+	)
+from speciation import read_gc_speciation_file
+
+class test_peak_deconvolution(unittest.TestCase):
+
+	def setUp(self):
+
+		# two co-eluting peaks split by a valley drop at 5.05 min, and a lone one
+		self.ret_times = np.array([5.0, 5.08, 6.0])
+		self.widths = np.array([0.06, 0.04, 0.05])
+		self.true_areas = np.array([1e8, 2e7, 5e6])
+		self.start_times = np.array([4.8, 5.05, 5.9])
+		self.end_times = np.array([5.05, 5.3, 6.1])
+
+	def get_peak_table(self, peak_shape):
+
+		centers, sigmas = peak_shape.get_positions(self.ret_times, self.widths)
+		reported_areas = self.true_areas.copy()
+		for i in range(2):
+			reported_areas[i] = sum(self.true_areas[j]*(peak_shape.cdf((self.end_times[i] - centers[j])/sigmas[j])
+										- peak_shape.cdf((self.start_times[i] - centers[j])/sigmas[j]))
+									for j in range(2))
+
+		return PeakTable(['1', '2', '3'], self.ret_times, ['M']*3, self.widths, reported_areas,
+						self.start_times, self.end_times, [0, 0, 0])
+
+	def get_signal(self, peak_shape, times):
+
+		centers, sigmas = peak_shape.get_positions(self.ret_times, self.widths)
+
+		# report areas are in signal*seconds, times in minutes
+		return sum(area/60.0*peak_shape.pdf((times - center)/sigma)/sigma
+					for area, center, sigma in zip(self.true_areas, centers, sigmas))
+
+	def test_peak_shape(self):
+
+		gaussian = get_peak_shape('gaussian')
+		self.assertAlmostEqual(gaussian.mode, 0.0)
+		self.assertAlmostEqual(gaussian.half_height_width, 2*np.sqrt(2*np.log(2)), places=4)
+
+		emg = PeakShape('emg', 1.0)
+		self.assertGreater(emg.mode, 0)
+		self.assertGreater(emg.half_height_width, gaussian.half_height_width)
+		self.assertAlmostEqual(float(emg.cdf(100.0)), 1.0)
+		self.assertAlmostEqual(float(np.sum(emg.pdf(emg.u))*0.005), 1.0, places=4)
+
+		with self.assertRaises(ValueError):
+			PeakShape('lorentzian')
+
+	def test_get_peak_clusters(self):
+
+		cluster_matrix = get_peak_clusters(self.start_times, self.end_times)
+		self.assertEqual(cluster_matrix.tolist(), [[0, 1]])
+
+		# peaks of two samples never make one cluster
+		cluster_matrix = get_peak_clusters([4.8, 5.05, 5.0, 5.05], [5.05, 5.3, 5.05, 5.3], [0, 0, 0, 1])
+		self.assertEqual(cluster_matrix.tolist(), [[0, 1]])
+
+	def test_deconvolve_reported_areas(self):
+
+		for peak_shape in [get_peak_shape('gaussian'), get_peak_shape('emg', 0.5)]:
+			peak_table = self.get_peak_table(peak_shape)
+			self.assertGreater(abs(peak_table.areas[1] - self.true_areas[1]), 1e6)
+
+			deconvolved_table = deconvolve_peak_table(peak_table, peak_shape)
+			np.testing.assert_allclose(deconvolved_table.areas, self.true_areas, rtol=1e-6)
+			np.testing.assert_array_equal(deconvolved_table.ret_times, peak_table.ret_times)
+
+	def test_fit_cluster_areas(self):
+
+		peak_shape = get_peak_shape('emg', 0.5)
+		times = np.linspace(4.0, 7.0, 3601)
+		peak_table = self.get_peak_table(peak_shape)
+
+		deconvolved_table = deconvolve_peak_table(peak_table, peak_shape, times,
+												self.get_signal(peak_shape, times) + 100.0)
+		np.testing.assert_allclose(deconvolved_table.areas, self.true_areas, rtol=1e-4)
+
+	def test_inner_standard_cluster(self):
+
+		# the reported width of chlorothiophene, the inner standard, spills more
+		# area past the valley than C6H5C2H5 has: the non-negative fit gives
+		# the cluster total to chlorothiophene
+		gc_speciation_file = os.path.join('data', 'measurement', 'test_condition',
+										'gc_speciation', 'sample0.txt')
+		peak_table = PeakTable.from_report(gc_speciation_file)
+		cluster = [peak_table.get_species().index(species) for species in ['chlorothiophene', 'C6H5C2H5']]
+
+		deconvolved_table = deconvolve_peak_table(peak_table)
+		self.assertAlmostEqual(deconvolved_table.areas[cluster[0]]/peak_table.areas[cluster].sum(), 1.0, 6)
+		self.assertEqual(deconvolved_table.areas[cluster[1]], 0.0)
+		unchanged = np.setdiff1d(np.arange(len(peak_table)), cluster)
+		np.testing.assert_array_equal(deconvolved_table.areas[unchanged], peak_table.areas[unchanged])
+
+		gc_speciation_data_dict = read_gc_speciation_file(gc_speciation_file, peak_shape=get_peak_shape())
+		self.assertGreater(gc_speciation_data_dict['chlorothiophene'],
+							read_gc_speciation_file(gc_speciation_file)['chlorothiophene'])
+
+		# with the raw trace, the cluster is fitted to it instead
+		centers, sigmas = get_peak_shape().get_positions(peak_table.ret_times[cluster], peak_table.widths[cluster])
+		times = np.linspace(6.0, 10.0, 24001)
+		true_areas = [9.5e7, 1.5e7]
+		signal = sum(area/60.0*get_peak_shape().pdf((times - center)/sigma)/sigma
+					for area, center, sigma in zip(true_areas, centers, sigmas))
+		gc_speciation_data_dict = read_gc_speciation_file(gc_speciation_file, peak_shape=get_peak_shape(),
+															signal=(times, signal))
+		self.assertAlmostEqual(gc_speciation_data_dict['chlorothiophene']/true_areas[0], 1.0, 4)
+		self.assertAlmostEqual(gc_speciation_data_dict['C6H5C2H5']/true_areas[1], 1.0, 4)
+
+	def test_deconvolve_peak_tables(self):
+
+		peak_shape = get_peak_shape()
+		peak_table = self.get_peak_table(peak_shape)
+
+		deconvolved_tables = deconvolve_peak_tables([peak_table]*50, peak_shape)
+		self.assertEqual(len(deconvolved_tables), 50)
+		for deconvolved_table in deconvolved_tables:
+			np.testing.assert_allclose(deconvolved_table.areas, self.true_areas, rtol=1e-6)
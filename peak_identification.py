@@ -0,0 +1,178 @@
+import os
+from bisect import bisect_left
+import numpy as np
+from calibration import list_calibration_species
+from workspace import get_default_workspace
+from report_parser import iter_peak_records
+from peak_table import (
+	PeakTable,
+	species_table
+	)
+
+class RetentionTimeIndex(object):
+	"""
+	This class is a sorted index of species retention-time windows, so that
+	an unlabeled peak is named by a bisect lookup, O(log n) per peak.
+	"""
+
+	def __init__(self, species_list, ret_time_windows):
+
+		order = np.argsort([0.5*(low + high) for low, high in ret_time_windows])
+		self.species_list = [species_list[i] for i in order]
+		self.lows = np.array([ret_time_windows[i][0] for i in order], dtype=float)
+		self.highs = np.array([ret_time_windows[i][1] for i in order], dtype=float)
+		self.centers = 0.5*(self.lows + self.highs)
+		self._center_list = list(self.centers)
+
+	@classmethod
+	def from_calibration_files(cls, calibration_species_list=None, calibration_path=None, tolerance=0.05,
+							workspace=None):
+		"""
+		This method builds the index from the `Ret Time` column of the
+		calibration files: each species' window spans its calibration
+		retention times widened by `tolerance` minutes on both sides.
+		"""
+
+		if calibration_path is None:
+			if workspace is None:
+				workspace = get_default_workspace()
+			calibration_path = workspace.calibration_path
+
+		if calibration_species_list is None:
+			calibration_species_list = list_calibration_species(calibration_path)
+
+		species_list = []
+		ret_time_windows = []
+		for species in calibration_species_list:
+			calibration_file = os.path.join(calibration_path, species+'.txt')
+			ret_times = [peak_record.ret_time for peak_record in iter_peak_records(calibration_file, 'volume')]
+			if ret_times:
+				species_list.append(species)
+				ret_time_windows.append((min(ret_times) - tolerance, max(ret_times) + tolerance))
+
+		return cls(species_list, ret_time_windows)
+
+	def lookup(self, ret_time):
+		"""
+		This method outputs the species whose window contains `ret_time`,
+		the one with the nearest center if windows overlap, or '' if none.
+		"""
+
+		i = bisect_left(self._center_list, ret_time)
+		best_species = ''
+		best_distance = None
+		for j in (i - 1, i):
+			if 0 <= j < len(self._center_list) and self.lows[j] <= ret_time <= self.highs[j]:
+				distance = abs(ret_time - self._center_list[j])
+				if best_distance is None or distance < best_distance:
+					best_species = self.species_list[j]
+					best_distance = distance
+
+		return best_species
+
+	def lookup_many(self, ret_times):
+		"""
+		This method is the vectorized form of `lookup` over an array of
+		retention times and outputs a list of species names.
+		"""
+
+		ret_times = np.asarray(ret_times, dtype=float)
+		if len(self.species_list) == 0:
+			return [''] * ret_times.shape[0]
+
+		i = np.searchsorted(self.centers, ret_times)
+		candidates = np.stack([np.clip(i - 1, 0, len(self.species_list) - 1),
+								np.clip(i, 0, len(self.species_list) - 1)])
+		inside = (self.lows[candidates] <= ret_times) & (ret_times <= self.highs[candidates])
+		distances = np.where(inside, np.abs(ret_times - self.centers[candidates]), np.inf)
+		best = candidates[distances.argmin(axis=0), np.arange(ret_times.shape[0])]
+		found = np.isfinite(distances.min(axis=0))
+
+		return [self.species_list[j] if is_found else '' for j, is_found in zip(best, found)]
+
+	def reference_ret_time(self, species):
+
+		return self.centers[self.species_list.index(species)]
+
+def get_anchor_ret_times(peak_table, retention_time_index):
+	"""
+	This method outputs the reference and observed retention times of the
+	peaks of a `PeakTable` whose species are in the index, as arrays.
+	"""
+
+	if len(retention_time_index.species_list) == 0:
+		return np.zeros(0), np.zeros(0)
+
+	index_species_ids = species_table.intern_many(retention_time_index.species_list)
+	order = np.argsort(index_species_ids)
+	positions = np.searchsorted(index_species_ids[order], peak_table.species_ids)
+	positions = np.minimum(positions, order.shape[0] - 1)
+	anchors = index_species_ids[order][positions] == peak_table.species_ids
+
+	return retention_time_index.centers[order][positions][anchors], peak_table.ret_times[anchors]
+
+def estimate_drift(peak_records, retention_time_index):
+	"""
+	This method estimates the retention-time drift of a run from its labeled
+	peaks that are also in the index (anchors), as
+	`observed = scale*reference + offset`: a least-squares line for two or
+	more anchors at distinct times, a pure offset for one, none otherwise.
+
+	output: tuple `(scale, offset)`
+	"""
+
+	if isinstance(peak_records, PeakTable):
+		reference_ret_times, observed_ret_times = get_anchor_ret_times(peak_records, retention_time_index)
+	else:
+		reference_ret_times = []
+		observed_ret_times = []
+		for peak_record in peak_records:
+			if peak_record.species in retention_time_index.species_list:
+				reference_ret_times.append(retention_time_index.reference_ret_time(peak_record.species))
+				observed_ret_times.append(peak_record.ret_time)
+
+	if len(reference_ret_times) == 0:
+		return 1.0, 0.0
+
+	if len(set(reference_ret_times)) == 1:
+		return 1.0, float(np.median(np.array(observed_ret_times) - np.array(reference_ret_times)))
+
+	scale, offset = np.polyfit(reference_ret_times, observed_ret_times, 1)
+
+	return float(scale), float(offset)
+
+def identify_peaks(peak_records, retention_time_index, correct_drift=True):
+	"""
+	This method names the unlabeled peaks (species '') of a run by looking
+	up their drift-corrected retention times in `retention_time_index`.
+	Labeled peaks are kept as they are and serve as drift anchors.
+
+	output: list of `PeakRecord`s, or a `PeakTable` for a `PeakTable`
+	"""
+
+	if isinstance(peak_records, PeakTable):
+		peak_table = peak_records
+		scale, offset = 1.0, 0.0
+		if correct_drift:
+			scale, offset = estimate_drift(peak_table, retention_time_index)
+
+		unlabeled = peak_table.species_ids == 0
+		identified_species = retention_time_index.lookup_many((peak_table.ret_times[unlabeled] - offset)/scale)
+		species_ids = peak_table.species_ids.copy()
+		species_ids[unlabeled] = species_table.intern_many(identified_species)
+
+		return peak_table.replace(species_ids=species_ids)
+
+	peak_records = list(peak_records)
+	scale, offset = 1.0, 0.0
+	if correct_drift:
+		scale, offset = estimate_drift(peak_records, retention_time_index)
+
+	unlabeled_positions = [i for i, peak_record in enumerate(peak_records) if peak_record.species == '']
+	corrected_ret_times = [(peak_records[i].ret_time - offset)/scale for i in unlabeled_positions]
+	identified_species = retention_time_index.lookup_many(corrected_ret_times)
+
+	for i, species in zip(unlabeled_positions, identified_species):
+		peak_records[i] = peak_records[i]._replace(species=species)
+
+	return peak_records
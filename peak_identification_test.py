@@ -0,0 +1,87 @@
+import unittest
+import os
+import shutil
+import tempfile
+from peak_identification import (
+	RetentionTimeIndex,
+	estimate_drift,
+	identify_peaks
+	)
+from report_parser import iter_peak_records
+from peak_table import PeakTable
+from speciation import read_gc_speciation_file
+
+class test_peak_identification(unittest.TestCase):
+
+	def setUp(self):
+
+		self.retention_time_index = RetentionTimeIndex.from_calibration_files()
+
+		# sample0 with every name but the inner standard's erased
+		self.gc_speciation_path = tempfile.mkdtemp()
+		self.gc_speciation_file = os.path.join(self.gc_speciation_path, 'sample0.txt')
+		with open(os.path.join('data', 'measurement', 'test_condition', 'gc_speciation', 'sample0.txt'), 'r') as read_in:
+			with open(self.gc_speciation_file, 'w') as write_out:
+				for line in read_in:
+					fields = line.rstrip('\n').split('\t')
+					if len(fields) == 8 and fields[0].isdigit() and fields[7] != 'chlorothiophene':
+						fields[7] = ''
+					write_out.write('\t'.join(fields) + '\n')
+
+	def tearDown(self):
+
+		shutil.rmtree(self.gc_speciation_path)
+
+	def test_from_calibration_files(self):
+
+		self.assertEqual(self.retention_time_index.species_list,
+						['toluene', 'chlorothiophene', 'undecane', 'PDD'])
+		self.assertAlmostEqual(self.retention_time_index.lows[3], 20.437, 6)
+		self.assertAlmostEqual(self.retention_time_index.highs[3], 20.777, 6)
+
+	def test_lookup(self):
+
+		self.assertEqual(self.retention_time_index.lookup(20.6), 'PDD')
+		self.assertEqual(self.retention_time_index.lookup(15.0), '')
+		self.assertEqual(self.retention_time_index.lookup_many([5.0, 15.0, 7.3, 30.0]),
+						['toluene', '', 'chlorothiophene', ''])
+
+	def test_identify_peaks(self):
+
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+		scale, offset = estimate_drift(peak_records, self.retention_time_index)
+		self.assertEqual(scale, 1.0)
+		self.assertAlmostEqual(offset, 7.730 - 7.295, 6)
+
+		peak_records = identify_peaks(peak_records, self.retention_time_index)
+		species_list = [peak_record.species for peak_record in peak_records]
+		self.assertEqual(species_list[0], 'toluene')
+		self.assertEqual(species_list[5], 'undecane')
+		self.assertEqual(species_list[11], 'PDD')
+		self.assertEqual(species_list[1], '')
+
+	def test_identify_peak_table(self):
+
+		peak_table = PeakTable.from_report(self.gc_speciation_file)
+		scale, offset = estimate_drift(peak_table, self.retention_time_index)
+		self.assertEqual(scale, 1.0)
+		self.assertAlmostEqual(offset, 7.730 - 7.295, 6)
+
+		identified_peak_table = identify_peaks(peak_table, self.retention_time_index)
+		self.assertEqual(identified_peak_table.get_species(),
+						[peak_record.species for peak_record in identify_peaks(
+							iter_peak_records(self.gc_speciation_file), self.retention_time_index)])
+		self.assertEqual(peak_table[0].species, '')
+
+		# without drift correction the run's peaks fall outside the calibration windows
+		peak_records = identify_peaks(iter_peak_records(self.gc_speciation_file),
+									self.retention_time_index, correct_drift=False)
+		self.assertEqual(peak_records[11].species, '')
+
+	def test_read_gc_speciation_file(self):
+
+		gc_speciation_data_dict = read_gc_speciation_file(self.gc_speciation_file,
+											retention_time_index=self.retention_time_index)
+
+		self.assertEqual(gc_speciation_data_dict['PDD'], 536041757)
+		self.assertEqual(gc_speciation_data_dict['toluene'], 29494571)
@@ -0,0 +1,235 @@
+import threading
+import numpy as np
+from report_parser import (
+	PeakRecord,
+	iter_report_rows
+	)
+
+class SpeciesTable(object):
+	"""
+	This class interns species names as small integer IDs, so that peak
+	tables store one int32 per peak instead of a string. ID 0 is the
+	unnamed species ''. IDs are only meaningful within one process.
+	"""
+
+	def __init__(self):
+
+		self.names = ['']
+		self.ids = {'': 0}
+		self._lock = threading.Lock()
+
+	def intern(self, name):
+
+		species_id = self.ids.get(name)
+		if species_id is not None:
+			return species_id
+
+		with self._lock:
+			species_id = self.ids.get(name)
+			if species_id is None:
+				species_id = len(self.names)
+				self.names.append(name)
+				self.ids[name] = species_id
+
+		return species_id
+
+	def intern_many(self, names):
+
+		return np.array([self.intern(name) for name in names], dtype=np.int32)
+
+	def get_name(self, species_id):
+
+		return self.names[species_id]
+
+	def get_names(self, species_ids):
+
+		names = self.names
+		return [names[species_id] for species_id in species_ids]
+
+# species IDs of this process
+species_table = SpeciesTable()
+
+class PeakView(object):
+	"""
+	This class is a light read-only view of one row of a `PeakTable`, with
+	the fields of a `PeakRecord`.
+	"""
+
+	__slots__ = ('table', 'index')
+
+	def __init__(self, table, index):
+
+		self.table = table
+		self.index = index
+
+	@property
+	def peak(self):
+		return str(self.table.peaks[self.index])
+
+	@property
+	def ret_time(self):
+		return float(self.table.ret_times[self.index])
+
+	@property
+	def peak_type(self):
+		return self.table.peak_types[self.index].decode('ascii')
+
+	@property
+	def width(self):
+		return float(self.table.widths[self.index])
+
+	@property
+	def area(self):
+		return float(self.table.areas[self.index])
+
+	@property
+	def start_time(self):
+		return float(self.table.start_times[self.index])
+
+	@property
+	def end_time(self):
+		return float(self.table.end_times[self.index])
+
+	@property
+	def species_id(self):
+		return int(self.table.species_ids[self.index])
+
+	@property
+	def species(self):
+		return species_table.get_name(self.table.species_ids[self.index])
+
+	def to_record(self):
+
+		return PeakRecord(self.peak, self.ret_time, self.peak_type, self.width, self.area,
+						self.start_time, self.end_time, self.species)
+
+class PeakTable(object):
+	"""
+	This class holds the peak table of a GC report (or of many) as typed
+	columns: float64 `ret_times`, `widths`, `areas`, `start_times`,
+	`end_times`, int32 `species_ids` interned in `species_table`, byte-string
+	`peak_types` as wide as the longest one, and `peaks`, the first report column (peak number, or
+	injection volume for calibration reports) kept as a string.
+
+	A peak takes about 60 bytes instead of several hundred as a
+	`PeakRecord` of Python floats and strings.
+	"""
+
+	__slots__ = ('peaks', 'ret_times', 'peak_types', 'widths', 'areas',
+				'start_times', 'end_times', 'species_ids')
+
+	def __init__(self, peaks, ret_times, peak_types, widths, areas, start_times, end_times, species_ids):
+
+		self.peaks = np.asarray(peaks, dtype=str)
+		self.ret_times = np.asarray(ret_times, dtype=np.float64)
+		self.peak_types = np.asarray(peak_types, dtype=bytes)
+		self.widths = np.asarray(widths, dtype=np.float64)
+		self.areas = np.asarray(areas, dtype=np.float64)
+		self.start_times = np.asarray(start_times, dtype=np.float64)
+		self.end_times = np.asarray(end_times, dtype=np.float64)
+		self.species_ids = np.asarray(species_ids, dtype=np.int32)
+
+	@classmethod
+	def from_report(cls, report_file, header_prefix='Peak', use_mmap=False):
+		"""
+		This method parses the peak rows of a GC report (see `iter_peak_records`)
+		straight into columns.
+		"""
+
+		columns = ([], [], [], [], [], [], [], [])
+		for fields in iter_report_rows(report_file, header_prefix, '\t', use_mmap):
+			for column, field in zip(columns[:7], fields):
+				column.append(field)
+			columns[7].append(species_table.intern(fields[7] if len(fields) > 7 else ''))
+
+		return cls(columns[0],
+					np.array(columns[1], dtype=np.float64),
+					columns[2],
+					np.array(columns[3], dtype=np.float64),
+					np.array(columns[4], dtype=np.float64),
+					np.array(columns[5], dtype=np.float64),
+					np.array(columns[6], dtype=np.float64),
+					columns[7])
+
+	@classmethod
+	def from_records(cls, peak_records):
+
+		peak_records = list(peak_records)
+		return cls([peak_record.peak for peak_record in peak_records],
+					[peak_record.ret_time for peak_record in peak_records],
+					[peak_record.peak_type for peak_record in peak_records],
+					[peak_record.width for peak_record in peak_records],
+					[peak_record.area for peak_record in peak_records],
+					[peak_record.start_time for peak_record in peak_records],
+					[peak_record.end_time for peak_record in peak_records],
+					species_table.intern_many([peak_record.species for peak_record in peak_records]))
+
+	@classmethod
+	def concatenate(cls, peak_tables):
+
+		return cls(*[np.concatenate([getattr(peak_table, column) for peak_table in peak_tables])
+					for column in cls.__slots__])
+
+	def __len__(self):
+
+		return self.ret_times.shape[0]
+
+	def __getitem__(self, index):
+
+		if isinstance(index, (int, np.integer)):
+			if index < 0:
+				index += len(self)
+			if not 0 <= index < len(self):
+				raise IndexError('peak index out of range')
+			return PeakView(self, index)
+
+		# slices, masks and index arrays select a new table
+		return PeakTable(*[getattr(self, column)[index] for column in self.__slots__])
+
+	def __iter__(self):
+
+		for index in range(len(self)):
+			yield PeakView(self, index)
+
+	def get_species(self):
+
+		return species_table.get_names(self.species_ids)
+
+	def replace(self, **columns):
+		"""
+		This method outputs a copy of the table with some columns replaced,
+		e.g. `replace(species_ids=...)`, sharing the other columns.
+		"""
+
+		return PeakTable(*[columns.get(column, getattr(self, column)) for column in self.__slots__])
+
+	def to_records(self):
+
+		return [PeakRecord(str(peak), float(ret_time), peak_type.decode('ascii'), float(width),
+						float(area), float(start_time), float(end_time), species)
+				for peak, ret_time, peak_type, width, area, start_time, end_time, species
+				in zip(self.peaks, self.ret_times, self.peak_types, self.widths, self.areas,
+						self.start_times, self.end_times, self.get_species())]
+
+	def sum_areas_by_species(self):
+		"""
+		This method sums peak areas per species, in order of first
+		appearance, and outputs a tuple `(species_ids, area_sums)`.
+		"""
+
+		species_ids, first_positions, inverse = np.unique(self.species_ids, return_index=True,
+														return_inverse=True)
+		area_sums = np.bincount(inverse, weights=self.areas, minlength=species_ids.shape[0])
+		order = np.argsort(first_positions)
+
+		return species_ids[order], area_sums[order]
+
+	def to_area_dict(self):
+		"""
+		This method outputs what `read_gc_speciation_file` outputs for the
+		report: a dictionary with key: `species` and value: summed peak area.
+		"""
+
+		species_ids, area_sums = self.sum_areas_by_species()
+
+		return dict(zip(species_table.get_names(species_ids), area_sums.tolist()))
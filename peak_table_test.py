@@ -0,0 +1,120 @@
+import unittest
+import os
+import sys
+import numpy as np
+from peak_table import (
+	PeakTable,
+	species_table
+	)
+from report_parser import iter_peak_records
+from speciation import (
+	read_gc_speciation_file,
+	read_gc_inner_standard_file,
+	calculate_speciation_in_moles_per_total_mass
+	)
+from calibration import (
+	load_fitted_calibration_factor_functions,
+	read_calibration_file
+	)
+from vectorized_speciation import build_peak_area_matrix
+
+class test_peak_table(unittest.TestCase):
+
+	def setUp(self):
+
+		self.gc_speciation_file = os.path.join('data', 'measurement', 'test_condition',
+												'gc_speciation', 'sample0.txt')
+		self.peak_table = PeakTable.from_report(self.gc_speciation_file)
+
+	def test_from_report(self):
+
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+
+		self.assertEqual(len(self.peak_table), len(peak_records))
+		self.assertEqual(self.peak_table.to_records(), peak_records)
+		self.assertEqual(PeakTable.from_records(peak_records).to_records(), peak_records)
+		self.assertEqual(self.peak_table.ret_times.dtype, np.float64)
+		self.assertEqual(self.peak_table.species_ids.dtype, np.int32)
+
+	def test_peak_views(self):
+
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+
+		peak_view = self.peak_table[2]
+		self.assertFalse(hasattr(peak_view, '__dict__'))
+		self.assertEqual(peak_view.to_record(), peak_records[2])
+		self.assertEqual(peak_view.species_id, species_table.intern(peak_records[2].species))
+		self.assertEqual(self.peak_table[-1].to_record(), peak_records[-1])
+		self.assertEqual([peak_view.area for peak_view in self.peak_table],
+						[peak_record.area for peak_record in peak_records])
+		self.assertRaises(IndexError, self.peak_table.__getitem__, len(peak_records))
+
+	def test_species_interning(self):
+
+		species_id = species_table.intern('PDD')
+		self.assertEqual(species_table.intern('PDD'), species_id)
+		self.assertEqual(species_table.get_name(species_id), 'PDD')
+		self.assertEqual(species_table.intern(''), 0)
+
+	def test_select_and_concatenate(self):
+
+		large_peaks = self.peak_table[self.peak_table.areas > 5e7]
+		self.assertTrue((large_peaks.areas > 5e7).all())
+		self.assertEqual(len(self.peak_table[:3]), 3)
+
+		peak_table = PeakTable.concatenate([self.peak_table, large_peaks])
+		self.assertEqual(len(peak_table), len(self.peak_table) + len(large_peaks))
+		self.assertEqual(peak_table.get_species()[len(self.peak_table):], large_peaks.get_species())
+
+	def test_long_peak_types(self):
+
+		# integration types are kept whole, however long
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+		peak_records[0] = peak_records[0]._replace(peak_type='BMGA S')
+		peak_table = PeakTable.from_records(peak_records)
+
+		self.assertEqual(peak_table[0].peak_type, 'BMGA S')
+		self.assertEqual(peak_table.to_records(), peak_records)
+		self.assertEqual(PeakTable.concatenate([self.peak_table, peak_table[:1]])[-1].peak_type, 'BMGA S')
+
+	def test_memory(self):
+
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+		record_bytes = sum(sys.getsizeof(peak_record) + sum(sys.getsizeof(field) for field in peak_record)
+							for peak_record in peak_records)
+		table_bytes = sum(getattr(self.peak_table, column).nbytes for column in PeakTable.__slots__)
+
+		self.assertLess(3*table_bytes, record_bytes)
+
+	def test_speciation_accepts_peak_tables(self):
+
+		self.assertEqual(read_gc_speciation_file(self.peak_table), read_gc_speciation_file(self.gc_speciation_file))
+
+		gc_inner_standard_data_dict = read_gc_inner_standard_file(os.path.join('data', 'measurement',
+									'test_condition', 'gc_inner_standard', 'sample0.csv'))
+		calibration_factor_function_dict = load_fitted_calibration_factor_functions()
+		self.assertEqual(calculate_speciation_in_moles_per_total_mass(self.peak_table,
+												gc_inner_standard_data_dict,
+												calibration_factor_function_dict),
+						calculate_speciation_in_moles_per_total_mass(
+												read_gc_speciation_file(self.gc_speciation_file),
+												gc_inner_standard_data_dict,
+												calibration_factor_function_dict))
+
+		peak_tables = [self.peak_table, self.peak_table[self.peak_table.areas > 5e7]]
+		peak_area_matrix, species_list = build_peak_area_matrix(peak_tables)
+		expected_peak_area_matrix, expected_species_list = build_peak_area_matrix(
+												[peak_table.to_area_dict() for peak_table in peak_tables])
+		self.assertEqual(species_list, expected_species_list)
+		np.testing.assert_array_equal(peak_area_matrix, expected_peak_area_matrix)
+
+		peak_area_matrix, _ = build_peak_area_matrix(peak_tables, ['PDD', 'not_there'])
+		np.testing.assert_array_equal(peak_area_matrix[:, 0],
+										expected_peak_area_matrix[:, species_list.index('PDD')])
+		self.assertTrue(np.isnan(peak_area_matrix[:, 1]).all())
+
+	def test_calibration_accepts_peak_tables(self):
+
+		calibration_file = os.path.join('data', 'calibration', 'PDD.txt')
+		self.assertEqual(read_calibration_file(PeakTable.from_report(calibration_file, 'volume')),
+						read_calibration_file(calibration_file))
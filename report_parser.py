@@ -0,0 +1,147 @@
+import os
+import re
+import sys
+import datetime
+from collections import namedtuple
+import mmap
+from instrumentation import metrics
+
+# one row of a GC report peak table (`Peak #	Ret Time	Type	Width	Area	Start Time	End Time	species`),
+# `species` is '' for peaks nobody has named yet
+PeakRecord = namedtuple('PeakRecord', ['peak', 'ret_time', 'peak_type', 'width', 'area',
+									'start_time', 'end_time', 'species'])
+
+def is_peak_table(data):
+	"""
+	This method tells whether `data` is a `peak_table.PeakTable`, without
+	importing that module (and NumPy) in processes that never built one.
+	"""
+
+	peak_table_module = sys.modules.get('peak_table')
+
+	return peak_table_module is not None and isinstance(data, peak_table_module.PeakTable)
+
+def iter_report_lines(report_file, use_mmap=False):
+	"""
+	This method lazily yields the lines of a report file, optionally
+	reading them through a read-only memory map.
+	"""
+
+	if metrics.enabled:
+		metrics.increment('files_read')
+		metrics.increment('bytes_parsed', os.path.getsize(report_file))
+
+	if not use_mmap:
+		with open(report_file, 'r') as read_in:
+			for line in read_in:
+				yield line
+		return
+
+	with open(report_file, 'rb') as read_in:
+		try:
+			mapped_file = mmap.mmap(read_in.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty files can't be mapped
+			return
+		try:
+			for line in iter(mapped_file.readline, b''):
+				yield line.decode('utf-8')
+		finally:
+			mapped_file.close()
+
+def iter_report_rows(report_file, header_prefix, delimiter='\t', use_mmap=False):
+	"""
+	This method yields the stripped fields of every non-blank line after
+	the header line starting with `header_prefix`; this is the layout shared
+	by GC speciation reports ('Peak'), calibration reports ('volume'),
+	inner standard files ('total_liquid_mass'), the species constants file
+	('species') and condition files ('Time').
+	"""
+
+	return iter_rows(iter_report_lines(report_file, use_mmap), header_prefix, delimiter)
+
+def iter_rows(lines, header_prefix, delimiter='\t'):
+	"""
+	This method is `iter_report_rows` over any iterable of report lines,
+	e.g. those of a report received as text.
+	"""
+
+	lines = iter(lines)
+	for line in lines:
+		if line.startswith(header_prefix):
+			break
+
+	for line in lines:
+		if line.strip() != '':
+			yield [field.strip() for field in line.split(delimiter)]
+
+def iter_peak_records(report_file, header_prefix='Peak', use_mmap=False):
+	"""
+	This method yields one typed `PeakRecord` per peak row of a GC report.
+	"""
+
+	return iter_rows_peak_records(iter_report_rows(report_file, header_prefix, '\t', use_mmap))
+
+def iter_text_peak_records(report_text, header_prefix='Peak'):
+	"""
+	This method yields the `PeakRecord`s of a GC report given as text.
+	"""
+
+	return iter_rows_peak_records(iter_rows(report_text.splitlines(), header_prefix, '\t'))
+
+def iter_rows_peak_records(rows):
+
+	for fields in rows:
+		yield PeakRecord(fields[0],
+						float(fields[1]),
+						fields[2],
+						float(fields[3]),
+						float(fields[4]),
+						float(fields[5]),
+						float(fields[6]),
+						fields[7] if len(fields) > 7 else '')
+
+def chain_peak_records(report_files, header_prefix='Peak', use_mmap=False):
+	"""
+	This method chains the peak records of many report files into a
+	single stream of `(report_file, peak_record)` pairs.
+	"""
+
+	for report_file in report_files:
+		for peak_record in iter_peak_records(report_file, header_prefix, use_mmap):
+			yield report_file, peak_record
+
+def parse_report_date(text):
+	"""
+	This method finds the acquisition date in a report name such as
+	`20161006_10_PDD_01ul` (YYYYMMDD, calibration reports) or
+	`07222016_sample0` (MMDDYYYY, sample reports) and outputs a
+	`datetime.date`, or None if `text` has no valid 8-digit date.
+	"""
+
+	for digits in re.findall(r'(?<!\d)\d{8}(?!\d)', text):
+		for year, month, day in [(digits[:4], digits[4:6], digits[6:]),
+								(digits[4:], digits[:2], digits[2:4])]:
+			if not 1900 <= int(year) <= 2100:
+				continue
+			try:
+				return datetime.date(int(year), int(month), int(day))
+			except ValueError:
+				continue
+
+	return None
+
+def read_report_date(report_file, header_prefix='Peak'):
+	"""
+	This method reads the acquisition date from the lines above the
+	header of a report (the `Signal:`/`TIC:` line and the report name).
+	"""
+
+	for line in iter_report_lines(report_file):
+		if line.startswith(header_prefix):
+			break
+		report_date = parse_report_date(line)
+		if report_date is not None:
+			return report_date
+
+	return None
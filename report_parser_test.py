@@ -0,0 +1,84 @@
+import unittest
+import os
+import shutil
+import datetime
+import tempfile
+from report_parser import (
+	iter_report_rows,
+	iter_peak_records,
+	chain_peak_records,
+	parse_report_date,
+	read_report_date
+	)
+
+class test_report_parser(unittest.TestCase):
+
+	def setUp(self):
+
+		self.gc_speciation_file = os.path.join('data', 'measurement', 'test_condition',
+											'gc_speciation', 'sample0.txt')
+		self.report_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.report_path)
+
+	def test_iter_report_rows(self):
+
+		calibration_file = os.path.join('data', 'calibration', 'PDD.txt')
+		rows = list(iter_report_rows(calibration_file, 'volume'))
+
+		self.assertEqual(len(rows), 4)
+		self.assertEqual(rows[0][:5], ['0.1', '20.487', 'M', '0.084', '131261886'])
+
+		rows = list(iter_report_rows(calibration_file, 'volume', use_mmap=True))
+		self.assertEqual(rows[3][4], '1084624371')
+
+	def test_iter_peak_records(self):
+
+		peak_records = list(iter_peak_records(self.gc_speciation_file))
+
+		self.assertEqual(len(peak_records), 12)
+		self.assertEqual(peak_records[2].species, 'chlorothiophene')
+		self.assertEqual(peak_records[2].area, 101958153)
+		self.assertEqual(peak_records[2].start_time, 7.536)
+		self.assertEqual(list(iter_peak_records(self.gc_speciation_file, use_mmap=True)), peak_records)
+
+	def test_iter_peak_records_large_export(self):
+
+		# an export with thousands of unnamed peaks
+		large_report_file = os.path.join(self.report_path, 'large.txt')
+		with open(large_report_file, 'w') as write_out:
+			write_out.write('TIC: large.D\\data.ms\n\nPeak #\tRet Time\tType\tWidth\tArea\tStart Time\tEnd Time\t\n')
+			for i in range(5000):
+				write_out.write('{0}\t{1:.3f}\t   M\t0.040\t{2}\t{3:.3f}\t{4:.3f}\t\n'.format(
+								i+1, 1+i*0.01, 1000+i, 0.995+i*0.01, 1.005+i*0.01))
+
+		for use_mmap in [False, True]:
+			total_area = 0
+			peak_count = 0
+			for peak_record in iter_peak_records(large_report_file, use_mmap=use_mmap):
+				self.assertEqual(peak_record.species, '')
+				total_area += peak_record.area
+				peak_count += 1
+			self.assertEqual(peak_count, 5000)
+			self.assertEqual(total_area, sum(range(1000, 6000)))
+
+	def test_chain_peak_records(self):
+
+		report_files = [self.gc_speciation_file, self.gc_speciation_file]
+		chained_records = list(chain_peak_records(report_files))
+
+		self.assertEqual(len(chained_records), 24)
+		self.assertEqual(chained_records[12][0], self.gc_speciation_file)
+		self.assertEqual(chained_records[12][1].species, 'toluene')
+
+	def test_read_report_date(self):
+
+		self.assertEqual(parse_report_date('20161006_10_PDD_01ul'), datetime.date(2016, 10, 6))
+		self.assertEqual(parse_report_date('07222016_sample0'), datetime.date(2016, 7, 22))
+		self.assertIsNone(parse_report_date('sample1_bf_instd'))
+
+		self.assertEqual(read_report_date(self.gc_speciation_file), datetime.date(2016, 7, 22))
+		self.assertEqual(read_report_date(os.path.join('data', 'calibration', 'PDD.txt'), 'volume'),
+						datetime.date(2016, 10, 6))
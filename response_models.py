@@ -0,0 +1,332 @@
+import os
+import json
+import tempfile
+import numpy as np
+from calibration import (
+	list_calibration_species,
+	read_calibration_data
+	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
+
+RESPONSE_MODELS = ['piecewise_linear', 'monotone_spline', 'quadratic']
+
+def get_response_knots(injection_moles, peak_areas):
+	"""
+	This method sorts calibration points by injection moles, averages
+	repeated injections of the same amount and puts the origin in front.
+	The detector response must increase with the amount injected, else
+	ValueError is raised since no inverse exists.
+	"""
+
+	injection_moles = np.asarray(injection_moles, dtype=float)
+	peak_areas = np.asarray(peak_areas, dtype=float)
+	selected = injection_moles > 0
+
+	x, inverse = np.unique(injection_moles[selected], return_inverse=True)
+	y = np.bincount(inverse, weights=peak_areas[selected])/np.bincount(inverse)
+	x = np.concatenate([[0.0], x])
+	y = np.concatenate([[0.0], y])
+
+	if x.shape[0] < 2 or np.any(np.diff(y) <= 0):
+		raise ValueError('Peak areas must increase with injection moles')
+
+	return x, y
+
+def get_monotone_spline_slopes(x, y):
+	"""
+	This method outputs the knot derivatives of the monotone piecewise
+	cubic Hermite (PCHIP) interpolant of Fritsch and Carlson: a weighted
+	harmonic mean of neighbouring secant slopes inside, and shape-preserving
+	three-point estimates at both ends.
+	"""
+
+	h = np.diff(x)
+	secants = np.diff(y)/h
+	if secants.shape[0] == 1:
+		return np.full(2, secants[0])
+
+	slopes = np.zeros(x.shape[0])
+	w1 = 2*h[1:] + h[:-1]
+	w2 = h[1:] + 2*h[:-1]
+	# knots next to a flat segment keep a zero slope
+	increasing = (secants[:-1] > 0) & (secants[1:] > 0)
+	slopes[1:-1][increasing] = (w1 + w2)[increasing]/(w1[increasing]/secants[:-1][increasing]
+													+ w2[increasing]/secants[1:][increasing])
+
+	for end, (h0, h1, secant0, secant1) in [(0, (h[0], h[1], secants[0], secants[1])),
+											(-1, (h[-1], h[-2], secants[-1], secants[-2]))]:
+		slope = ((2*h0 + h1)*secant0 - h0*secant1)/(h0 + h1)
+		if slope <= 0:
+			slope = 0.0
+		elif slope > 3*secant0:
+			slope = 3*secant0
+		slopes[end] = slope
+
+	return slopes
+
+class ResponseModel(object):
+	"""
+	This class is a fitted detector response `peak_area = f(injection_moles)`
+	of one species, increasing with `injection_moles`:
+
+		piecewise_linear: straight segments through the origin and the
+			averaged calibration points
+		monotone_spline: monotone cubic (PCHIP) through the same knots
+		quadratic: `peak_area = a*injection_moles + c*injection_moles^2`,
+			fitted by least squares
+
+	Beyond the last calibration point every model continues linearly with
+	its slope there, see `get_end_slope`.
+	"""
+
+	def __init__(self, model, params):
+
+		if model not in RESPONSE_MODELS:
+			raise ValueError('Unknown response model: {0}'.format(model))
+
+		self.model = model
+		self.params = dict((key, np.asarray(value, dtype=float)) for key, value in params.items())
+
+	@classmethod
+	def fit(cls, injection_moles, peak_areas, model='monotone_spline'):
+
+		x, y = get_response_knots(injection_moles, peak_areas)
+
+		if model == 'piecewise_linear':
+			return cls(model, {'x': x, 'y': y})
+
+		if model == 'monotone_spline':
+			return cls(model, {'x': x, 'y': y, 'slopes': get_monotone_spline_slopes(x, y)})
+
+		if model == 'quadratic':
+			# scaled columns keep the least-squares problem well conditioned
+			scale = x[-1]
+			design = np.column_stack([x/scale, (x/scale)**2])
+			(a, c), _, _, _ = np.linalg.lstsq(design, y, rcond=None)
+			a, c = a/scale, c/scale**2
+			if a <= 0 or a + 2*c*x[-1] <= 0:
+				raise ValueError('Quadratic response is not increasing over the calibration range')
+			return cls(model, {'a': [a], 'c': [c], 'x_max': [x[-1]]})
+
+		raise ValueError('Unknown response model: {0}'.format(model))
+
+	def get_max_injection_moles(self):
+
+		if self.model == 'quadratic':
+			return float(self.params['x_max'][0])
+
+		return float(self.params['x'][-1])
+
+	def get_end_slope(self):
+		"""
+		This method outputs d(peak_area)/d(injection_moles) at the last
+		calibration point, the slope the response continues with beyond it.
+		"""
+
+		if self.model == 'quadratic':
+			return float(self.params['a'][0] + 2*self.params['c'][0]*self.params['x_max'][0])
+
+		x, y = self.params['x'], self.params['y']
+		last_secant = float((y[-1] - y[-2])/(x[-1] - x[-2]))
+		if self.model == 'monotone_spline' and self.params['slopes'][-1] > 0:
+			return float(self.params['slopes'][-1])
+
+		return last_secant
+
+	def predict(self, injection_moles):
+		"""
+		This method evaluates the response at an array of `injection_moles`.
+		"""
+
+		injection_moles = np.asarray(injection_moles, dtype=float)
+		max_injection_moles = self.get_max_injection_moles()
+		above = injection_moles > max_injection_moles
+		inside_moles = np.where(above, max_injection_moles, injection_moles)
+
+		if self.model == 'quadratic':
+			a, c = self.params['a'][0], self.params['c'][0]
+			peak_areas = a*inside_moles + c*inside_moles**2
+		else:
+			x, y = self.params['x'], self.params['y']
+			index = np.clip(np.searchsorted(x, inside_moles, side='right') - 1, 0, x.shape[0] - 2)
+			h = x[index + 1] - x[index]
+			t = (inside_moles - x[index])/h
+
+			if self.model == 'piecewise_linear':
+				peak_areas = y[index] + t*(y[index + 1] - y[index])
+			else:
+				slopes = self.params['slopes']
+				h00 = (1 + 2*t)*(1 - t)**2
+				h10 = t*(1 - t)**2
+				h01 = t**2*(3 - 2*t)
+				h11 = t**2*(t - 1)
+				peak_areas = h00*y[index] + h10*h*slopes[index] + h01*y[index + 1] + h11*h*slopes[index + 1]
+
+		return np.where(above, peak_areas + (injection_moles - inside_moles)*self.get_end_slope(), peak_areas)
+
+	def invert(self, peak_areas, iterations=64):
+		"""
+		This method outputs the injection moles giving `peak_areas`, by the
+		closed form for quadratic models and by bisection otherwise. It is
+		exact but slow; speciation uses the lookup table instead.
+		"""
+
+		peak_areas = np.asarray(peak_areas, dtype=float)
+		max_injection_moles = self.get_max_injection_moles()
+		max_peak_area = float(self.predict(max_injection_moles))
+		above = peak_areas > max_peak_area
+		inside_peak_areas = np.where(above, max_peak_area, peak_areas)
+
+		if self.model == 'quadratic':
+			a, c = self.params['a'][0], self.params['c'][0]
+			# stable root of c*n^2 + a*n - peak_area = 0
+			injection_moles = 2*inside_peak_areas/(a + np.sqrt(a**2 + 4*c*inside_peak_areas))
+		else:
+			low = np.zeros(peak_areas.shape)
+			high = np.full(peak_areas.shape, max_injection_moles)
+			for i in range(iterations):
+				middle = 0.5*(low + high)
+				below = self.predict(middle) < inside_peak_areas
+				low = np.where(below, middle, low)
+				high = np.where(below, high, middle)
+			injection_moles = 0.5*(low + high)
+
+		return np.where(above, max_injection_moles + (peak_areas - max_peak_area)/self.get_end_slope(),
+						injection_moles)
+
+	def build_lookup_table(self, table_size=4097):
+		"""
+		This method tabulates the inverse response on `table_size` equally
+		spaced peak areas from 0 to the response at the last calibration point.
+		"""
+
+		max_peak_area = float(self.predict(self.get_max_injection_moles()))
+		peak_area_step = max_peak_area/(table_size - 1)
+		moles = self.invert(np.arange(table_size)*peak_area_step)
+		moles[0] = 0.0
+
+		return ResponseLookupTable(peak_area_step, moles)
+
+	def to_dict(self):
+
+		return {'model': self.model,
+				'params': dict((key, value.tolist()) for key, value in self.params.items())}
+
+class ResponseLookupTable(object):
+	"""
+	This class converts peak areas to injection moles by linear
+	interpolation in a dense table of the inverse detector response,
+	`moles[i]` being the moles giving a peak area of `i*peak_area_step`.
+	Indices are computed instead of searched, so converting an array of
+	any shape is a few vectorized operations. Areas beyond the table
+	continue with the slope of its last segment, which is close to the
+	end slope of the model; NaN stays NaN.
+	"""
+
+	def __init__(self, peak_area_step, moles):
+
+		self.peak_area_step = float(peak_area_step)
+		self.moles = np.asarray(moles, dtype=float)
+
+	def to_moles(self, peak_areas):
+
+		position = np.asarray(peak_areas, dtype=float)/self.peak_area_step
+		index = np.clip(np.floor(np.nan_to_num(position)), 0, self.moles.shape[0] - 2).astype(np.intp)
+		fraction = position - index
+
+		return self.moles[index] + fraction*(self.moles[index + 1] - self.moles[index])
+
+	def to_dict(self):
+
+		return {'peak_area_step': self.peak_area_step, 'moles': self.moles.tolist()}
+
+	@classmethod
+	def from_dict(cls, lookup_table_dict):
+
+		return cls(lookup_table_dict['peak_area_step'], lookup_table_dict['moles'])
+
+@timed('calibration_fit')
+def fit_response_models(calibration_data_dict, model='monotone_spline', table_size=4097):
+	"""
+	This method fits a response `model` for every species of `calibration_data_dict`
+	(see `read_calibration_data`) and outputs a dictionary with
+	key: `species` and value: tuple `(response_model, response_lookup_table)`.
+	"""
+
+	response_model_dict = {}
+	for species, (injection_moles, peak_areas) in calibration_data_dict.items():
+		response_model = ResponseModel.fit(injection_moles, peak_areas, model)
+		response_model_dict[species] = (response_model, response_model.build_lookup_table(table_size))
+	if metrics.enabled:
+		metrics.increment('species_calibrated', len(response_model_dict))
+
+	return response_model_dict
+
+def save_response_models(response_model_dict, response_models_file):
+
+	saved_response_models = {}
+	for species, (response_model, response_lookup_table) in response_model_dict.items():
+		saved_response_models[species] = response_model.to_dict()
+		saved_response_models[species]['lookup_table'] = response_lookup_table.to_dict()
+
+	with metrics.stage_timer('json_write'):
+		# a temporary file of its own, so that processes saving at once never mix their writes
+		descriptor, temporary_file = tempfile.mkstemp(prefix='fitted_response_models.', suffix='.tmp',
+													dir=os.path.dirname(response_models_file))
+		try:
+			with os.fdopen(descriptor, 'w') as write_out:
+				json.dump(saved_response_models, write_out, indent=2, sort_keys=True)
+			os.replace(temporary_file, response_models_file)
+		except BaseException:
+			os.remove(temporary_file)
+			raise
+
+def load_response_lookup_tables(response_models_file):
+	"""
+	This method reads `fitted_response_models.json` and outputs a dictionary
+	with key: `species` and value: `ResponseLookupTable`.
+	"""
+
+	with open(response_models_file, 'r') as read_in:
+		saved_response_models = json.load(read_in)
+
+	return dict((species, ResponseLookupTable.from_dict(saved_response_model['lookup_table']))
+				for species, saved_response_model in saved_response_models.items())
+
+@timed('calibration')
+def prepare_response_models(
+						calibration_species_list=None,
+						calibration_path=None,
+						model='monotone_spline',
+						table_size=4097,
+						registry=None,
+						workspace=None
+						):
+	"""
+	This method fits response models on all calibration points and saves
+	them with their lookup tables to `fitted_response_models.json` in the
+	folder of `registry` (default: the calibration folder of `workspace`).
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if calibration_path is None:
+		calibration_path = workspace.calibration_path
+
+	if calibration_species_list is None:
+		calibration_species_list = list_calibration_species(calibration_path)
+
+	if registry is None:
+		registry = workspace.registry
+
+	calibration_data_dict = read_calibration_data(calibration_species_list, calibration_path, registry)
+	response_model_dict = fit_response_models(calibration_data_dict, model, table_size)
+	save_response_models(response_model_dict,
+						os.path.join(registry.calibration_path, 'fitted_response_models.json'))
+
+	return response_model_dict
@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from calibration import (
+	CalibrationRegistry,
+	read_calibration_data
+	)
+from response_models import (
+	RESPONSE_MODELS,
+	ResponseModel,
+	get_monotone_spline_slopes,
+	prepare_response_models
+	)
+from speciation import (
+	prepare_speciation_in_moles_per_total_mass,
+	read_gc_inner_standard_file,
+	read_gc_speciation_file
+	)
+from vectorized_speciation import calculate_speciation_for_samples
+
+class test_response_models(unittest.TestCase):
+
+	def setUp(self):
+
+		self.calibration_data_dict = read_calibration_data(['PDD', 'chlorothiophene'])
+
+	def test_response_models(self):
+
+		injection_moles, peak_areas = self.calibration_data_dict['PDD']
+		for model in RESPONSE_MODELS:
+			response_model = ResponseModel.fit(injection_moles, peak_areas, model)
+
+			# the response bends down: concave over the calibration range
+			self.assertLess(float(response_model.predict(injection_moles[-1]))/injection_moles[-1],
+							float(response_model.predict(injection_moles[0]))/injection_moles[0])
+			if model != 'quadratic':
+				np.testing.assert_allclose(response_model.predict(injection_moles), peak_areas, rtol=1e-12)
+
+			test_peak_areas = np.linspace(0, 1.2*peak_areas[-1], 101)[1:]
+			test_moles = response_model.invert(test_peak_areas)
+			np.testing.assert_allclose(response_model.predict(test_moles), test_peak_areas, rtol=1e-9)
+
+			response_lookup_table = response_model.build_lookup_table()
+			np.testing.assert_allclose(response_lookup_table.to_moles(test_peak_areas), test_moles, rtol=1e-4)
+			self.assertTrue(np.isnan(response_lookup_table.to_moles(np.nan)))
+
+		self.assertRaises(ValueError, ResponseModel.fit, [1, 2], [2.0, 1.0], 'piecewise_linear')
+
+	def test_monotone_spline_slopes(self):
+
+		x = np.array([0.0, 1.0, 2.0, 3.0])
+		y = np.array([0.0, 1.0, 1.0, 2.0])
+		slopes = get_monotone_spline_slopes(x, y)
+
+		# flat segments keep zero slopes so the spline never overshoots
+		self.assertEqual(slopes[1], 0)
+		self.assertEqual(slopes[2], 0)
+		response_model = ResponseModel('monotone_spline', {'x': x, 'y': y, 'slopes': slopes})
+		self.assertTrue(np.all(np.diff(response_model.predict(np.linspace(0, 3, 301))) > -1e-12))
+
+	def test_speciation_with_response_models(self):
+
+		calibration_path = tempfile.mkdtemp()
+		try:
+			shutil.copy(os.path.join('data', 'calibration', 'calibration_species_constants.csv'), calibration_path)
+			registry = CalibrationRegistry(calibration_path)
+			prepare_response_models(None, os.path.join('data', 'calibration'), 'piecewise_linear', registry=registry)
+			response_lookup_tables = registry.get_response_lookup_tables()
+			self.assertEqual(sorted(response_lookup_tables), ['PDD', 'chlorothiophene', 'toluene', 'undecane'])
+			self.assertEqual([f for f in os.listdir(calibration_path) if f.endswith('.tmp')], [])
+
+			speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0', {},
+																		registry=registry,
+																		save_results=False,
+																		response_lookup_tables=response_lookup_tables)
+			linear_speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+																		save_results=False)
+			self.assertEqual(sorted(speciation_dict), ['PDD', 'toluene', 'undecane'])
+			self.assertNotAlmostEqual(speciation_dict['PDD']/linear_speciation_dict['PDD'], 1.0, 2)
+
+			# the vectorized path converts whole columns with the same tables
+			test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+			speciation_matrix, species_list = calculate_speciation_for_samples(
+								[read_gc_speciation_file(os.path.join(test_condition_path, 'gc_speciation', 'sample0.txt'))],
+								[read_gc_inner_standard_file(os.path.join(test_condition_path, 'gc_inner_standard', 'sample0.csv'))],
+								{},
+								registry,
+								response_lookup_tables)
+			for species, moles_per_total_mass in speciation_dict.items():
+				self.assertAlmostEqual(speciation_matrix[0, species_list.index(species)]/moles_per_total_mass, 1.0, 12)
+		finally:
+			shutil.rmtree(calibration_path)
@@ -0,0 +1,238 @@
+import os
+import json
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+from instrumentation import timed
+from workspace import get_default_workspace
+
+def get_result_store_file(condition, gc_measurement_path=None, workspace=None):
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
+	return os.path.join(gc_measurement_path, condition, 'speciation_results.npz')
+
+@contextmanager
+def lock_condition_results(condition, gc_measurement_path):
+	"""
+	This method holds an exclusive lock on the result store of a condition,
+	`<condition>/speciation_results.lock`, so that processes updating it
+	(a batch run, the watch daemon, a queue merge) don't drop each other's
+	samples. Locking needs `fcntl`; elsewhere writers are not serialized.
+	"""
+
+	try:
+		import fcntl
+	except ImportError:
+		yield
+		return
+
+	lock_file = os.path.join(gc_measurement_path, condition, 'speciation_results.lock')
+	with open(lock_file, 'a') as lock:
+		fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+def speciation_dicts_to_columns(speciation_dict_by_sample):
+	"""
+	This method converts a dictionary with key: `sample` and value: speciation
+	in moles/g into columnar arrays `(samples, species_list, values)` where
+	`values` has shape (samples, species) and NaN marks species not reported
+	for a sample. Samples and species are sorted.
+	"""
+
+	samples = sorted(speciation_dict_by_sample)
+	species_set = set()
+	for speciation_dict in speciation_dict_by_sample.values():
+		species_set.update(speciation_dict)
+	species_list = sorted(species_set)
+	species_index_dict = dict((species, j) for j, species in enumerate(species_list))
+
+	values = np.full((len(samples), len(species_list)), np.nan)
+	for i, sample in enumerate(samples):
+		for species, moles_per_total_mass in speciation_dict_by_sample[sample].items():
+			values[i, species_index_dict[species]] = moles_per_total_mass
+
+	return samples, species_list, values
+
+def columns_to_speciation_dicts(samples, species_list, values):
+
+	speciation_dict_by_sample = {}
+	for i, sample in enumerate(samples):
+		row = values[i]
+		speciation_dict_by_sample[sample] = dict((species_list[j], float(row[j]))
+												for j in np.flatnonzero(~np.isnan(row)))
+
+	return speciation_dict_by_sample
+
+def merge_columns(old_columns, new_columns):
+	"""
+	This method merges two `(samples, species_list, values)` column sets;
+	rows of `new_columns` replace rows of the same sample in `old_columns`.
+	"""
+
+	old_samples, old_species_list, old_values = old_columns
+	new_samples, new_species_list, new_values = new_columns
+
+	samples = sorted(set(old_samples) | set(new_samples))
+	species_list = sorted(set(old_species_list) | set(new_species_list))
+	sample_index_dict = dict((sample, i) for i, sample in enumerate(samples))
+	species_index_dict = dict((species, j) for j, species in enumerate(species_list))
+
+	values = np.full((len(samples), len(species_list)), np.nan)
+	for column_samples, column_species_list, column_values in [old_columns, new_columns]:
+		rows = np.array([sample_index_dict[sample] for sample in column_samples], dtype=int)
+		columns = np.array([species_index_dict[species] for species in column_species_list], dtype=int)
+		values[np.ix_(rows, columns)] = column_values
+
+	return samples, species_list, values
+
+def load_condition_results(condition, gc_measurement_path=None, workspace=None):
+	"""
+	This method loads the columnar speciation results of a condition as
+	`(samples, species_list, values)`, or None if the condition has no store.
+	"""
+
+	result_store_file = get_result_store_file(condition, gc_measurement_path, workspace)
+	if not os.path.exists(result_store_file):
+		return None
+
+	with np.load(result_store_file, allow_pickle=False) as result_store:
+		samples = [str(sample) for sample in result_store['samples']]
+		species_list = [str(species) for species in result_store['species']]
+		values = result_store['values']
+
+	return samples, species_list, values
+
+@timed('result_write')
+def save_condition_results(condition, speciation_dict_by_sample, gc_measurement_path=None, merge=True,
+						catalog_file=None, workspace=None):
+	"""
+	This method writes the speciation results of many samples of a condition
+	into `data/measurement/<condition>/speciation_results.npz` in one go.
+	With `merge=True` samples already in the store are kept unless they are
+	in `speciation_dict_by_sample`. The file is replaced atomically, and the
+	store is locked from reading to replacing (see `lock_condition_results`).
+
+	The same samples are added to the results catalog `catalog_file`, or to
+	the catalog of `workspace` (default: `data/results_catalog.sqlite`) if
+	that one was built (see `results_catalog`).
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	result_store_file = get_result_store_file(condition, gc_measurement_path)
+	with lock_condition_results(condition, gc_measurement_path):
+		columns = speciation_dicts_to_columns(speciation_dict_by_sample)
+		if merge:
+			old_columns = load_condition_results(condition, gc_measurement_path)
+			if old_columns is not None:
+				columns = merge_columns(old_columns, columns)
+		samples, species_list, values = columns
+
+		descriptor, temporary_file = tempfile.mkstemp(prefix='speciation_results.', suffix='.tmp.npz',
+													dir=os.path.dirname(result_store_file))
+		try:
+			with os.fdopen(descriptor, 'wb') as write_out:
+				np.savez(write_out,
+						samples=np.array(samples, dtype=str),
+						species=np.array(species_list, dtype=str),
+						values=values)
+			os.replace(temporary_file, result_store_file)
+		except BaseException:
+			os.remove(temporary_file)
+			raise
+
+	from results_catalog import get_catalog
+	if catalog_file is None and os.path.exists(workspace.catalog_file):
+		catalog_file = workspace.catalog_file
+	if catalog_file is not None:
+		get_catalog(catalog_file).add_condition_results(condition, speciation_dict_by_sample,
+														gc_measurement_path,
+														replace_condition=not merge)
+
+class ResultWriter(object):
+	"""
+	This class collects the speciation results of single samples and writes
+	the store of each condition once, on `flush` or at the end of a `with`
+	block, rather than rewriting it for every sample:
+
+		with ResultWriter() as result_writer:
+			for sample in samples:
+				prepare_speciation_in_moles_per_total_mass(condition, sample,
+															result_writer=result_writer)
+
+	Paths not given are those of `workspace` (default: `data`).
+	"""
+
+	def __init__(self, gc_measurement_path=None, workspace=None):
+
+		if workspace is None:
+			workspace = get_default_workspace()
+
+		if gc_measurement_path is None:
+			gc_measurement_path = workspace.gc_measurement_path
+
+		self.gc_measurement_path = gc_measurement_path
+		self.workspace = workspace
+		self._pending = {} # key: condition, value: {sample: speciation in moles/g}
+
+	def add(self, condition, sample, speciation_dict_in_moles_per_total_mass):
+
+		self._pending.setdefault(condition, {})[sample] = speciation_dict_in_moles_per_total_mass
+
+	def flush(self):
+		"""
+		This method writes the collected samples, one store write per
+		condition, and outputs their number.
+		"""
+
+		pending, self._pending = self._pending, {}
+		for condition, speciation_dict_by_sample in sorted(pending.items()):
+			save_condition_results(condition, speciation_dict_by_sample, self.gc_measurement_path,
+									workspace=self.workspace)
+
+		return sum(len(speciation_dict_by_sample) for speciation_dict_by_sample in pending.values())
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *args):
+
+		self.flush()
+
+@timed('result_read')
+def load_condition_speciation_dicts(condition, gc_measurement_path=None, workspace=None):
+	"""
+	This method outputs a dictionary with key: `sample` and value: speciation in
+	moles/g for a condition, from its result store or, for folders written
+	before the store existed, from the `speciation_results/*.json` files.
+	"""
+
+	columns = load_condition_results(condition, gc_measurement_path, workspace)
+	if columns is not None:
+		return columns_to_speciation_dicts(*columns)
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+	speciation_results_path = os.path.join(gc_measurement_path, condition, 'speciation_results')
+
+	speciation_dict_by_sample = {}
+	for f in os.listdir(speciation_results_path):
+		if os.path.isfile(os.path.join(speciation_results_path, f)) and f.endswith('.json'):
+			with open(os.path.join(speciation_results_path, f), 'r') as read_in:
+				speciation_dict_by_sample[f.split('.json')[0]] = json.load(read_in)
+
+	return speciation_dict_by_sample
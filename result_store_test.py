@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+from result_store import (
+	ResultWriter,
+	speciation_dicts_to_columns,
+	save_condition_results,
+	load_condition_results,
+	load_condition_speciation_dicts
+	)
+
+class test_result_store(unittest.TestCase):
+
+	def setUp(self):
+
+		self.gc_measurement_path = tempfile.mkdtemp()
+		os.mkdir(os.path.join(self.gc_measurement_path, 'test_condition'))
+
+	def tearDown(self):
+
+		shutil.rmtree(self.gc_measurement_path)
+
+	def test_speciation_dicts_to_columns(self):
+
+		samples, species_list, values = speciation_dicts_to_columns({
+											'sample1': {'PDD': 1e-3, 'toluene': 2e-4},
+											'sample0': {'PDD': 2e-3}})
+
+		self.assertEqual(samples, ['sample0', 'sample1'])
+		self.assertEqual(species_list, ['PDD', 'toluene'])
+		self.assertEqual(values[1, 1], 2e-4)
+		self.assertTrue(np.isnan(values[0, 1]))
+
+	def test_save_condition_results(self):
+
+		save_condition_results('test_condition', {'sample0': {'PDD': 2e-3, 'toluene': 1e-4},
+												'sample1': {'PDD': 1e-3}},
+								self.gc_measurement_path)
+		save_condition_results('test_condition', {'sample1': {'undecane': 5e-4},
+												'sample2': {'PDD': 3e-3}},
+								self.gc_measurement_path)
+
+		samples, species_list, values = load_condition_results('test_condition', self.gc_measurement_path)
+		self.assertEqual(samples, ['sample0', 'sample1', 'sample2'])
+		self.assertEqual(species_list, ['PDD', 'toluene', 'undecane'])
+		self.assertEqual(values.shape, (3, 3))
+
+		speciation_dict_by_sample = load_condition_speciation_dicts('test_condition', self.gc_measurement_path)
+		self.assertEqual(speciation_dict_by_sample['sample0'], {'PDD': 2e-3, 'toluene': 1e-4})
+		self.assertEqual(speciation_dict_by_sample['sample1'], {'undecane': 5e-4})
+
+	@unittest.skipIf(os.name == 'nt', 'result stores are only locked where fcntl exists')
+	def test_save_condition_results_concurrently(self):
+
+		def save_samples(first_sample):
+			for i in range(first_sample, first_sample + 10):
+				save_condition_results('test_condition', {'sample{0}'.format(i): {'PDD': float(i)}},
+										self.gc_measurement_path)
+
+		threads = [threading.Thread(target=save_samples, args=(10*j,)) for j in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		# no writer dropped another's samples or left a temporary file
+		speciation_dict_by_sample = load_condition_speciation_dicts('test_condition', self.gc_measurement_path)
+		self.assertEqual(len(speciation_dict_by_sample), 40)
+		self.assertEqual(speciation_dict_by_sample['sample37'], {'PDD': 37.0})
+		self.assertEqual(sorted(os.listdir(os.path.join(self.gc_measurement_path, 'test_condition'))),
+						['speciation_results.lock', 'speciation_results.npz'])
+
+	def test_result_writer(self):
+
+		with ResultWriter(self.gc_measurement_path) as result_writer:
+			for i in range(3):
+				result_writer.add('test_condition', 'sample{0}'.format(i), {'PDD': 1e-3*i})
+			# nothing is written before the end of the block
+			self.assertIsNone(load_condition_results('test_condition', self.gc_measurement_path))
+
+		speciation_dict_by_sample = load_condition_speciation_dicts('test_condition', self.gc_measurement_path)
+		self.assertEqual(sorted(speciation_dict_by_sample), ['sample0', 'sample1', 'sample2'])
+		self.assertEqual(speciation_dict_by_sample['sample2'], {'PDD': 2e-3})
+		self.assertEqual(result_writer.flush(), 0)
+
+	def test_load_condition_speciation_dicts_from_json(self):
+
+		speciation_dict_by_sample = load_condition_speciation_dicts('test_condition')
+
+		self.assertEqual(list(speciation_dict_by_sample), ['sample0'])
+		self.assertIn('PDD', speciation_dict_by_sample['sample0'])
@@ -0,0 +1,523 @@
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+import numpy as np
+from report_parser import read_report_date
+from instrumentation import timed
+from workspace import get_default_workspace
+
+# columns of a catalog query, one entry per (sample, species) value
+CatalogRows = namedtuple('CatalogRows', ['campaigns', 'conditions', 'samples', 'species',
+										'temperatures', 'acquisition_dates', 'values'])
+
+# columns of a trajectory query, one entry per (sample, species, time) normalized value
+TrajectoryRows = namedtuple('TrajectoryRows', ['campaigns', 'sources', 'samples', 'species',
+												'temperatures', 'pressures', 'times', 'values'])
+
+# the source of the trajectories written by `save_exptl_trajectories`; those
+# of `save_exptl_data_to_chemkin_simulation_format` are named by their condition
+EXPTL_TRAJECTORIES_SOURCE = 'exptl_trajectories'
+
+# keys of integration outputs that are not species
+TRAJECTORY_KEYS = ['Time', 'Temperature', 'Pressure', 'conditions']
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conditions (
+	condition_id INTEGER PRIMARY KEY,
+	campaign TEXT NOT NULL,
+	condition TEXT NOT NULL,
+	time REAL,
+	temperature REAL,
+	pressure REAL,
+	UNIQUE (campaign, condition)
+);
+CREATE TABLE IF NOT EXISTS samples (
+	sample_id INTEGER PRIMARY KEY,
+	condition_id INTEGER NOT NULL REFERENCES conditions (condition_id),
+	sample TEXT NOT NULL,
+	acquisition_date TEXT,
+	UNIQUE (condition_id, sample)
+);
+CREATE TABLE IF NOT EXISTS species (
+	species_id INTEGER PRIMARY KEY,
+	species TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS results (
+	sample_id INTEGER NOT NULL REFERENCES samples (sample_id),
+	species_id INTEGER NOT NULL REFERENCES species (species_id),
+	moles_per_total_mass REAL NOT NULL,
+	PRIMARY KEY (sample_id, species_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trajectories (
+	campaign TEXT NOT NULL,
+	source TEXT NOT NULL,
+	sample TEXT NOT NULL,
+	temperature REAL NOT NULL,
+	pressure REAL NOT NULL,
+	time REAL NOT NULL,
+	species_id INTEGER NOT NULL REFERENCES species (species_id),
+	moles_per_total_mass REAL NOT NULL,
+	PRIMARY KEY (campaign, source, sample, temperature, pressure, time, species_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_by_species ON results (species_id, sample_id);
+CREATE INDEX IF NOT EXISTS trajectories_by_species ON trajectories (species_id, temperature);
+CREATE INDEX IF NOT EXISTS samples_by_sample ON samples (sample);
+CREATE INDEX IF NOT EXISTS samples_by_date ON samples (acquisition_date);
+CREATE INDEX IF NOT EXISTS conditions_by_condition ON conditions (condition);
+CREATE INDEX IF NOT EXISTS conditions_by_temperature ON conditions (temperature);
+"""
+
+def get_default_catalog_file():
+
+	return get_default_workspace().catalog_file
+
+class ResultsCatalog(object):
+	"""
+	This class is an SQLite catalog of speciation results of any number of
+	measurement folders (campaigns), indexed by species, condition, sample,
+	temperature (from `condition.csv`) and acquisition date (from the GC
+	report), so that cross-campaign questions such as "PDD mol/g of every
+	450C sample this year" are answered by `query` without reading any
+	result store.
+
+	Result writers feed it through `add_condition_results`; see
+	`result_store.save_condition_results`. The normalized trajectories of
+	`exptl_data_integration` are catalogued too, through `add_trajectories`,
+	and queried with `query_trajectories`.
+	"""
+
+	def __init__(self, catalog_file=None):
+
+		if catalog_file is None:
+			catalog_file = get_default_catalog_file()
+
+		self.catalog_file = catalog_file
+		self._lock = threading.Lock()
+		self._connection = sqlite3.connect(catalog_file, check_same_thread=False)
+		self._connection.execute('PRAGMA journal_mode=WAL')
+		self._connection.execute('PRAGMA synchronous=NORMAL')
+		self._connection.executescript(CATALOG_SCHEMA)
+		self._species_ids = dict((species, species_id) for species_id, species
+								in self._connection.execute('SELECT species_id, species FROM species'))
+
+	def close(self):
+
+		with self._lock:
+			self._connection.execute('PRAGMA optimize')
+			self._connection.close()
+
+	def analyze(self):
+		"""
+		This method updates the statistics the query planner uses to pick
+		the most selective index, e.g. temperature before species.
+		"""
+
+		with self._lock:
+			self._connection.execute('ANALYZE')
+
+	def _get_species_id(self, species):
+
+		species_id = self._species_ids.get(species)
+		if species_id is None:
+			# another process may have added the species meanwhile
+			self._connection.execute('INSERT OR IGNORE INTO species (species) VALUES (?)', (species,))
+			species_id = self._connection.execute('SELECT species_id FROM species WHERE species = ?',
+												(species,)).fetchone()[0]
+			self._species_ids[species] = species_id
+
+		return species_id
+
+	def _lookup_species_ids(self, species_list):
+
+		if any(species not in self._species_ids for species in species_list):
+			self._species_ids = dict((species, species_id) for species_id, species
+									in self._connection.execute('SELECT species_id, species FROM species'))
+
+		return [self._species_ids.get(species, -1) for species in species_list]
+
+	def _get_condition_id(self, campaign, condition, condition_details):
+
+		time, temperature, pressure = condition_details if condition_details is not None else (None, None, None)
+		self._connection.execute('INSERT INTO conditions (campaign, condition, time, temperature, pressure) '
+								'VALUES (?, ?, ?, ?, ?) ON CONFLICT (campaign, condition) DO UPDATE SET '
+								'time = excluded.time, temperature = excluded.temperature, '
+								'pressure = excluded.pressure',
+								(campaign, condition, time, temperature, pressure))
+
+		return self._connection.execute('SELECT condition_id FROM conditions WHERE campaign = ? AND condition = ?',
+										(campaign, condition)).fetchone()[0]
+
+	@timed('catalog_write')
+	def add_condition_results(
+						self,
+						condition,
+						speciation_dict_by_sample,
+						gc_measurement_path=None,
+						replace_condition=False,
+						workspace=None
+						):
+		"""
+		This method adds (or replaces) the results of some samples of a
+		condition, in one transaction. With `replace_condition=True` samples
+		of the condition that are not in `speciation_dict_by_sample` are
+		removed, as when its result store is rewritten without merging.
+		"""
+
+		if gc_measurement_path is None:
+			if workspace is None:
+				workspace = get_default_workspace()
+			gc_measurement_path = workspace.gc_measurement_path
+
+		campaign = os.path.abspath(gc_measurement_path)
+		condition_details = read_condition_details_if_any(condition, gc_measurement_path)
+		acquisition_dates = {}
+		for sample in speciation_dict_by_sample:
+			acquisition_dates[sample] = read_acquisition_date_if_any(condition, sample, gc_measurement_path)
+
+		with self._lock:
+			try:
+				self._add_condition_results(campaign, condition, condition_details,
+											speciation_dict_by_sample, acquisition_dates,
+											replace_condition)
+			except Exception:
+				# species ids of a rolled back transaction must not be reused
+				self._species_ids = {}
+				raise
+
+	def _add_condition_results(self, campaign, condition, condition_details, speciation_dict_by_sample,
+								acquisition_dates, replace_condition):
+
+		with self._connection:
+			condition_id = self._get_condition_id(campaign, condition, condition_details)
+			if replace_condition:
+				self._connection.execute('DELETE FROM results WHERE sample_id IN '
+										'(SELECT sample_id FROM samples WHERE condition_id = ?)', (condition_id,))
+				self._connection.execute('DELETE FROM samples WHERE condition_id = ?', (condition_id,))
+
+			rows = []
+			for sample, speciation_dict in speciation_dict_by_sample.items():
+				self._connection.execute('INSERT INTO samples (condition_id, sample, acquisition_date) '
+										'VALUES (?, ?, ?) ON CONFLICT (condition_id, sample) DO UPDATE SET '
+										'acquisition_date = excluded.acquisition_date',
+										(condition_id, sample, acquisition_dates[sample]))
+				sample_id = self._connection.execute('SELECT sample_id FROM samples WHERE condition_id = ? '
+													'AND sample = ?', (condition_id, sample)).fetchone()[0]
+				self._connection.execute('DELETE FROM results WHERE sample_id = ?', (sample_id,))
+				for species, moles_per_total_mass in speciation_dict.items():
+					rows.append((sample_id, self._get_species_id(species), moles_per_total_mass))
+
+			self._connection.executemany('INSERT INTO results (sample_id, species_id, moles_per_total_mass) '
+										'VALUES (?, ?, ?)', rows)
+
+	@timed('catalog_write')
+	def add_trajectories(self, source, trajectories, gc_measurement_path=None, workspace=None):
+		"""
+		This method replaces the trajectories of `source` (a condition after
+		experiment, or `EXPTL_TRAJECTORIES_SOURCE`) of a campaign, in one
+		transaction. `trajectories` is a list of tuples `(sample, temperature,
+		pressure, exptl_data)` with `exptl_data` as written by
+		`exptl_data_integration`: "Time" and one list of mol/g per species.
+		"""
+
+		if gc_measurement_path is None:
+			if workspace is None:
+				workspace = get_default_workspace()
+			gc_measurement_path = workspace.gc_measurement_path
+
+		campaign = os.path.abspath(gc_measurement_path)
+		with self._lock:
+			try:
+				with self._connection:
+					self._connection.execute('DELETE FROM trajectories WHERE campaign = ? AND source = ?',
+											(campaign, source))
+					rows = []
+					for sample, temperature, pressure, exptl_data in trajectories:
+						for species, moles_per_total_masses in exptl_data.items():
+							if species in TRAJECTORY_KEYS:
+								continue
+							species_id = self._get_species_id(species)
+							for time, moles_per_total_mass in zip(exptl_data['Time'], moles_per_total_masses):
+								rows.append((campaign, source, sample, temperature, pressure, time, species_id,
+											moles_per_total_mass))
+					self._connection.executemany('INSERT OR REPLACE INTO trajectories (campaign, source, sample, '
+												'temperature, pressure, time, species_id, moles_per_total_mass) '
+												'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+			except Exception:
+				# species ids of a rolled back transaction must not be reused
+				self._species_ids = {}
+				raise
+
+	@timed('catalog_query')
+	def query_trajectories(
+						self,
+						species=None,
+						samples=None,
+						temperature=None,
+						sources=None,
+						campaigns=None
+						):
+		"""
+		This method outputs the catalogued trajectory values matching every
+		given filter as `TrajectoryRows` of NumPy arrays, with the filters of
+		`query`; `sources` takes a name or a list of names.
+		"""
+
+		clauses = []
+		parameters = []
+
+		with self._lock:
+			for column, names in [('t.species_id', species), ('t.sample', samples),
+								('t.source', sources), ('t.campaign', campaigns)]:
+				if names is None:
+					continue
+				if isinstance(names, str):
+					names = [names]
+				if column == 't.campaign':
+					names = [os.path.abspath(name) for name in names]
+				if column == 't.species_id':
+					names = self._lookup_species_ids(names)
+				clauses.append('{0} IN ({1})'.format(column, ', '.join('?'*len(names))))
+				parameters.extend(names)
+
+		if temperature is not None:
+			if isinstance(temperature, (tuple, list)):
+				clauses.append('t.temperature BETWEEN ? AND ?')
+				parameters.extend(temperature)
+			else:
+				clauses.append('t.temperature = ?')
+				parameters.append(temperature)
+
+		sql = ('SELECT t.campaign, t.source, t.sample, sp.species, t.temperature, t.pressure, t.time, '
+				't.moles_per_total_mass FROM trajectories t '
+				'JOIN species sp ON sp.species_id = t.species_id')
+		if clauses:
+			sql += ' WHERE ' + ' AND '.join(clauses)
+		sql += ' ORDER BY t.campaign, t.source, t.sample, sp.species, t.temperature, t.pressure, t.time'
+
+		with self._lock:
+			rows = self._connection.execute(sql, parameters).fetchall()
+
+		columns = list(zip(*rows)) if rows else [()]*8
+
+		return TrajectoryRows(*([np.array(column, dtype=str) for column in columns[:4]]
+								+ [np.array(column, dtype=float) for column in columns[4:]]))
+
+	@timed('catalog_query')
+	def query(
+			self,
+			species=None,
+			conditions=None,
+			samples=None,
+			temperature=None,
+			date_from=None,
+			date_to=None,
+			campaigns=None
+			):
+		"""
+		This method outputs the catalogued values matching every given filter
+		as `CatalogRows` of NumPy arrays: `species`, `conditions`, `samples`
+		and `campaigns` take a name or a list of names, `temperature` a value
+		or a `(low, high)` range, and `date_from`/`date_to` inclusive
+		`datetime.date` bounds on the acquisition date. Missing temperatures
+		are NaN and missing dates NaT.
+		"""
+
+		clauses = []
+		parameters = []
+
+		with self._lock:
+			for column, names in [('sp.species', species), ('c.condition', conditions),
+								('s.sample', samples), ('c.campaign', campaigns)]:
+				if names is None:
+					continue
+				if isinstance(names, str):
+					names = [names]
+				if column == 'c.campaign':
+					names = [os.path.abspath(name) for name in names]
+				if column == 'sp.species':
+					# filter on indexed ids instead of joining on names
+					column = 'r.species_id'
+					names = self._lookup_species_ids(names)
+				clauses.append('{0} IN ({1})'.format(column, ', '.join('?'*len(names))))
+				parameters.extend(names)
+
+		if temperature is not None:
+			if isinstance(temperature, (tuple, list)):
+				clauses.append('c.temperature BETWEEN ? AND ?')
+				parameters.extend(temperature)
+			else:
+				clauses.append('c.temperature = ?')
+				parameters.append(temperature)
+		if date_from is not None:
+			clauses.append('s.acquisition_date >= ?')
+			parameters.append(date_from.isoformat())
+		if date_to is not None:
+			clauses.append('s.acquisition_date <= ?')
+			parameters.append(date_to.isoformat())
+
+		sql = ('SELECT c.campaign, c.condition, s.sample, sp.species, c.temperature, s.acquisition_date, '
+				'r.moles_per_total_mass FROM results r '
+				'JOIN samples s ON s.sample_id = r.sample_id '
+				'JOIN conditions c ON c.condition_id = s.condition_id '
+				'JOIN species sp ON sp.species_id = r.species_id')
+		if clauses:
+			sql += ' WHERE ' + ' AND '.join(clauses)
+
+		with self._lock:
+			rows = self._connection.execute(sql, parameters).fetchall()
+
+		columns = list(zip(*rows)) if rows else [()]*7
+
+		return CatalogRows(np.array(columns[0], dtype=str),
+						np.array(columns[1], dtype=str),
+						np.array(columns[2], dtype=str),
+						np.array(columns[3], dtype=str),
+						np.array([np.nan if value is None else value for value in columns[4]], dtype=float),
+						np.array(['NaT' if value is None else value for value in columns[5]], dtype='datetime64[D]'),
+						np.array(columns[6], dtype=float))
+
+	def count(self):
+
+		with self._lock:
+			return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+def read_condition_details_if_any(condition, gc_measurement_path):
+
+	if not os.path.exists(os.path.join(gc_measurement_path, condition, 'condition.csv')):
+		return None
+
+	from exptl_data_integration import read_condition_details
+
+	return read_condition_details(condition, gc_measurement_path)
+
+def get_built_catalog(catalog_file=None, workspace=None):
+	"""
+	This method outputs the catalog `catalog_file`, or the one of `workspace`
+	(default: `data/results_catalog.sqlite`) if that one was built, else None.
+	"""
+
+	if catalog_file is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		if not os.path.exists(workspace.catalog_file):
+			return None
+		catalog_file = workspace.catalog_file
+
+	return get_catalog(catalog_file)
+
+def read_acquisition_date_if_any(condition, sample, gc_measurement_path):
+
+	gc_speciation_file = os.path.join(gc_measurement_path, condition, 'gc_speciation', sample+'.txt')
+	if not os.path.exists(gc_speciation_file):
+		return None
+
+	acquisition_date = read_report_date(gc_speciation_file)
+
+	return acquisition_date.isoformat() if acquisition_date is not None else None
+
+_catalogs = {} # key: absolute catalog file, value: ResultsCatalog
+_catalogs_lock = threading.Lock()
+
+def get_catalog(catalog_file=None):
+	"""
+	This method returns the process-wide `ResultsCatalog` of `catalog_file`
+	(default: `data/results_catalog.sqlite`), opening it on first use.
+	"""
+
+	if catalog_file is None:
+		catalog_file = get_default_catalog_file()
+
+	key = os.path.abspath(catalog_file)
+	with _catalogs_lock:
+		if key not in _catalogs:
+			_catalogs[key] = ResultsCatalog(catalog_file)
+
+		return _catalogs[key]
+
+def close_catalogs():
+
+	with _catalogs_lock:
+		for catalog in _catalogs.values():
+			catalog.close()
+		_catalogs.clear()
+
+@timed('catalog_build')
+def build_catalog(gc_measurement_paths=None, catalog_file=None, workspace=None):
+	"""
+	This method (re)catalogs every condition with results, and the
+	integration outputs, in the given measurement folders (default: the
+	one of `workspace`) and outputs the catalog, by default the one of
+	`workspace`. Afterwards result writers keep it current, see
+	`result_store.save_condition_results` and `exptl_data_integration`.
+	"""
+
+	from result_store import (
+		get_result_store_file,
+		load_condition_speciation_dicts
+		)
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_paths is None:
+		gc_measurement_paths = [workspace.gc_measurement_path]
+
+	if catalog_file is None:
+		catalog_file = workspace.catalog_file
+
+	catalog = get_catalog(catalog_file)
+	for gc_measurement_path in gc_measurement_paths:
+		for condition in sorted(os.listdir(gc_measurement_path)):
+			if not os.path.exists(get_result_store_file(condition, gc_measurement_path)) \
+				and not os.path.isdir(os.path.join(gc_measurement_path, condition, 'speciation_results')):
+				continue
+			catalog.add_condition_results(condition,
+										load_condition_speciation_dicts(condition, gc_measurement_path),
+										gc_measurement_path,
+										replace_condition=True)
+		add_integration_outputs(catalog, gc_measurement_path)
+	catalog.analyze()
+
+	return catalog
+
+def add_integration_outputs(catalog, gc_measurement_path):
+	"""
+	This method catalogs the files written by `exptl_data_integration` in a
+	measurement folder: `<condition>/exptl_data_for_simulation/*.json` and
+	`exptl_trajectories_for_simulation.json`.
+	"""
+
+	import json
+	from exptl_data_integration import read_condition_details
+
+	for condition in sorted(os.listdir(gc_measurement_path)):
+		exptl_data_path = os.path.join(gc_measurement_path, condition, 'exptl_data_for_simulation')
+		if not os.path.isdir(exptl_data_path):
+			continue
+		_, temperature, pressure = read_condition_details(condition, gc_measurement_path)
+		trajectories = []
+		for f in sorted(os.listdir(exptl_data_path)):
+			if f.endswith('.json'):
+				with open(os.path.join(exptl_data_path, f), 'r') as read_in:
+					# files are named <sample>_<condition suffix>.json
+					trajectories.append((f[:-len('.json')].rsplit('_', 1)[0], temperature, pressure,
+										json.load(read_in)))
+		catalog.add_trajectories(condition, trajectories, gc_measurement_path)
+
+	exptl_trajectories_file = os.path.join(gc_measurement_path, 'exptl_trajectories_for_simulation.json')
+	if os.path.exists(exptl_trajectories_file):
+		with open(exptl_trajectories_file, 'r') as read_in:
+			exptl_trajectory_dict = json.load(read_in)
+		catalog.add_trajectories(EXPTL_TRAJECTORIES_SOURCE, get_trajectory_list(exptl_trajectory_dict),
+								gc_measurement_path)
+
+def get_trajectory_list(exptl_trajectory_dict):
+	"""
+	This method flattens the output of `assemble_exptl_trajectories` into
+	the `(sample, temperature, pressure, exptl_data)` list of `add_trajectories`.
+	"""
+
+	return [(sample, exptl_data['Temperature'], exptl_data['Pressure'], exptl_data)
+			for sample, exptl_trajectories in sorted(exptl_trajectory_dict.items())
+			for exptl_data in exptl_trajectories]
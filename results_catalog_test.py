@@ -0,0 +1,127 @@
+import unittest
+import os
+import json
+import shutil
+import datetime
+import tempfile
+import numpy as np
+from results_catalog import (
+	EXPTL_TRAJECTORIES_SOURCE,
+	ResultsCatalog,
+	build_catalog,
+	close_catalogs
+	)
+from result_store import save_condition_results
+from exptl_data_integration import (
+	assemble_exptl_trajectories,
+	save_exptl_data_to_chemkin_simulation_format,
+	save_exptl_trajectories
+	)
+
+class test_results_catalog(unittest.TestCase):
+
+	def setUp(self):
+
+		self.campaign_path = tempfile.mkdtemp()
+		self.catalog_file = os.path.join(self.campaign_path, 'results_catalog.sqlite')
+		self.gc_measurement_path = os.path.join(self.campaign_path, 'measurement')
+
+		with open(os.path.join('data', 'measurement', 'test_condition', 'gc_speciation', 'sample0.txt'), 'r') as read_in:
+			gc_speciation_report = read_in.read()
+		for condition, condition_details in [('before_pyrolysis', None),
+											('pyrolysis_450C', '72, 450, 1'),
+											('pyrolysis_400C', '72, 400, 1')]:
+			os.makedirs(os.path.join(self.gc_measurement_path, condition, 'gc_speciation'))
+			if condition_details is not None:
+				with open(os.path.join(self.gc_measurement_path, condition, 'condition.csv'), 'w') as write_out:
+					write_out.write('Time(h), Temperature(C), Pressure(atm)\n{0}\n'.format(condition_details))
+		# sample0 was measured on 2016-07-22, the other sample has no report
+		with open(os.path.join(self.gc_measurement_path, 'pyrolysis_450C', 'gc_speciation', 'sample1_aft_instd.txt'), 'w') as write_out:
+			write_out.write(gc_speciation_report)
+
+	def tearDown(self):
+
+		close_catalogs()
+		shutil.rmtree(self.campaign_path)
+
+	def test_results_catalog(self):
+
+		save_condition_results('before_pyrolysis', {'sample1_bf_instd': {'PDD': 4e-3}}, self.gc_measurement_path)
+		save_condition_results('pyrolysis_450C', {'sample1_aft_instd': {'PDD': 1e-3, 'toluene': 2e-4},
+												'sample2_aft_instd': {'PDD': 3e-3}}, self.gc_measurement_path)
+
+		catalog = build_catalog([self.gc_measurement_path], self.catalog_file)
+		self.assertEqual(catalog.count(), 4)
+
+		catalog_rows = catalog.query(species='PDD', temperature=450)
+		order = np.argsort(catalog_rows.samples)
+		self.assertEqual(catalog_rows.samples[order].tolist(), ['sample1_aft_instd', 'sample2_aft_instd'])
+		np.testing.assert_array_equal(catalog_rows.values[order], [1e-3, 3e-3])
+		np.testing.assert_array_equal(catalog_rows.temperatures, [450, 450])
+		self.assertEqual(catalog_rows.acquisition_dates[order][0], np.datetime64('2016-07-22'))
+		self.assertTrue(np.isnat(catalog_rows.acquisition_dates[order][1]))
+
+		catalog_rows = catalog.query(date_from=datetime.date(2016, 1, 1), date_to=datetime.date(2016, 12, 31))
+		self.assertEqual(sorted(catalog_rows.species.tolist()), ['PDD', 'toluene'])
+		self.assertTrue(np.isnan(catalog.query(conditions='before_pyrolysis').temperatures[0]))
+		self.assertEqual(len(catalog.query(species=['xylene'])), 7)
+		self.assertEqual(len(catalog.query(species=['xylene']).values), 0)
+
+		# writers keep a built catalog current
+		save_condition_results('pyrolysis_400C', {'sample1_aft_instd': {'PDD': 2e-3}}, self.gc_measurement_path,
+								catalog_file=self.catalog_file)
+		save_condition_results('pyrolysis_450C', {'sample2_aft_instd': {'PDD': 5e-3, 'octane': 1e-5}},
+								self.gc_measurement_path, catalog_file=self.catalog_file)
+		catalog_rows = catalog.query(species='PDD', temperature=(400, 450), samples=['sample2_aft_instd'])
+		np.testing.assert_array_equal(catalog_rows.values, [5e-3])
+		self.assertEqual(catalog.count(), 6)
+
+		save_condition_results('pyrolysis_450C', {'sample3_aft_instd': {'PDD': 1e-3}}, self.gc_measurement_path,
+								merge=False, catalog_file=self.catalog_file)
+		self.assertEqual(catalog.query(conditions='pyrolysis_450C').samples.tolist(), ['sample3_aft_instd'])
+
+		# another process sees the same catalog
+		other_catalog = ResultsCatalog(self.catalog_file)
+		try:
+			self.assertEqual(other_catalog.count(), catalog.count())
+			self.assertEqual(other_catalog.query(campaigns=self.gc_measurement_path).values.shape, (3,))
+		finally:
+			other_catalog.close()
+
+	def test_catalog_integration_outputs(self):
+
+		save_condition_results('before_pyrolysis', {'sample1_bf_instd': {'PDD': 4e-3, 'toluene': 1e-4}},
+								self.gc_measurement_path)
+		save_condition_results('pyrolysis_450C', {'sample1_aft_instd': {'PDD': 1e-3, 'toluene': 2e-4}},
+								self.gc_measurement_path)
+		save_condition_results('pyrolysis_400C', {'sample1_aft_instd': {'PDD': 2e-3}}, self.gc_measurement_path)
+		catalog = build_catalog([self.gc_measurement_path], self.catalog_file)
+
+		# integration writers feed a built catalog
+		save_exptl_data_to_chemkin_simulation_format('before_pyrolysis', 'pyrolysis_450C',
+													gc_measurement_path=self.gc_measurement_path,
+													catalog_file=self.catalog_file)
+		exptl_trajectory_dict = assemble_exptl_trajectories('before_pyrolysis',
+															gc_measurement_path=self.gc_measurement_path)
+		save_exptl_trajectories(exptl_trajectory_dict, self.gc_measurement_path, catalog_file=self.catalog_file)
+
+		with open(os.path.join(self.gc_measurement_path, 'pyrolysis_450C', 'exptl_data_for_simulation',
+								'sample1_450C.json'), 'r') as read_in:
+			exptl_data = json.load(read_in)
+		trajectory_rows = catalog.query_trajectories(species='PDD', sources='pyrolysis_450C')
+		self.assertEqual(trajectory_rows.samples.tolist(), ['sample1', 'sample1'])
+		np.testing.assert_array_equal(trajectory_rows.times, [0, 72])
+		np.testing.assert_array_equal(trajectory_rows.values, exptl_data['PDD'])
+		np.testing.assert_array_equal(trajectory_rows.temperatures, [450, 450])
+
+		trajectory_rows = catalog.query_trajectories(species='PDD', temperature=400,
+													sources=EXPTL_TRAJECTORIES_SOURCE)
+		np.testing.assert_array_equal(trajectory_rows.times, [0, 72])
+		np.testing.assert_array_equal(trajectory_rows.values, exptl_trajectory_dict['sample1'][0]['PDD'])
+
+		# and a rebuilt catalog reads their files
+		rebuilt_catalog = build_catalog([self.gc_measurement_path], os.path.join(self.campaign_path, 'rebuilt.sqlite'))
+		for source in ['pyrolysis_450C', EXPTL_TRAJECTORIES_SOURCE]:
+			for rebuilt_column, column in zip(rebuilt_catalog.query_trajectories(sources=source),
+											catalog.query_trajectories(sources=source)):
+				np.testing.assert_array_equal(rebuilt_column, column)
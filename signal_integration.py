@@ -0,0 +1,226 @@
+import os
+import struct
+import numpy as np
+from report_parser import PeakRecord
+from peak_table import PeakTable
+
+# ChemStation reports areas in signal*seconds while traces are indexed in minutes
+AREA_SCALE = 60.0
+
+def read_chemstation_ch_file(ch_file):
+	"""
+	This method loads an Agilent ChemStation `.ch` signal file of format
+	version 179 (e.g. `FID1B.ch`) as `(times, signal)` arrays, times in
+	minutes. The little-endian float64 data block at 0x1800 is memory-mapped;
+	start/end times (ms) sit at 0x11A and the signal scaling factor at 0x127C.
+	"""
+
+	with open(ch_file, 'rb') as read_in:
+		version = read_in.read(4)[1:].decode('ascii', 'replace')
+		if version != '179':
+			raise ValueError('Unsupported ChemStation file version {0} in {1}'.format(version, ch_file))
+
+		read_in.seek(0x11A)
+		start_time, end_time = struct.unpack('>ii', read_in.read(8))
+		read_in.seek(0x127C)
+		scaling_factor = struct.unpack('>d', read_in.read(8))[0]
+
+	signal = np.memmap(ch_file, dtype='<f8', mode='r', offset=0x1800)
+	if scaling_factor and np.isfinite(scaling_factor) and scaling_factor != 1.0:
+		signal = signal*scaling_factor
+	times = np.linspace(start_time/60000.0, end_time/60000.0, signal.shape[0])
+
+	return times, signal
+
+def load_signal(signal_file):
+	"""
+	This method loads a raw chromatogram as `(times, signal)`, times in minutes,
+	from a ChemStation `.ch` file, a `.npy` array of shape (2, points)
+	(memory-mapped) or a two-column time/signal text export (`.csv`, `.txt`).
+
+	MSD `data.ms` files are not decoded; export their TIC as text first.
+	"""
+
+	extension = os.path.splitext(signal_file)[1].lower()
+	if extension == '.ch':
+		return read_chemstation_ch_file(signal_file)
+	if extension == '.npy':
+		trace = np.load(signal_file, mmap_mode='r')
+		return trace[0], trace[1]
+	if extension in ('.csv', '.txt'):
+		delimiter = ',' if extension == '.csv' else None
+		trace = np.loadtxt(signal_file, delimiter=delimiter, comments='#', ndmin=2)
+		return trace[:, 0], trace[:, 1]
+
+	raise ValueError('Unsupported signal file: {0}'.format(signal_file))
+
+def estimate_baseline(signal, window):
+	"""
+	This method estimates a slowly varying baseline as the minimum of each
+	block of `window` points, linearly interpolated between the minima.
+	"""
+
+	signal = np.asarray(signal, dtype=float)
+	point_count = signal.shape[0]
+	block_count = max(1, point_count//window)
+	blocks = signal[:block_count*window].reshape(block_count, -1)
+
+	block_minima = blocks.min(axis=1)
+	block_minimum_positions = blocks.argmin(axis=1) + np.arange(block_count)*blocks.shape[1]
+	if block_count*window < point_count:
+		tail = signal[block_count*window:]
+		block_minima = np.append(block_minima, tail.min())
+		block_minimum_positions = np.append(block_minimum_positions, block_count*window + tail.argmin())
+
+	return np.interp(np.arange(point_count), block_minimum_positions, block_minima)
+
+def get_window_points(times, window):
+	"""
+	This method converts a time window in minutes to a number of points.
+	"""
+
+	sampling_interval = (times[-1] - times[0])/max(1, times.shape[0] - 1)
+
+	return max(3, int(round(window/sampling_interval)))
+
+def estimate_noise(signal):
+	"""
+	This method estimates the noise level of a trace from the median
+	absolute deviation of its first difference.
+	"""
+
+	differences = np.diff(np.asarray(signal, dtype=float))
+	median_absolute_deviation = np.median(np.abs(differences - np.median(differences)))
+
+	return 1.4826*median_absolute_deviation/np.sqrt(2.0)
+
+def detect_peaks(corrected_signal, threshold=None, min_points=3):
+	"""
+	This method finds peaks as runs of baseline-corrected signal above
+	`threshold` (default: 10 times the noise level) and outputs arrays
+	`(start_indices, apex_indices, end_indices)`; end indices are inclusive.
+	"""
+
+	corrected_signal = np.asarray(corrected_signal, dtype=float)
+	if threshold is None:
+		threshold = 10*estimate_noise(corrected_signal)
+
+	above = np.concatenate([[False], corrected_signal > threshold, [False]])
+	edges = np.flatnonzero(np.diff(above.astype(np.int8)))
+	start_indices = edges[0::2]
+	end_indices = edges[1::2] - 1
+
+	keep = end_indices - start_indices + 1 >= min_points
+	start_indices = start_indices[keep]
+	end_indices = end_indices[keep]
+	if start_indices.shape[0] == 0:
+		return start_indices, start_indices.copy(), end_indices
+
+	# widen each run to its neighbouring zero crossings of the corrected signal
+	nonpositive = np.flatnonzero(corrected_signal <= 0)
+	if nonpositive.shape[0] == 0:
+		nonpositive = np.array([0, corrected_signal.shape[0] - 1])
+	before = np.searchsorted(nonpositive, start_indices) - 1
+	after = np.searchsorted(nonpositive, end_indices)
+	start_indices = np.where(before >= 0, nonpositive[np.maximum(before, 0)], 0)
+	end_indices = np.where(after < nonpositive.shape[0],
+							nonpositive[np.minimum(after, nonpositive.shape[0] - 1)],
+							corrected_signal.shape[0] - 1)
+
+	# runs widened into the same peak are merged
+	unique_starts, first_positions = np.unique(start_indices, return_index=True)
+	start_indices = unique_starts
+	end_indices = np.maximum.reduceat(end_indices, first_positions)
+
+	apex_indices = start_indices + np.array([corrected_signal[start:end+1].argmax()
+											for start, end in zip(start_indices, end_indices)],
+											dtype=int)
+
+	return start_indices, apex_indices, end_indices
+
+def integrate_peaks(times, corrected_signal, start_indices, end_indices, baseline='none'):
+	"""
+	This method integrates every peak between its start and end index with
+	the trapezoid rule on one cumulative integral of the trace. With
+	`baseline='linear'` the straight line joining the signal at peak start
+	and end (drop line to drop line) is subtracted as well.
+
+	Areas are in signal*seconds, like the instrument reports.
+	"""
+
+	times = np.asarray(times, dtype=float)
+	corrected_signal = np.asarray(corrected_signal, dtype=float)
+
+	cumulative_integral = np.concatenate([[0.0], np.cumsum(
+							0.5*(corrected_signal[1:] + corrected_signal[:-1])*np.diff(times))])
+	areas = cumulative_integral[end_indices] - cumulative_integral[start_indices]
+
+	if baseline == 'linear':
+		areas = areas - 0.5*(corrected_signal[start_indices] + corrected_signal[end_indices])\
+						*(times[end_indices] - times[start_indices])
+	elif baseline != 'none':
+		raise ValueError('Unknown baseline: {0}'.format(baseline))
+
+	return areas*AREA_SCALE
+
+def integrate_signal(times, signal, baseline_window=1.0, threshold=None, min_points=3):
+	"""
+	This method baseline-corrects a raw trace (block minima over
+	`baseline_window` minutes, which must be wider than the peaks), detects
+	and integrates its peaks, and outputs one unnamed `PeakRecord` per peak,
+	like the rows `iter_peak_records` reads from an instrument report.
+	"""
+
+	times = np.asarray(times, dtype=float)
+	signal = np.asarray(signal, dtype=float)
+	corrected_signal = signal - estimate_baseline(signal, get_window_points(times, baseline_window))
+
+	start_indices, apex_indices, end_indices = detect_peaks(corrected_signal, threshold, min_points)
+	areas = integrate_peaks(times, corrected_signal, start_indices, end_indices)
+
+	# gaussian full width at half maximum from area and height
+	heights = corrected_signal[apex_indices]
+	widths = areas/AREA_SCALE/(heights*1.0645)
+
+	peak_records = []
+	for i in range(start_indices.shape[0]):
+		peak_records.append(PeakRecord(str(i+1),
+									float(times[apex_indices[i]]),
+									'BB',
+									float(widths[i]),
+									float(areas[i]),
+									float(times[start_indices[i]]),
+									float(times[end_indices[i]]),
+									''))
+
+	return peak_records
+
+def reintegrate_gc_speciation_file(gc_speciation_file, times, signal, baseline_window=1.0, baseline='none'):
+	"""
+	This method re-integrates the peaks of a GC speciation report (a file or
+	a `PeakTable`) on its raw trace, keeping the report's start/end times and species names, and
+	outputs a dictionary like `read_gc_speciation_file`:
+	key: `species` and value: summed peak area.
+
+	The trace is corrected with a block-minimum baseline over `baseline_window`
+	minutes (None to skip) and, with `baseline='linear'`, per-peak drop lines.
+	"""
+
+	times = np.asarray(times, dtype=float)
+	corrected_signal = np.asarray(signal, dtype=float)
+	if baseline_window:
+		corrected_signal = corrected_signal - estimate_baseline(corrected_signal,
+													get_window_points(times, baseline_window))
+
+	if isinstance(gc_speciation_file, PeakTable):
+		peak_table = gc_speciation_file
+	else:
+		peak_table = PeakTable.from_report(gc_speciation_file)
+	start_indices = np.searchsorted(times, peak_table.start_times)
+	end_indices = np.searchsorted(times, peak_table.end_times)
+	start_indices = np.clip(start_indices, 0, times.shape[0] - 1)
+	end_indices = np.clip(end_indices, 0, times.shape[0] - 1)
+
+	areas = integrate_peaks(times, corrected_signal, start_indices, end_indices, baseline)
+
+	return peak_table.replace(areas=areas).to_area_dict()
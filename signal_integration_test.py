@@ -0,0 +1,97 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+import time
+import numpy as np
+from signal_integration import (
+	read_chemstation_ch_file,
+	load_signal,
+	estimate_baseline,
+	integrate_signal,
+	reintegrate_gc_speciation_file
+	)
+
+class test_signal_integration(unittest.TestCase):
+
+	def setUp(self):
+
+		# 30 minutes at 100 Hz: drifting baseline, noise and three gaussian peaks
+		self.times = np.linspace(0, 30, 180001)
+		self.peak_parameters = [(5.483, 0.02, 5e4), (7.730, 0.04, 2e5), (21.127, 0.05, 1e6)]
+		random_state = np.random.RandomState(0)
+		self.signal = 100 + 2*self.times + random_state.normal(0, 1, self.times.shape[0])
+		for center, sigma, height in self.peak_parameters:
+			self.signal += height*np.exp(-0.5*((self.times - center)/sigma)**2)
+
+		self.signal_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.signal_path)
+
+	def expected_area(self, sigma, height):
+
+		return height*sigma*np.sqrt(2*np.pi)*60
+
+	def test_estimate_baseline(self):
+
+		baseline = estimate_baseline(self.signal, 6000)
+
+		self.assertEqual(baseline.shape, self.signal.shape)
+		self.assertLess(abs(np.median(baseline - (100 + 2*self.times))), 5)
+
+	def test_integrate_signal(self):
+
+		start_time = time.time()
+		peak_records = integrate_signal(self.times, self.signal)
+		elapsed_time = time.time() - start_time
+
+		self.assertEqual(len(peak_records), 3)
+		for peak_record, (center, sigma, height) in zip(peak_records, self.peak_parameters):
+			self.assertAlmostEqual(peak_record.ret_time, center, 2)
+			self.assertAlmostEqual(peak_record.area/self.expected_area(sigma, height), 1.0, 2)
+			self.assertEqual(peak_record.species, '')
+		self.assertLess(elapsed_time, 0.5)
+
+	def test_read_chemstation_ch_file(self):
+
+		ch_file = os.path.join(self.signal_path, 'FID1B.ch')
+		header = bytearray(0x1800)
+		header[0:4] = b'\x03179'
+		header[0x11A:0x122] = struct.pack('>ii', 0, 30*60000)
+		header[0x127C:0x1284] = struct.pack('>d', 2.0)
+		with open(ch_file, 'wb') as write_out:
+			write_out.write(bytes(header))
+			write_out.write(self.signal.astype('<f8').tobytes())
+
+		times, signal = load_signal(ch_file)
+		np.testing.assert_allclose(times, self.times)
+		np.testing.assert_allclose(signal, 2.0*self.signal)
+
+		with open(ch_file, 'r+b') as write_out:
+			write_out.write(b'\x0381 ')
+		self.assertRaises(ValueError, read_chemstation_ch_file, ch_file)
+
+	def test_reintegrate_gc_speciation_file(self):
+
+		gc_speciation_file = os.path.join(self.signal_path, 'sample0.txt')
+		with open(gc_speciation_file, 'w') as write_out:
+			write_out.write('TIC: sample0.D\\data.ms\n\nPeak #\tRet Time\tType\tWidth\tArea\tStart Time\tEnd Time\t\n')
+			for i, (center, sigma, height) in enumerate(self.peak_parameters):
+				write_out.write('{0}\t{1}\tM\t0.1\t1\t{2}\t{3}\t{4}\n'.format(
+								i+1, center, center - 6*sigma, center + 6*sigma, ['toluene', 'PDD', 'PDD'][i]))
+
+		npy_file = os.path.join(self.signal_path, 'sample0.npy')
+		np.save(npy_file, np.vstack([self.times, self.signal]))
+		times, signal = load_signal(npy_file)
+
+		gc_speciation_data_dict = reintegrate_gc_speciation_file(gc_speciation_file, times, signal)
+		self.assertEqual(sorted(gc_speciation_data_dict), ['PDD', 'toluene'])
+		self.assertAlmostEqual(gc_speciation_data_dict['PDD']/(self.expected_area(0.04, 2e5)
+															+ self.expected_area(0.05, 1e6)), 1.0, 2)
+
+		gc_speciation_data_dict = reintegrate_gc_speciation_file(gc_speciation_file, times, signal,
+																baseline_window=None, baseline='linear')
+		self.assertAlmostEqual(gc_speciation_data_dict['toluene']/self.expected_area(0.02, 5e4), 1.0, 2)
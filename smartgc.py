@@ -0,0 +1,611 @@
+"""
+Command-line entry point of smartGC:
+
+	python smartgc.py calibrate [--species PDD toluene ...] [--incremental] [--select-model [--folds K]] [--history]
+	                            [--response-model MODEL]
+	python smartgc.py speciate [CONDITION [SAMPLE ...]] [--processes N] [--incremental] [--calibration-history]
+	                           [--response-models] [--deconvolve SHAPE [--tau-ratio R]] [--spectral-library]
+	python smartgc.py integrate CONDITION_BEFORE CONDITION_AFTER
+	python smartgc.py assemble CONDITION_BEFORE [CONDITION_AFTER ...]
+	python smartgc.py uncertainty CONDITION [SAMPLE ...] [--draws N] [--normalize]
+	python smartgc.py watch [--settle-time SECONDS]
+	python smartgc.py serve [--host HOST] [--port PORT]
+	python smartgc.py catalog [--build] [--species PDD ...] [--temperature T] [--date-from YYYY-MM-DD]
+	python smartgc.py library LIBRARY.msp
+	python smartgc.py identify CONDITION [SAMPLE ...] [--top-k K] [--min-score S]
+	python smartgc.py queue {submit,work,status,merge} [--queue-path DIR] [--lease-time SECONDS] [--workers N]
+
+Any command takes `--data-root DIR` to work on another data folder laid
+out like `data/` (see `workspace`), `--metrics FILE` (json, or Prometheus text for `.prom`)
+to report stage timers and counters, and `--profile STAGE` to profile one
+stage (e.g. `parse`, `speciation`, `calibration_fit`) with cProfile; stages
+run by worker processes are only profiled with `--processes 1`.
+
+Only argparse is imported at start-up; each subcommand imports its own
+modules when it runs. NumPy is loaded by the commands that fit calibration
+data and by those that read or write result stores (`speciate`, `integrate`,
+`assemble`, ...), but importing the speciation modules does not load it.
+"""
+import argparse
+import sys
+
+def get_workspace(args):
+
+	from workspace import get_workspace
+
+	return get_workspace(args.data_root)
+
+def get_calibration_registry(args):
+	"""
+	This method outputs the registry of `--calibration-path` if given, else
+	None so that the workspace's one is used.
+	"""
+
+	if args.calibration_path is None:
+		return None
+
+	from calibration import get_registry
+
+	return get_registry(args.calibration_path)
+
+def calibrate(args):
+
+	if args.history:
+		return update_history(args)
+
+	if args.response_model is not None:
+		return fit_response_models(args)
+
+	from calibration import prepare_calibration_factor_functions
+
+	calibration_factor_function_dict = prepare_calibration_factor_functions(
+											args.species,
+											args.calibration_path,
+											args.incremental,
+											workspace=get_workspace(args),
+											select_model=args.select_model,
+											folds=args.folds
+											)
+
+	for species in sorted(calibration_factor_function_dict):
+		print('{0}: {1}'.format(species, calibration_factor_function_dict[species]))
+
+	return 0
+
+def update_history(args):
+
+	from calibration_history import (
+		list_calibration_files,
+		update_calibration_history
+		)
+
+	workspace = get_workspace(args)
+	calibration_files_dict = list_calibration_files(args.calibration_path or workspace.calibration_path)
+	if args.species is not None:
+		calibration_files_dict = dict((species, calibration_files_dict[species]) for species in args.species)
+
+	calibration_history = update_calibration_history(
+							calibration_files_dict,
+							registry=get_calibration_registry(args),
+							forgetting_factor=args.forgetting_factor,
+							rebuild=args.rebuild,
+							workspace=workspace
+							)
+
+	for species in sorted(calibration_files_dict):
+		entry = calibration_history.get_entry(species)
+		print('{0}: {1} ({2})'.format(species, entry['calibration_factor'], entry['date']))
+
+	return 0
+
+def fit_response_models(args):
+
+	from response_models import prepare_response_models
+
+	response_model_dict = prepare_response_models(
+							args.species,
+							args.calibration_path,
+							args.response_model,
+							registry=get_calibration_registry(args),
+							workspace=get_workspace(args)
+							)
+
+	for species in sorted(response_model_dict):
+		print('{0}: {1} {2}'.format(species, args.response_model,
+								response_model_dict[species][0].to_dict()['params']))
+
+	return 0
+
+def speciate(args):
+
+	from batch_speciation import (
+		discover_condition_samples,
+		run_batch_speciation
+		)
+
+	workspace = get_workspace(args)
+
+	calibration_history = None
+	if args.calibration_history:
+		calibration_history = workspace.load_calibration_history()
+
+	response_lookup_tables = None
+	if args.response_models:
+		response_lookup_tables = workspace.registry.get_response_lookup_tables()
+
+	peak_shape = None
+	if args.deconvolve is not None:
+		from peak_deconvolution import get_peak_shape
+		peak_shape = get_peak_shape(args.deconvolve, args.tau_ratio)
+
+	spectral_library = None
+	if args.spectral_library:
+		from spectral_library import SpectralLibrary
+		spectral_library = SpectralLibrary.load(workspace.spectral_library_file)
+
+	if args.condition is None:
+		condition_samples_dict = discover_condition_samples(args.measurement_path, workspace)
+	elif args.samples:
+		condition_samples_dict = {args.condition: args.samples}
+	else:
+		condition_samples_dict = {args.condition: discover_condition_samples(
+										args.measurement_path, workspace).get(args.condition, [])}
+
+	batch_speciation_dict, samples_per_second = run_batch_speciation(
+												condition_samples_dict,
+												gc_measurement_path=args.measurement_path,
+												processes=args.processes,
+												incremental=args.incremental,
+												export_json=args.export_json,
+												calibration_history=calibration_history,
+												response_lookup_tables=response_lookup_tables,
+												workspace=workspace,
+												peak_shape=peak_shape,
+												spectral_library=spectral_library
+												)
+
+	sample_count = sum(len(samples) for samples in batch_speciation_dict.values())
+	print('speciated {0} samples in {1} conditions: {2:.1f} samples/s'.format(
+										sample_count,
+										len(batch_speciation_dict),
+										samples_per_second
+										))
+
+	return 0
+
+def integrate(args):
+
+	from exptl_data_integration import save_exptl_data_to_chemkin_simulation_format
+
+	save_exptl_data_to_chemkin_simulation_format(args.condition_before,
+												args.condition_after,
+												gc_measurement_path=args.measurement_path,
+												workspace=get_workspace(args))
+
+	return 0
+
+def assemble(args):
+
+	from exptl_data_integration import (
+		assemble_exptl_trajectories,
+		save_exptl_trajectories
+		)
+
+	workspace = get_workspace(args)
+	exptl_trajectory_dict = assemble_exptl_trajectories(args.condition_before,
+													args.conditions_after or None,
+													gc_measurement_path=args.measurement_path,
+													workspace=workspace)
+	exptl_trajectories_file = save_exptl_trajectories(exptl_trajectory_dict, args.measurement_path,
+													workspace)
+
+	trajectory_count = sum(len(exptl_trajectories) for exptl_trajectories in exptl_trajectory_dict.values())
+	print('wrote {0} trajectories of {1} samples to {2}'.format(trajectory_count,
+													len(exptl_trajectory_dict),
+													exptl_trajectories_file))
+
+	return 0
+
+def uncertainty(args):
+
+	from uncertainty import prepare_speciation_uncertainty
+
+	speciation_uncertainty_dict = prepare_speciation_uncertainty(args.condition,
+													args.samples or None,
+													args.measurement_path,
+													draws=args.draws,
+													peak_area_rsd=args.peak_area_rsd,
+													inner_standard_mass_sd=args.inner_standard_mass_sd,
+													normalize=args.normalize,
+													seed=args.seed,
+													workspace=get_workspace(args))
+
+	for sample in sorted(speciation_uncertainty_dict):
+		for species, (moles_per_total_mass, standard_deviation) in sorted(
+													speciation_uncertainty_dict[sample].items()):
+			print('{0} {1}: {2:.4e} +/- {3:.2e}'.format(sample, species,
+													moles_per_total_mass, standard_deviation))
+
+	return 0
+
+def watch(args):
+
+	import asyncio
+	import logging
+	from watch_daemon import SpeciationWatcher
+
+	logging.basicConfig(level=logging.INFO)
+	watcher = SpeciationWatcher(args.measurement_path,
+								poll_interval=args.poll_interval,
+								settle_time=args.settle_time,
+								workers=args.workers,
+								export_json=args.export_json,
+								workspace=get_workspace(args))
+	try:
+		asyncio.run(watcher.run(process_existing=args.process_existing))
+	except KeyboardInterrupt:
+		pass
+	print('latency: {0}'.format(watcher.get_latency_stats()))
+
+	return 0
+
+def serve(args):
+
+	import logging
+	from speciation_service import serve as serve_speciation
+
+	workspace = get_workspace(args)
+
+	calibration_history = None
+	if args.calibration_history:
+		calibration_history = workspace.load_calibration_history()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+	serve_speciation(args.host, args.port, calibration_history=calibration_history, workspace=workspace)
+
+	return 0
+
+def catalog(args):
+
+	import datetime
+	from results_catalog import (
+		build_catalog,
+		get_catalog
+		)
+
+	workspace = get_workspace(args)
+
+	if args.build:
+		results_catalog = build_catalog(args.measurement_paths, args.catalog_file, workspace)
+		print('catalogued {0} values'.format(results_catalog.count()))
+		return 0
+
+	def parse_date(text):
+		return datetime.date(*[int(part) for part in text.split('-')]) if text is not None else None
+
+	temperature = args.temperature
+	if temperature is not None and len(temperature) == 1:
+		temperature = temperature[0]
+
+	catalog_rows = get_catalog(args.catalog_file or workspace.catalog_file).query(species=args.species,
+														conditions=args.conditions,
+														samples=args.samples,
+														temperature=temperature,
+														date_from=parse_date(args.date_from),
+														date_to=parse_date(args.date_to))
+
+	for row in zip(catalog_rows.conditions, catalog_rows.samples, catalog_rows.species,
+					catalog_rows.temperatures, catalog_rows.acquisition_dates, catalog_rows.values):
+		print('{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(*row))
+
+	return 0
+
+def library(args):
+
+	from spectral_library import SpectralLibrary
+
+	library_file = args.output or get_workspace(args).spectral_library_file
+	spectral_library = SpectralLibrary.from_msp(args.msp_file, args.max_mz)
+	spectral_library.save(library_file)
+	print('indexed {0} spectra to {1}'.format(len(spectral_library), library_file))
+
+	return 0
+
+def identify(args):
+
+	import os
+	from peak_table import PeakTable
+	from spectral_library import (
+		SpectralLibrary,
+		identify_peak_table_by_spectra
+		)
+
+	workspace = get_workspace(args)
+	spectral_library = SpectralLibrary.load(args.library or workspace.spectral_library_file)
+	calibrated_species = workspace.registry.get_fitted_calibration_factor_functions()
+
+	condition_path = workspace.get_condition_path(args.condition)
+	samples = args.samples or sorted(f[:-len('.msp')] for f in os.listdir(os.path.join(condition_path, 'gc_spectra'))
+									if f.endswith('.msp'))
+	for sample in samples:
+		peak_table = PeakTable.from_report(os.path.join(condition_path, 'gc_speciation', sample+'.txt'))
+		_, suggestions = identify_peak_table_by_spectra(peak_table,
+														os.path.join(condition_path, 'gc_spectra', sample+'.msp'),
+														spectral_library,
+														calibrated_species,
+														args.top_k,
+														args.min_score)
+		for peak_index, hits in sorted(suggestions.items()):
+			print('{0} peak {1} ({2:.3f} min, {3}): {4}'.format(sample,
+														peak_table.peaks[peak_index],
+														peak_table.ret_times[peak_index],
+														peak_table[peak_index].species or 'unnamed',
+														', '.join('{0} {1:.3f}'.format(name, score)
+																for name, score in hits)))
+
+	return 0
+
+def get_work_queue(args):
+
+	from work_queue import WorkQueue
+
+	return WorkQueue(args.queue_path,
+					lease_time=args.lease_time,
+					max_attempts=args.max_attempts,
+					gc_measurement_path=args.measurement_path,
+					workspace=get_workspace(args))
+
+def work_queue_process(args):
+
+	from work_queue import run_worker
+
+	return run_worker(get_work_queue(args), poll_interval=args.poll_interval)
+
+def queue(args):
+
+	work_queue = get_work_queue(args)
+
+	if args.action == 'submit':
+		condition_samples_dict = None
+		if args.condition is not None:
+			from batch_speciation import discover_condition_samples
+			condition_samples_dict = {args.condition: args.samples or discover_condition_samples(
+										work_queue.gc_measurement_path, work_queue.workspace).get(args.condition, [])}
+		print('submitted {0} samples to {1}'.format(work_queue.submit(condition_samples_dict), work_queue.queue_path))
+
+	elif args.action == 'work':
+		if args.workers > 1:
+			from multiprocessing import Pool
+			pool = Pool(args.workers)
+			try:
+				committed = sum(pool.map(work_queue_process, [args]*args.workers))
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			committed = work_queue_process(args)
+		print('committed {0} samples'.format(committed))
+
+	elif args.action == 'merge':
+		print('merged {0} samples'.format(work_queue.merge_results(force=args.force)))
+
+	status = work_queue.get_status()
+	print(', '.join('{0} {1}'.format(status[state], state)
+					for state in ['done', 'leased', 'expired', 'pending', 'failed']))
+
+	return 0
+
+def build_parser():
+
+	parser = argparse.ArgumentParser(prog='smartgc', description='GC analysis tool')
+	parser.add_argument('--data-root', default=None, metavar='DIR',
+						help='data folder with calibration/ and measurement/ (default: data)')
+	parser.add_argument('--metrics', default=None, metavar='FILE',
+						help='write stage timers and counters to FILE (.prom: Prometheus text, else json)')
+	parser.add_argument('--profile', default=None, metavar='STAGE',
+						help='profile every run of STAGE with cProfile')
+	parser.add_argument('--profile-output', default=None, metavar='FILE',
+						help='pstats file of the profiled stage (default: STAGE.prof)')
+	subparsers = parser.add_subparsers(dest='command')
+	subparsers.required = True
+
+	calibrate_parser = subparsers.add_parser('calibrate',
+									help='fit and save calibration factor functions')
+	calibrate_parser.add_argument('--species', nargs='+', default=None,
+									help='calibration species (default: every .txt file)')
+	calibrate_parser.add_argument('--calibration-path', default=None,
+									help='folder of calibration files (default: <data root>/calibration)')
+	calibrate_parser.add_argument('--incremental', action='store_true',
+									help='skip the fit when calibration inputs are unchanged')
+	calibrate_parser.add_argument('--select-model', action='store_true',
+									help='choose intercept, weighting and points per species by cross-validation')
+	calibrate_parser.add_argument('--folds', type=int, default=None,
+									help='k-fold cross-validation with --select-model (default: leave-one-out)')
+	calibrate_parser.add_argument('--history', action='store_true',
+									help='add new dated calibration reports to calibration_history.json')
+	calibrate_parser.add_argument('--forgetting-factor', type=float, default=None,
+									help='weight of each older calibration session in the history (default: 0.8)')
+	calibrate_parser.add_argument('--rebuild', action='store_true',
+									help='recompute the calibration history from all reports')
+	calibrate_parser.add_argument('--response-model', default=None,
+									choices=['piecewise_linear', 'monotone_spline', 'quadratic'],
+									help='fit nonlinear responses and lookup tables to fitted_response_models.json')
+	calibrate_parser.set_defaults(run=calibrate)
+
+	speciate_parser = subparsers.add_parser('speciate',
+									help='compute speciation in moles/g and save results')
+	speciate_parser.add_argument('condition', nargs='?', default=None,
+									help='condition to speciate (default: every condition)')
+	speciate_parser.add_argument('samples', nargs='*',
+									help='samples to speciate (default: every sample of the condition)')
+	speciate_parser.add_argument('--processes', type=int, default=None,
+									help='worker processes (default: one per CPU, 1 runs in-process)')
+	speciate_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	speciate_parser.add_argument('--incremental', action='store_true',
+									help='only speciate samples whose inputs or calibration changed')
+	speciate_parser.add_argument('--export-json', action='store_true',
+									help='also write speciation_results/<sample>.json files')
+	speciate_parser.add_argument('--calibration-history', action='store_true',
+									help='use the calibration valid on each sample\'s date')
+	speciate_parser.add_argument('--response-models', action='store_true',
+									help='convert peak areas with fitted_response_models.json')
+	speciate_parser.add_argument('--deconvolve', default=None, choices=['gaussian', 'emg'],
+									help='deconvolve co-eluting peaks with this peak shape, fitted to '
+									'gc_signal/<sample>.ch if present')
+	speciate_parser.add_argument('--tau-ratio', type=float, default=1.0,
+									help='EMG tail time constant in gaussian standard deviations (default: 1)')
+	speciate_parser.add_argument('--spectral-library', action='store_true',
+									help='name uncalibrated peaks from gc_spectra/<sample>.msp with spectral_library.npz')
+	speciate_parser.set_defaults(run=speciate)
+
+	integrate_parser = subparsers.add_parser('integrate',
+									help='write exptl_data files for chemkin simulation')
+	integrate_parser.add_argument('condition_before')
+	integrate_parser.add_argument('condition_after')
+	integrate_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	integrate_parser.set_defaults(run=integrate)
+
+	assemble_parser = subparsers.add_parser('assemble',
+									help='write per-sample trajectories over many conditions')
+	assemble_parser.add_argument('condition_before')
+	assemble_parser.add_argument('conditions_after', nargs='*',
+									help='conditions after experiment (default: every condition with condition.csv)')
+	assemble_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	assemble_parser.set_defaults(run=assemble)
+
+	uncertainty_parser = subparsers.add_parser('uncertainty',
+									help='Monte Carlo standard deviations of speciation results')
+	uncertainty_parser.add_argument('condition')
+	uncertainty_parser.add_argument('samples', nargs='*',
+									help='samples (default: every sample of the condition)')
+	uncertainty_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	uncertainty_parser.add_argument('--draws', type=int, default=10000,
+									help='Monte Carlo draws')
+	uncertainty_parser.add_argument('--peak-area-rsd', type=float, default=0.01,
+									help='relative standard deviation of peak areas')
+	uncertainty_parser.add_argument('--inner-standard-mass-sd', type=float, default=1e-4,
+									help='standard deviation of inner standard masses in g')
+	uncertainty_parser.add_argument('--normalize', action='store_true',
+									help='average repeated samples and normalize as initial data')
+	uncertainty_parser.add_argument('--seed', type=int, default=None)
+	uncertainty_parser.set_defaults(run=uncertainty)
+
+	watch_parser = subparsers.add_parser('watch',
+									help='speciate new GC reports as they arrive')
+	watch_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	watch_parser.add_argument('--poll-interval', type=float, default=0.1,
+									help='seconds between folder scans')
+	watch_parser.add_argument('--settle-time', type=float, default=0.3,
+									help='seconds a report must stay unchanged before it is read')
+	watch_parser.add_argument('--workers', type=int, default=2,
+									help='concurrent speciation workers')
+	watch_parser.add_argument('--export-json', action='store_true',
+									help='also write speciation_results/<sample>.json files')
+	watch_parser.add_argument('--process-existing', action='store_true',
+									help='also speciate samples already in a result store')
+	watch_parser.set_defaults(run=watch)
+
+	serve_parser = subparsers.add_parser('serve',
+									help='serve speciation over local HTTP/json')
+	serve_parser.add_argument('--host', default='127.0.0.1',
+									help='address to listen on (default: localhost only)')
+	serve_parser.add_argument('--port', type=int, default=8765)
+	serve_parser.add_argument('--calibration-history', action='store_true',
+									help='use the calibration valid on each sample\'s date')
+	serve_parser.set_defaults(run=serve)
+
+	catalog_parser = subparsers.add_parser('catalog',
+									help='build or query the results catalog')
+	catalog_parser.add_argument('--build', action='store_true',
+									help='catalog every result of the measurement folders')
+	catalog_parser.add_argument('--measurement-paths', nargs='+', default=None,
+									help='measurement folders to catalog (default: <data root>/measurement)')
+	catalog_parser.add_argument('--catalog-file', default=None,
+									help='catalog database (default: <data root>/results_catalog.sqlite)')
+	catalog_parser.add_argument('--species', nargs='+', default=None)
+	catalog_parser.add_argument('--conditions', nargs='+', default=None)
+	catalog_parser.add_argument('--samples', nargs='+', default=None)
+	catalog_parser.add_argument('--temperature', type=float, nargs='+', default=None,
+									help='temperature, or LOW HIGH range, in C')
+	catalog_parser.add_argument('--date-from', default=None,
+									help='first acquisition date, YYYY-MM-DD')
+	catalog_parser.add_argument('--date-to', default=None,
+									help='last acquisition date, YYYY-MM-DD')
+	catalog_parser.set_defaults(run=catalog)
+
+	library_parser = subparsers.add_parser('library',
+									help='index an MSP mass-spectral library for identify')
+	library_parser.add_argument('msp_file')
+	library_parser.add_argument('--output', default=None,
+									help='index file (default: <data root>/spectral_library.npz)')
+	library_parser.add_argument('--max-mz', type=int, default=500)
+	library_parser.set_defaults(run=library)
+
+	identify_parser = subparsers.add_parser('identify',
+									help='suggest species of uncalibrated peaks from their spectra')
+	identify_parser.add_argument('condition')
+	identify_parser.add_argument('samples', nargs='*',
+									help='samples (default: every sample with gc_spectra/<sample>.msp)')
+	identify_parser.add_argument('--library', default=None,
+									help='index or .msp library (default: <data root>/spectral_library.npz)')
+	identify_parser.add_argument('--top-k', type=int, default=3)
+	identify_parser.add_argument('--min-score', type=float, default=0.8,
+									help='cosine similarity needed to name a peak')
+	identify_parser.set_defaults(run=identify)
+
+	queue_parser = subparsers.add_parser('queue',
+									help='speciate through a work queue shared by workers on several hosts')
+	queue_parser.add_argument('action', choices=['submit', 'work', 'status', 'merge'])
+	queue_parser.add_argument('condition', nargs='?', default=None,
+									help='condition to submit (default: every condition)')
+	queue_parser.add_argument('samples', nargs='*',
+									help='samples to submit (default: every sample of the condition)')
+	queue_parser.add_argument('--measurement-path', default=None,
+									help='measurement folder (default: <data root>/measurement)')
+	queue_parser.add_argument('--queue-path', default=None,
+									help='queue folder on the shared file system (default: <measurement>/.work_queue)')
+	queue_parser.add_argument('--lease-time', type=float, default=60.0,
+									help='seconds before the sample of a silent worker is retried')
+	queue_parser.add_argument('--max-attempts', type=int, default=3,
+									help='attempts before a sample is marked failed')
+	queue_parser.add_argument('--workers', type=int, default=1,
+									help='worker processes to run on this host')
+	queue_parser.add_argument('--poll-interval', type=float, default=1.0,
+									help='seconds between scans while other workers hold leases')
+	queue_parser.add_argument('--force', action='store_true',
+									help='merge even if samples are unfinished')
+	queue_parser.set_defaults(run=queue)
+
+	return parser
+
+def main(argv=None):
+
+	args = build_parser().parse_args(argv)
+	if args.metrics is None and args.profile is None:
+		return args.run(args)
+
+	from instrumentation import (
+		metrics,
+		save_metrics,
+		save_profile_stats
+		)
+
+	metrics.reset()
+	metrics.enable(args.profile)
+	try:
+		return args.run(args)
+	finally:
+		metrics.disable()
+		if args.metrics is not None:
+			save_metrics(args.metrics)
+		if args.profile is not None:
+			profile_output = args.profile_output or '{0}.prof'.format(args.profile)
+			save_profile_stats(profile_output, print_top=15)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,51 @@
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from smartgc import main
+
+# seconds allowed for importing the CLI and the modules of its speciate path
+IMPORT_TIME_BUDGET = 0.5
+
+class test_smartgc(unittest.TestCase):
+
+	def measure_import(self, modules):
+
+		code = '\n'.join([
+				'import sys, time',
+				'start_time = time.time()',
+				'import {0}'.format(', '.join(modules)),
+				'print(time.time() - start_time)',
+				'print(int("numpy" in sys.modules), int("statsmodels" in sys.modules))'
+				])
+		output = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+
+		return float(output[0]), output[1:]
+
+	def test_import_time_budget(self):
+
+		import_time, heavy_modules_loaded = self.measure_import(['smartgc'])
+		self.assertLess(import_time, IMPORT_TIME_BUDGET)
+		self.assertEqual(heavy_modules_loaded, ['0', '0'])
+
+		import_time, heavy_modules_loaded = self.measure_import(['smartgc', 'batch_speciation', 
+																'exptl_data_integration'])
+		self.assertLess(import_time, IMPORT_TIME_BUDGET)
+		self.assertEqual(heavy_modules_loaded, ['0', '0'])
+
+	def test_speciate(self):
+
+		gc_measurement_path = tempfile.mkdtemp()
+		try:
+			shutil.copytree(os.path.join('data', 'measurement', 'test_condition'),
+							os.path.join(gc_measurement_path, 'test_condition'))
+			shutil.rmtree(os.path.join(gc_measurement_path, 'test_condition', 'speciation_results'))
+
+			self.assertEqual(main(['speciate', 'test_condition', 'sample0',
+								'--processes', '1', '--measurement-path', gc_measurement_path]), 0)
+			self.assertTrue(os.path.isfile(os.path.join(gc_measurement_path,
+								'test_condition', 'speciation_results.npz')))
+		finally:
+			shutil.rmtree(gc_measurement_path)
@@ -1,16 +1,62 @@
 import os
 import json
-from calibration import (
-	load_fitted_calibration_factor_functions,
-	read_calibration_species_constants
+from calibration import get_calibration_line
+from report_parser import (
+	is_peak_table,
+	iter_peak_records,
+	iter_report_rows,
+	read_report_date
 	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
 
+@timed('speciation')
 def prepare_speciation_in_moles_per_total_mass(
 										condition,
 										sample,
-										calibration_factor_function_dict=None
+										calibration_factor_function_dict=None,
+										gc_measurement_path=None,
+										registry=None,
+										save_results=True,
+										export_json=False,
+										calibration_history=None,
+										response_lookup_tables=None,
+										workspace=None,
+										peak_shape=None,
+										spectral_library=None,
+										result_writer=None
 										):
-	gc_measurement_path = os.path.join('data', 'measurement')
+	"""
+	This method speciates one sample and, with `save_results=True`, adds it
+	to the condition's result store `speciation_results.npz`. That rewrites
+	the whole store, so loops over many samples should pass a
+	`result_store.ResultWriter` as `result_writer`, which writes each store
+	once, or use `batch_speciation`. With `export_json=True` it is also
+	written to `speciation_results/<sample>.json`.
+
+	With a `calibration_history.CalibrationHistory`, the factors valid on the
+	sample's acquisition date (read from its report) are used, on top of
+	`calibration_factor_function_dict` if one is given. Species with a
+	nonlinear response are converted by `response_lookup_tables`. With a
+	`peak_deconvolution.PeakShape`, areas of co-eluting peaks are deconvolved
+	first, fitted to the sample's raw trace `gc_signal/<sample>.ch` if it
+	has one. With a `spectral_library.SpectralLibrary`, peaks of species that
+	are not calibrated are named after their best library hit, if the
+	sample has peak spectra in `gc_spectra/<sample>.msp`.
+
+	Paths and calibration not given default to those of `workspace`
+	(default: `data`), see `workspace.Workspace`.
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
 	gc_speciation_file = os.path.join(
 								gc_measurement_path, 
 								condition, 'gc_speciation',
@@ -22,19 +68,67 @@ def prepare_speciation_in_moles_per_total_mass(
 								'{0}.csv'.format(sample)
 								)
 
-	gc_speciation_data_dict = read_gc_speciation_file(gc_speciation_file)
-
 	gc_inner_standard_data_dict = read_gc_inner_standard_file(gc_inner_standard_file)
 
-	if calibration_factor_function_dict is None:
-		calibration_factor_function_dict = load_fitted_calibration_factor_functions()
+	if registry is None:
+		registry = workspace.registry
+
+	if calibration_history is not None:
+		sample_date = read_report_date(gc_speciation_file)
+		dated_calibration_factor_function_dict = dict(calibration_factor_function_dict or {})
+		dated_calibration_factor_function_dict.update(
+			calibration_history.get_calibration_factor_function_dict(sample_date))
+		calibration_factor_function_dict = dated_calibration_factor_function_dict
+	elif calibration_factor_function_dict is None:
+		calibration_factor_function_dict = registry.get_fitted_calibration_factor_functions()
+
+	gc_speciation_data = gc_speciation_file
+	gc_spectra_file = os.path.join(gc_measurement_path, condition, 'gc_spectra', '{0}.msp'.format(sample))
+	if spectral_library is not None and os.path.exists(gc_spectra_file):
+		from peak_table import PeakTable
+		from spectral_library import identify_peak_table_by_spectra
+		known_species = set(calibration_factor_function_dict).union(response_lookup_tables or {})
+		gc_speciation_data, _ = identify_peak_table_by_spectra(PeakTable.from_report(gc_speciation_file),
+																gc_spectra_file, spectral_library, known_species)
+
+	signal = None
+	gc_signal_file = os.path.join(gc_measurement_path, condition, 'gc_signal', '{0}.ch'.format(sample))
+	if peak_shape is not None and os.path.exists(gc_signal_file):
+		from signal_integration import load_signal
+		signal = load_signal(gc_signal_file)
+
+	gc_speciation_data_dict = read_gc_speciation_file(gc_speciation_data, peak_shape=peak_shape, signal=signal)
 
 	speciation_dict_in_moles_per_total_mass = calculate_speciation_in_moles_per_total_mass(
 												gc_speciation_data_dict,
 												gc_inner_standard_data_dict,
-												calibration_factor_function_dict
+												calibration_factor_function_dict,
+												registry,
+												response_lookup_tables
 												)
 	# save speciation data in mole per total liquid mass (moles/g)
+	if save_results and result_writer is not None:
+		result_writer.add(condition, sample, speciation_dict_in_moles_per_total_mass)
+	elif save_results:
+		# NumPy is only needed for writing the result store
+		from result_store import save_condition_results
+		save_condition_results(condition, {sample: speciation_dict_in_moles_per_total_mass},
+								gc_measurement_path, workspace=workspace)
+
+	if export_json:
+		save_speciation_json(condition, sample, speciation_dict_in_moles_per_total_mass,
+							gc_measurement_path)
+
+	return speciation_dict_in_moles_per_total_mass
+
+def save_speciation_json(condition, sample, speciation_dict_in_moles_per_total_mass, gc_measurement_path=None,
+						workspace=None):
+
+	if gc_measurement_path is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		gc_measurement_path = workspace.gc_measurement_path
+
 	save_results_path = os.path.join(gc_measurement_path,
 									condition, 
 									'speciation_results'
@@ -47,84 +141,136 @@ def prepare_speciation_in_moles_per_total_mass(
 												'{0}.json'.format(sample)
 												)
 
+	with metrics.stage_timer('json_write'):
+		with open(speciation_in_moles_per_total_mass_save_file, 'w') as write_out:
+			json.dump(speciation_dict_in_moles_per_total_mass, write_out, indent=2)
 
-	with open(speciation_in_moles_per_total_mass_save_file, 'w') as write_out:
-		json.dump(speciation_dict_in_moles_per_total_mass, write_out, indent=2)
+@timed('parse')
+def read_gc_speciation_file(gc_speciation_file, use_mmap=False, retention_time_index=None, peak_shape=None,
+							signal=None):
+	"""
+	This method sums peak areas per species of a GC speciation report, 
+	given as a file or as a `PeakTable`. Peaks without a species name are 
+	named by `retention_time_index` (see `peak_identification`) when one 
+	is given. With a `peak_shape`, valley-drop areas of co-eluting peaks 
+	are deconvolved first (see `peak_deconvolution`), by fitting the raw
+	trace if `signal` gives it as `(times, signal)`.
+	"""
 
-	return speciation_dict_in_moles_per_total_mass
+	if peak_shape is not None and not is_peak_table(gc_speciation_file):
+		from peak_table import PeakTable
+		gc_speciation_file = PeakTable.from_report(gc_speciation_file, use_mmap=use_mmap)
+
+	if is_peak_table(gc_speciation_file):
+		peak_table = gc_speciation_file
+		if peak_shape is not None:
+			from peak_deconvolution import deconvolve_peak_table
+			times, signal_values = signal if signal is not None else (None, None)
+			peak_table = deconvolve_peak_table(peak_table, peak_shape, times, signal_values)
+		if retention_time_index is not None:
+			from peak_identification import identify_peaks
+			peak_table = identify_peaks(peak_table, retention_time_index)
+		return peak_table.to_area_dict()
+
+	peak_records = iter_peak_records(gc_speciation_file, use_mmap=use_mmap)
+	if retention_time_index is not None:
+		from peak_identification import identify_peaks
+		peak_records = identify_peaks(peak_records, retention_time_index)
 
-def read_gc_speciation_file(gc_speciation_file):
+	return sum_peak_areas_by_species(peak_records)
+
+def sum_peak_areas_by_species(peak_records):
 
 	gc_speciation_data_dict = {}
-	with open(gc_speciation_file, 'r') as read_in:
-		start_read = False
-		
-		for line in read_in:
-			if start_read and line.strip() != '':
-				fields = line.split('\t')
-				peak_area = float(fields[4].strip())
-				species = fields[7].strip()
-				if species not in gc_speciation_data_dict:
-					gc_speciation_data_dict[species] = peak_area
-				else:
-					gc_speciation_data_dict[species] += peak_area
-
-			if line.startswith('Peak'):
-				start_read = True
+	for peak_record in peak_records:
+		species = peak_record.species
+		if species not in gc_speciation_data_dict:
+			gc_speciation_data_dict[species] = peak_record.area
+		else:
+			gc_speciation_data_dict[species] += peak_record.area
 
 	return gc_speciation_data_dict
 
+@timed('parse')
 def read_gc_inner_standard_file(gc_inner_standard_file):
 
 	gc_inner_standard_data_dict = {}
-	with open(gc_inner_standard_file, 'r') as read_in:
-		start_read = False
-		
-		for line in read_in:
-			if start_read and line.strip() != '':
-				fields = line.split(',')
-				total_liquid_mass = float(fields[0].strip())
-				inner_standard = fields[1].strip()
-				inner_standard_mass = float(fields[2].strip())
-
-				gc_inner_standard_data_dict['total_liquid_mass(g)'] = total_liquid_mass
-				gc_inner_standard_data_dict['inner_standard'] = inner_standard
-				gc_inner_standard_data_dict['inner_standard_mass(g)'] = inner_standard_mass
-
-			if line.startswith('total_liquid_mass'):
-				start_read = True
+	for fields in iter_report_rows(gc_inner_standard_file, 'total_liquid_mass', ','):
+		total_liquid_mass = float(fields[0])
+		inner_standard = fields[1]
+		inner_standard_mass = float(fields[2])
+
+		gc_inner_standard_data_dict['total_liquid_mass(g)'] = total_liquid_mass
+		gc_inner_standard_data_dict['inner_standard'] = inner_standard
+		gc_inner_standard_data_dict['inner_standard_mass(g)'] = inner_standard_mass
 
 	return gc_inner_standard_data_dict
 
+@timed('speciation_compute')
 def calculate_speciation_in_moles_per_total_mass(
 										gc_speciation_data_dict,
 										gc_inner_standard_data_dict,
-										calibration_factor_function_dict
+										calibration_factor_function_dict,
+										registry=None,
+										response_lookup_tables=None,
+										workspace=None
 										):
+	"""
+	This method converts peak areas to moles with the linear calibration
+	factors or, for species in `response_lookup_tables` (see
+	`response_models`), with their nonlinear detector response. Species
+	constants come from `registry` (default: that of `workspace`).
+	"""
+
+	if registry is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		registry = workspace.registry
+
+	if response_lookup_tables is None:
+		response_lookup_tables = {}
+
+	# a PeakTable is summed per species as `read_gc_speciation_file` does
+	if is_peak_table(gc_speciation_data_dict):
+		gc_speciation_data_dict = gc_speciation_data_dict.to_area_dict()
+
+	def get_injection_moles(species, peak_area):
+
+		if species in response_lookup_tables:
+			return float(response_lookup_tables[species].to_moles(peak_area))
+
+		slope, intercept = get_calibration_line(calibration_factor_function_dict[species])
+
+		return (peak_area - intercept)/slope
 
 	speciation_dict_in_moles_per_total_mass = {}
 
 	# get inner standard
 	inner_standard = gc_inner_standard_data_dict['inner_standard']
-	inner_standard_calibration_factor = calibration_factor_function_dict[inner_standard][0]
-	inner_standard_peak_area = gc_speciation_data_dict[inner_standard]
+	inner_standard_moles = get_injection_moles(inner_standard, gc_speciation_data_dict[inner_standard])
 	inner_standard_mass = gc_inner_standard_data_dict['inner_standard_mass(g)']
-	inner_standard_MW = read_calibration_species_constants()[inner_standard]['MW']
+	inner_standard_MW = registry.get_calibration_species_constants()[inner_standard]['MW']
 	total_liquid_mass = gc_inner_standard_data_dict['total_liquid_mass(g)']
 
 
 	for species in gc_speciation_data_dict:
 
-		if species != inner_standard and (species in calibration_factor_function_dict):
+		if species != inner_standard and (species in calibration_factor_function_dict
+											or species in response_lookup_tables):
 
-			species_peak_area = gc_speciation_data_dict[species]
-			species_calibration_factor = calibration_factor_function_dict[species][0]
-			species_moles_per_total_mass = (species_peak_area/species_calibration_factor)\
-									/(inner_standard_peak_area/inner_standard_calibration_factor)\
+			species_moles = get_injection_moles(species, gc_speciation_data_dict[species])
+			species_moles_per_total_mass = species_moles/inner_standard_moles\
 									*inner_standard_mass/inner_standard_MW/total_liquid_mass
 
 			speciation_dict_in_moles_per_total_mass[species] = species_moles_per_total_mass
 
+	if metrics.enabled:
+		metrics.increment('samples_speciated')
+		metrics.increment('species_computed', len(speciation_dict_in_moles_per_total_mass))
+		# peaks of species without calibration are left out of the results
+		metrics.increment('species_uncalibrated', len(gc_speciation_data_dict) - 1
+							- len(speciation_dict_in_moles_per_total_mass))
+
 	return speciation_dict_in_moles_per_total_mass
 
 if __name__ == '__main__':
@@ -152,8 +298,12 @@ if __name__ == '__main__':
 	condition = 'before_pyrolysis'
 	samples = condition_samples_dict[condition]
 
-	for sample in samples:
-		prepare_speciation_in_moles_per_total_mass(
-										condition,
-										sample
-										)
+	from result_store import ResultWriter
+
+	with ResultWriter() as result_writer:
+		for sample in samples:
+			prepare_speciation_in_moles_per_total_mass(
+											condition,
+											sample,
+											result_writer=result_writer
+											)
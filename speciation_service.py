@@ -0,0 +1,324 @@
+import json
+import logging
+import datetime
+import threading
+import http.client
+from http.server import (
+	BaseHTTPRequestHandler,
+	ThreadingHTTPServer
+	)
+from report_parser import (
+	iter_text_peak_records,
+	parse_report_date
+	)
+from speciation import (
+	calculate_speciation_in_moles_per_total_mass,
+	sum_peak_areas_by_species
+	)
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
+
+logger = logging.getLogger('smartgc.service')
+
+INNER_STANDARD_KEYS = ['total_liquid_mass(g)', 'inner_standard', 'inner_standard_mass(g)']
+
+class SpeciationService(object):
+	"""
+	This class answers speciation requests from calibration kept warm in
+	`registry` (default: that of `workspace`), which re-reads its files
+	only when they change (or on `POST /reload`). Requests are dispatched by `dispatch`, so the same
+	service runs behind the HTTP server of `create_server` or in-process
+	behind a `TestClient`.
+
+	Routes, all with json bodies:
+		GET /health
+		GET /calibration: fitted calibration factors and species constants
+		GET /metrics: stage timers and counters, see `instrumentation`
+		POST /reload: forget cached calibration files
+		POST /speciate: see `speciate`
+	"""
+
+	def __init__(self, registry=None, calibration_history=None, workspace=None):
+
+		if workspace is None:
+			workspace = get_default_workspace()
+		if registry is None:
+			registry = workspace.registry
+
+		self.registry = registry
+		self.calibration_history = calibration_history
+		self.requests = 0
+		self._lock = threading.Lock()
+		self._routes = {('GET', '/health'): self.get_health,
+						('GET', '/calibration'): self.get_calibration,
+						('GET', '/metrics'): self.get_metrics,
+						('POST', '/reload'): self.reload,
+						('POST', '/speciate'): self.speciate}
+
+	def dispatch(self, method, path, body=None):
+		"""
+		This method handles one request and outputs a tuple
+		`(status, response_dict)`; `body` is the raw request body.
+		"""
+
+		with self._lock:
+			self.requests += 1
+
+		route = self._routes.get((method, path.split('?')[0]))
+		if route is None:
+			if any(route_path == path.split('?')[0] for _, route_path in self._routes):
+				return 405, {'error': 'Method {0} not allowed on {1}'.format(method, path)}
+			return 404, {'error': 'Unknown path {0}'.format(path)}
+
+		request_dict = {}
+		if body:
+			try:
+				request_dict = json.loads(body)
+			except ValueError as e:
+				return 400, {'error': 'Invalid json: {0}'.format(e)}
+			if not isinstance(request_dict, dict):
+				return 400, {'error': 'Request body must be a json object'}
+
+		try:
+			return 200, route(request_dict)
+		except (KeyError, TypeError, ValueError) as e:
+			return 400, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+		except OSError as e:
+			# e.g. calibration files missing on the server
+			logger.exception('%s %s failed', method, path)
+			return 500, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+
+	def get_health(self, request_dict):
+
+		return {'status': 'ok', 'requests': self.requests}
+
+	def get_calibration(self, request_dict):
+
+		return {'calibration_factors': self.registry.get_fitted_calibration_factor_functions(),
+				'species_constants': self.registry.get_calibration_species_constants()}
+
+	def get_metrics(self, request_dict):
+
+		return metrics.get_report()
+
+	def reload(self, request_dict):
+
+		self.registry.invalidate()
+
+		return {'status': 'reloaded'}
+
+	@timed('service_speciate')
+	def speciate(self, request_dict):
+		"""
+		This method speciates a batch of samples:
+		{ "samples": [ { "sample": name,
+		                 "report": GC report text, or "peak_areas": { species: area },
+		                 "inner_standard": { "total_liquid_mass(g)", "inner_standard", "inner_standard_mass(g)" },
+		                 "date": "YYYY-MM-DD" (optional) } ],
+		  "calibration_factors": { species: [a] } (optional, default: fitted) }
+		and outputs { "results": [ { "sample", "speciation" } or { "sample", "error" } ] }
+		in request order; one bad sample doesn't fail the others.
+
+		With a calibration history, each sample uses the factors valid on its
+		`date`, or on the date in its report header.
+		"""
+
+		calibration_factor_function_dict = request_dict.get('calibration_factors')
+		if calibration_factor_function_dict is None and self.calibration_history is None:
+			calibration_factor_function_dict = self.registry.get_fitted_calibration_factor_functions()
+
+		results = []
+		for sample_dict in request_dict['samples']:
+			result = {'sample': sample_dict.get('sample')}
+			try:
+				result['speciation'] = self.speciate_sample(sample_dict, calibration_factor_function_dict)
+			except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+				result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+			results.append(result)
+
+		return {'results': results}
+
+	def speciate_sample(self, sample_dict, calibration_factor_function_dict):
+
+		if 'report' in sample_dict:
+			gc_speciation_data_dict = sum_peak_areas_by_species(iter_text_peak_records(sample_dict['report']))
+		else:
+			gc_speciation_data_dict = dict((species, float(peak_area))
+											for species, peak_area in sample_dict['peak_areas'].items())
+
+		gc_inner_standard_data_dict = dict((key, sample_dict['inner_standard'][key])
+											for key in INNER_STANDARD_KEYS)
+		gc_inner_standard_data_dict['total_liquid_mass(g)'] = float(gc_inner_standard_data_dict['total_liquid_mass(g)'])
+		gc_inner_standard_data_dict['inner_standard_mass(g)'] = float(gc_inner_standard_data_dict['inner_standard_mass(g)'])
+
+		if self.calibration_history is not None:
+			if 'date' in sample_dict:
+				sample_date = datetime.date(*[int(part) for part in sample_dict['date'].split('-')])
+			else:
+				sample_date = parse_report_date('\n'.join(sample_dict.get('report', '').splitlines()[:2]))
+			dated_calibration_factor_function_dict = dict(calibration_factor_function_dict or {})
+			dated_calibration_factor_function_dict.update(
+				self.calibration_history.get_calibration_factor_function_dict(sample_date))
+			calibration_factor_function_dict = dated_calibration_factor_function_dict
+
+		return calculate_speciation_in_moles_per_total_mass(
+					gc_speciation_data_dict,
+					gc_inner_standard_data_dict,
+					calibration_factor_function_dict,
+					self.registry
+					)
+
+def make_request_handler(service):
+	"""
+	This method outputs a request handler class bound to `service`. It
+	speaks HTTP/1.1, so clients can keep one connection for many requests.
+	"""
+
+	class SpeciationRequestHandler(BaseHTTPRequestHandler):
+
+		protocol_version = 'HTTP/1.1'
+		# headers and body are written separately; with Nagle's algorithm
+		# the body would wait for the client's delayed ACK of the headers
+		disable_nagle_algorithm = True
+
+		def _handle(self, method):
+
+			content_length = int(self.headers.get('Content-Length') or 0)
+			body = self.rfile.read(content_length) if content_length else None
+
+			status, response_dict = service.dispatch(method, self.path, body)
+
+			response_body = json.dumps(response_dict).encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(response_body)))
+			self.end_headers()
+			self.wfile.write(response_body)
+
+		def do_GET(self):
+			self._handle('GET')
+
+		def do_POST(self):
+			self._handle('POST')
+
+		def log_message(self, format, *args):
+			logger.debug('%s - %s', self.address_string(), format % args)
+
+	return SpeciationRequestHandler
+
+def create_server(service=None, host='127.0.0.1', port=8765):
+	"""
+	This method outputs a threaded HTTP server for `service` (default: one
+	on `data/calibration`), listening on localhost unless `host` says
+	otherwise; `port=0` picks a free port. Call `serve_forever()` on it.
+	"""
+
+	if service is None:
+		service = SpeciationService()
+
+	server = ThreadingHTTPServer((host, port), make_request_handler(service))
+	server.daemon_threads = True
+	server.service = service
+
+	return server
+
+class ServiceClient(object):
+	"""
+	This class is a json client of the speciation service that keeps one
+	HTTP connection open across requests.
+	"""
+
+	def __init__(self, host='127.0.0.1', port=8765, timeout=10):
+
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self._connection = None
+
+	def request(self, method, path, data=None):
+		"""
+		This method sends one request and outputs a tuple
+		`(status, response_dict)`.
+		"""
+
+		body = json.dumps(data).encode('utf-8') if data is not None else None
+		headers = {'Content-Type': 'application/json'} if body is not None else {}
+
+		if self._connection is None:
+			self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+		try:
+			self._connection.request(method, path, body, headers)
+			response = self._connection.getresponse()
+			response_body = response.read()
+		except (http.client.HTTPException, OSError):
+			# reconnect once if the server closed the kept-alive connection
+			self.close()
+			self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+			self._connection.request(method, path, body, headers)
+			response = self._connection.getresponse()
+			response_body = response.read()
+
+		return response.status, json.loads(response_body)
+
+	def speciate(self, samples, calibration_factors=None):
+		"""
+		This method outputs the `results` list of `POST /speciate`, see
+		`SpeciationService.speciate`, and raises ValueError if the whole
+		request is rejected.
+		"""
+
+		request_dict = {'samples': samples}
+		if calibration_factors is not None:
+			request_dict['calibration_factors'] = calibration_factors
+
+		status, response_dict = self.request('POST', '/speciate', request_dict)
+		if status != 200:
+			raise ValueError('Speciation request failed with {0}: {1}'.format(status, response_dict['error']))
+
+		return response_dict['results']
+
+	def close(self):
+
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+class TestClient(ServiceClient):
+	"""
+	This class is a `ServiceClient` that calls `service.dispatch` in-process,
+	with the same json encoding, so tests need no network.
+	"""
+
+	__test__ = False
+
+	def __init__(self, service=None):
+
+		ServiceClient.__init__(self)
+		if service is None:
+			service = SpeciationService()
+		self.service = service
+
+	def request(self, method, path, data=None):
+
+		body = json.dumps(data).encode('utf-8') if data is not None else None
+		status, response_dict = self.service.dispatch(method, path, body)
+
+		return status, json.loads(json.dumps(response_dict))
+
+def serve(host='127.0.0.1', port=8765, registry=None, calibration_history=None, workspace=None):
+
+	server = create_server(SpeciationService(registry, calibration_history, workspace), host, port)
+	logger.info('serving speciation on http://%s:%s', *server.server_address[:2])
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	serve()
@@ -0,0 +1,80 @@
+import unittest
+import os
+import time
+import threading
+from speciation import (
+	prepare_speciation_in_moles_per_total_mass,
+	read_gc_inner_standard_file
+	)
+from speciation_service import (
+	ServiceClient,
+	SpeciationService,
+	TestClient,
+	create_server
+	)
+
+class test_speciation_service(unittest.TestCase):
+
+	def setUp(self):
+
+		test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+		with open(os.path.join(test_condition_path, 'gc_speciation', 'sample0.txt'), 'r') as read_in:
+			self.gc_speciation_report = read_in.read()
+		self.gc_inner_standard_data_dict = read_gc_inner_standard_file(
+												os.path.join(test_condition_path, 'gc_inner_standard', 'sample0.csv'))
+		self.expected_speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+																				save_results=False)
+
+	def test_speciate(self):
+
+		client = TestClient(SpeciationService())
+		samples = [{'sample': 'sample0',
+					'report': self.gc_speciation_report,
+					'inner_standard': self.gc_inner_standard_data_dict},
+					{'sample': 'no_inner_standard_peak',
+					'peak_areas': {'PDD': 1e8},
+					'inner_standard': self.gc_inner_standard_data_dict}]
+		results = client.speciate(samples)
+
+		self.assertEqual(results[0], {'sample': 'sample0', 'speciation': self.expected_speciation_dict})
+		self.assertEqual(results[1]['sample'], 'no_inner_standard_peak')
+		self.assertIn('chlorothiophene', results[1]['error'])
+
+		status, response_dict = client.request('GET', '/calibration')
+		self.assertEqual(status, 200)
+		self.assertEqual(response_dict['species_constants']['PDD']['MW'], 246.43)
+		self.assertEqual(client.request('GET', '/health')[1]['status'], 'ok')
+
+	def test_bad_requests(self):
+
+		client = TestClient()
+		self.assertEqual(client.request('GET', '/unknown')[0], 404)
+		self.assertEqual(client.request('GET', '/speciate')[0], 405)
+		self.assertEqual(client.request('POST', '/speciate', {'no_samples': []})[0], 400)
+		self.assertEqual(client.service.dispatch('POST', '/speciate', b'{not json')[0], 400)
+		self.assertRaises(ValueError, client.speciate, None)
+
+	def test_http_server(self):
+
+		server = create_server(port=0)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.start()
+		client = ServiceClient(*server.server_address[:2])
+		try:
+			samples = [{'sample': 'sample0',
+						'report': self.gc_speciation_report,
+						'inner_standard': self.gc_inner_standard_data_dict}]
+
+			start_time = time.time()
+			for i in range(100):
+				results = client.speciate(samples)
+			requests_per_second = 100/(time.time() - start_time)
+
+			self.assertEqual(results[0]['speciation'], self.expected_speciation_dict)
+			self.assertEqual(client.request('POST', '/reload')[1], {'status': 'reloaded'})
+			self.assertGreater(requests_per_second, 100)
+		finally:
+			client.close()
+			server.shutdown()
+			server.server_close()
+			thread.join()
@@ -0,0 +1,256 @@
+import os
+import re
+import hashlib
+import numpy as np
+from peak_table import species_table
+from instrumentation import (
+	metrics,
+	timed
+	)
+
+# number of (query, reference) scores computed at once, bounds memory to a few 10 MB
+MAX_CHUNK_ELEMENTS = 2**22
+
+MSP_PEAK_PATTERN = re.compile(r'(\d+(?:\.\d*)?)[\s:,]+(\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)')
+
+def iter_msp_spectra(msp_file):
+	"""
+	This method reads a spectra file in NIST MSP text format and yields a
+	tuple `(name, metadata, mzs, intensities)` per spectrum; `metadata` has
+	the other `Key: value` lines with lower-case keys. Peak lines may hold
+	one or several `mz intensity` pairs separated by `;`.
+	"""
+
+	name, metadata, mzs, intensities = None, {}, [], []
+	with open(msp_file, 'r') as read_in:
+		for line in read_in:
+			line = line.strip()
+			key, separator, value = line.partition(':')
+			if not line or key.lower() == 'name' and separator:
+				if name is not None:
+					yield name, metadata, np.array(mzs, dtype=float), np.array(intensities, dtype=float)
+				name, metadata, mzs, intensities = None, {}, [], []
+				if line:
+					name = value.strip()
+			elif 'num peaks' in metadata:
+				for mz, intensity in MSP_PEAK_PATTERN.findall(line):
+					mzs.append(float(mz))
+					intensities.append(float(intensity))
+			elif separator:
+				metadata[key.strip().lower()] = value.strip()
+
+	if name is not None:
+		yield name, metadata, np.array(mzs, dtype=float), np.array(intensities, dtype=float)
+
+def vectorize_spectra(spectra, max_mz=500, intensity_power=0.5):
+	"""
+	This method bins spectra, given as `(mzs, intensities)` tuples, to
+	nominal masses 0..`max_mz`, weights intensities by `intensity_power`
+	(square roots by default, so a few dominant ions don't decide the
+	match alone) and outputs a float32 matrix of unit rows; a spectrum
+	without ions in range is a zero row.
+	"""
+
+	spectrum_matrix = np.zeros((len(spectra), max_mz + 1), dtype=np.float32)
+	for i, (mzs, intensities) in enumerate(spectra):
+		mz_bins = np.rint(np.asarray(mzs, dtype=float)).astype(np.intp)
+		selected = (mz_bins >= 0) & (mz_bins <= max_mz)
+		np.add.at(spectrum_matrix[i], mz_bins[selected], np.asarray(intensities, dtype=float)[selected])
+
+	spectrum_matrix = np.power(np.maximum(spectrum_matrix, 0), intensity_power)
+	norms = np.linalg.norm(spectrum_matrix, axis=1, keepdims=True)
+
+	return spectrum_matrix/np.where(norms > 0, norms, 1)
+
+class SpectralLibrary(object):
+	"""
+	This class is a search index of reference mass spectra: their `names`
+	and a matrix of binned, weighted and normalized spectra (see
+	`vectorize_spectra`), one row per reference. The cosine similarity of
+	any number of query spectra to every reference is then one matrix
+	product, see `search`.
+
+	The index is built once from an MSP library with `from_msp` and saved
+	to `.npz` with `save`, which `load` reads back without parsing.
+	"""
+
+	def __init__(self, names, spectrum_matrix, max_mz=500, intensity_power=0.5):
+
+		self.names = [str(name) for name in names]
+		self.spectrum_matrix = np.ascontiguousarray(spectrum_matrix, dtype=np.float32)
+		self.max_mz = int(max_mz)
+		self.intensity_power = float(intensity_power)
+
+	def __len__(self):
+
+		return len(self.names)
+
+	@classmethod
+	@timed('library_index')
+	def from_msp(cls, msp_file, max_mz=500, intensity_power=0.5):
+
+		names, spectra = [], []
+		for name, metadata, mzs, intensities in iter_msp_spectra(msp_file):
+			names.append(name)
+			spectra.append((mzs, intensities))
+
+		return cls(names, vectorize_spectra(spectra, max_mz, intensity_power), max_mz, intensity_power)
+
+	@classmethod
+	def load(cls, library_file):
+		"""
+		This method loads an index saved by `save`, or indexes an `.msp` library.
+		"""
+
+		if library_file.lower().endswith('.msp'):
+			return cls.from_msp(library_file)
+
+		with np.load(library_file, allow_pickle=False) as library:
+			return cls([str(name) for name in library['names']], library['spectrum_matrix'],
+						int(library['max_mz']), float(library['intensity_power']))
+
+	def save(self, library_file):
+
+		temporary_file = library_file[:-len('.npz')] + '.tmp.npz'
+		np.savez(temporary_file,
+				names=np.array(self.names, dtype=str),
+				spectrum_matrix=self.spectrum_matrix,
+				max_mz=self.max_mz,
+				intensity_power=self.intensity_power)
+		os.replace(temporary_file, library_file)
+
+	def get_signature(self):
+		"""
+		This method outputs a sha1 of the index, e.g. for incremental runs.
+		"""
+
+		signature = hashlib.sha1('\n'.join(self.names).encode('utf-8'))
+		signature.update(self.spectrum_matrix.tobytes())
+		signature.update('{0} {1}'.format(self.max_mz, self.intensity_power).encode('ascii'))
+
+		return signature.hexdigest()
+
+	def vectorize(self, spectra):
+
+		return vectorize_spectra(spectra, self.max_mz, self.intensity_power)
+
+	@timed('library_search')
+	def search(self, spectra, top_k=5):
+		"""
+		This method scores query spectra, `(mzs, intensities)` tuples or a
+		matrix from `vectorize`, against every reference and outputs a tuple
+		`(indices, scores)` of shape (queries, top_k): the references with
+		the highest cosine similarity, best first.
+		"""
+
+		if isinstance(spectra, np.ndarray):
+			query_matrix = np.asarray(spectra, dtype=np.float32)
+		else:
+			query_matrix = self.vectorize(spectra)
+
+		top_k = min(top_k, len(self))
+		indices = np.zeros((query_matrix.shape[0], top_k), dtype=np.intp)
+		scores = np.zeros((query_matrix.shape[0], top_k), dtype=np.float32)
+		if top_k == 0:
+			return indices, scores
+
+		chunk_size = max(1, MAX_CHUNK_ELEMENTS//max(1, len(self)))
+		for begin in range(0, query_matrix.shape[0], chunk_size):
+			similarities = query_matrix[begin:begin + chunk_size].dot(self.spectrum_matrix.T)
+			if top_k < len(self):
+				candidates = np.argpartition(-similarities, top_k - 1, axis=1)[:, :top_k]
+			else:
+				candidates = np.broadcast_to(np.arange(len(self)), similarities.shape)
+			candidate_scores = np.take_along_axis(similarities, candidates, axis=1)
+			order = np.argsort(-candidate_scores, axis=1, kind='stable')
+			indices[begin:begin + chunk_size] = np.take_along_axis(candidates, order, axis=1)
+			scores[begin:begin + chunk_size] = np.take_along_axis(candidate_scores, order, axis=1)
+		if metrics.enabled:
+			metrics.increment('spectra_searched', query_matrix.shape[0])
+
+		return indices, scores
+
+def read_peak_spectra(spectra_file, peak_table, ret_time_tolerance=0.02):
+	"""
+	This method reads the spectra exported for the peaks of a GC report, an
+	MSP file with one spectrum per peak, and outputs a tuple
+	`(peak_indices, spectra)` matching each spectrum to a row of
+	`peak_table` by its `Peak:` number (or its name), else by the nearest
+	`RT:` retention time within `ret_time_tolerance` minutes. Spectra
+	matching no peak are left out.
+	"""
+
+	peak_positions = dict((str(peak), index) for index, peak in enumerate(peak_table.peaks))
+
+	peak_indices, spectra = [], []
+	for name, metadata, mzs, intensities in iter_msp_spectra(spectra_file):
+		peak_index = peak_positions.get(metadata.get('peak', name))
+		ret_time = metadata.get('rt', metadata.get('retentiontime'))
+		if peak_index is None and ret_time is not None and len(peak_table):
+			ret_time_differences = np.abs(peak_table.ret_times - float(ret_time.split()[0]))
+			if ret_time_differences.min() <= ret_time_tolerance:
+				peak_index = int(ret_time_differences.argmin())
+		if peak_index is not None:
+			peak_indices.append(peak_index)
+			spectra.append((mzs, intensities))
+
+	return np.array(peak_indices, dtype=np.intp), spectra
+
+@timed('identification')
+def suggest_peak_species(
+					peak_table,
+					peak_indices,
+					spectra,
+					spectral_library,
+					known_species=None,
+					top_k=3,
+					min_score=0.8
+					):
+	"""
+	This method searches `spectral_library` for the spectra of the peaks
+	at `peak_indices` of `peak_table` that are unknown: unnamed, or not in
+	`known_species` (e.g. the calibrated species) when it is given.
+
+	It outputs a tuple `(peak_table, suggestions)`: a copy of the table in
+	which each unknown peak whose best hit scores at least `min_score` is
+	named after it, and a dictionary with key: peak index and value: list
+	of the `top_k` tuples `(name, score)`, best first.
+	"""
+
+	peak_indices = np.asarray(peak_indices, dtype=np.intp)
+	peak_species = peak_table.get_species()
+	unknown = np.array([not peak_species[index] or (known_species is not None
+											and peak_species[index] not in known_species)
+						for index in peak_indices], dtype=bool)
+	peak_indices = peak_indices[unknown]
+	if peak_indices.shape[0] == 0:
+		return peak_table, {}
+
+	spectra = [spectrum for spectrum, is_unknown in zip(spectra, unknown) if is_unknown]
+	indices, scores = spectral_library.search(spectra, top_k)
+
+	suggestions = {}
+	for peak_index, hit_indices, hit_scores in zip(peak_indices, indices, scores):
+		suggestions[int(peak_index)] = [(spectral_library.names[hit_index], float(hit_score))
+										for hit_index, hit_score in zip(hit_indices, hit_scores)]
+
+	species_ids = peak_table.species_ids.copy()
+	identified = scores[:, 0] >= min_score if scores.shape[1] else np.zeros(0, dtype=bool)
+	species_ids[peak_indices[identified]] = species_table.intern_many(
+									[spectral_library.names[hit_index] for hit_index in indices[identified, 0]])
+	if metrics.enabled:
+		metrics.increment('peaks_identified_by_spectrum', int(identified.sum()))
+
+	return peak_table.replace(species_ids=species_ids), suggestions
+
+def identify_peak_table_by_spectra(peak_table, spectra_file, spectral_library, known_species=None, top_k=3,
+								min_score=0.8):
+	"""
+	This method reads the spectra of a report's peaks (see `read_peak_spectra`)
+	and names its unknown peaks with `suggest_peak_species`.
+	"""
+
+	peak_indices, spectra = read_peak_spectra(spectra_file, peak_table)
+
+	return suggest_peak_species(peak_table, peak_indices, spectra, spectral_library, known_species,
+								top_k, min_score)
@@ -0,0 +1,137 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from peak_table import PeakTable
+from spectral_library import (
+	SpectralLibrary,
+	identify_peak_table_by_spectra,
+	iter_msp_spectra,
+	read_peak_spectra
+	)
+from speciation import prepare_speciation_in_moles_per_total_mass
+from workspace import Workspace
+
+def write_msp(msp_file, spectra):
+
+	with open(msp_file, 'w') as write_out:
+		for name, metadata, mzs, intensities in spectra:
+			write_out.write('Name: {0}\n'.format(name))
+			for key, value in metadata.items():
+				write_out.write('{0}: {1}\n'.format(key, value))
+			write_out.write('Num Peaks: {0}\n'.format(len(mzs)))
+			write_out.write('; '.join('{0} {1}'.format(mz, intensity)
+									for mz, intensity in zip(mzs, intensities)) + ';\n\n')
+
+class test_spectral_library(unittest.TestCase):
+
+	def setUp(self):
+
+		self.scratch_path = tempfile.mkdtemp()
+
+		# random reference spectra of 12 ions each, one of them ethylbenzene
+		random_state = np.random.RandomState(0)
+		self.reference_spectra = []
+		for i in range(300):
+			mzs = np.sort(random_state.choice(np.arange(15, 300), 12, replace=False))
+			intensities = np.rint(random_state.uniform(1, 999, 12))
+			self.reference_spectra.append(('compound{0}'.format(i), {'Formula': 'C8H10'}, mzs, intensities))
+		self.reference_spectra[42] = ('ethylbenzene', {'CAS': '100-41-4'}, np.array([51, 65, 77, 91, 106]),
+									np.array([60, 40, 50, 999, 310]))
+		self.library_file = os.path.join(self.scratch_path, 'library.msp')
+		write_msp(self.library_file, self.reference_spectra)
+
+	def tearDown(self):
+
+		shutil.rmtree(self.scratch_path)
+
+	def test_iter_msp_spectra(self):
+
+		spectra = list(iter_msp_spectra(self.library_file))
+
+		self.assertEqual(len(spectra), 300)
+		name, metadata, mzs, intensities = spectra[42]
+		self.assertEqual(name, 'ethylbenzene')
+		self.assertEqual(metadata['cas'], '100-41-4')
+		self.assertEqual(mzs.tolist(), [51, 65, 77, 91, 106])
+		self.assertEqual(intensities.tolist(), [60, 40, 50, 999, 310])
+
+	def test_search(self):
+
+		spectral_library = SpectralLibrary.from_msp(self.library_file)
+		index_file = os.path.join(self.scratch_path, 'library.npz')
+		spectral_library.save(index_file)
+		spectral_library = SpectralLibrary.load(index_file)
+		self.assertEqual(len(spectral_library), 300)
+
+		# noisy copies of every reference find their reference first
+		random_state = np.random.RandomState(1)
+		queries = [(mzs, intensities*random_state.uniform(0.8, 1.2, intensities.shape[0]))
+					for _, _, mzs, intensities in self.reference_spectra]
+		indices, scores = spectral_library.search(queries, top_k=4)
+
+		self.assertEqual(indices.shape, (300, 4))
+		np.testing.assert_array_equal(indices[:, 0], np.arange(300))
+		self.assertTrue(np.all(scores[:, 0] > 0.98))
+		self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+
+		# scores are cosine similarities
+		query_matrix = spectral_library.vectorize(queries[:1])
+		self.assertAlmostEqual(float(scores[0, 1]),
+							float(query_matrix[0].dot(spectral_library.spectrum_matrix[indices[0, 1]])), places=5)
+
+	def test_identify_peak_table_by_spectra(self):
+
+		gc_speciation_file = os.path.join('data', 'measurement', 'test_condition', 'gc_speciation', 'sample0.txt')
+		peak_table = PeakTable.from_report(gc_speciation_file)
+
+		# spectra of C6H5C2H5 (by peak number) and of decane (by retention time)
+		spectra_file = os.path.join(self.scratch_path, 'sample0.msp')
+		write_msp(spectra_file, [('4', {}, np.array([51, 65, 77, 91, 106]), np.array([55, 45, 50, 999, 300])),
+								('unknown', {'RT': '11.041'}, np.array([43, 57, 71, 85]), np.array([999, 800, 300, 150])),
+								('unknown', {'RT': '30.0'}, np.array([43]), np.array([999]))])
+		peak_indices, spectra = read_peak_spectra(spectra_file, peak_table)
+		self.assertEqual(peak_indices.tolist(), [3, 4])
+
+		spectral_library = SpectralLibrary.from_msp(self.library_file)
+		identified_table, suggestions = identify_peak_table_by_spectra(peak_table, spectra_file, spectral_library,
+																	known_species=['toluene', 'ethylbenzene'])
+
+		self.assertEqual(sorted(suggestions), [3, 4])
+		self.assertEqual(suggestions[3][0][0], 'ethylbenzene')
+		self.assertEqual(len(suggestions[3]), 3)
+		self.assertEqual(identified_table[3].species, 'ethylbenzene')
+		# decane matches nothing well and keeps its name
+		self.assertLess(suggestions[4][0][1], 0.8)
+		self.assertEqual(identified_table[4].species, 'decane')
+		self.assertEqual(identified_table[0].species, 'toluene')
+
+	def test_prepare_speciation_with_spectral_library(self):
+
+		# a scratch data root, calibrated for ethylbenzene whatever other tests refit
+		workspace = Workspace(os.path.join(self.scratch_path, 'data'))
+		shutil.copytree(os.path.join('data', 'calibration'), workspace.calibration_path)
+		shutil.copytree(os.path.join('data', 'measurement', 'test_condition'),
+						workspace.get_condition_path('test_condition'),
+						ignore=shutil.ignore_patterns('speciation_results*'))
+		os.mkdir(os.path.join(workspace.get_condition_path('test_condition'), 'gc_spectra'))
+		write_msp(os.path.join(workspace.get_condition_path('test_condition'), 'gc_spectra', 'sample0.msp'),
+				[('4', {}, np.array([51, 65, 77, 91, 106]), np.array([55, 45, 50, 999, 300]))])
+		calibration_factor_function_dict = dict(workspace.registry.get_fitted_calibration_factor_functions())
+		calibration_factor_function_dict['ethylbenzene'] = [221215846525525.81]
+
+		speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+													calibration_factor_function_dict,
+													save_results=False,
+													workspace=workspace)
+		identified_speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+													calibration_factor_function_dict,
+													save_results=False,
+													workspace=workspace,
+													spectral_library=SpectralLibrary.from_msp(self.library_file))
+
+		self.assertNotIn('ethylbenzene', speciation_dict)
+		self.assertGreater(identified_speciation_dict['ethylbenzene'], 0)
+		for species, moles_per_total_mass in speciation_dict.items():
+			self.assertAlmostEqual(identified_speciation_dict[species], moles_per_total_mass)
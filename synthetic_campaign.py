@@ -0,0 +1,148 @@
+import os
+import json
+import numpy as np
+
+INNER_STANDARD = 'chlorothiophene'
+INJECTION_VOLUMES = [0.1, 0.2, 0.5, 1]
+
+def get_species_list(species_count):
+
+	return [INNER_STANDARD] + ['species{0:04d}'.format(i) for i in range(1, species_count)]
+
+def generate_calibration_files(calibration_path, species_list, random_state):
+	"""
+	This method writes one calibration report per species like
+	`data/calibration/PDD.txt` (four injections, slightly bending response),
+	and `calibration_species_constants.csv`.
+
+	output: dictionary with key: `species` and value:
+	`(density, MW, retention time, peak area per mole)`
+	"""
+
+	if not os.path.exists(calibration_path):
+		os.makedirs(calibration_path)
+
+	species_properties = {}
+	ret_times = np.sort(random_state.uniform(3.0, 28.0, len(species_list)))
+	for i, species in enumerate(species_list):
+		density = random_state.uniform(0.65, 1.3)
+		MW = random_state.uniform(80.0, 300.0)
+		response = random_state.uniform(1.5e14, 3.5e14) # peak area per mole
+		species_properties[species] = (density, MW, ret_times[i], response)
+
+		lines = ['Signal: 20161006_{0:02d}_{1}_01ul.D\\FID1B.ch'.format(i % 100, species),
+				'20161006_{0:02d}_{1}_01ul'.format(i % 100, species),
+				'',
+				'volume/uL\tRet Time\tType\tWidth\tArea\tStart Time\tEnd Time\t']
+		for volume in INJECTION_VOLUMES:
+			moles = volume*1e-3*density/MW
+			peak_area = response*moles*(1 - 0.08*volume)*random_state.normal(1, 0.01)
+			ret_time = ret_times[i] + 0.25*volume
+			width = 0.08 + 0.13*volume
+			lines.append('{0}\t{1:.3f}\t   M\t{2:.3f}\t{3:13d}\t{4:.3f}\t{5:.3f}\t'.format(
+							volume, ret_time, width, int(peak_area),
+							ret_time - width, ret_time + width/2))
+
+		with open(os.path.join(calibration_path, species+'.txt'), 'w') as write_out:
+			write_out.write('\n'.join(lines) + '\n')
+
+	with open(os.path.join(calibration_path, 'calibration_species_constants.csv'), 'w') as write_out:
+		write_out.write('species, density(g/cm3), MW(g/mol)\n')
+		for species in species_list:
+			density, MW, _, _ = species_properties[species]
+			write_out.write('{0}, {1:.3f}, {2:.2f}\n'.format(species, density, MW))
+
+	return species_properties
+
+def generate_sample_files(gc_measurement_path, condition, sample, species_properties, random_state, fraction_present=0.6):
+	"""
+	This method writes the GC speciation report and the GC inner standard
+	file of one sample, with a random subset of species present.
+	"""
+
+	total_liquid_mass = random_state.uniform(0.15, 0.25)
+	inner_standard_mass = random_state.uniform(0.015, 0.025)
+
+	lines = ['TIC: 07222016_{0}.D\\data.ms'.format(sample),
+			'07222016_{0}'.format(sample),
+			'',
+			'Peak #\tRet Time\tType\tWidth\tArea\tStart Time\tEnd Time\t']
+	peak = 1
+	for species in sorted(species_properties, key=lambda species: species_properties[species][2]):
+		if species != INNER_STANDARD and random_state.uniform() > fraction_present:
+			continue
+
+		density, MW, ret_time, response = species_properties[species]
+		if species == INNER_STANDARD:
+			moles = inner_standard_mass/MW
+		else:
+			moles = random_state.uniform(1e-6, 5e-5)
+		# ~1 uL of liquid is injected
+		peak_area = response*moles/(total_liquid_mass/0.9e-3)
+		width = random_state.uniform(0.03, 0.14)
+		lines.append('{0}\t{1:.3f}\t   M\t{2:.3f}\t{3:13d}\t{4:.3f}\t{5:.3f}\t{6}'.format(
+						peak, ret_time + 0.4, width, int(peak_area),
+						ret_time + 0.4 - width, ret_time + 0.4 + width/2, species))
+		peak += 1
+
+	for folder in ['gc_speciation', 'gc_inner_standard']:
+		folder_path = os.path.join(gc_measurement_path, condition, folder)
+		if not os.path.exists(folder_path):
+			os.makedirs(folder_path)
+
+	with open(os.path.join(gc_measurement_path, condition, 'gc_speciation', sample+'.txt'), 'w') as write_out:
+		write_out.write('\n'.join(lines) + '\n')
+
+	with open(os.path.join(gc_measurement_path, condition, 'gc_inner_standard', sample+'.csv'), 'w') as write_out:
+		write_out.write('total_liquid_mass(g), inner_standard, inner_standard_mass(g)\n')
+		write_out.write('{0:.4f}, {1}, {2:.4f}'.format(total_liquid_mass, INNER_STANDARD, inner_standard_mass))
+
+def generate_campaign(
+				data_path,
+				condition_count=3,
+				samples_per_condition=10,
+				species_count=20,
+				seed=0
+				):
+	"""
+	This method writes a synthetic campaign under `data_path` laid out like
+	`data/`: calibration reports and species constants in `calibration`, and
+	in `measurement` one `before_pyrolysis` condition plus
+	`condition_count - 1` conditions `pyrolysis_<T>C` with their
+	`condition.csv`. Samples are named `sample<N>_bf_instd` and
+	`sample<N>_aft_instd` as `save_exptl_data_to_chemkin_simulation_format`
+	expects.
+
+	output: dictionary with key: `condition` and value: list of `samples`
+	"""
+
+	random_state = np.random.RandomState(seed)
+	calibration_path = os.path.join(data_path, 'calibration')
+	gc_measurement_path = os.path.join(data_path, 'measurement')
+
+	species_list = get_species_list(species_count)
+	species_properties = generate_calibration_files(calibration_path, species_list, random_state)
+
+	condition_samples_dict = {}
+	conditions = ['before_pyrolysis'] + ['pyrolysis_{0}C'.format(350 + 25*i)
+										for i in range(condition_count - 1)]
+	for condition in conditions:
+		suffix = 'bf' if condition == 'before_pyrolysis' else 'aft'
+		samples = ['sample{0}_{1}_instd'.format(i, suffix) for i in range(samples_per_condition)]
+		for sample in samples:
+			generate_sample_files(gc_measurement_path, condition, sample, species_properties, random_state)
+		condition_samples_dict[condition] = samples
+
+		condition_path = os.path.join(gc_measurement_path, condition)
+		if condition != 'before_pyrolysis':
+			with open(os.path.join(condition_path, 'condition.csv'), 'w') as write_out:
+				write_out.write('Time(h), Temperature(C), Pressure(atm)\n')
+				write_out.write('{0}, {1}, 1\n'.format(72, condition.split('_')[1][:-1]))
+
+	with open(os.path.join(data_path, 'campaign.json'), 'w') as write_out:
+		json.dump({'condition_count': condition_count,
+					'samples_per_condition': samples_per_condition,
+					'species_count': species_count,
+					'seed': seed}, write_out, indent=2)
+
+	return condition_samples_dict
@@ -0,0 +1,72 @@
+import unittest
+import os
+import shutil
+import tempfile
+from synthetic_campaign import generate_campaign
+from calibration import (
+	get_registry,
+	prepare_calibration_factor_functions
+	)
+from batch_speciation import (
+	discover_condition_samples,
+	run_batch_speciation
+	)
+
+class test_synthetic_campaign(unittest.TestCase):
+
+	def setUp(self):
+
+		self.data_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.data_path)
+
+	def test_generate_campaign(self):
+
+		condition_samples_dict = generate_campaign(self.data_path, condition_count=3,
+													samples_per_condition=4, species_count=6)
+
+		self.assertEqual(sorted(condition_samples_dict),
+						['before_pyrolysis', 'pyrolysis_350C', 'pyrolysis_375C'])
+		self.assertEqual(condition_samples_dict['pyrolysis_350C'][0], 'sample0_aft_instd')
+
+		gc_measurement_path = os.path.join(self.data_path, 'measurement')
+		self.assertEqual(discover_condition_samples(gc_measurement_path), condition_samples_dict)
+		self.assertTrue(os.path.exists(os.path.join(gc_measurement_path, 'pyrolysis_375C', 'condition.csv')))
+
+		calibration_files = [f for f in os.listdir(os.path.join(self.data_path, 'calibration'))
+							if f.endswith('.txt')]
+		self.assertEqual(len(calibration_files), 6)
+
+	def test_generate_campaign_is_reproducible(self):
+
+		other_data_path = tempfile.mkdtemp()
+		try:
+			generate_campaign(self.data_path, 2, 2, 5, seed=3)
+			generate_campaign(other_data_path, 2, 2, 5, seed=3)
+			sample_file = os.path.join('measurement', 'pyrolysis_350C', 'gc_speciation', 'sample1_aft_instd.txt')
+			with open(os.path.join(self.data_path, sample_file)) as read_in:
+				expected = read_in.read()
+			with open(os.path.join(other_data_path, sample_file)) as read_in:
+				self.assertEqual(read_in.read(), expected)
+		finally:
+			shutil.rmtree(other_data_path)
+
+	def test_campaign_speciates(self):
+
+		generate_campaign(self.data_path, condition_count=2, samples_per_condition=3, species_count=5)
+
+		calibration_path = os.path.join(self.data_path, 'calibration')
+		registry = get_registry(calibration_path)
+		prepare_calibration_factor_functions(calibration_path=calibration_path, registry=registry)
+		batch_speciation_dict, _ = run_batch_speciation(
+											gc_measurement_path=os.path.join(self.data_path, 'measurement'),
+											processes=1,
+											registry=registry)
+
+		speciation = batch_speciation_dict['pyrolysis_350C']['sample0_aft_instd']
+		self.assertTrue(len(speciation) > 0)
+		for moles_per_total_mass in speciation.values():
+			# 1e-6 to 5e-5 moles in 0.15 to 0.25 g, up to calibration curvature
+			self.assertTrue(1e-6 < moles_per_total_mass < 1e-3)
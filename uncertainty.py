@@ -0,0 +1,469 @@
+import os
+import json
+import numpy as np
+from calibration import read_calibration_data
+from calibration_fitting import fit_calibration_factors
+from speciation import (
+	read_gc_inner_standard_file,
+	read_gc_speciation_file
+	)
+from vectorized_speciation import (
+	build_inner_standard_vectors,
+	build_peak_area_matrix,
+	build_species_vectors,
+	calculate_speciation_matrix,
+	normalize_initial_moles_per_total_mass_matrix,
+	subtract_calibration_intercepts
+	)
+from instrumentation import timed
+from workspace import get_default_workspace
+
+# number of (draw, peak) values computed at once, bounds memory to a few 10 MB
+MAX_CHUNK_ELEMENTS = 2**21
+
+def get_calibration_factor_standard_errors(
+									calibration_data_dict,
+									zero_intercept=True,
+									weighting=None,
+									point_range=None
+									):
+	"""
+	This method fits the calibration data like
+	`get_calibration_factor_function_dict_by_linear_regression` and outputs a
+	dictionary with key: `species` and value: standard error of the
+	calibration factor (the slope `a`).
+	"""
+
+	calibration_fit = fit_calibration_factors(calibration_data_dict,
+											zero_intercept=zero_intercept,
+											weighting=weighting,
+											point_range=point_range)
+
+	calibration_factor_standard_error_dict = {}
+	for species, standard_errors in zip(calibration_fit.species_list, calibration_fit.standard_errors):
+		calibration_factor_standard_error_dict[species] = float(standard_errors[-1])
+
+	return calibration_factor_standard_error_dict
+
+def prepare_calibration_factor_standard_errors(calibration_species_list=None, registry=None, workspace=None):
+	"""
+	This method reads the calibration files of `registry`'s folder (default:
+	the calibration folder of `workspace`) and outputs their calibration
+	factor standard errors, each species fitted with the model selected for
+	its factor if any (see `CalibrationRegistry.get_calibration_model_selection`).
+	"""
+
+	if registry is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		registry = workspace.registry
+
+	calibration_data_dict = read_calibration_data(calibration_species_list, registry.calibration_path, registry)
+	selected_model_dict = registry.get_calibration_model_selection()
+
+	# species fitted alike are fitted together
+	calibration_data_dict_by_model = {}
+	for species, calibration_data in calibration_data_dict.items():
+		selected_model = selected_model_dict.get(species, {})
+		point_range = selected_model.get('point_range')
+		model = (selected_model.get('zero_intercept', True), selected_model.get('weighting'),
+				tuple(point_range) if point_range else None)
+		calibration_data_dict_by_model.setdefault(model, {})[species] = calibration_data
+
+	calibration_factor_standard_error_dict = {}
+	for (zero_intercept, weighting, point_range), model_calibration_data_dict \
+		in calibration_data_dict_by_model.items():
+		calibration_factor_standard_error_dict.update(get_calibration_factor_standard_errors(
+															model_calibration_data_dict,
+															zero_intercept,
+															weighting,
+															point_range))
+
+	return calibration_factor_standard_error_dict
+
+def draw_factors(
+				inner_standard_peak_areas,
+				inner_standard_masses,
+				total_liquid_masses,
+				inner_standard_indices,
+				calibration_factors,
+				calibration_factor_standard_errors,
+				MWs,
+				draw_count,
+				peak_area_rsd,
+				inner_standard_mass_sd,
+				random_generator
+				):
+	"""
+	This method draws `draw_count` realizations of the two factors the
+	moles/g of a peak is made of besides its own area,
+	`peak_area*inverse_calibration_factor*sample_factor`, and outputs them
+	as a tuple `(inverse_calibration_factors, sample_factors)` of shapes
+	(draws, species) and (draws, samples).
+
+	Each draw perturbs every species' calibration factor by its standard
+	error, every inner standard peak area by a relative normal error
+	`peak_area_rsd` and every inner standard mass by an absolute normal
+	error `inner_standard_mass_sd` (g). A calibration factor is shared by
+	all samples of a draw, since one calibration serves the whole campaign.
+	"""
+
+	sample_count = inner_standard_masses.shape[0]
+	species_count = calibration_factors.shape[0]
+
+	drawn_calibration_factors = calibration_factors + calibration_factor_standard_errors\
+								*random_generator.standard_normal((draw_count, species_count))
+	drawn_inner_standard_peak_areas = inner_standard_peak_areas*(1 + peak_area_rsd
+								*random_generator.standard_normal((draw_count, sample_count)))
+	drawn_inner_standard_masses = inner_standard_masses + inner_standard_mass_sd\
+								*random_generator.standard_normal((draw_count, sample_count))
+
+	sample_factors = drawn_calibration_factors[:, inner_standard_indices]/drawn_inner_standard_peak_areas\
+					*drawn_inner_standard_masses/MWs[inner_standard_indices]/total_liquid_masses
+
+	return 1/drawn_calibration_factors, sample_factors
+
+def draw_peak_speciation(
+					peak_areas,
+					peak_sample_indices,
+					peak_species_indices,
+					inverse_calibration_factors,
+					sample_factors,
+					peak_area_rsd,
+					random_generator
+					):
+	"""
+	This method combines drawn factors (see `draw_factors`) with drawn peak
+	areas into the moles/g of every peak, an array of shape (draws, peaks).
+	Peaks are the flattened non-NaN entries of a peak area matrix, given by
+	their area and their sample and species indices.
+	"""
+
+	drawn_peak_areas = peak_areas*(1 + peak_area_rsd
+								*random_generator.standard_normal((sample_factors.shape[0], peak_areas.shape[0])))
+
+	return drawn_peak_areas*inverse_calibration_factors[:, peak_species_indices]\
+			*sample_factors[:, peak_sample_indices]
+
+def get_group_segments(group_matrix, peak_sample_indices, peak_species_indices, species_count):
+	"""
+	This method prepares the averaging of drawn peaks over the samples of
+	each group, like repeated injections are averaged in
+	`save_exptl_data_to_chemkin_simulation_format` (species missing from a
+	sample count as 0). `group_matrix` has shape (groups, samples) and holds
+	1/(samples in group) for the samples of each group.
+
+	output: tuple `(entry_peaks, entry_weights, segment_starts, targets)`
+	for `group_peak_draws`
+	"""
+
+	entry_groups, entry_peaks = np.nonzero(group_matrix[:, peak_sample_indices])
+	entry_weights = group_matrix[entry_groups, peak_sample_indices[entry_peaks]]
+	entry_targets = entry_groups*species_count + peak_species_indices[entry_peaks]
+
+	order = np.argsort(entry_targets, kind='stable')
+	entry_peaks = entry_peaks[order]
+	entry_weights = entry_weights[order]
+	targets, segment_starts = np.unique(entry_targets[order], return_index=True)
+
+	return entry_peaks, entry_weights, segment_starts, targets
+
+def group_peak_draws(drawn_values, group_segments, group_count, species_count):
+	"""
+	This method averages drawn peaks of shape (draws, peaks) per group with
+	the output of `get_group_segments` and outputs an array of shape
+	(draws, groups, species).
+	"""
+
+	entry_peaks, entry_weights, segment_starts, targets = group_segments
+
+	grouped_values = np.zeros((drawn_values.shape[0], group_count*species_count))
+	if targets.shape[0] > 0:
+		grouped_values[:, targets] = np.add.reduceat(drawn_values[:, entry_peaks]*entry_weights,
+													segment_starts, axis=1)
+
+	return grouped_values.reshape(drawn_values.shape[0], group_count, species_count)
+
+def normalize_initial_moles_per_total_mass_draws(drawn_initial_moles_per_total_mass, MWs):
+	"""
+	This method is `normalize_initial_moles_per_total_mass_matrix` over a
+	leading draw axis: every draw of every sample is divided by its own
+	mass sum(MW*mol/g) over the species present.
+	"""
+
+	present = drawn_initial_moles_per_total_mass > 0
+	masses = np.where(present, MWs*drawn_initial_moles_per_total_mass, 0).sum(axis=-1)
+
+	return drawn_initial_moles_per_total_mass/masses[..., None]
+
+def update_moments(moments, key, drawn_values, draw_total):
+	"""
+	This method merges the mean and sum of squared deviations of a chunk of
+	draws (first axis) into `moments[key]`, after `draw_total` earlier draws
+	(Chan's parallel update), so that draws never have to be kept.
+	"""
+
+	draw_count = drawn_values.shape[0]
+	chunk_mean = drawn_values.mean(axis=0)
+	chunk_sum_of_squared_deviations = ((drawn_values - chunk_mean)**2).sum(axis=0)
+	if key not in moments:
+		moments[key] = (chunk_mean, chunk_sum_of_squared_deviations)
+		return
+
+	mean, sum_of_squared_deviations = moments[key]
+	delta = chunk_mean - mean
+	new_draw_total = draw_total + draw_count
+	moments[key] = (mean + delta*draw_count/new_draw_total,
+					sum_of_squared_deviations + chunk_sum_of_squared_deviations
+					+ delta**2*draw_total*draw_count/new_draw_total)
+
+@timed('uncertainty')
+def propagate_speciation_uncertainty(
+							peak_area_matrix,
+							inner_standard_masses,
+							total_liquid_masses,
+							inner_standard_indices,
+							calibration_factors,
+							calibration_factor_standard_errors,
+							MWs,
+							draws=10000,
+							peak_area_rsd=0.01,
+							inner_standard_mass_sd=1e-4,
+							group_matrix=None,
+							normalize=False,
+							seed=None
+							):
+	"""
+	This method propagates peak area, inner standard mass and calibration
+	factor uncertainty through `calculate_speciation_matrix` by Monte Carlo:
+	all samples are drawn together, in chunks of at most `MAX_CHUNK_ELEMENTS`
+	values, and only running means and variances are kept.
+
+	Per-sample results only need draws of the per-species and per-sample
+	factors (see `draw_factors`), so their cost does not grow with the
+	number of peaks.
+
+	With `group_matrix` (see `get_group_segments`) samples are averaged per group,
+	and with `normalize=True` each row is then normalized like
+	`normalize_initial_moles_per_total_mass`, so the output is the
+	uncertainty of the initial composition handed to chemkin.
+
+	output: tuple `(mean_matrix, standard_deviation_matrix)` of shape
+	(samples or groups, species), NaN where the speciation matrix is NaN
+	"""
+
+	random_generator = np.random.default_rng(seed)
+	sample_count, species_count = peak_area_matrix.shape
+
+	# only real peaks are drawn; each sample's inner standard is left out
+	peak_area_matrix = np.array(peak_area_matrix, dtype=float)
+	sample_indices = np.arange(sample_count)
+	inner_standard_peak_areas = peak_area_matrix[sample_indices, inner_standard_indices]
+	peak_area_matrix[sample_indices, inner_standard_indices] = np.nan
+	peak_area_matrix[:, np.isnan(calibration_factors)] = np.nan
+	peak_sample_indices, peak_species_indices = np.nonzero(~np.isnan(peak_area_matrix))
+	peak_areas = peak_area_matrix[peak_sample_indices, peak_species_indices]
+
+	calibration_factor_standard_errors = np.nan_to_num(calibration_factor_standard_errors)
+	grouped = group_matrix is not None or normalize
+	if grouped and group_matrix is None:
+		group_matrix = np.eye(sample_count)
+	if grouped:
+		# only peaks of grouped samples are drawn
+		grouped_peaks = group_matrix[:, peak_sample_indices].any(axis=0)
+		peak_areas = peak_areas[grouped_peaks]
+		peak_sample_indices = peak_sample_indices[grouped_peaks]
+		peak_species_indices = peak_species_indices[grouped_peaks]
+		group_segments = get_group_segments(group_matrix, peak_sample_indices, peak_species_indices,
+											species_count)
+		values_per_draw = group_segments[0].shape[0] + group_matrix.shape[0]*species_count
+	else:
+		values_per_draw = sample_count + species_count
+	chunk_size = max(1, min(draws, MAX_CHUNK_ELEMENTS//max(1, values_per_draw)))
+
+	draw_total = 0
+	moments = {}
+	while draw_total < draws:
+		draw_count = min(chunk_size, draws - draw_total)
+		inverse_calibration_factors, sample_factors = draw_factors(inner_standard_peak_areas,
+															inner_standard_masses,
+															total_liquid_masses,
+															inner_standard_indices,
+															calibration_factors,
+															calibration_factor_standard_errors,
+															MWs,
+															draw_count,
+															peak_area_rsd,
+															inner_standard_mass_sd,
+															random_generator)
+		if grouped:
+			drawn_values = draw_peak_speciation(peak_areas,
+											peak_sample_indices,
+											peak_species_indices,
+											inverse_calibration_factors,
+											sample_factors,
+											peak_area_rsd,
+											random_generator)
+			drawn_values = group_peak_draws(drawn_values, group_segments, group_matrix.shape[0], species_count)
+			if normalize:
+				drawn_values = normalize_initial_moles_per_total_mass_draws(drawn_values, MWs)
+			update_moments(moments, 'speciation', drawn_values, draw_total)
+		else:
+			update_moments(moments, 'inverse_calibration_factors', inverse_calibration_factors, draw_total)
+			update_moments(moments, 'sample_factors', sample_factors, draw_total)
+		draw_total += draw_count
+
+	if grouped:
+		mean, sum_of_squared_deviations = moments['speciation']
+		standard_deviation = np.sqrt(sum_of_squared_deviations/max(1, draw_total - 1))
+		# species no sample of a group has stay missing
+		present = group_matrix.dot(~np.isnan(peak_area_matrix)) > 0
+		return np.where(present, mean, np.nan), np.where(present, standard_deviation, np.nan)
+
+	# a peak's own area error is independent of both factors (its species
+	# is not its sample's inner standard), so the moments of the product are
+	# the products of the moments: with relative variances r, the relative
+	# variance of the product is (1 + r_area)(1 + r_species)(1 + r_sample) - 1
+	mean_species, sum_of_squared_deviations_species = moments['inverse_calibration_factors']
+	mean_samples, sum_of_squared_deviations_samples = moments['sample_factors']
+	relative_variances_species = sum_of_squared_deviations_species/draw_total/mean_species**2
+	relative_variances_samples = sum_of_squared_deviations_samples/draw_total/mean_samples**2
+
+	mean = peak_areas*mean_species[peak_species_indices]*mean_samples[peak_sample_indices]
+	relative_variances = np.expm1(np.log1p(peak_area_rsd**2)
+								+ np.log1p(relative_variances_species[peak_species_indices])
+								+ np.log1p(relative_variances_samples[peak_sample_indices]))
+	variance = mean**2*relative_variances*draw_total/max(1, draw_total - 1)
+
+	mean_matrix = np.full((sample_count, species_count), np.nan)
+	standard_deviation_matrix = np.full((sample_count, species_count), np.nan)
+	mean_matrix[peak_sample_indices, peak_species_indices] = mean
+	standard_deviation_matrix[peak_sample_indices, peak_species_indices] = np.sqrt(variance)
+
+	return mean_matrix, standard_deviation_matrix
+
+def get_sample_groups(samples, separator='_bf'):
+	"""
+	This method groups repeated injections by the part of the sample name
+	before `separator`, as `save_exptl_data_to_chemkin_simulation_format`
+	does, and outputs a tuple `(groups, group_matrix)` (see `get_group_segments`).
+	"""
+
+	groups = sorted(set(sample.split(separator)[0] for sample in samples))
+	group_index_dict = dict((group, i) for i, group in enumerate(groups))
+
+	group_matrix = np.zeros((len(groups), len(samples)))
+	for j, sample in enumerate(samples):
+		group_matrix[group_index_dict[sample.split(separator)[0]], j] = 1.0
+	group_matrix /= group_matrix.sum(axis=1, keepdims=True)
+
+	return groups, group_matrix
+
+def prepare_speciation_uncertainty(
+							condition,
+							samples=None,
+							gc_measurement_path=None,
+							registry=None,
+							draws=10000,
+							peak_area_rsd=0.01,
+							inner_standard_mass_sd=1e-4,
+							normalize=False,
+							seed=None,
+							save_results=True,
+							workspace=None
+							):
+	"""
+	This method outputs, and with `save_results=True` saves to
+	`data/measurement/<condition>/speciation_uncertainty.json`, a dictionary
+	with key: `sample` and value: {`species`: [mol/g, standard deviation]}.
+	The mol/g values are the ones speciation reports; the standard
+	deviations come from `propagate_speciation_uncertainty`.
+
+	With `normalize=True` repeated samples (`<name>_bf...`) are averaged and
+	normalized like the initial data of `save_exptl_data_to_chemkin_simulation_format`,
+	and keys are the sample names without suffix. The normalization runs
+	over every species of the samples, not only those measured after the
+	experiment.
+	"""
+
+	if workspace is None:
+		workspace = get_default_workspace()
+
+	if gc_measurement_path is None:
+		gc_measurement_path = workspace.gc_measurement_path
+
+	if samples is None:
+		from batch_speciation import discover_condition_samples
+		samples = discover_condition_samples(gc_measurement_path).get(condition, [])
+
+	if registry is None:
+		registry = workspace.registry
+
+	gc_speciation_data_dicts = []
+	gc_inner_standard_data_dicts = []
+	for sample in samples:
+		gc_speciation_data_dicts.append(read_gc_speciation_file(os.path.join(
+									gc_measurement_path, condition, 'gc_speciation', sample+'.txt')))
+		gc_inner_standard_data_dicts.append(read_gc_inner_standard_file(os.path.join(
+									gc_measurement_path, condition, 'gc_inner_standard', sample+'.csv')))
+
+	calibration_factor_function_dict = registry.get_fitted_calibration_factor_functions()
+	calibration_factor_standard_error_dict = prepare_calibration_factor_standard_errors(
+												registry=registry)
+
+	peak_area_matrix, species_list = build_peak_area_matrix(gc_speciation_data_dicts)
+	inner_standard_masses, total_liquid_masses, inner_standard_indices = build_inner_standard_vectors(
+																gc_inner_standard_data_dicts,
+																species_list
+																)
+	calibration_factors, MWs = build_species_vectors(species_list,
+													calibration_factor_function_dict,
+													registry)
+	peak_area_matrix = subtract_calibration_intercepts(peak_area_matrix, species_list,
+														calibration_factor_function_dict)
+	calibration_factor_standard_errors = np.array([calibration_factor_standard_error_dict.get(species, 0.0)
+												for species in species_list])
+
+	speciation_matrix = calculate_speciation_matrix(peak_area_matrix,
+													inner_standard_masses,
+													total_liquid_masses,
+													inner_standard_indices,
+													calibration_factors,
+													MWs)
+
+	names = samples
+	group_matrix = None
+	if normalize:
+		names, group_matrix = get_sample_groups(samples)
+		present = group_matrix.dot(~np.isnan(speciation_matrix)) > 0
+		speciation_matrix = np.where(present, normalize_initial_moles_per_total_mass_matrix(
+									group_matrix.dot(np.nan_to_num(speciation_matrix)), MWs), np.nan)
+
+	_, standard_deviation_matrix = propagate_speciation_uncertainty(peak_area_matrix,
+													inner_standard_masses,
+													total_liquid_masses,
+													inner_standard_indices,
+													calibration_factors,
+													calibration_factor_standard_errors,
+													MWs,
+													draws,
+													peak_area_rsd,
+													inner_standard_mass_sd,
+													group_matrix,
+													normalize,
+													seed)
+
+	speciation_uncertainty_dict = {}
+	for i, name in enumerate(names):
+		speciation_uncertainty_dict[name] = dict(
+								(species_list[j], [float(speciation_matrix[i, j]),
+													float(standard_deviation_matrix[i, j])])
+								for j in np.flatnonzero(~np.isnan(speciation_matrix[i])))
+
+	if save_results:
+		speciation_uncertainty_file = os.path.join(gc_measurement_path, condition,
+												'speciation_uncertainty.json')
+		with open(speciation_uncertainty_file, 'w') as write_out:
+			json.dump(speciation_uncertainty_dict, write_out, indent=2, sort_keys=True)
+
+	return speciation_uncertainty_dict
@@ -0,0 +1,174 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import uncertainty
+from uncertainty import (
+	get_calibration_factor_standard_errors,
+	get_sample_groups,
+	prepare_calibration_factor_standard_errors,
+	prepare_speciation_uncertainty,
+	propagate_speciation_uncertainty
+	)
+from vectorized_speciation import calculate_speciation_matrix
+from speciation import prepare_speciation_in_moles_per_total_mass
+from calibration import (
+	get_registry,
+	read_calibration_data,
+	read_calibration_species_constants
+	)
+
+class test_uncertainty(unittest.TestCase):
+
+	def setUp(self):
+
+		# 3 samples x 4 species, species 0 is the inner standard
+		self.peak_area_matrix = np.array([[1.0e8, 2.0e7, 3.0e7, np.nan],
+										[1.2e8, 2.5e7, np.nan, 4.0e7],
+										[0.9e8, 1.5e7, 3.5e7, 4.5e7]])
+		self.inner_standard_masses = np.array([0.02, 0.021, 0.019])
+		self.total_liquid_masses = np.array([0.2, 0.21, 0.19])
+		self.inner_standard_indices = np.array([0, 0, 0])
+		self.calibration_factors = np.array([3.0e14, 2.0e14, 2.5e14, 3.5e14])
+		self.MWs = np.array([118.6, 92.1, 114.2, 106.2])
+		self.speciation_matrix = calculate_speciation_matrix(self.peak_area_matrix,
+															self.inner_standard_masses,
+															self.total_liquid_masses,
+															self.inner_standard_indices,
+															self.calibration_factors,
+															self.MWs)
+
+	def propagate(self, calibration_factor_standard_errors, **kwargs):
+
+		return propagate_speciation_uncertainty(self.peak_area_matrix,
+												self.inner_standard_masses,
+												self.total_liquid_masses,
+												self.inner_standard_indices,
+												self.calibration_factors,
+												calibration_factor_standard_errors,
+												self.MWs,
+												**kwargs)
+
+	def test_no_uncertainty(self):
+
+		mean_matrix, standard_deviation_matrix = self.propagate(np.zeros(4), draws=10,
+														peak_area_rsd=0, inner_standard_mass_sd=0)
+
+		np.testing.assert_allclose(mean_matrix, self.speciation_matrix, rtol=1e-12)
+		np.testing.assert_array_equal(np.isnan(standard_deviation_matrix), np.isnan(self.speciation_matrix))
+		np.testing.assert_allclose(np.nan_to_num(standard_deviation_matrix/self.speciation_matrix), 0, atol=1e-12)
+
+	def test_peak_area_uncertainty(self):
+
+		_, standard_deviation_matrix = self.propagate(np.zeros(4), draws=20000, peak_area_rsd=0.01,
+													inner_standard_mass_sd=0, seed=0)
+
+		# ratio of two peak areas with 1% relative error each
+		relative_standard_deviations = standard_deviation_matrix/self.speciation_matrix
+		present = ~np.isnan(self.speciation_matrix)
+		np.testing.assert_allclose(relative_standard_deviations[present], np.sqrt(2)*0.01, rtol=0.05)
+
+	def test_calibration_factor_uncertainty(self):
+
+		calibration_factor_standard_errors = self.calibration_factors*np.array([0.02, 0.01, 0.03, 0.0])
+		_, standard_deviation_matrix = self.propagate(calibration_factor_standard_errors, draws=20000,
+													peak_area_rsd=0, inner_standard_mass_sd=0, seed=1)
+
+		relative_standard_deviations = standard_deviation_matrix/self.speciation_matrix
+		expected = np.sqrt(np.array([0.02, 0.01, 0.03, 0.0])**2 + 0.02**2)
+		for j in range(1, 4):
+			present = ~np.isnan(self.speciation_matrix[:, j])
+			np.testing.assert_allclose(relative_standard_deviations[present, j], expected[j], rtol=0.05)
+
+	def test_chunked_draws(self):
+
+		calibration_factor_standard_errors = 0.02*self.calibration_factors
+		mean_matrix, standard_deviation_matrix = self.propagate(calibration_factor_standard_errors,
+																draws=20000, seed=2)
+
+		max_chunk_elements = uncertainty.MAX_CHUNK_ELEMENTS
+		uncertainty.MAX_CHUNK_ELEMENTS = 1000
+		try:
+			chunked_mean_matrix, chunked_standard_deviation_matrix = self.propagate(
+																calibration_factor_standard_errors,
+																draws=20000, seed=3)
+		finally:
+			uncertainty.MAX_CHUNK_ELEMENTS = max_chunk_elements
+
+		np.testing.assert_allclose(chunked_mean_matrix, mean_matrix, rtol=0.01)
+		np.testing.assert_allclose(chunked_standard_deviation_matrix, standard_deviation_matrix, rtol=0.05)
+
+	def test_normalized_uncertainty(self):
+
+		samples = ['sample1_bf_instd', 'sample1_bf_instd_repeat', 'sample2_bf_instd']
+		groups, group_matrix = get_sample_groups(samples)
+		self.assertEqual(groups, ['sample1', 'sample2'])
+		np.testing.assert_allclose(group_matrix, [[0.5, 0.5, 0], [0, 0, 1]])
+
+		mean_matrix, standard_deviation_matrix = self.propagate(0.01*self.calibration_factors,
+														draws=5000, group_matrix=group_matrix,
+														normalize=True, seed=4)
+
+		# normalized initial compositions have unit mass
+		np.testing.assert_allclose(np.nansum(mean_matrix*self.MWs, axis=1), 1, rtol=1e-3)
+		self.assertTrue(np.isnan(mean_matrix[:, 0]).all())
+		self.assertTrue((standard_deviation_matrix[:, 1:] > 0).all())
+
+	def test_get_calibration_factor_standard_errors(self):
+
+		calibration_data_dict = read_calibration_data()
+		calibration_factor_standard_error_dict = get_calibration_factor_standard_errors(calibration_data_dict)
+
+		self.assertEqual(sorted(calibration_factor_standard_error_dict), sorted(calibration_data_dict))
+		for standard_error in calibration_factor_standard_error_dict.values():
+			self.assertTrue(standard_error > 0)
+
+	def test_prepare_calibration_factor_standard_errors_with_selected_models(self):
+
+		calibration_path = tempfile.mkdtemp()
+		try:
+			for f in os.listdir(os.path.join('data', 'calibration')):
+				shutil.copy(os.path.join('data', 'calibration', f), calibration_path)
+			registry = get_registry(calibration_path)
+			default_standard_error_dict = prepare_calibration_factor_standard_errors(registry=registry)
+
+			# toluene was fitted with an intercept on its lowest 3 points
+			with open(os.path.join(calibration_path, 'calibration_model_selection.json'), 'w') as write_out:
+				json.dump({'toluene': {'zero_intercept': False, 'weighting': '1/x', 'point_range': [0, 3]}},
+						write_out)
+			calibration_factor_standard_error_dict = prepare_calibration_factor_standard_errors(registry=registry)
+
+			calibration_data_dict = read_calibration_data(['toluene'], calibration_path, registry)
+			self.assertEqual(calibration_factor_standard_error_dict['toluene'],
+							get_calibration_factor_standard_errors(calibration_data_dict, False, '1/x',
+																	(0, 3))['toluene'])
+			self.assertNotEqual(calibration_factor_standard_error_dict['toluene'],
+								default_standard_error_dict['toluene'])
+			for species, standard_error in default_standard_error_dict.items():
+				if species != 'toluene':
+					self.assertEqual(calibration_factor_standard_error_dict[species], standard_error)
+		finally:
+			shutil.rmtree(calibration_path)
+
+	def test_prepare_speciation_uncertainty(self):
+
+		speciation_uncertainty_dict = prepare_speciation_uncertainty('test_condition', ['sample0'],
+																draws=2000, seed=0, save_results=False)
+		speciation_dict = prepare_speciation_in_moles_per_total_mass('test_condition', 'sample0',
+																save_results=False)
+
+		self.assertEqual(sorted(speciation_uncertainty_dict['sample0']), sorted(speciation_dict))
+		for species, (moles_per_total_mass, standard_deviation) in speciation_uncertainty_dict['sample0'].items():
+			self.assertAlmostEqual(moles_per_total_mass, speciation_dict[species], delta=1e-12)
+			self.assertTrue(0 < standard_deviation < moles_per_total_mass)
+
+		normalized_uncertainty_dict = prepare_speciation_uncertainty('test_condition', ['sample0'],
+																draws=2000, normalize=True,
+																seed=0, save_results=False)
+		self.assertEqual(list(normalized_uncertainty_dict), ['sample0'])
+		MW_dict = read_calibration_species_constants()
+		mass = sum(MW_dict[species]['MW']*moles_per_total_mass
+					for species, (moles_per_total_mass, _) in normalized_uncertainty_dict['sample0'].items())
+		self.assertAlmostEqual(mass, 1.0)
@@ -0,0 +1,252 @@
+import numpy as np
+from calibration import get_calibration_line
+from workspace import get_default_workspace
+from peak_table import (
+	PeakTable,
+	species_table
+	)
+
+def build_peak_area_matrix(gc_speciation_data_dicts, species_list=None):
+	"""
+	This method stacks the outputs of `read_gc_speciation_file` for many
+	samples into a `peak_area_matrix` of shape (samples, species), with NaN
+	where a sample has no peak of a species. If `species_list` is None
+	the species are collected in order of first appearance.
+
+	`PeakTable`s can be given instead of dictionaries; their areas are summed
+	per species and placed by species ID without going through names.
+
+	output: tuple `(peak_area_matrix, species_list)`
+	"""
+
+	if gc_speciation_data_dicts and all(isinstance(gc_speciation_data, PeakTable)
+										for gc_speciation_data in gc_speciation_data_dicts):
+		return build_peak_area_matrix_from_tables(gc_speciation_data_dicts, species_list)
+	gc_speciation_data_dicts = [gc_speciation_data.to_area_dict() if isinstance(gc_speciation_data, PeakTable)
+								else gc_speciation_data for gc_speciation_data in gc_speciation_data_dicts]
+
+	if species_list is None:
+		species_list = []
+		seen_species = set()
+		for gc_speciation_data_dict in gc_speciation_data_dicts:
+			for species in gc_speciation_data_dict:
+				if species not in seen_species:
+					seen_species.add(species)
+					species_list.append(species)
+
+	species_index_dict = dict((species, j) for j, species in enumerate(species_list))
+
+	peak_area_matrix = np.full((len(gc_speciation_data_dicts), len(species_list)), np.nan)
+	for i, gc_speciation_data_dict in enumerate(gc_speciation_data_dicts):
+		for species, peak_area in gc_speciation_data_dict.items():
+			if species in species_index_dict:
+				peak_area_matrix[i, species_index_dict[species]] = peak_area
+
+	return peak_area_matrix, species_list
+
+def build_peak_area_matrix_from_tables(peak_tables, species_list=None):
+
+	area_sums = [peak_table.sum_areas_by_species() for peak_table in peak_tables]
+	species_ids = np.concatenate([np.zeros(0, dtype=np.int32)] + [ids for ids, _ in area_sums])
+	row_indices = np.repeat(np.arange(len(peak_tables)), [ids.shape[0] for ids, _ in area_sums])
+	peak_areas = np.concatenate([np.zeros(0)] + [sums for _, sums in area_sums])
+
+	if species_list is None:
+		unique_species_ids, first_positions = np.unique(species_ids, return_index=True)
+		column_species_ids = unique_species_ids[np.argsort(first_positions)]
+		species_list = species_table.get_names(column_species_ids)
+	else:
+		column_species_ids = species_table.intern_many(species_list)
+
+	column_by_species_id = np.full(len(species_table.names), -1)
+	column_by_species_id[column_species_ids] = np.arange(column_species_ids.shape[0])
+	column_indices = column_by_species_id[species_ids]
+	kept = column_indices >= 0
+
+	peak_area_matrix = np.full((len(peak_tables), len(species_list)), np.nan)
+	peak_area_matrix[row_indices[kept], column_indices[kept]] = peak_areas[kept]
+
+	return peak_area_matrix, species_list
+
+def build_inner_standard_vectors(gc_inner_standard_data_dicts, species_list):
+	"""
+	This method turns the outputs of `read_gc_inner_standard_file` into
+	per-sample vectors `(inner_standard_masses, total_liquid_masses,
+	inner_standard_indices)`, where `inner_standard_indices` point into
+	`species_list`.
+	"""
+
+	species_index_dict = dict((species, j) for j, species in enumerate(species_list))
+
+	inner_standard_masses = np.array([gc_inner_standard_data_dict['inner_standard_mass(g)']
+							for gc_inner_standard_data_dict in gc_inner_standard_data_dicts], dtype=float)
+	total_liquid_masses = np.array([gc_inner_standard_data_dict['total_liquid_mass(g)']
+							for gc_inner_standard_data_dict in gc_inner_standard_data_dicts], dtype=float)
+	inner_standard_indices = np.array([species_index_dict[gc_inner_standard_data_dict['inner_standard']]
+							for gc_inner_standard_data_dict in gc_inner_standard_data_dicts], dtype=int)
+
+	return inner_standard_masses, total_liquid_masses, inner_standard_indices
+
+def build_species_vectors(species_list, calibration_factor_function_dict, registry=None, workspace=None):
+	"""
+	This method outputs per-species vectors `(calibration_factors, MWs)`
+	aligned with `species_list`, with NaN for uncalibrated species or
+	species without constants.
+	"""
+
+	if registry is None:
+		if workspace is None:
+			workspace = get_default_workspace()
+		registry = workspace.registry
+	calibration_species_constants_dict = registry.get_calibration_species_constants()
+
+	calibration_factors = np.full(len(species_list), np.nan)
+	MWs = np.full(len(species_list), np.nan)
+	for j, species in enumerate(species_list):
+		if species in calibration_factor_function_dict:
+			calibration_factors[j] = get_calibration_line(calibration_factor_function_dict[species])[0]
+		if species in calibration_species_constants_dict:
+			MWs[j] = calibration_species_constants_dict[species]['MW']
+
+	return calibration_factors, MWs
+
+def subtract_calibration_intercepts(peak_area_matrix, species_list, calibration_factor_function_dict,
+									response_lookup_tables=None):
+	"""
+	This method subtracts the fitted intercepts of species calibrated with
+	one from the columns of a (samples, species) peak area matrix, so that
+	dividing by `calibration_factors` gives injection moles. Species in
+	`response_lookup_tables` keep their areas. Without any intercept the
+	matrix is returned as is.
+	"""
+
+	if response_lookup_tables is None:
+		response_lookup_tables = {}
+
+	intercepts = np.array([get_calibration_line(calibration_factor_function_dict[species])[1]
+							if species in calibration_factor_function_dict and species not in response_lookup_tables
+							else 0.0 for species in species_list])
+	if not np.any(intercepts):
+		return peak_area_matrix
+
+	return peak_area_matrix - intercepts
+
+def calculate_speciation_matrix(
+						peak_area_matrix,
+						inner_standard_masses,
+						total_liquid_masses,
+						inner_standard_indices,
+						calibration_factors,
+						MWs
+						):
+	"""
+	This method is the batched form of `calculate_speciation_in_moles_per_total_mass`:
+	it outputs the (samples, species) matrix of moles per total liquid mass
+	(moles/g) in one broadcasted computation. The operations are done in the
+	same order as the per-sample function so results match it exactly.
+
+	Entries are NaN for missing peaks, uncalibrated species and each
+	sample's own inner standard, which the per-sample function leaves out.
+	"""
+
+	sample_indices = np.arange(peak_area_matrix.shape[0])
+	inner_standard_peak_areas = peak_area_matrix[sample_indices, inner_standard_indices]
+	inner_standard_calibration_factors = calibration_factors[inner_standard_indices]
+	inner_standard_MWs = MWs[inner_standard_indices]
+
+	speciation_matrix = (peak_area_matrix/calibration_factors)\
+						/(inner_standard_peak_areas/inner_standard_calibration_factors)[:, None]\
+						*inner_standard_masses[:, None]/inner_standard_MWs[:, None]/total_liquid_masses[:, None]
+
+	speciation_matrix[sample_indices, inner_standard_indices] = np.nan
+
+	return speciation_matrix
+
+def convert_peak_area_matrix_to_moles(peak_area_matrix, species_list, calibration_factors,
+									response_lookup_tables):
+	"""
+	This method converts a (samples, species) peak area matrix to injection
+	moles, a whole column at a time: by the lookup table of the species in
+	`response_lookup_tables` (see `response_models`), else by dividing by its
+	linear `calibration_factors` entry.
+	"""
+
+	peak_moles_matrix = peak_area_matrix/calibration_factors
+	for j, species in enumerate(species_list):
+		if species in response_lookup_tables:
+			peak_moles_matrix[:, j] = response_lookup_tables[species].to_moles(peak_area_matrix[:, j])
+
+	return peak_moles_matrix
+
+def normalize_initial_moles_per_total_mass_matrix(initial_moles_per_total_mass_matrix, MWs):
+	"""
+	This method is the batched form of `normalize_initial_moles_per_total_mass`:
+	each sample's initial mol/g is divided by the mass sum(MW*mol/g) of the
+	species present (mol/g > 0).
+
+	The mass is accumulated column by column with `cumsum`, so with columns in
+	the same order as the `exptl_data` keys the result matches the per-sample
+	function exactly.
+	"""
+
+	present = initial_moles_per_total_mass_matrix > 0
+	species_masses = np.where(present, MWs*initial_moles_per_total_mass_matrix, 0)
+	masses = np.cumsum(species_masses, axis=1)[:, -1]
+
+	return initial_moles_per_total_mass_matrix/masses[:, None]
+
+def speciation_matrix_to_dicts(speciation_matrix, species_list):
+	"""
+	This method converts a speciation matrix back to one
+	`speciation_dict_in_moles_per_total_mass` per sample, dropping NaN entries.
+	"""
+
+	speciation_dicts = []
+	for row in speciation_matrix:
+		speciation_dicts.append(dict((species_list[j], float(row[j]))
+								for j in np.flatnonzero(~np.isnan(row))))
+
+	return speciation_dicts
+
+def calculate_speciation_for_samples(
+							gc_speciation_data_dicts,
+							gc_inner_standard_data_dicts,
+							calibration_factor_function_dict,
+							registry=None,
+							response_lookup_tables=None
+							):
+	"""
+	This method builds the matrices and vectors from per-sample dictionaries
+	and runs `calculate_speciation_matrix` on them. Species in
+	`response_lookup_tables` are converted by their nonlinear response.
+
+	output: tuple `(speciation_matrix, species_list)`
+	"""
+
+	peak_area_matrix, species_list = build_peak_area_matrix(gc_speciation_data_dicts)
+	inner_standard_masses, total_liquid_masses, inner_standard_indices = build_inner_standard_vectors(
+																gc_inner_standard_data_dicts,
+																species_list
+																)
+	calibration_factors, MWs = build_species_vectors(species_list,
+													calibration_factor_function_dict,
+													registry)
+	peak_area_matrix = subtract_calibration_intercepts(peak_area_matrix, species_list,
+														calibration_factor_function_dict,
+														response_lookup_tables)
+	if response_lookup_tables:
+		# moles are then passed with unit calibration factors
+		peak_area_matrix = convert_peak_area_matrix_to_moles(peak_area_matrix, species_list,
+															calibration_factors, response_lookup_tables)
+		calibration_factors = np.ones(len(species_list))
+
+	speciation_matrix = calculate_speciation_matrix(
+							peak_area_matrix,
+							inner_standard_masses,
+							total_liquid_masses,
+							inner_standard_indices,
+							calibration_factors,
+							MWs
+							)
+
+	return speciation_matrix, species_list
@@ -0,0 +1,100 @@
+import unittest
+import os
+import numpy as np
+from vectorized_speciation import (
+	build_peak_area_matrix,
+	calculate_speciation_for_samples,
+	normalize_initial_moles_per_total_mass_matrix,
+	speciation_matrix_to_dicts
+	)
+from speciation import (
+	read_gc_speciation_file,
+	read_gc_inner_standard_file,
+	calculate_speciation_in_moles_per_total_mass
+	)
+from calibration import (
+	load_fitted_calibration_factor_functions,
+	read_calibration_species_constants
+	)
+from exptl_data_integration import normalize_initial_moles_per_total_mass
+
+class test_vectorized_speciation(unittest.TestCase):
+
+	def setUp(self):
+
+		self.calibration_factor_function_dict = load_fitted_calibration_factor_functions()
+
+		gc_measurement_path = os.path.join('data', 'measurement')
+		gc_speciation_data_dict = read_gc_speciation_file(os.path.join(
+									gc_measurement_path, 
+									'test_condition', 'gc_speciation',
+									'sample0.txt'))
+		gc_inner_standard_data_dict = read_gc_inner_standard_file(os.path.join(
+									gc_measurement_path, 
+									'test_condition', 'gc_inner_standard',
+									'sample0.csv'))
+
+		# perturbed copies of sample0, one of them using toluene as inner standard
+		random_state = np.random.RandomState(0)
+		self.gc_speciation_data_dicts = []
+		self.gc_inner_standard_data_dicts = []
+		for i in range(5):
+			self.gc_speciation_data_dicts.append(dict(
+					(species, peak_area*random_state.uniform(0.5, 2.0))
+					for species, peak_area in gc_speciation_data_dict.items()))
+			gc_inner_standard_data_dict = dict(gc_inner_standard_data_dict)
+			gc_inner_standard_data_dict['inner_standard_mass(g)'] *= random_state.uniform(0.5, 2.0)
+			self.gc_inner_standard_data_dicts.append(gc_inner_standard_data_dict)
+		del self.gc_speciation_data_dicts[2]['octane']
+		self.gc_inner_standard_data_dicts[3]['inner_standard'] = 'toluene'
+
+	def test_build_peak_area_matrix(self):
+
+		peak_area_matrix, species_list = build_peak_area_matrix(self.gc_speciation_data_dicts)
+
+		self.assertEqual(peak_area_matrix.shape, (5, 12))
+		self.assertTrue(np.isnan(peak_area_matrix[2, species_list.index('octane')]))
+
+	def test_calculate_speciation_for_samples(self):
+
+		# calibrations with an intercept are params [b, a]
+		intercept_calibration_factor_function_dict = dict(self.calibration_factor_function_dict)
+		for species in ['toluene', 'PDD']:
+			intercept_calibration_factor_function_dict[species] = [2e7, self.calibration_factor_function_dict[species][0]]
+
+		for calibration_factor_function_dict in [self.calibration_factor_function_dict,
+												intercept_calibration_factor_function_dict]:
+			speciation_matrix, species_list = calculate_speciation_for_samples(
+													self.gc_speciation_data_dicts,
+													self.gc_inner_standard_data_dicts,
+													calibration_factor_function_dict
+													)
+			speciation_dicts = speciation_matrix_to_dicts(speciation_matrix, species_list)
+
+			for i in range(5):
+				speciation_dict_in_moles_per_total_mass = calculate_speciation_in_moles_per_total_mass(
+														self.gc_speciation_data_dicts[i],
+														self.gc_inner_standard_data_dicts[i],
+														calibration_factor_function_dict
+														)
+				self.assertEqual(speciation_dicts[i], speciation_dict_in_moles_per_total_mass)
+
+	def test_normalize_initial_moles_per_total_mass_matrix(self):
+
+		species_list = ['PDD', 'toluene', 'undecane', 'decane']
+		initial_moles_per_total_mass_matrix = np.array([[3.1e-3, 1.2e-4, 9.7e-4, 0.0],
+														[2.9e-3, 0.0, 1.1e-3, 0.0]])
+		calibration_species_constants_dict = read_calibration_species_constants()
+		MWs = np.array([calibration_species_constants_dict.get(species, {'MW': np.nan})['MW']
+						for species in species_list])
+
+		normalized_matrix = normalize_initial_moles_per_total_mass_matrix(
+												initial_moles_per_total_mass_matrix,
+												MWs
+												)
+
+		for i, row in enumerate(initial_moles_per_total_mass_matrix):
+			exptl_data = dict((species, [row[j], 0.0]) for j, species in enumerate(species_list))
+			exptl_data = normalize_initial_moles_per_total_mass(exptl_data)
+			for j, species in enumerate(species_list):
+				self.assertEqual(normalized_matrix[i, j], exptl_data[species][0])
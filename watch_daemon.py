@@ -0,0 +1,247 @@
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from speciation import prepare_speciation_in_moles_per_total_mass
+from workspace import get_default_workspace
+
+logger = logging.getLogger('smartgc.watch')
+
+class SpeciationWatcher(object):
+	"""
+	This class is a long-running asyncio service that watches
+	`data/measurement/<condition>/gc_speciation` for new or changed reports
+	and speciates them as soon as both the report and its inner standard
+	file have stopped changing for `settle_time` seconds (the instrument may
+	still be writing them). Samples go through a bounded queue to `workers`
+	worker tasks that run speciation in the default executor; calibration
+	stays warm in `registry`, which reloads it only when its files change.
+	Paths and calibration not given are those of `workspace` (default: `data`).
+	"""
+
+	def __init__(
+			self,
+			gc_measurement_path=None,
+			registry=None,
+			poll_interval=0.1,
+			settle_time=0.3,
+			workers=2,
+			queue_size=100,
+			export_json=False,
+			on_result=None,
+			workspace=None
+			):
+
+		if workspace is None:
+			workspace = get_default_workspace()
+		if gc_measurement_path is None:
+			gc_measurement_path = workspace.gc_measurement_path
+		if registry is None:
+			registry = workspace.registry
+
+		self.workspace = workspace
+		self.gc_measurement_path = gc_measurement_path
+		self.registry = registry
+		self.poll_interval = poll_interval
+		self.settle_time = settle_time
+		self.workers = workers
+		self.queue_size = queue_size
+		self.export_json = export_json
+		self.on_result = on_result
+
+		self.latencies = [] # seconds from submit to result
+		self.file_latencies = [] # seconds from last file change to result
+		self.errors = [] # (condition, sample, exception)
+
+		self._stop_event = None
+		self._seen = {} # key: (condition, sample), value: (signature, first seen time)
+		self._processed = {} # key: (condition, sample), value: signature
+		self._condition_locks = {}
+		self._pending_results = {} # key: condition, value: [(sample, speciation, future)]
+
+	def _get_sample_signature(self, condition, sample):
+
+		signature = []
+		for folder, extension in [('gc_speciation', '.txt'), ('gc_inner_standard', '.csv')]:
+			try:
+				file_stat = os.stat(os.path.join(self.gc_measurement_path, condition,
+												folder, sample+extension))
+			except OSError:
+				return None
+			signature.append((file_stat.st_mtime_ns, file_stat.st_size))
+
+		return tuple(signature)
+
+	def _list_samples(self):
+
+		condition_samples = []
+		for condition in os.listdir(self.gc_measurement_path):
+			gc_speciation_path = os.path.join(self.gc_measurement_path, condition, 'gc_speciation')
+			if not os.path.isdir(gc_speciation_path):
+				continue
+			for f in os.listdir(gc_speciation_path):
+				if f.endswith('.txt'):
+					condition_samples.append((condition, f.split('.txt')[0]))
+
+		return condition_samples
+
+	def _mark_stored_samples_processed(self):
+
+		from result_store import load_condition_results
+
+		stored_samples_dict = {}
+		for condition, sample in self._list_samples():
+			if condition not in stored_samples_dict:
+				columns = load_condition_results(condition, self.gc_measurement_path)
+				stored_samples_dict[condition] = set(columns[0]) if columns is not None else set()
+			if sample in stored_samples_dict[condition]:
+				self._processed[(condition, sample)] = self._get_sample_signature(condition, sample)
+
+	def _find_settled_samples(self):
+		"""
+		This method outputs the samples whose files exist, changed since
+		they were last processed and kept the same signature for
+		`settle_time` seconds.
+		"""
+
+		now = time.time()
+		settled_samples = []
+		for key in self._list_samples():
+			signature = self._get_sample_signature(*key)
+			if signature is None or self._processed.get(key) == signature:
+				continue
+
+			if key not in self._seen or self._seen[key][0] != signature:
+				self._seen[key] = (signature, now)
+			elif now - self._seen[key][1] >= self.settle_time:
+				settled_samples.append((key, signature))
+
+		return settled_samples
+
+	async def _scan(self, queue):
+
+		while not self._stop_event.is_set():
+			for key, signature in self._find_settled_samples():
+				self._processed[key] = signature
+				del self._seen[key]
+				await queue.put((key, signature, time.time()))
+
+			try:
+				await asyncio.wait_for(self._stop_event.wait(), self.poll_interval)
+			except asyncio.TimeoutError:
+				pass
+
+	async def _save_result(self, condition, sample, speciation_dict_in_moles_per_total_mass):
+		"""
+		This method adds a result to the condition's result store. The store is
+		rewritten as a whole by one writer per condition at a time, so results
+		that finish while it writes are saved together by the next writer.
+		"""
+
+		from result_store import save_condition_results
+
+		loop = asyncio.get_running_loop()
+		saved = loop.create_future()
+		self._pending_results.setdefault(condition, []).append((sample, speciation_dict_in_moles_per_total_mass,
+																saved))
+
+		condition_lock = self._condition_locks.setdefault(condition, asyncio.Lock())
+		async with condition_lock:
+			if not saved.done():
+				pending_results = self._pending_results.pop(condition)
+				speciation_dict_by_sample = dict((pending_sample, speciation_dict)
+												for pending_sample, speciation_dict, _ in pending_results)
+				try:
+					await loop.run_in_executor(None, partial(save_condition_results, condition,
+												speciation_dict_by_sample, self.gc_measurement_path,
+												workspace=self.workspace))
+				except Exception as e:
+					for _, _, pending_saved in pending_results:
+						pending_saved.set_exception(e)
+				else:
+					for _, _, pending_saved in pending_results:
+						pending_saved.set_result(len(speciation_dict_by_sample))
+
+		await saved
+
+	async def _work(self, queue):
+
+		loop = asyncio.get_running_loop()
+		while True:
+			(condition, sample), signature, submit_time = await queue.get()
+			try:
+				speciation_dict_in_moles_per_total_mass = await loop.run_in_executor(None, partial(
+												prepare_speciation_in_moles_per_total_mass,
+												condition,
+												sample,
+												gc_measurement_path=self.gc_measurement_path,
+												registry=self.registry,
+												save_results=False,
+												export_json=self.export_json))
+
+				await self._save_result(condition, sample, speciation_dict_in_moles_per_total_mass)
+
+				result_time = time.time()
+				self.latencies.append(result_time - submit_time)
+				self.file_latencies.append(result_time - max(mtime_ns for mtime_ns, _ in signature)/1e9)
+				logger.info('speciated %s/%s in %.3f s', condition, sample, result_time - submit_time)
+
+				if self.on_result is not None:
+					self.on_result(condition, sample, speciation_dict_in_moles_per_total_mass)
+			except Exception as e:
+				logger.exception('failed to speciate %s/%s', condition, sample)
+				self.errors.append((condition, sample, e))
+				# retried at a later scan, e.g. once calibration or a missing file is fixed
+				if self._processed.get((condition, sample)) == signature:
+					del self._processed[(condition, sample)]
+			finally:
+				queue.task_done()
+
+	async def run(self, process_existing=False):
+		"""
+		This method runs the watcher until `stop` is called. Samples already
+		in a result store when it starts are skipped unless `process_existing`.
+		"""
+
+		self._stop_event = asyncio.Event()
+		if not process_existing:
+			self._mark_stored_samples_processed()
+
+		queue = asyncio.Queue(self.queue_size)
+		worker_tasks = [asyncio.ensure_future(self._work(queue)) for _ in range(self.workers)]
+		try:
+			await self._scan(queue)
+			await queue.join()
+		finally:
+			for worker_task in worker_tasks:
+				worker_task.cancel()
+			await asyncio.gather(*worker_tasks, return_exceptions=True)
+
+	def stop(self):
+
+		if self._stop_event is not None:
+			self._stop_event.set()
+
+	def get_latency_stats(self):
+		"""
+		This method summarizes submit-to-result latencies in seconds.
+		"""
+
+		if not self.latencies:
+			return {'count': 0}
+
+		latencies = sorted(self.latencies)
+		return {'count': len(latencies),
+				'mean': sum(latencies)/len(latencies),
+				'p50': latencies[len(latencies)//2],
+				'p95': latencies[min(len(latencies) - 1, int(0.95*len(latencies)))],
+				'max': latencies[-1]}
+
+if __name__ == '__main__':
+
+	logging.basicConfig(level=logging.INFO)
+	try:
+		asyncio.run(SpeciationWatcher().run())
+	except KeyboardInterrupt:
+		pass
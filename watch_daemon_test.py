@@ -0,0 +1,163 @@
+import unittest
+import os
+import shutil
+import tempfile
+import asyncio
+import time
+import result_store
+import watch_daemon
+from watch_daemon import SpeciationWatcher
+from result_store import load_condition_speciation_dicts
+
+class test_watch_daemon(unittest.TestCase):
+
+	def setUp(self):
+
+		self.gc_measurement_path = tempfile.mkdtemp()
+		for folder in ['gc_speciation', 'gc_inner_standard']:
+			os.makedirs(os.path.join(self.gc_measurement_path, 'test_condition', folder))
+
+		test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+		with open(os.path.join(test_condition_path, 'gc_speciation', 'sample0.txt'), 'r') as read_in:
+			self.gc_speciation_report = read_in.read()
+		with open(os.path.join(test_condition_path, 'gc_inner_standard', 'sample0.csv'), 'r') as read_in:
+			self.gc_inner_standard_report = read_in.read()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.gc_measurement_path)
+
+	def write_report(self, sample, folder, content):
+
+		extension = '.txt' if folder == 'gc_speciation' else '.csv'
+		with open(os.path.join(self.gc_measurement_path, 'test_condition',
+								folder, sample+extension), 'w') as write_out:
+			write_out.write(content)
+
+	def test_speciation_watcher(self):
+
+		results = []
+		watcher = SpeciationWatcher(self.gc_measurement_path,
+									poll_interval=0.02,
+									settle_time=0.1,
+									on_result=lambda condition, sample, speciation: results.append(sample))
+
+		async def autosampler():
+
+			self.write_report('sample1', 'gc_inner_standard', self.gc_inner_standard_report)
+			# a report written in two steps is only picked up once complete
+			half = len(self.gc_speciation_report)//2
+			self.write_report('sample1', 'gc_speciation', self.gc_speciation_report[:half])
+			await asyncio.sleep(0.05)
+			self.write_report('sample1', 'gc_speciation', self.gc_speciation_report)
+
+			for _ in range(100):
+				await asyncio.sleep(0.02)
+				if results:
+					break
+
+			# a rewritten report is speciated again
+			self.write_report('sample1', 'gc_speciation', self.gc_speciation_report + '\n')
+			for _ in range(100):
+				await asyncio.sleep(0.02)
+				if len(results) == 2:
+					break
+			watcher.stop()
+
+		async def run():
+
+			await asyncio.gather(watcher.run(), autosampler())
+
+		asyncio.run(run())
+
+		self.assertEqual(results, ['sample1', 'sample1'])
+		self.assertEqual(watcher.errors, [])
+		self.assertLess(watcher.get_latency_stats()['max'], 1.0)
+		self.assertLess(max(watcher.file_latencies), 1.0)
+		speciation_dict_by_sample = load_condition_speciation_dicts('test_condition', self.gc_measurement_path)
+		self.assertIn('PDD', speciation_dict_by_sample['sample1'])
+
+	def test_speciation_watcher_retry(self):
+
+		# the first attempt fails, e.g. while calibration is being refitted
+		prepare_speciation = watch_daemon.prepare_speciation_in_moles_per_total_mass
+		attempts = []
+		def fail_once(*args, **kwargs):
+			attempts.append(args[1])
+			if len(attempts) == 1:
+				raise KeyError('PDD')
+			return prepare_speciation(*args, **kwargs)
+
+		results = []
+		watcher = SpeciationWatcher(self.gc_measurement_path,
+									poll_interval=0.02,
+									settle_time=0.05,
+									on_result=lambda condition, sample, speciation: results.append(sample))
+
+		async def autosampler():
+
+			self.write_report('sample1', 'gc_inner_standard', self.gc_inner_standard_report)
+			self.write_report('sample1', 'gc_speciation', self.gc_speciation_report)
+			for _ in range(100):
+				await asyncio.sleep(0.02)
+				if results:
+					break
+			watcher.stop()
+
+		async def run():
+
+			await asyncio.gather(watcher.run(), autosampler())
+
+		watch_daemon.prepare_speciation_in_moles_per_total_mass = fail_once
+		try:
+			asyncio.run(run())
+		finally:
+			watch_daemon.prepare_speciation_in_moles_per_total_mass = prepare_speciation
+
+		# the unchanged sample is queued again after the failure
+		self.assertEqual(attempts, ['sample1', 'sample1'])
+		self.assertEqual(results, ['sample1'])
+		self.assertEqual(len(watcher.errors), 1)
+
+	def test_speciation_watcher_saves_together(self):
+
+		# a slow store write: results finishing meanwhile are saved by the next one
+		save_condition_results = result_store.save_condition_results
+		saved_sample_counts = []
+		def save_condition_results_slowly(condition, speciation_dict_by_sample, *args, **kwargs):
+			time.sleep(0.1)
+			saved_sample_counts.append(len(speciation_dict_by_sample))
+			return save_condition_results(condition, speciation_dict_by_sample, *args, **kwargs)
+
+		results = []
+		watcher = SpeciationWatcher(self.gc_measurement_path,
+									poll_interval=0.02,
+									settle_time=0.05,
+									workers=4,
+									on_result=lambda condition, sample, speciation: results.append(sample))
+
+		async def autosampler():
+
+			for i in range(12):
+				self.write_report('sample{0}'.format(i), 'gc_inner_standard', self.gc_inner_standard_report)
+				self.write_report('sample{0}'.format(i), 'gc_speciation', self.gc_speciation_report)
+			for _ in range(200):
+				await asyncio.sleep(0.02)
+				if len(results) == 12:
+					break
+			watcher.stop()
+
+		async def run():
+
+			await asyncio.gather(watcher.run(), autosampler())
+
+		result_store.save_condition_results = save_condition_results_slowly
+		try:
+			asyncio.run(run())
+		finally:
+			result_store.save_condition_results = save_condition_results
+
+		self.assertEqual(sorted(results), sorted('sample{0}'.format(i) for i in range(12)))
+		self.assertEqual(sum(saved_sample_counts), 12)
+		self.assertLess(len(saved_sample_counts), 12)
+		self.assertEqual(len(load_condition_speciation_dicts('test_condition', self.gc_measurement_path)), 12)
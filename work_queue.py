@@ -0,0 +1,517 @@
+import os
+import json
+import time
+import zlib
+import socket
+import logging
+import tempfile
+import threading
+from speciation import prepare_speciation_in_moles_per_total_mass
+from instrumentation import (
+	metrics,
+	timed
+	)
+from workspace import get_default_workspace
+
+logger = logging.getLogger('smartgc.queue')
+
+class Lease(object):
+	"""
+	This class is a worker's claim on one sample: generation `generation`
+	of the sample's lease, held until `expires` unless renewed. `lost` is
+	set once another worker took the sample over.
+	"""
+
+	def __init__(self, condition, sample, generation, worker_id, lease_file, expires):
+
+		self.condition = condition
+		self.sample = sample
+		self.generation = generation
+		self.worker_id = worker_id
+		self.lease_file = lease_file
+		self.expires = expires
+		self.lost = False
+
+class WorkQueue(object):
+	"""
+	This class is a queue of samples to speciate, kept as plain files under
+	`queue_path` (default: `<measurement folder>/.work_queue`) so that
+	workers on any host mounting the same measurement tree can share it:
+
+		tasks.json: the (condition, sample) tasks, written by `submit`
+		leases/<condition>/<sample>.<generation>.lease: json {worker, host, expires}
+		results/<condition>/<sample>.json: speciation in moles/g, once committed
+		failed/<condition>/<sample>.json: last error, after `max_attempts` attempts
+
+	Claims rely only on atomic file creation: the first worker to link a
+	fully written lease generation 1 into place owns a sample, and a lease
+	that is not renewed within `lease_time` seconds is taken over by
+	creating the next generation, which again only one worker can do. A
+	lease file that cannot be read expires `lease_time` after it was last
+	modified. Results are committed by hard-linking a fully written file
+	into place too, so a sample has at most one result even if a worker
+	that lost its lease still finishes.
+	Hosts are expected to keep their clocks in sync (e.g. NTP); choose
+	`lease_time` well above the clock skew.
+	"""
+
+	def __init__(self, queue_path=None, lease_time=60.0, max_attempts=3, gc_measurement_path=None,
+				workspace=None):
+
+		if workspace is None:
+			workspace = get_default_workspace()
+
+		if gc_measurement_path is None:
+			gc_measurement_path = workspace.gc_measurement_path
+
+		if queue_path is None:
+			queue_path = os.path.join(gc_measurement_path, '.work_queue')
+
+		self.queue_path = queue_path
+		self.gc_measurement_path = gc_measurement_path
+		self.lease_time = lease_time
+		self.max_attempts = max_attempts
+		self.workspace = workspace
+
+	def _get_path(self, folder, condition, file_name):
+
+		return os.path.join(self.queue_path, folder, condition, file_name)
+
+	def get_result_file(self, condition, sample):
+
+		return self._get_path('results', condition, sample+'.json')
+
+	def get_failed_file(self, condition, sample):
+
+		return self._get_path('failed', condition, sample+'.json')
+
+	def get_lease_file(self, condition, sample, generation):
+
+		return self._get_path('leases', condition, '{0}.{1}.lease'.format(sample, generation))
+
+	def submit(self, condition_samples_dict=None):
+		"""
+		This method sets the tasks of the queue, by default every sample of
+		the measurement folder, and outputs their number. Samples already
+		committed stay done.
+		"""
+
+		if condition_samples_dict is None:
+			from batch_speciation import discover_condition_samples
+			condition_samples_dict = discover_condition_samples(self.gc_measurement_path)
+
+		tasks = [[condition, sample] for condition in sorted(condition_samples_dict)
+				for sample in condition_samples_dict[condition]]
+		for condition in condition_samples_dict:
+			for folder in ['leases', 'results', 'failed']:
+				os.makedirs(os.path.join(self.queue_path, folder, condition), exist_ok=True)
+
+		write_json_atomically(os.path.join(self.queue_path, 'tasks.json'), tasks)
+		if os.path.exists(os.path.join(self.queue_path, 'merged.json')):
+			os.remove(os.path.join(self.queue_path, 'merged.json'))
+
+		return len(tasks)
+
+	def load_tasks(self):
+
+		with open(os.path.join(self.queue_path, 'tasks.json'), 'r') as read_in:
+			return [tuple(task) for task in json.load(read_in)]
+
+	def get_lease_generations(self, condition):
+		"""
+		This method outputs a dictionary with key: `sample` and value: the
+		latest lease generation of the samples of `condition` ever claimed.
+		"""
+
+		lease_generations = {}
+		for f in os.listdir(os.path.join(self.queue_path, 'leases', condition)):
+			if not f.endswith('.lease'):
+				continue
+			sample, generation = f[:-len('.lease')].rsplit('.', 1)
+			lease_generations[sample] = max(lease_generations.get(sample, 0), int(generation))
+
+		return lease_generations
+
+	def read_lease(self, condition, sample, generation):
+		"""
+		This method outputs the content of a lease, or None if it cannot
+		be read.
+		"""
+
+		try:
+			with open(self.get_lease_file(condition, sample, generation), 'r') as read_in:
+				return json.load(read_in)
+		except (OSError, ValueError):
+			return None
+
+	def get_state(self, condition, sample, generation=None):
+		"""
+		This method outputs the state of a task: `done`, `failed`, `pending`
+		(never claimed), `leased` or `expired`.
+		"""
+
+		if os.path.exists(self.get_result_file(condition, sample)):
+			return 'done'
+		if os.path.exists(self.get_failed_file(condition, sample)):
+			return 'failed'
+
+		if generation is None:
+			generation = self.get_lease_generations(condition).get(sample, 0)
+		if generation == 0:
+			return 'pending'
+
+		lease = self.read_lease(condition, sample, generation)
+		if lease is not None:
+			expires = lease['expires']
+		else:
+			# e.g. left empty by a worker that died writing it
+			try:
+				expires = os.path.getmtime(self.get_lease_file(condition, sample, generation)) + self.lease_time
+			except OSError:
+				expires = 0
+		if expires > time.time():
+			return 'leased'
+
+		return 'expired'
+
+	def claim(self, condition, sample, worker_id, generation=None):
+		"""
+		This method tries to lease a pending or expired task and outputs a
+		`Lease`, or None if the task is done, failed or held by another
+		worker. A task whose `max_attempts` leases all expired is failed.
+		"""
+
+		return self.try_claim(condition, sample, worker_id, generation)[0]
+
+	def try_claim(self, condition, sample, worker_id, generation=None):
+		"""
+		This method is `claim` that also outputs the task state it saw, as a
+		tuple `(lease, state)`; `generation` is the latest lease generation
+		if known (see `get_lease_generations`).
+		"""
+
+		if generation is None:
+			generation = self.get_lease_generations(condition).get(sample, 0)
+
+		state = self.get_state(condition, sample, generation)
+		if state not in ('pending', 'expired'):
+			return None, state
+
+		if generation >= self.max_attempts:
+			self.fail(condition, sample, 'lease expired {0} times'.format(generation))
+			return None, 'failed'
+
+		lease_file = self.get_lease_file(condition, sample, generation + 1)
+		expires = time.time() + self.lease_time
+		descriptor, temporary_file = tempfile.mkstemp(prefix=sample+'.', suffix='.lease.tmp',
+														dir=os.path.dirname(lease_file))
+		try:
+			with os.fdopen(descriptor, 'w') as write_out:
+				json.dump({'worker': worker_id, 'host': socket.gethostname(), 'expires': expires}, write_out)
+			# the lease appears fully written, and only for the first worker
+			os.link(temporary_file, lease_file)
+		except FileExistsError:
+			return None, 'leased'
+		finally:
+			os.remove(temporary_file)
+
+		if metrics.enabled:
+			metrics.increment('queue_claims')
+			if generation > 0:
+				metrics.increment('queue_takeovers')
+
+		return Lease(condition, sample, generation + 1, worker_id, lease_file, expires), state
+
+	def is_superseded(self, lease):
+
+		return os.path.exists(self.get_lease_file(lease.condition, lease.sample, lease.generation + 1))
+
+	def renew(self, lease):
+		"""
+		This method extends a lease by `lease_time` and outputs False if
+		another worker took the task over meanwhile.
+		"""
+
+		if lease.lost or self.is_superseded(lease):
+			lease.lost = True
+			return False
+
+		lease.expires = time.time() + self.lease_time
+		write_json_atomically(lease.lease_file, {'worker': lease.worker_id, 'host': socket.gethostname(),
+												'expires': lease.expires}, '.' + lease.worker_id)
+
+		return True
+
+	def release(self, lease):
+		"""
+		This method gives a task back for another attempt, e.g. after an error.
+		"""
+
+		if not self.is_superseded(lease):
+			write_json_atomically(lease.lease_file, {'worker': lease.worker_id, 'host': socket.gethostname(),
+													'expires': 0}, '.' + lease.worker_id)
+
+	def commit(self, lease, speciation_dict_in_moles_per_total_mass):
+		"""
+		This method stores the result of a leased task and outputs True, or
+		False if the lease was lost or the task was already committed.
+		"""
+
+		if lease.lost or self.is_superseded(lease):
+			lease.lost = True
+			return False
+
+		result_file = self.get_result_file(lease.condition, lease.sample)
+		temporary_file = '{0}.{1}.tmp'.format(result_file, lease.worker_id)
+		with open(temporary_file, 'w') as write_out:
+			json.dump(speciation_dict_in_moles_per_total_mass, write_out)
+			write_out.flush()
+			os.fsync(write_out.fileno())
+		try:
+			# unlike a rename, a link never replaces a result committed first
+			os.link(temporary_file, result_file)
+		except FileExistsError:
+			return False
+		finally:
+			os.remove(temporary_file)
+
+		if metrics.enabled:
+			metrics.increment('queue_commits')
+
+		return True
+
+	def fail(self, condition, sample, error):
+
+		try:
+			descriptor = os.open(self.get_failed_file(condition, sample), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			return
+		with os.fdopen(descriptor, 'w') as write_out:
+			json.dump({'error': error}, write_out)
+		logger.warning('%s/%s failed: %s', condition, sample, error)
+
+	def get_status(self):
+		"""
+		This method outputs a dictionary with key: task state (see
+		`get_state`) and value: number of tasks.
+		"""
+
+		status = dict((state, 0) for state in ['pending', 'leased', 'expired', 'done', 'failed'])
+		lease_generations = {}
+		for condition, sample in self.load_tasks():
+			if condition not in lease_generations:
+				lease_generations[condition] = self.get_lease_generations(condition)
+			status[self.get_state(condition, sample, lease_generations[condition].get(sample, 0))] += 1
+
+		return status
+
+	def is_complete(self):
+
+		status = self.get_status()
+
+		return status['done'] + status['failed'] == sum(status.values())
+
+	@timed('queue_merge')
+	def merge_results(self, force=False):
+		"""
+		This method writes the committed results of every condition into
+		its result store in one go (see `result_store.save_condition_results`)
+		and outputs the number of samples merged. One worker merges at a
+		time, touching its `merge.lock` while it does; others return 0
+		meanwhile, as do later calls until the next `submit` unless
+		`force=True`.
+		"""
+
+		merged_file = os.path.join(self.queue_path, 'merged.json')
+		if not force and os.path.exists(merged_file):
+			return 0
+
+		merge_lock_file = os.path.join(self.queue_path, 'merge.lock')
+		try:
+			descriptor = os.open(merge_lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
+			# a merger that died keeps the lock only for a lease time
+			try:
+				if time.time() - os.path.getmtime(merge_lock_file) < self.lease_time:
+					return 0
+				os.remove(merge_lock_file)
+			except OSError:
+				return 0
+			return self.merge_results(force)
+		os.close(descriptor)
+
+		from result_store import save_condition_results
+
+		try:
+			with LockHeartbeat(self, merge_lock_file):
+				speciation_dict_by_condition = {}
+				for condition, sample in self.load_tasks():
+					result_file = self.get_result_file(condition, sample)
+					if os.path.exists(result_file):
+						with open(result_file, 'r') as read_in:
+							speciation_dict_by_condition.setdefault(condition, {})[sample] = json.load(read_in)
+
+				for condition, speciation_dict_by_sample in sorted(speciation_dict_by_condition.items()):
+					save_condition_results(condition, speciation_dict_by_sample, self.gc_measurement_path,
+											workspace=self.workspace)
+				sample_count = sum(len(speciation_dict_by_sample) for speciation_dict_by_sample
+									in speciation_dict_by_condition.values())
+				write_json_atomically(merged_file, {'samples': sample_count, 'time': time.time()})
+		finally:
+			os.remove(merge_lock_file)
+
+		return sample_count
+
+def write_json_atomically(json_file, data, suffix=''):
+
+	temporary_file = json_file + suffix + '.tmp'
+	with open(temporary_file, 'w') as write_out:
+		json.dump(data, write_out)
+	os.replace(temporary_file, json_file)
+
+def get_worker_id():
+
+	return '{0}-{1}-{2}'.format(socket.gethostname(), os.getpid(), threading.get_ident())
+
+class Heartbeat(object):
+	"""
+	This class renews a lease from a background thread every third of the
+	lease time while its task runs.
+	"""
+
+	def __init__(self, work_queue, lease):
+
+		self.work_queue = work_queue
+		self.lease = lease
+		self._stop_event = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def renew(self):
+
+		return self.work_queue.renew(self.lease)
+
+	def _run(self):
+
+		while not self._stop_event.wait(self.work_queue.lease_time/3.0):
+			if not self.renew():
+				return
+
+	def __enter__(self):
+
+		self._thread.start()
+		return self
+
+	def __exit__(self, *args):
+
+		self._stop_event.set()
+		self._thread.join()
+
+class LockHeartbeat(Heartbeat):
+	"""
+	This class touches a lock file, such as the queue's `merge.lock`, every
+	third of the lease time so that it is not taken for a dead holder's.
+	"""
+
+	def __init__(self, work_queue, lock_file):
+
+		Heartbeat.__init__(self, work_queue, None)
+		self.lock_file = lock_file
+
+	def renew(self):
+
+		try:
+			os.utime(self.lock_file)
+		except OSError:
+			return False
+
+		return True
+
+@timed('queue_worker')
+def run_worker(
+			work_queue,
+			worker_id=None,
+			calibration_factor_function_dict=None,
+			registry=None,
+			poll_interval=1.0,
+			wait=True,
+			max_tasks=None,
+			merge=True
+			):
+	"""
+	This method claims and speciates tasks of `work_queue` until none is
+	left to claim and outputs the number of samples it committed. With
+	`wait=True` it keeps polling while other workers hold leases, so that
+	tasks of workers that died are retried. A failing sample is released
+	for another attempt. The worker that sees the queue complete merges
+	the results into the result stores, with `merge=True`.
+
+	Workers start from different tasks to keep lease contention low.
+	"""
+
+	if worker_id is None:
+		worker_id = get_worker_id()
+
+	if registry is None:
+		registry = work_queue.workspace.registry
+
+	if calibration_factor_function_dict is None:
+		calibration_factor_function_dict = registry.get_fitted_calibration_factor_functions()
+
+	tasks = work_queue.load_tasks()
+	offset = zlib.crc32(worker_id.encode('utf-8')) % max(1, len(tasks))
+	remaining_tasks = tasks[offset:] + tasks[:offset]
+
+	committed = 0
+	while remaining_tasks and (max_tasks is None or committed < max_tasks):
+		# one pass over the tasks not known to be finished
+		unfinished_tasks = []
+		claimed = False
+		lease_generations = {}
+		for condition, sample in remaining_tasks:
+			if max_tasks is not None and committed >= max_tasks:
+				break
+			if condition not in lease_generations:
+				lease_generations[condition] = work_queue.get_lease_generations(condition)
+			lease, state = work_queue.try_claim(condition, sample, worker_id,
+												lease_generations[condition].get(sample, 0))
+			if lease is None:
+				if state not in ('done', 'failed'):
+					unfinished_tasks.append((condition, sample))
+				continue
+
+			claimed = True
+			try:
+				with Heartbeat(work_queue, lease):
+					speciation_dict_in_moles_per_total_mass = prepare_speciation_in_moles_per_total_mass(
+													condition,
+													sample,
+													calibration_factor_function_dict,
+													work_queue.gc_measurement_path,
+													registry,
+													save_results=False,
+													workspace=work_queue.workspace
+													)
+			except Exception as e:
+				logger.exception('%s/%s failed on attempt %s', condition, sample, lease.generation)
+				if lease.generation >= work_queue.max_attempts:
+					work_queue.fail(condition, sample, '{0}: {1}'.format(type(e).__name__, e))
+				else:
+					work_queue.release(lease)
+					unfinished_tasks.append((condition, sample))
+				continue
+
+			if work_queue.commit(lease, speciation_dict_in_moles_per_total_mass):
+				committed += 1
+			else:
+				unfinished_tasks.append((condition, sample))
+
+		remaining_tasks = unfinished_tasks
+		if remaining_tasks and not claimed:
+			if not wait:
+				break
+			time.sleep(poll_interval)
+
+	if merge and work_queue.is_complete():
+		work_queue.merge_results()
+
+	return committed
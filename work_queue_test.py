@@ -0,0 +1,153 @@
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from multiprocessing import Pool
+from work_queue import (
+	WorkQueue,
+	run_worker
+	)
+from batch_speciation import run_batch_speciation
+import result_store
+from result_store import load_condition_speciation_dicts
+
+def run_test_worker(args):
+
+	queue_path, gc_measurement_path, worker_id = args
+	work_queue = WorkQueue(queue_path, lease_time=0.5, gc_measurement_path=gc_measurement_path)
+
+	return worker_id, run_worker(work_queue, worker_id, poll_interval=0.05)
+
+class test_work_queue(unittest.TestCase):
+
+	def setUp(self):
+
+		# copy test_condition into a scratch measurement folder with a few samples
+		self.gc_measurement_path = tempfile.mkdtemp()
+		self.queue_path = os.path.join(self.gc_measurement_path, '.work_queue')
+		test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+		for condition in ['condition_a', 'condition_b']:
+			for folder, extension in [('gc_speciation', '.txt'), ('gc_inner_standard', '.csv')]:
+				os.makedirs(os.path.join(self.gc_measurement_path, condition, folder))
+				for i in range(12):
+					shutil.copy(os.path.join(test_condition_path, folder, 'sample0'+extension),
+								os.path.join(self.gc_measurement_path, condition, folder,
+											'sample{0}{1}'.format(i, extension)))
+
+		self.work_queue = WorkQueue(lease_time=0.2, max_attempts=2, gc_measurement_path=self.gc_measurement_path)
+		self.task_count = self.work_queue.submit()
+
+	def tearDown(self):
+
+		shutil.rmtree(self.gc_measurement_path)
+
+	def test_claim_and_commit(self):
+
+		self.assertEqual(self.task_count, 24)
+		self.assertEqual(self.work_queue.get_status()['pending'], 24)
+
+		lease = self.work_queue.claim('condition_a', 'sample0', 'worker1')
+		self.assertEqual(lease.generation, 1)
+		self.assertIsNone(self.work_queue.claim('condition_a', 'sample0', 'worker2'))
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'leased')
+
+		self.assertTrue(self.work_queue.commit(lease, {'PDD': 1.0}))
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'done')
+		self.assertIsNone(self.work_queue.claim('condition_a', 'sample0', 'worker2'))
+		with open(self.work_queue.get_result_file('condition_a', 'sample0'), 'r') as read_in:
+			self.assertEqual(json.load(read_in), {'PDD': 1.0})
+
+	def test_expired_lease(self):
+
+		lease = self.work_queue.claim('condition_a', 'sample0', 'worker1')
+		time.sleep(0.3)
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'expired')
+
+		# the task is taken over and the late worker can no longer commit
+		takeover_lease = self.work_queue.claim('condition_a', 'sample0', 'worker2')
+		self.assertEqual(takeover_lease.generation, 2)
+		self.assertFalse(self.work_queue.renew(lease))
+		self.assertFalse(self.work_queue.commit(lease, {'PDD': 1.0}))
+		self.assertTrue(self.work_queue.renew(takeover_lease))
+
+		# after max_attempts expired leases the task fails
+		time.sleep(0.3)
+		self.assertIsNone(self.work_queue.claim('condition_a', 'sample0', 'worker3'))
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'failed')
+
+	def test_unreadable_lease(self):
+
+		# a worker died before its lease file was written
+		open(self.work_queue.get_lease_file('condition_a', 'sample0', 1), 'w').close()
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'leased')
+		self.assertIsNone(self.work_queue.claim('condition_a', 'sample0', 'worker1'))
+
+		time.sleep(0.3)
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'expired')
+		lease = self.work_queue.claim('condition_a', 'sample0', 'worker1')
+		self.assertEqual(lease.generation, 2)
+		self.assertEqual(self.work_queue.read_lease('condition_a', 'sample0', 2)['worker'], 'worker1')
+		self.assertEqual([f for f in os.listdir(os.path.dirname(lease.lease_file)) if f.endswith('.tmp')], [])
+
+	def test_merge_lock_heartbeat(self):
+
+		for condition in ['condition_a', 'condition_b']:
+			self.work_queue.commit(self.work_queue.claim(condition, 'sample0', 'worker1'), {'PDD': 1.0})
+
+		# a merge that outlasts the lease time keeps its lock
+		save_condition_results = result_store.save_condition_results
+		def save_condition_results_slowly(*args, **kwargs):
+			time.sleep(0.3)
+			return save_condition_results(*args, **kwargs)
+
+		merged_counts = []
+		result_store.save_condition_results = save_condition_results_slowly
+		try:
+			merge_thread = threading.Thread(target=lambda: merged_counts.append(self.work_queue.merge_results()))
+			merge_thread.start()
+			time.sleep(0.45)
+			self.assertEqual(self.work_queue.merge_results(force=True), 0)
+			merge_thread.join()
+		finally:
+			result_store.save_condition_results = save_condition_results
+
+		self.assertEqual(merged_counts, [2])
+		self.assertFalse(os.path.exists(os.path.join(self.queue_path, 'merge.lock')))
+
+	def test_release(self):
+
+		lease = self.work_queue.claim('condition_a', 'sample0', 'worker1')
+		self.work_queue.release(lease)
+
+		self.assertEqual(self.work_queue.get_state('condition_a', 'sample0'), 'expired')
+		self.assertEqual(self.work_queue.claim('condition_a', 'sample0', 'worker2').generation, 2)
+
+	def test_run_workers(self):
+
+		# a worker that died holding a lease
+		WorkQueue(lease_time=0.5, gc_measurement_path=self.gc_measurement_path).claim('condition_b', 'sample5',
+																					'dead_worker')
+
+		pool = Pool(3)
+		try:
+			committed_counts = dict(pool.map(run_test_worker, [(self.queue_path, self.gc_measurement_path,
+																'worker{0}'.format(i)) for i in range(3)]))
+		finally:
+			pool.close()
+			pool.join()
+
+		# every sample is speciated exactly once, the abandoned one included
+		self.assertEqual(sum(committed_counts.values()), 24)
+		self.assertTrue(self.work_queue.is_complete())
+		self.assertEqual(self.work_queue.get_state('condition_b', 'sample5'), 'done')
+
+		# and the merged result stores match a single-process batch run
+		batch_speciation_dict, _ = run_batch_speciation(gc_measurement_path=self.gc_measurement_path,
+														processes=1)
+		for condition in ['condition_a', 'condition_b']:
+			self.assertEqual(load_condition_speciation_dicts(condition, self.gc_measurement_path),
+							batch_speciation_dict[condition])
+		self.assertEqual(self.work_queue.merge_results(), 0)
@@ -0,0 +1,87 @@
+import os
+import threading
+
+class Workspace(object):
+	"""
+	This class owns a data root laid out like `data/`:
+
+		<data_root>/calibration: calibration reports, species constants and fits
+		<data_root>/measurement: one folder per condition
+		<data_root>/results_catalog.sqlite: the results catalog, once built
+		<data_root>/spectral_library.npz: the mass-spectral search index, once built
+
+	Functions take a `workspace` wherever they default to one of these
+	paths, so one process can serve several campaigns at the same time
+	from threads or worker processes, without changing directory. Explicit
+	path arguments still take precedence over the workspace.
+
+	The calibration cache of a workspace is the `CalibrationRegistry` of
+	its calibration folder, shared by every workspace on the same root. A
+	workspace only holds paths, so it pickles cheaply for worker processes.
+	"""
+
+	def __init__(self, data_root=None):
+
+		if data_root is None:
+			data_root = 'data'
+
+		self.data_root = data_root
+		self.calibration_path = os.path.join(data_root, 'calibration')
+		self.gc_measurement_path = os.path.join(data_root, 'measurement')
+		self.catalog_file = os.path.join(data_root, 'results_catalog.sqlite')
+		self.spectral_library_file = os.path.join(data_root, 'spectral_library.npz')
+
+	def __repr__(self):
+
+		return 'Workspace({0!r})'.format(self.data_root)
+
+	@property
+	def registry(self):
+
+		from calibration import get_registry
+
+		return get_registry(self.calibration_path)
+
+	def get_calibration_file(self, file_name):
+
+		return os.path.join(self.calibration_path, file_name)
+
+	def get_condition_path(self, condition):
+
+		return os.path.join(self.gc_measurement_path, condition)
+
+	def get_catalog(self):
+
+		from results_catalog import get_catalog
+
+		return get_catalog(self.catalog_file)
+
+	def load_calibration_history(self, forgetting_factor=None):
+
+		from calibration_history import CalibrationHistory
+
+		return CalibrationHistory.load(self.get_calibration_file('calibration_history.json'),
+										forgetting_factor)
+
+_workspaces = {} # key: normalized data root, value: Workspace
+_workspaces_lock = threading.Lock()
+
+def get_workspace(data_root=None):
+	"""
+	This method returns the process-wide `Workspace` of a data root
+	(default: `data`), creating it on first use.
+	"""
+
+	if data_root is None:
+		data_root = 'data'
+
+	key = os.path.normpath(data_root)
+	with _workspaces_lock:
+		if key not in _workspaces:
+			_workspaces[key] = Workspace(data_root)
+
+		return _workspaces[key]
+
+def get_default_workspace():
+
+	return get_workspace()
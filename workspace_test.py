@@ -0,0 +1,130 @@
+import unittest
+import os
+import json
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from workspace import (
+	Workspace,
+	get_default_workspace,
+	get_workspace
+	)
+from batch_speciation import run_batch_speciation
+from speciation import read_gc_inner_standard_file
+from result_store import (
+	get_result_store_file,
+	load_condition_speciation_dicts
+	)
+from calibration_history import (
+	CalibrationHistory,
+	list_calibration_files
+	)
+from peak_identification import RetentionTimeIndex
+from calibration import (
+	CalibrationRegistry,
+	get_registry,
+	load_fitted_calibration_factor_functions,
+	read_calibration_species_constants
+	)
+
+class test_workspace(unittest.TestCase):
+
+	def setUp(self):
+
+		# two campaigns with the same reports, the second one calibrated with
+		# twice the calibration factors of all species but the inner standard
+		self.data_roots = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+		test_condition_path = os.path.join('data', 'measurement', 'test_condition')
+		self.inner_standard = read_gc_inner_standard_file(os.path.join(
+								test_condition_path, 'gc_inner_standard', 'sample0.csv'))['inner_standard']
+		with open(os.path.join('data', 'calibration', 'fitted_calibration_factor_functions.json'), 'r') as read_in:
+			calibration_factor_function_dict = json.load(read_in)
+
+		for scale, data_root in zip([1, 2], self.data_roots):
+			calibration_path = os.path.join(data_root, 'calibration')
+			os.makedirs(calibration_path)
+			shutil.copy(os.path.join('data', 'calibration', 'calibration_species_constants.csv'), calibration_path)
+			with open(os.path.join(calibration_path, 'fitted_calibration_factor_functions.json'), 'w') as write_out:
+				json.dump(dict((species, [params[0]*(1 if species == self.inner_standard else scale)])
+								for species, params in calibration_factor_function_dict.items()), write_out)
+
+			for folder, extension in [('gc_speciation', '.txt'), ('gc_inner_standard', '.csv')]:
+				os.makedirs(os.path.join(data_root, 'measurement', 'condition_a', folder))
+				for sample in ['sample0', 'sample1']:
+					shutil.copy(os.path.join(test_condition_path, folder, 'sample0'+extension),
+								os.path.join(data_root, 'measurement', 'condition_a', folder, sample+extension))
+
+	def tearDown(self):
+
+		for data_root in self.data_roots:
+			shutil.rmtree(data_root)
+
+	def test_workspace_paths(self):
+
+		workspace = Workspace(self.data_roots[0])
+
+		self.assertEqual(workspace.calibration_path, os.path.join(self.data_roots[0], 'calibration'))
+		self.assertEqual(workspace.get_condition_path('condition_a'),
+						os.path.join(self.data_roots[0], 'measurement', 'condition_a'))
+		self.assertEqual(workspace.registry.calibration_path, workspace.calibration_path)
+		self.assertEqual(get_default_workspace().gc_measurement_path, os.path.join('data', 'measurement'))
+
+		# workspaces are cached per data root and pickle as their paths
+		self.assertIs(get_workspace(self.data_roots[0]), get_workspace(self.data_roots[0] + os.sep))
+		self.assertEqual(pickle.loads(pickle.dumps(workspace)).catalog_file, workspace.catalog_file)
+
+	def test_concurrent_runs(self):
+
+		workspaces = [get_workspace(data_root) for data_root in self.data_roots]
+
+		with ThreadPoolExecutor(len(workspaces)) as executor:
+			futures = [executor.submit(run_batch_speciation, processes=1, workspace=workspace)
+						for workspace in workspaces]
+			batch_speciation_dicts = [future.result()[0] for future in futures]
+
+		for workspace, batch_speciation_dict in zip(workspaces, batch_speciation_dicts):
+			self.assertEqual(load_condition_speciation_dicts('condition_a', workspace=workspace),
+							batch_speciation_dict['condition_a'])
+
+		speciation_dict, scaled_speciation_dict = [batch_speciation_dict['condition_a']['sample1']
+													for batch_speciation_dict in batch_speciation_dicts]
+		self.assertEqual(sorted(speciation_dict), sorted(scaled_speciation_dict))
+		for species in speciation_dict:
+			self.assertAlmostEqual(scaled_speciation_dict[species]/speciation_dict[species], 0.5)
+
+	def test_helper_defaults(self):
+
+		workspace = Workspace(self.data_roots[0])
+		shutil.copy(os.path.join('data', 'calibration', 'PDD.txt'), workspace.calibration_path)
+
+		# helpers given a workspace never fall back to ./data
+		self.assertEqual(get_result_store_file('condition_a', workspace=workspace),
+						os.path.join(workspace.get_condition_path('condition_a'), 'speciation_results.npz'))
+		self.assertEqual(CalibrationHistory(workspace=workspace).history_file,
+						workspace.get_calibration_file('calibration_history.json'))
+		self.assertEqual(list_calibration_files(workspace=workspace),
+						{'PDD': [workspace.get_calibration_file('PDD.txt')]})
+		self.assertEqual(RetentionTimeIndex.from_calibration_files(workspace=workspace).species_list, ['PDD'])
+
+	def test_calibration_defaults(self):
+
+		workspace = Workspace(self.data_roots[1])
+		inner_standard_params = get_default_workspace().registry.get_fitted_calibration_factor_functions()[
+									self.inner_standard]
+
+		# calibration helpers given a workspace work from any directory
+		working_directory = os.getcwd()
+		scratch_path = tempfile.mkdtemp()
+		os.chdir(scratch_path)
+		try:
+			self.assertIn('PDD', read_calibration_species_constants(workspace=workspace))
+			calibration_factor_function_dict = load_fitted_calibration_factor_functions(workspace=workspace)
+			self.assertEqual(calibration_factor_function_dict[self.inner_standard], inner_standard_params)
+			self.assertEqual(CalibrationRegistry(workspace=workspace).calibration_path, workspace.calibration_path)
+			registry = get_registry(workspace=workspace)
+			self.assertIs(registry, workspace.registry)
+			self.assertEqual(registry.get_fitted_calibration_factor_functions(), calibration_factor_function_dict)
+		finally:
+			os.chdir(working_directory)
+			shutil.rmtree(scratch_path)